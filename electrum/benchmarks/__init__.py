@@ -0,0 +1,112 @@
+# Copyright (C) 2020 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+"""
+Benchmarks of wallet, blockchain and lightning hot paths, on synthetic data.
+
+usage:  python3 -m electrum.benchmarks [--scale 0.1] [--output results.json]
+
+Each suite generates its dataset (a wallet with many transactions,
+a header chain, a channel graph, ...) and then times a number of
+operations on it. The sync suite runs the network stack against
+an in-process mock server, see mock_server.py. Dataset sizes are multiplied by --scale.
+Results are written as JSON, and can be compared with an
+earlier run using --compare.
+"""
+
+import importlib
+import platform
+import re
+import statistics
+import sys
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+
+# benchmark suites, by name. each module has a run(runner) function
+SUITES = {
+    'wallet': 'electrum.benchmarks.wallet',
+    'headers': 'electrum.benchmarks.headers',
+    'lightning': 'electrum.benchmarks.lightning',
+    'sync': 'electrum.benchmarks.sync',
+}
+
+
+class Runner:
+
+    def __init__(self, *, scale: float = 1.0, workdir: str, pattern: str = None,
+                 min_time: float = 1.0, verbose: bool = True):
+        self.scale = scale
+        self.workdir = workdir
+        self.pattern = re.compile(pattern) if pattern else None
+        self.min_time = min_time  # seconds spent measuring each benchmark, at least
+        self.verbose = verbose
+        self.results = {}  # type: Dict[str, dict]
+
+    def size(self, n: int) -> int:
+        """Returns n scaled by --scale."""
+        return max(1, int(n * self.scale))
+
+    def log(self, msg: str) -> None:
+        if self.verbose:
+            print(msg, file=sys.stderr, flush=True)
+
+    def wants(self, name: str) -> bool:
+        return self.pattern is None or bool(self.pattern.search(name))
+
+    def measure(self, name: str, func: Callable[[], None], *,
+                setup: Callable[[], None] = None, max_runs: int = 1000, **params) -> Optional[dict]:
+        """Calls func repeatedly, for at least min_time seconds or max_runs times,
+        and records the statistics of its run times (in seconds).
+        setup, if given, is called before each run, untimed.
+        params describe the dataset and are stored with the result.
+        """
+        if not self.wants(name):
+            return None
+        times = []
+        while len(times) < max_runs and (len(times) < 3 or sum(times) < self.min_time):
+            if setup:
+                setup()
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+        result = {
+            'runs': len(times),
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'max': max(times),
+            'params': params,
+        }
+        self.results[name] = result
+        self.log(f"{name:<45} {result['median'] * 1000:>12.3f} ms  (min {result['min'] * 1000:.3f} ms, {len(times)} runs)")
+        return result
+
+    def run_suites(self, names: Sequence[str]) -> None:
+        for name in names:
+            module = importlib.import_module(SUITES[name])
+            self.log(f"# {name}")
+            module.run(self)
+
+    def to_json(self) -> dict:
+        from electrum.version import ELECTRUM_VERSION
+        return {
+            'electrum_version': ELECTRUM_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': int(time.time()),
+            'scale': self.scale,
+            'results': self.results,
+        }
+
+
+def compare(old: dict, new: dict) -> Dict[str, float]:
+    """Returns new/old ratios of the median run times of benchmarks in both.
+    Ratios above 1 are slowdowns.
+    """
+    ratios = {}
+    for name, result in new['results'].items():
+        old_result = old['results'].get(name)
+        if old_result and old_result['median'] > 0:
+            ratios[name] = result['median'] / old_result['median']
+    return ratios
@@ -0,0 +1,57 @@
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from electrum.benchmarks import SUITES, Runner, compare
+from electrum.util import create_and_start_event_loop
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m electrum.benchmarks',
+                                     description='Run benchmarks on synthetic data.')
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help=f"suites to run: {', '.join(SUITES)} (default: all)")
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+                        help='multiply dataset sizes by this factor (e.g. 0.1 for a quick run)')
+    parser.add_argument('-k', dest='pattern', default=None,
+                        help='only run benchmarks whose name matches this regex')
+    parser.add_argument('-t', '--min-time', type=float, default=1.0,
+                        help='seconds to spend measuring each benchmark, at least')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write results as JSON to this file (default: stdout)')
+    parser.add_argument('-c', '--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    for name in args.suites:
+        if name not in SUITES:
+            parser.error(f"unknown suite: {name}")
+
+    # wallets trigger callbacks, and the gossip db runs, on an event loop
+    loop, stop_loop, loop_thread = create_and_start_event_loop()
+    workdir = tempfile.mkdtemp(prefix='electrum_benchmarks_')
+    try:
+        runner = Runner(scale=args.scale, workdir=workdir, pattern=args.pattern, min_time=args.min_time)
+        runner.run_suites(args.suites or list(SUITES))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        loop.call_soon_threadsafe(stop_loop.set_result, 1)
+        loop_thread.join(timeout=1)
+
+    results = runner.to_json()
+    s = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(s)
+    else:
+        print(s)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        for name, ratio in sorted(compare(old, results).items()):
+            print(f"{name:<45} {ratio:>8.2f}x", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
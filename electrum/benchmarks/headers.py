@@ -0,0 +1,85 @@
+"""
+Header chain benchmarks, on a synthetic regtest chain.
+
+Note: on regtest, proof of work is not checked, so verification
+times are dominated by header deserialization and hashing.
+"""
+
+import random
+
+from electrum import blockchain, constants
+from electrum.blockchain import Blockchain, HEADER_SIZE, deserialize_header, hash_header, serialize_header
+from electrum.crypto import sha256
+from electrum.simple_config import SimpleConfig
+from electrum.util import bfh, bh2u
+
+from .mock_server import REGTEST_GENESIS_HEADER, REGTEST_BITS
+
+
+NUM_CHUNKS = 100
+NUM_READS = 1000
+
+
+def make_chunks(num_chunks: int):
+    """Returns num_chunks chunks of 2016 serialized headers, starting at genesis."""
+    header = deserialize_header(bfh(REGTEST_GENESIS_HEADER), 0)
+    assert hash_header(header) == constants.net.GENESIS
+    chunks = []
+    data = bfh(REGTEST_GENESIS_HEADER)
+    for height in range(1, num_chunks * 2016):
+        header = {
+            'version': 0x20000000,
+            'prev_block_hash': hash_header(header),
+            'merkle_root': bh2u(sha256(height.to_bytes(4, 'big'))),
+            'timestamp': 1296688602 + 600 * height,
+            'bits': REGTEST_BITS,
+            'nonce': 0,
+            'block_height': height,
+        }
+        data += bfh(serialize_header(header))
+        if (height + 1) % 2016 == 0:
+            chunks.append(data)
+            data = b''
+    return chunks
+
+
+def run(runner):
+    constants.set_regtest()
+    try:
+        _run(runner)
+    finally:
+        blockchain.blockchains = {}
+        constants.set_mainnet()
+
+
+def _run(runner):
+    config = SimpleConfig({'electrum_path': runner.workdir})
+    num_chunks = runner.size(NUM_CHUNKS)
+    runner.log(f"generating {num_chunks} chunks of headers...")
+    chunks = make_chunks(num_chunks)
+    blockchain.blockchains = {}
+    blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+        config=config, forkpoint=0, parent=None,
+        forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+    open(chain.path(), 'w+').close()
+    for index, chunk in enumerate(chunks[:-1]):
+        assert chain.connect_chunk(index, bh2u(chunk))
+    params = {'num_headers': len(chunks) * 2016}
+
+    last_index, last_chunk = len(chunks) - 1, chunks[-1]
+    last_chunk_hex = bh2u(last_chunk)
+    runner.measure('headers.verify_chunk', lambda: chain.verify_chunk(last_index, last_chunk), **params)
+    def connect_chunk():
+        assert chain.connect_chunk(last_index, last_chunk_hex)
+    runner.measure('headers.connect_chunk', connect_chunk, **params)
+
+    heights = [random.randrange(chain.height() + 1) for i in range(NUM_READS)]
+    def read_headers():
+        for height in heights:
+            chain.read_header(height)
+    runner.measure('headers.read_header', read_headers, num_reads=NUM_READS, **params)
+
+    def deserialize_and_hash():
+        for i in range(0, len(last_chunk), HEADER_SIZE):
+            hash_header(deserialize_header(last_chunk[i:i+HEADER_SIZE], last_index * 2016 + i // HEADER_SIZE))
+    runner.measure('headers.deserialize_and_hash', deserialize_and_hash, num_headers_hashed=2016)
@@ -0,0 +1,197 @@
+"""
+Lightning benchmarks: path finding and gossip on a synthetic channel graph,
+wire message serialization, the HTLC log of a long-lived channel,
+and the onion processing done for each incoming HTLC.
+"""
+
+import asyncio
+import os
+import random
+import time
+
+from electrum import constants, ecc, lnrouter
+from electrum.crypto import sha256
+from electrum.json_db import StoredDict
+from electrum.lnhtlc import HTLCManager
+from electrum.lnmsg import decode_msg, encode_msg
+from electrum.lnonion import (new_onion_packet, process_onion_packet, construct_onion_error,
+                              OnionHopsDataSingle, OnionRoutingFailureMessage, OnionFailureCode,
+                              ProcessedOnionCache)
+from electrum.lnutil import LOCAL, REMOTE, UpdateAddHtlc
+from electrum.simple_config import SimpleConfig
+
+
+NUM_NODES = 2000
+NUM_CHANNELS = 10_000
+NUM_PATHS = 100
+NUM_MESSAGES = 1000
+NUM_HTLCS = 1000
+INITIAL_BALANCE_MSAT = 10**10
+NUM_ONION_PACKETS = 100
+
+
+def node_id(i: int) -> bytes:
+    return b'\x02' + sha256(i.to_bytes(4, 'big'))
+
+
+def make_channel_update(short_channel_id: bytes, direction: int, timestamp: int, rnd: random.Random) -> dict:
+    return {
+        'short_channel_id': short_channel_id,
+        'message_flags': b'\x00',
+        'channel_flags': bytes([direction]),
+        'cltv_expiry_delta': rnd.choice((40, 144)),
+        'htlc_minimum_msat': 1000,
+        'fee_base_msat': rnd.randrange(2000),
+        'fee_proportional_millionths': rnd.randrange(1000),
+        'chain_hash': constants.net.rev_genesis_bytes(),
+        'timestamp': timestamp,
+    }
+
+
+def run(runner):
+    run_gossip_and_routing(runner)
+    run_lnmsg(runner)
+    run_htlc_log(runner)
+    run_onion(runner)
+
+
+def run_gossip_and_routing(runner):
+    config = SimpleConfig({'electrum_path': runner.workdir})
+    class fake_network:
+        asyncio_loop = asyncio.get_event_loop()
+        trigger_callback = lambda *args: None
+        register_callback = lambda *args: None
+        interface = None
+    fake_network.config = config
+    cdb = lnrouter.ChannelDB(fake_network())
+    cdb.data_loaded.set()
+    num_nodes, num_channels = runner.size(NUM_NODES), runner.size(NUM_CHANNELS)
+    runner.log(f"generating channel graph with {num_nodes} nodes and {num_channels} channels...")
+    rnd = random.Random(0)
+    channels = []
+    for i in range(num_channels):
+        node1, node2 = sorted(node_id(n) for n in rnd.sample(range(num_nodes), 2))
+        channels.append({
+            'node_id_1': node1, 'node_id_2': node2,
+            'bitcoin_key_1': node1, 'bitcoin_key_2': node2,
+            'short_channel_id': (i + 1).to_bytes(8, 'big'),
+            'chain_hash': constants.net.rev_genesis_bytes(),
+            'len': 0, 'features': b''})
+    cdb.add_channel_announcement(channels, trusted=True)
+    params = {'num_nodes': num_nodes, 'num_channels': num_channels}
+
+    # each run re-applies all updates, with a newer timestamp
+    timestamp = int(time.time()) - 10**6
+    def add_channel_updates():
+        nonlocal timestamp
+        timestamp += 100
+        updates = [make_channel_update(chan['short_channel_id'], direction, timestamp, rnd)
+                   for chan in channels for direction in (0, 1)]
+        cdb.add_channel_updates(updates)
+    runner.measure('lightning.add_channel_updates', add_channel_updates, max_runs=100, **params)
+
+    path_finder = lnrouter.LNPathFinder(cdb)
+    pairs = [tuple(node_id(i) for i in rnd.sample(range(num_nodes), 2)) for j in range(NUM_PATHS)]
+    def find_paths():
+        for node_a, node_b in pairs:
+            path_finder.find_path_for_payment(node_a, node_b, 100_000)
+    # the first run also builds the routing graph snapshot
+    runner.measure('lightning.find_path_for_payment', find_paths, num_paths=NUM_PATHS, **params)
+
+
+def run_lnmsg(runner):
+    rnd = random.Random(0)
+    fields = make_channel_update((1).to_bytes(8, 'big'), 1, 1600000000, rnd)
+    fields['signature'] = bytes(64)
+    raw = encode_msg('channel_update', **fields)
+    runner.measure('lnmsg.encode_msg', lambda: [encode_msg('channel_update', **fields) for i in range(NUM_MESSAGES)],
+                   num_messages=NUM_MESSAGES)
+    runner.measure('lnmsg.decode_msg', lambda: [decode_msg(raw) for i in range(NUM_MESSAGES)],
+                   num_messages=NUM_MESSAGES)
+
+
+def make_htlc(htlc_id: int, amount_msat: int) -> UpdateAddHtlc:
+    return UpdateAddHtlc(amount_msat=amount_msat, payment_hash=sha256(htlc_id.to_bytes(4, 'big')),
+                         cltv_expiry=500 + htlc_id, timestamp=1600000000 + htlc_id, htlc_id=htlc_id)
+
+
+def sign_both_ways(A: HTLCManager, B: HTLCManager) -> None:
+    A.send_ctx()
+    B.recv_ctx()
+    B.send_rev()
+    A.recv_rev()
+    B.send_ctx()
+    A.recv_ctx()
+    A.send_rev()
+    B.recv_rev()
+
+
+def run_htlc_log(runner):
+    num_htlcs = runner.size(NUM_HTLCS)
+    runner.log(f"generating htlc log with {num_htlcs} htlcs per side...")
+    A = HTLCManager(StoredDict({}, None, []))
+    B = HTLCManager(StoredDict({}, None, []))
+    A.channel_open_finished()
+    B.channel_open_finished()
+    # both sides add an htlc, and the other side settles (3 out of 4) or fails it
+    for i in range(num_htlcs):
+        B.recv_htlc(A.send_htlc(make_htlc(i, 1000 * (i + 1))))
+        A.recv_htlc(B.send_htlc(make_htlc(i, 10 * (i + 1))))
+        sign_both_ways(A, B)
+        if i % 4:
+            B.send_settle(i)
+            A.recv_settle(i)
+            B.recv_settle(i)
+            A.send_settle(i)
+        else:
+            B.send_fail(i)
+            A.recv_fail(i)
+            A.send_fail(i)
+            B.recv_fail(i)
+        sign_both_ways(A, B)
+    params = {'num_htlcs': num_htlcs}
+    runner.measure('htlc.load', lambda: HTLCManager(A.log), **params)
+    runner.measure('htlc.get_balance_msat', lambda: A.get_balance_msat(
+        LOCAL, initial_balance_msat=INITIAL_BALANCE_MSAT), **params)
+    runner.measure('htlc.get_balance_msat_past_ctn', lambda: A.get_balance_msat(
+        REMOTE, ctn=A.ctn_latest(LOCAL) // 2, initial_balance_msat=INITIAL_BALANCE_MSAT), **params)
+    runner.measure('htlc.all_settled_htlcs_ever', lambda: A.all_settled_htlcs_ever(LOCAL), **params)
+    runner.measure('htlc.get_htlcs_in_latest_ctx', lambda: A.get_htlcs_in_latest_ctx(LOCAL), **params)
+
+
+def run_onion(runner):
+    privkeys = [os.urandom(32) for i in range(5)]
+    pubkeys = [ecc.ECPrivkey(privkey).get_public_key_bytes() for privkey in privkeys]
+    hops_data = [
+        OnionHopsDataSingle(is_tlv_payload=True, payload={
+            "amt_to_forward": {"amt_to_forward": 1000 * i},
+            "outgoing_cltv_value": {"outgoing_cltv_value": 100 * i},
+            "short_channel_id": {"short_channel_id": bytes([i]) * 8},
+        }) for i in range(5)]
+    payment_hash = os.urandom(32)
+    packets = [new_onion_packet(pubkeys, os.urandom(32), hops_data, payment_hash)
+               for i in range(NUM_ONION_PACKETS)]
+    reason = OnionRoutingFailureMessage(code=OnionFailureCode.TEMPORARY_NODE_FAILURE, data=b'')
+    params = {'num_packets': NUM_ONION_PACKETS}
+
+    def process():
+        for packet in packets:
+            process_onion_packet(packet, payment_hash, privkeys[0])
+    runner.measure('onion.process_onion_packet', process, **params)
+
+    cache = ProcessedOnionCache()
+    def process_cached():
+        for i, packet in enumerate(packets):
+            cache.process_onion_packet(packet, payment_hash, privkeys[0], htlc_key=bytes([i]))
+    runner.measure('onion.process_onion_packet_cached', process_cached, **params)
+
+    def construct_error():
+        for packet in packets:
+            construct_onion_error(reason, packet, privkeys[0])
+    runner.measure('onion.construct_onion_error', construct_error, **params)
+
+    shared_secret = process_onion_packet(packets[0], payment_hash, privkeys[0]).shared_secret
+    def construct_error_with_shared_secret():
+        for i in range(NUM_ONION_PACKETS):
+            construct_onion_error(reason, packets[0], privkeys[0], shared_secret=shared_secret)
+    runner.measure('onion.construct_onion_error_shared_secret', construct_error_with_shared_secret, **params)
@@ -0,0 +1,369 @@
+"""
+An in-process stand-in for an electrum server, speaking the electrum
+protocol over aiorpcx (plaintext tcp), for end-to-end runs of the
+network stack without a network.
+
+It serves a synthetic regtest chain (MockChain): headers, raw
+transactions, merkle proofs and scripthash histories. Latency and
+failures can be injected: delayed responses, error responses,
+requests that are never answered, and dropped connections.
+
+usage (on the network's event loop, with regtest constants):
+
+    chain = MockChain()
+    chain.add_block([tx1, tx2])
+    server = MockServer(chain, latency=0.05, error_rate=0.01)
+    await server.start()
+    config.set_key('server', str(server.server_addr))
+"""
+
+import asyncio
+import random
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import aiorpcx
+from aiorpcx import RPCSession, Request
+from aiorpcx.jsonrpc import JSONRPC, RPCError
+
+from electrum import constants
+from electrum.bitcoin import script_to_scripthash
+from electrum.blockchain import deserialize_header, hash_raw_header, serialize_header
+from electrum.crypto import sha256d
+from electrum.interface import ServerAddr
+from electrum.logging import Logger
+from electrum.synchronizer import history_status
+from electrum.transaction import Transaction
+from electrum.util import bfh, bh2u
+from electrum.version import PROTOCOL_VERSION
+
+
+# regtest genesis header
+REGTEST_GENESIS_HEADER = "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4adae5494dffff7f2002000000"
+# target of regtest blocks. proof of work is not checked on regtest
+REGTEST_BITS = 0x207fffff
+# max number of headers returned by blockchain.block.headers
+MAX_CHUNK_SIZE = 2016
+
+
+def merkle_root_and_branches(txids: Sequence[str]) -> Tuple[str, List[List[str]]]:
+    """Returns the merkle root of a block with txids, and the merkle branch of each txid,
+    in the formats of block headers and of blockchain.transaction.get_merkle.
+    """
+    level = [bfh(txid)[::-1] for txid in txids]
+    branches = [[] for txid in txids]
+    positions = list(range(len(txids)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for branch, pos in zip(branches, positions):
+            branch.append(bh2u(level[pos ^ 1][::-1]))
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        positions = [pos // 2 for pos in positions]
+    return bh2u(level[0][::-1]), branches
+
+
+class MockChain:
+    """A synthetic regtest chain, and the index of its transactions by scripthash."""
+
+    def __init__(self, *, block_interval: int = 600):
+        self.block_interval = block_interval
+        self.headers = [bfh(REGTEST_GENESIS_HEADER)]  # type: List[bytes]
+        assert hash_raw_header(REGTEST_GENESIS_HEADER) == constants.net.GENESIS, 'regtest constants needed'
+        self.raw_txs = {}  # type: Dict[str, str]  # txid -> raw tx
+        self.tx_positions = {}  # type: Dict[str, Tuple[int, int]]  # txid -> (height, pos)
+        self.merkle_branches = {}  # type: Dict[str, List[str]]
+        self.histories = defaultdict(list)  # type: Dict[str, List[Tuple[str, int]]]  # scripthash -> [(txid, height)]
+        self._output_scripthashes = {}  # type: Dict[Tuple[str, int], str]  # (txid, out_idx) -> scripthash
+
+    def height(self) -> int:
+        return len(self.headers) - 1
+
+    def add_block(self, txs: Sequence[Transaction] = (), *, timestamp: int = None) -> int:
+        """Appends a block with txs, and returns its height."""
+        height = len(self.headers)
+        txids = [tx.txid() for tx in txs]
+        if txids:
+            merkle_root, branches = merkle_root_and_branches(txids)
+        else:
+            merkle_root, branches = bh2u(bytes(32)), []
+        if timestamp is None:
+            timestamp = deserialize_header(self.headers[-1], height - 1)['timestamp'] + self.block_interval
+        header = {
+            'version': 0x20000000,
+            'prev_block_hash': hash_raw_header(bh2u(self.headers[-1])),
+            'merkle_root': merkle_root,
+            'timestamp': timestamp,
+            'bits': REGTEST_BITS,
+            'nonce': height,
+            'block_height': height,
+        }
+        self.headers.append(bfh(serialize_header(header)))
+        for pos, (tx, branch) in enumerate(zip(txs, branches)):
+            self._add_tx(tx, height, pos, branch)
+        return height
+
+    def add_blocks(self, num_blocks: int) -> int:
+        """Appends empty blocks, and returns the new height."""
+        for i in range(num_blocks):
+            self.add_block()
+        return self.height()
+
+    def _add_tx(self, tx: Transaction, height: int, pos: int, branch: List[str]) -> None:
+        txid = tx.txid()
+        self.raw_txs[txid] = tx.serialize()
+        self.tx_positions[txid] = (height, pos)
+        self.merkle_branches[txid] = branch
+        scripthashes = set()
+        for txin in tx.inputs():
+            sh = self._output_scripthashes.get((txin.prevout.txid.hex(), txin.prevout.out_idx))
+            if sh is not None:
+                scripthashes.add(sh)
+        for out_idx, txout in enumerate(tx.outputs()):
+            sh = script_to_scripthash(txout.scriptpubkey.hex())
+            self._output_scripthashes[(txid, out_idx)] = sh
+            scripthashes.add(sh)
+        for sh in scripthashes:
+            self.histories[sh].append((txid, height))
+
+    def get_header(self, height: int) -> dict:
+        return deserialize_header(self.headers[height], height)
+
+    def get_headers_hex(self, start_height: int, count: int) -> str:
+        return bh2u(b''.join(self.headers[start_height:start_height + count]))
+
+    def get_history(self, scripthash: str) -> List[Tuple[str, int]]:
+        return self.histories.get(scripthash, [])
+
+    def get_status(self, scripthash: str) -> Optional[str]:
+        history = self.get_history(scripthash)
+        return history_status(history) if history else None
+
+    def get_merkle(self, txid: str) -> Optional[dict]:
+        if txid not in self.tx_positions:
+            return None
+        height, pos = self.tx_positions[txid]
+        return {'block_height': height, 'merkle': self.merkle_branches[txid], 'pos': pos}
+
+
+class MockServerSession(RPCSession):
+
+    # requests the server decided to never answer should not time out on its side
+    processing_timeout = 10**6
+
+    def __init__(self, *args, server: 'MockServer', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = server
+        self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self.subscribed_to_headers = False
+        self.scripthash_statuses = {}  # type: Dict[str, Optional[str]]  # last status sent, per scripthash
+        server.sessions.add(self)
+        server.num_sessions += 1
+
+    async def handle_request(self, request):
+        if not isinstance(request, Request):
+            return
+        return await self.server.handle_request(self, request.method, list(request.args))
+
+    async def connection_lost(self):
+        await super().connection_lost()
+        self.server.sessions.discard(self)
+
+
+class MockServer(Logger):
+    """Serves a MockChain over the electrum protocol.
+
+    Failure injection, for each request (if inject_methods is set, only
+    for requests of these methods):
+    - latency: seconds before answering, plus up to jitter seconds
+    - error_rate: fraction of requests answered with an error
+    - timeout_rate: fraction of requests never answered
+    - disconnect_rate: fraction of requests after which the connection is dropped
+    """
+
+    def __init__(self, chain: MockChain, *, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, timeout_rate: float = 0.0, disconnect_rate: float = 0.0,
+                 inject_methods: Set[str] = None, seed: int = None):
+        Logger.__init__(self)
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.disconnect_rate = disconnect_rate
+        self.inject_methods = inject_methods
+        self.random = random.Random(seed)
+        self.sessions = set()  # type: Set[MockServerSession]
+        self.broadcast_txs = []  # type: List[str]
+        # statistics
+        self.num_sessions = 0
+        self.requests = Counter()  # type: Counter[str]  # method -> number of requests
+        self.num_injected_failures = 0
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+        self._handlers = {
+            'server.version': self.server_version,
+            'server.ping': self.server_ping,
+            'server.banner': self.server_banner,
+            'server.donation_address': self.server_donation_address,
+            'server.peers.subscribe': self.server_peers_subscribe,
+            'blockchain.headers.subscribe': self.headers_subscribe,
+            'blockchain.block.header': self.block_header,
+            'blockchain.block.headers': self.block_headers,
+            'blockchain.estimatefee': self.estimatefee,
+            'blockchain.relayfee': self.relayfee,
+            'mempool.get_fee_histogram': self.get_fee_histogram,
+            'blockchain.scripthash.subscribe': self.scripthash_subscribe,
+            'blockchain.scripthash.get_history': self.scripthash_get_history,
+            'blockchain.transaction.get': self.transaction_get,
+            'blockchain.transaction.get_merkle': self.transaction_get_merkle,
+            'blockchain.transaction.broadcast': self.transaction_broadcast,
+        }
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Starts listening. Port 0 picks a free port, see server_addr."""
+        session_factory = lambda *args, **kwargs: MockServerSession(*args, **kwargs, server=self)
+        self._server = await aiorpcx.serve_rs(session_factory, host, port)
+        self.logger.info(f'listening on {self.server_addr}')
+
+    @property
+    def server_addr(self) -> ServerAddr:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return ServerAddr(host, port, protocol='t')
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self.disconnect_all()
+        await self._server.wait_closed()
+
+    async def disconnect_all(self) -> None:
+        for session in list(self.sessions):
+            await session.abort()
+
+    def reset_stats(self) -> None:
+        self.num_sessions = len(self.sessions)
+        self.requests.clear()
+        self.num_injected_failures = 0
+
+    def get_stats(self) -> dict:
+        return {
+            'sessions': self.num_sessions,
+            'requests': dict(self.requests),
+            'injected_failures': self.num_injected_failures,
+        }
+
+    async def add_block(self, txs: Sequence[Transaction] = ()) -> int:
+        """Mines a block, and notifies subscribed sessions."""
+        height = self.chain.add_block(txs)
+        await self.notify_sessions()
+        return height
+
+    async def notify_sessions(self) -> None:
+        header = self._get_tip()
+        for session in list(self.sessions):
+            if session.subscribed_to_headers:
+                await session.send_notification('blockchain.headers.subscribe', (header,))
+            for sh, old_status in list(session.scripthash_statuses.items()):
+                status = self.chain.get_status(sh)
+                if status != old_status:
+                    session.scripthash_statuses[sh] = status
+                    await session.send_notification('blockchain.scripthash.subscribe', (sh, status))
+
+    def _should_inject(self, method: str, rate: float) -> bool:
+        if not rate or (self.inject_methods is not None and method not in self.inject_methods):
+            return False
+        return self.random.random() < rate
+
+    async def handle_request(self, session: MockServerSession, method: str, params: list):
+        self.requests[method] += 1
+        handler = self._handlers.get(method)
+        if handler is None:
+            raise RPCError(JSONRPC.METHOD_NOT_FOUND, f'unknown method {method}')
+        if self.inject_methods is None or method in self.inject_methods:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            if delay:
+                await asyncio.sleep(delay)
+        if self._should_inject(method, self.disconnect_rate):
+            self.num_injected_failures += 1
+            await session.abort()
+            return
+        if self._should_inject(method, self.timeout_rate):
+            self.num_injected_failures += 1
+            await asyncio.Future()  # until the session is closed
+        if self._should_inject(method, self.error_rate):
+            self.num_injected_failures += 1
+            raise RPCError(JSONRPC.INTERNAL_ERROR, 'injected failure')
+        try:
+            return await handler(session, *params)
+        except TypeError as e:
+            raise RPCError(JSONRPC.INVALID_ARGS, f'invalid arguments: {e}') from e
+
+    def _get_tip(self) -> dict:
+        height = self.chain.height()
+        return {'hex': bh2u(self.chain.headers[height]), 'height': height}
+
+    def _get_height(self, height) -> int:
+        if not isinstance(height, int) or not 0 <= height <= self.chain.height():
+            raise RPCError(JSONRPC.INVALID_ARGS, f'invalid height {height!r}')
+        return height
+
+    async def server_version(self, session, client_name='', protocol_version=None):
+        return ['ElectrumMockServer 1.0', PROTOCOL_VERSION]
+
+    async def server_ping(self, session):
+        return None
+
+    async def server_banner(self, session):
+        return 'electrum mock server'
+
+    async def server_donation_address(self, session):
+        return ''
+
+    async def server_peers_subscribe(self, session):
+        return []
+
+    async def headers_subscribe(self, session):
+        session.subscribed_to_headers = True
+        return self._get_tip()
+
+    async def block_header(self, session, height, cp_height=0):
+        return bh2u(self.chain.headers[self._get_height(height)])
+
+    async def block_headers(self, session, start_height, count, cp_height=0):
+        self._get_height(start_height)
+        count = max(0, min(count, MAX_CHUNK_SIZE))
+        hexdata = self.chain.get_headers_hex(start_height, count)
+        return {'hex': hexdata, 'count': len(hexdata) // 160, 'max': MAX_CHUNK_SIZE}
+
+    async def estimatefee(self, session, number):
+        return 0.0001
+
+    async def relayfee(self, session):
+        return 0.00001
+
+    async def get_fee_histogram(self, session):
+        return []
+
+    async def scripthash_subscribe(self, session, scripthash):
+        status = self.chain.get_status(scripthash)
+        session.scripthash_statuses[scripthash] = status
+        return status
+
+    async def scripthash_get_history(self, session, scripthash):
+        return [{'tx_hash': txid, 'height': height} for txid, height in self.chain.get_history(scripthash)]
+
+    async def transaction_get(self, session, txid, verbose=False):
+        raw_tx = self.chain.raw_txs.get(txid)
+        if raw_tx is None:
+            raise RPCError(2, f'No such mempool or blockchain transaction: {txid}')
+        return raw_tx
+
+    async def transaction_get_merkle(self, session, txid, height=None):
+        merkle = self.chain.get_merkle(txid)
+        if merkle is None:
+            raise RPCError(2, f'tx {txid} not in a block')
+        return merkle
+
+    async def transaction_broadcast(self, session, raw_tx):
+        tx = Transaction(raw_tx)
+        self.broadcast_txs.append(raw_tx)
+        return tx.txid()
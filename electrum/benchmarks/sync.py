@@ -0,0 +1,111 @@
+"""
+End-to-end sync benchmarks: the real network stack (Network, Interface,
+Synchronizer, SPV) against an in-process MockServer on regtest.
+
+Measures header sync, and wallet restore times without and with
+injected latency and failures. The requests the server received
+are stored with each result.
+"""
+
+import asyncio
+import os
+import time
+
+from electrum import bitcoin, blockchain, constants, keystore
+from electrum.network import Network
+from electrum.simple_config import SimpleConfig
+
+from .mock_server import MockChain, MockServer
+from .wallet import NUM_TXS_PER_BLOCK, SEED, make_txs, new_wallet
+
+
+NUM_TXS = 10_000
+NUM_RECEIVING_ADDRESSES = 200
+NUM_CHANGE_ADDRESSES = 50
+# empty blocks mined after the transactions, to have full chunks of headers
+NUM_EMPTY_BLOCKS = 10_000
+# seconds to wait for a sync before giving up
+SYNC_TIMEOUT = 600
+
+
+def get_addresses(for_change: int, num_addresses: int):
+    ks = keystore.from_seed(SEED, '')
+    return [bitcoin.pubkey_to_address('p2pkh', ks.derive_pubkey(for_change, n).hex())
+            for n in range(num_addresses)]
+
+
+def wait_until(condition, what: str) -> None:
+    start_time = time.monotonic()
+    while not condition():
+        if time.monotonic() - start_time > SYNC_TIMEOUT:
+            raise Exception(f'timed out waiting for {what}')
+        time.sleep(0.01)
+
+
+def run(runner):
+    constants.set_regtest()
+    try:
+        _run(runner)
+    finally:
+        blockchain.blockchains = {}
+        constants.set_mainnet()
+
+
+def _run(runner):
+    loop = asyncio.get_event_loop()
+    num_txs = 2 * runner.size(NUM_TXS // 2)
+    runner.log(f"generating chain with {num_txs} transactions...")
+    chain = MockChain()
+    txs = make_txs(get_addresses(0, NUM_RECEIVING_ADDRESSES), get_addresses(1, NUM_CHANGE_ADDRESSES),
+                   num_txs, bitcoin.hash160_to_p2pkh(bytes(20)))
+    for i in range(0, len(txs), NUM_TXS_PER_BLOCK):
+        chain.add_block([tx for tx, addresses in txs[i:i + NUM_TXS_PER_BLOCK]])
+    chain.add_blocks(runner.size(NUM_EMPTY_BLOCKS))
+    server = MockServer(chain, seed=0)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+    datadir = os.path.join(runner.workdir, 'sync')
+    config = SimpleConfig({'electrum_path': datadir, 'server': str(server.server_addr),
+                           'oneserver': True, 'auto_connect': False})
+    network = Network(config)
+    params = {'num_txs': num_txs, 'num_headers': chain.height() + 1}
+
+    def start_network():
+        network.start()
+        wait_until(lambda: network.get_local_height() == chain.height(), 'header sync')
+    result = runner.measure('sync.headers', start_network, max_runs=1, num_headers=chain.height() + 1)
+    if not result:
+        start_network()
+
+    wallet = None
+    def setup():
+        nonlocal wallet
+        server.reset_stats()
+        path = os.path.join(datadir, f'wallet_{time.monotonic()}')
+        wallet = new_wallet(config, path)
+    def restore():
+        wallet.start_network(network)
+        wait_until(lambda: (wallet.is_up_to_date()
+                            and not wallet.get_unverified_txs()
+                            and len(wallet.db.list_verified_tx()) == num_txs), 'wallet restore')
+        wallet.stop()
+
+    for name, injection in (
+            ('sync.restore', {}),
+            ('sync.restore_latency', {'latency': 0.02, 'jitter': 0.02}),
+            # each error closes the connection; measures reconnects and resumed syncs
+            ('sync.restore_errors', {'error_rate': 0.002,
+                                     'inject_methods': {'blockchain.scripthash.get_history',
+                                                        'blockchain.transaction.get'}}),
+    ):
+        defaults = {key: getattr(server, key) for key in injection}
+        for key, value in injection.items():
+            setattr(server, key, value)
+        result = runner.measure(name, restore, setup=setup, max_runs=3, **params)
+        if result:
+            result['server'] = server.get_stats()
+        for key, value in defaults.items():
+            setattr(server, key, value)
+
+    network.stop()
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
@@ -0,0 +1,127 @@
+"""
+Wallet benchmarks, on a synthetic standard (p2pkh) wallet.
+
+Transactions come in pairs: the first one funds a receiving address of
+the wallet from an external coin, the second one spends that coin to an
+external address, with change. So there is one UTXO per pair.
+"""
+
+import os
+from typing import List, Sequence, Tuple
+
+from electrum import bitcoin, keystore
+from electrum.bitcoin import int_to_hex, rev_hex, var_int
+from electrum.crypto import sha256
+from electrum.simple_config import SimpleConfig
+from electrum.storage import WalletStorage
+from electrum.transaction import Transaction, PartialTxOutput, tx_from_any
+from electrum.util import TxMinedInfo, bh2u
+from electrum.wallet import Wallet
+from electrum.wallet_db import WalletDB
+
+
+NUM_TXS = 100_000
+NUM_RECEIVING_ADDRESSES = 1000
+NUM_TXS_PER_BLOCK = 20
+NUM_INPUTS_TO_SIGN = 20
+# standard seed, also used in the tests
+SEED = 'cycle rocket west magnet parrot shuffle foot correct salt library feed song'
+# mainnet address; the coins sent to it are not ours
+EXTERNAL_ADDRESS = bitcoin.hash160_to_p2pkh(bytes(20))
+
+
+def make_raw_tx(inputs: Sequence[Tuple[str, int]], outputs: Sequence[Tuple[str, int]]) -> str:
+    """Unsigned transaction spending prevouts inputs (txid, index) to outputs (address, value)."""
+    s = int_to_hex(2, 4) + var_int(len(inputs))
+    for prevout_hash, prevout_n in inputs:
+        s += rev_hex(prevout_hash) + int_to_hex(prevout_n, 4) + '00' + 'fdffffff'
+    s += var_int(len(outputs))
+    for address, value in outputs:
+        script = bitcoin.address_to_script(address)
+        s += int_to_hex(value, 8) + var_int(len(script) // 2) + script
+    s += int_to_hex(0, 4)
+    return s
+
+
+def make_txs(receiving: Sequence[str], change: Sequence[str], num_txs: int,
+             external_address: str) -> List[Tuple[Transaction, Sequence[str]]]:
+    """Returns pairs of transactions, as described above, and the addresses each one touches."""
+    txs = []
+    for k in range(num_txs // 2):
+        value = 100_000 + k
+        addr, change_addr = receiving[k % len(receiving)], change[k % len(change)]
+        funding_outpoint = (bh2u(sha256(k.to_bytes(4, 'big'))), 0)
+        tx1 = Transaction(make_raw_tx([funding_outpoint], [(addr, value)]))
+        tx2 = Transaction(make_raw_tx([(tx1.txid(), 0)], [(external_address, 50_000),
+                                                          (change_addr, value - 51_000)]))
+        txs += [(tx1, [addr]), (tx2, [addr, change_addr])]
+    return txs
+
+
+def new_wallet(config: SimpleConfig, path: str, *, gap_limit: int = None) -> Wallet:
+    db = WalletDB('', manual_upgrades=False)
+    db.put('keystore', keystore.from_seed(SEED, '').dump())
+    db.put('wallet_type', 'standard')
+    if gap_limit is not None:
+        db.put('gap_limit', gap_limit)
+    return Wallet(db, WalletStorage(path), config=config)
+
+
+def create_wallet(config: SimpleConfig, path: str, num_txs: int) -> Wallet:
+    wallet = new_wallet(config, path, gap_limit=NUM_RECEIVING_ADDRESSES)
+    wallet.synchronize()
+    receiving = wallet.get_receiving_addresses()
+    change = wallet.get_change_addresses()
+    txs = make_txs(receiving, change, num_txs, EXTERNAL_ADDRESS)
+    histories = {addr: [] for addr in receiving + change}
+    for i, (tx, addresses) in enumerate(txs):
+        for addr in addresses:
+            histories[addr].append((tx.txid(), 1 + i // NUM_TXS_PER_BLOCK))
+    # what the synchronizer does: receive histories, then transactions, then SPV proofs
+    for addr, hist in histories.items():
+        wallet.receive_history_callback(addr, hist, {})
+    for i, (tx, addresses) in enumerate(txs):
+        wallet.receive_tx_callback(tx.txid(), tx, 1 + i // NUM_TXS_PER_BLOCK)
+    for i, (tx, addresses) in enumerate(txs):
+        height = 1 + i // NUM_TXS_PER_BLOCK
+        wallet.add_verified_tx(tx.txid(), TxMinedInfo(height=height, timestamp=1600000000 + 600 * height,
+                                                      txpos=i % NUM_TXS_PER_BLOCK, header_hash='00' * 32))
+    return wallet
+
+
+def run(runner):
+    config = SimpleConfig({'electrum_path': runner.workdir})
+    path = os.path.join(runner.workdir, 'wallet_benchmark')
+    num_txs = 2 * runner.size(NUM_TXS // 2)
+    runner.log(f"generating wallet with {num_txs} transactions...")
+    wallet = create_wallet(config, path, num_txs)
+    params = {'num_txs': num_txs}
+
+    # the db is only written when modified
+    runner.measure('wallet.save', lambda: wallet.save_db(), setup=lambda: wallet.db.set_modified(True), **params)
+    wallet.save_db()
+
+    def load():
+        storage = WalletStorage(path)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        Wallet(db, storage, config=config)
+    runner.measure('wallet.load', load, **params)
+
+    runner.measure('wallet.get_history', lambda: wallet.get_history(), **params)
+    runner.measure('wallet.get_full_history', lambda: wallet.get_full_history(), **params)
+    coins = wallet.get_utxos()
+    params['num_utxos'] = len(coins)
+    runner.measure('wallet.get_utxos', lambda: wallet.get_utxos(), **params)
+
+    def make_tx():
+        outputs = [PartialTxOutput.from_address_and_value(EXTERNAL_ADDRESS, 5 * 100_000)]
+        wallet.make_unsigned_transaction(coins=coins, outputs=outputs, fee=5000)
+    runner.measure('wallet.coin_selection', make_tx, **params)
+
+    outputs = [PartialTxOutput.from_address_and_value(EXTERNAL_ADDRESS, '!')]
+    tx = wallet.make_unsigned_transaction(coins=coins[:NUM_INPUTS_TO_SIGN], outputs=outputs, fee=5000)
+    psbt = tx.serialize()
+    def sign_psbt():
+        signed_tx = wallet.sign_transaction(tx_from_any(psbt), password=None)
+        assert signed_tx.is_complete()
+    runner.measure('wallet.sign_psbt', sign_psbt, num_inputs=len(tx.inputs()))
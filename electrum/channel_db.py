@@ -26,17 +26,20 @@
 import time
 import random
 import os
+import struct
 from collections import defaultdict
 from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
 import binascii
 import base64
 import asyncio
 import threading
+from bisect import bisect_left, insort
 from enum import IntEnum
 
 
 from .sql_db import SqlDB, sql
 from . import constants, util
+from . import instrumentation
 from .util import bh2u, profiler, get_headers_dir, is_ip_address, json_normalize
 from .logging import Logger
 from .lnutil import (LNPeerAddr, format_short_channel_id, ShortChannelID,
@@ -52,6 +55,11 @@ if TYPE_CHECKING:
 FLAG_DISABLE   = 1 << 1
 FLAG_DIRECTION = 1 << 0
 
+# fixed-layout records stored next to the raw gossip messages,
+# so that loading the db does not require decoding every message
+_POLICY_COMPACT = struct.Struct('>HQ?QIIBBI')
+_NODE_INFO_COMPACT_HEADER = struct.Struct('>IH')  # timestamp, len(features)
+
 
 class NodeAddress(NamedTuple):
     """Holds address information of Lightning nodes
@@ -88,6 +96,18 @@ class ChannelInfo(NamedTuple):
         payload_dict = decode_msg(raw)[1]
         return ChannelInfo.from_msg(payload_dict)
 
+    def to_compact(self) -> bytes:
+        return self.node1_id + self.node2_id
+
+    @staticmethod
+    def from_compact(short_channel_id: bytes, data: bytes) -> 'ChannelInfo':
+        return ChannelInfo(
+            short_channel_id = ShortChannelID.normalize(short_channel_id),
+            node1_id = data[0:33],
+            node2_id = data[33:66],
+            capacity_sat = None,
+        )
+
 
 class Policy(NamedTuple):
     key: bytes
@@ -120,6 +140,35 @@ class Policy(NamedTuple):
         payload['start_node'] = key[8:]
         return Policy.from_msg(payload)
 
+    def to_compact(self) -> bytes:
+        return _POLICY_COMPACT.pack(
+            self.cltv_expiry_delta,
+            self.htlc_minimum_msat,
+            self.htlc_maximum_msat is not None,
+            self.htlc_maximum_msat or 0,
+            self.fee_base_msat,
+            self.fee_proportional_millionths,
+            self.channel_flags,
+            self.message_flags,
+            self.timestamp)
+
+    @staticmethod
+    def from_compact(key: bytes, data: bytes) -> 'Policy':
+        (cltv_expiry_delta, htlc_minimum_msat, has_htlc_maximum_msat, htlc_maximum_msat,
+         fee_base_msat, fee_proportional_millionths, channel_flags, message_flags,
+         timestamp) = _POLICY_COMPACT.unpack(data)
+        return Policy(
+            key                         = key,
+            cltv_expiry_delta           = cltv_expiry_delta,
+            htlc_minimum_msat           = htlc_minimum_msat,
+            htlc_maximum_msat           = htlc_maximum_msat if has_htlc_maximum_msat else None,
+            fee_base_msat               = fee_base_msat,
+            fee_proportional_millionths = fee_proportional_millionths,
+            channel_flags               = channel_flags,
+            message_flags               = message_flags,
+            timestamp                   = timestamp,
+        )
+
     def is_disabled(self):
         return self.channel_flags & FLAG_DISABLE
 
@@ -132,6 +181,95 @@ class Policy(NamedTuple):
         return self.key[8:]
 
 
+class NodePolicyStats(NamedTuple):
+    """Aggregate statistics over the policies a node announced."""
+    number_channels: int
+    num_disabled: int
+    num_capacity_unknown: int
+    # over the policies with a known htlc_maximum_msat
+    total_capacity_msat: int
+    median_capacity_msat: float
+    # block heights of the channels
+    min_block_height: int
+    max_block_height: int
+    mean_block_height: float
+    # fees
+    mean_fee_base_msat: float
+    mean_fee_proportional_millionths: float
+    median_fee_proportional_millionths: float
+
+    @property
+    def disabled_ratio(self) -> float:
+        return self.num_disabled / self.number_channels
+
+
+def _median(sorted_values: Sequence[float]) -> float:
+    n = len(sorted_values)
+    if n % 2:
+        return sorted_values[n // 2]
+    return (sorted_values[n // 2 - 1] + sorted_values[n // 2]) / 2
+
+
+def _remove_sorted(sorted_values: list, value) -> None:
+    del sorted_values[bisect_left(sorted_values, value)]
+
+
+class _NodePolicyAggregate:
+    """Keeps NodePolicyStats of a node up to date as its policies change."""
+
+    def __init__(self):
+        self.num_disabled = 0
+        self.num_capacity_unknown = 0
+        self.total_capacity_msat = 0
+        self.sum_block_height = 0
+        self.sum_fee_base_msat = 0
+        self.sum_fee_proportional_millionths = 0
+        self.capacities = []  # sorted
+        self.block_heights = []  # sorted
+        self.fee_proportional_millionths = []  # sorted
+        self._stats = None  # type: Optional[NodePolicyStats]
+
+    def __len__(self):
+        return len(self.block_heights)
+
+    def add(self, policy: Policy, sign: int = 1) -> None:
+        update = insort if sign > 0 else _remove_sorted
+        self.num_disabled += sign * bool(policy.is_disabled())
+        if policy.htlc_maximum_msat is None:
+            self.num_capacity_unknown += sign
+        else:
+            self.total_capacity_msat += sign * policy.htlc_maximum_msat
+            update(self.capacities, policy.htlc_maximum_msat)
+        block_height = policy.short_channel_id.block_height
+        self.sum_block_height += sign * block_height
+        update(self.block_heights, block_height)
+        self.sum_fee_base_msat += sign * policy.fee_base_msat
+        self.sum_fee_proportional_millionths += sign * policy.fee_proportional_millionths
+        update(self.fee_proportional_millionths, policy.fee_proportional_millionths)
+        self._stats = None
+
+    def remove(self, policy: Policy) -> None:
+        self.add(policy, sign=-1)
+
+    def get_stats(self) -> NodePolicyStats:
+        if self._stats is None:
+            n = len(self)
+            self._stats = NodePolicyStats(
+                number_channels=n,
+                num_disabled=self.num_disabled,
+                num_capacity_unknown=self.num_capacity_unknown,
+                total_capacity_msat=self.total_capacity_msat,
+                median_capacity_msat=_median(self.capacities) if self.capacities else 0,
+                min_block_height=self.block_heights[0],
+                max_block_height=self.block_heights[-1],
+                mean_block_height=self.sum_block_height / n,
+                mean_fee_base_msat=self.sum_fee_base_msat / n,
+                mean_fee_proportional_millionths=self.sum_fee_proportional_millionths / n,
+                median_fee_proportional_millionths=_median(self.fee_proportional_millionths),
+            )
+        return self._stats
+
+
 class NodeInfo(NamedTuple):
     node_id: bytes
     features: int
@@ -164,6 +302,19 @@ class NodeInfo(NamedTuple):
         payload_dict = decode_msg(raw)[1]
         return NodeInfo.from_msg(payload_dict)
 
+    def to_compact(self) -> bytes:
+        features = self.features.to_bytes((self.features.bit_length() + 7) // 8, 'big')
+        return (_NODE_INFO_COMPACT_HEADER.pack(self.timestamp, len(features))
+                + features + self.alias.encode('utf8'))
+
+    @staticmethod
+    def from_compact(node_id: bytes, data: bytes) -> 'NodeInfo':
+        timestamp, features_len = _NODE_INFO_COMPACT_HEADER.unpack_from(data)
+        offset = _NODE_INFO_COMPACT_HEADER.size
+        features = int.from_bytes(data[offset:offset+features_len], 'big')
+        alias = data[offset+features_len:].decode('utf8')
+        return NodeInfo(node_id=node_id, features=features, timestamp=timestamp, alias=alias)
+
     @staticmethod
     def parse_addresses_field(addresses_field):
         buf = addresses_field
@@ -220,10 +371,12 @@ class CategorizedChannelUpdates(NamedTuple):
     good: List        # good updates
 
 
+# note: 'compact' holds the fields we need from 'msg', see to_compact/from_compact
 create_channel_info = """
 CREATE TABLE IF NOT EXISTS channel_info (
 short_channel_id BLOB(8),
 msg BLOB,
+compact BLOB,
 PRIMARY KEY(short_channel_id)
 )"""
 
@@ -231,6 +384,7 @@ create_policy = """
 CREATE TABLE IF NOT EXISTS policy (
 key BLOB(41),
 msg BLOB,
+compact BLOB,
 PRIMARY KEY(key)
 )"""
 
@@ -247,6 +401,7 @@ create_node_info = """
 CREATE TABLE IF NOT EXISTS node_info (
 node_id BLOB(33),
 msg BLOB,
+compact BLOB,
 PRIMARY KEY(node_id)
 )"""
 
@@ -268,6 +423,7 @@ class ChannelDB(SqlDB):
         # note: modify/iterate needs self.lock
         self._channels = {}  # type: Dict[ShortChannelID, ChannelInfo]
         self._policies = {}  # type: Dict[Tuple[bytes, ShortChannelID], Policy]  # (node_id, scid) -> Policy
+        self._policy_stats = {}  # type: Dict[bytes, _NodePolicyAggregate]  # node_id -> aggregate of its policies
         self._nodes = {}  # type: Dict[bytes, NodeInfo]  # node_id -> NodeInfo
         # node_id -> (host, port, ts)
         self._addresses = defaultdict(set)  # type: Dict[bytes, Set[NodeAddress]]
@@ -276,6 +432,10 @@ class ChannelDB(SqlDB):
         self._chans_with_0_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_1_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_2_policies = set()  # type: Set[ShortChannelID]
+        # log of channels whose announcement or policies changed.
+        # consumers (e.g. routing graph snapshots) remember a position in it.
+        self._chan_changelog = []  # type: List[ShortChannelID]
+        self._chan_changelog_start = 0
 
         self.data_loaded = asyncio.Event()
         self.network = network # only for callback
@@ -291,6 +451,33 @@ class ChannelDB(SqlDB):
         with self.lock:
             return set(self._channels.keys())
 
+    CHAN_CHANGELOG_MAX_SIZE = 100_000
+
+    def _note_channel_changed(self, short_channel_id: ShortChannelID) -> None:
+        with self.lock:
+            self._chan_changelog.append(short_channel_id)
+            if len(self._chan_changelog) > self.CHAN_CHANGELOG_MAX_SIZE:
+                # consumers that are further behind will have to rebuild from scratch
+                num_dropped = len(self._chan_changelog) // 2
+                self._chan_changelog = self._chan_changelog[num_dropped:]
+                self._chan_changelog_start += num_dropped
+
+    def _reset_channel_changelog(self) -> None:
+        with self.lock:
+            self._chan_changelog_start += len(self._chan_changelog) + 1
+            self._chan_changelog = []
+
+    def get_channels_changed_since(self, position: int) -> Tuple[int, Optional[Set[ShortChannelID]]]:
+        """Returns (new_position, changed_channels).
+        changed_channels is None if the log no longer reaches back to 'position',
+        in which case the caller needs to rebuild its view of the graph.
+        """
+        with self.lock:
+            end = self._chan_changelog_start + len(self._chan_changelog)
+            if position < self._chan_changelog_start:
+                return end, None
+            return end, set(self._chan_changelog[position - self._chan_changelog_start:])
+
     def add_recent_peer(self, peer: LNPeerAddr):
         now = int(time.time())
         node_id = peer.pubkey
@@ -331,11 +518,13 @@ class ChannelDB(SqlDB):
     #       even slower; especially as servers will start throttling us.
     #       It would probably put significant strain on servers if all clients
     #       verified the complete gossip.
+    @instrumentation.traced('gossip.add_channel_announcement')
     def add_channel_announcement(self, msg_payloads, *, trusted=True):
         # note: signatures have already been verified.
         if type(msg_payloads) is dict:
             msg_payloads = [msg_payloads]
         added = 0
+        rows_to_save = []
         for msg in msg_payloads:
             short_channel_id = ShortChannelID(msg['short_channel_id'])
             if short_channel_id in self._channels:
@@ -350,14 +539,22 @@ class ChannelDB(SqlDB):
                 continue
             if trusted:
                 added += 1
-                self.add_verified_channel_info(msg)
+                self._add_verified_channel_info(msg, rows_to_save=rows_to_save)
             else:
                 added += self.ca_verifier.add_new_channel_info(short_channel_id, msg)
-
+        if rows_to_save:
+            self._db_save_channels(rows_to_save)
         self.update_counts()
         self.logger.debug('add_channel_announcement: %d/%d'%(added, len(msg_payloads)))
 
     def add_verified_channel_info(self, msg: dict, *, capacity_sat: int = None) -> None:
+        rows_to_save = []
+        self._add_verified_channel_info(msg, capacity_sat=capacity_sat, rows_to_save=rows_to_save)
+        if rows_to_save:
+            self._db_save_channels(rows_to_save)
+
+    def _add_verified_channel_info(self, msg: dict, *, capacity_sat: int = None, rows_to_save: list) -> None:
+        # note: the db row is appended to rows_to_save, so that callers can write many at once
         try:
             channel_info = ChannelInfo.from_msg(msg)
         except IncompatibleOrInsaneFeatures:
@@ -368,8 +565,9 @@ class ChannelDB(SqlDB):
             self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
             self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
         self._update_num_policies_for_chan(channel_info.short_channel_id)
+        self._note_channel_changed(channel_info.short_channel_id)
         if 'raw' in msg:
-            self._db_save_channel(channel_info.short_channel_id, msg['raw'])
+            rows_to_save.append((channel_info.short_channel_id, msg['raw'], channel_info.to_compact()))
 
     def policy_changed(self, old_policy: Policy, new_policy: Policy, verbose: bool) -> bool:
         changed = False
@@ -406,6 +604,14 @@ class ChannelDB(SqlDB):
         return changed
 
     def add_channel_update(self, payload, max_age=None, verify=False, verbose=True):
+        rows_to_save = []
+        r = self._add_channel_update(payload, max_age=max_age, verify=verify, verbose=verbose, rows_to_save=rows_to_save)
+        if rows_to_save:
+            self._db_save_policies(rows_to_save)
+        return r
+
+    def _add_channel_update(self, payload, *, max_age, verify, verbose, rows_to_save: list) -> UpdateStatus:
+        # note: the db row is appended to rows_to_save, so that callers can write many at once
         now = int(time.time())
         short_channel_id = ShortChannelID(payload['short_channel_id'])
         timestamp = payload['timestamp']
@@ -432,23 +638,26 @@ class ChannelDB(SqlDB):
             self.verify_channel_update(payload)
         policy = Policy.from_msg(payload)
         with self.lock:
-            self._policies[key] = policy
+            self._set_policy(key, policy)
         self._update_num_policies_for_chan(short_channel_id)
+        self._note_channel_changed(short_channel_id)
         if 'raw' in payload:
-            self._db_save_policy(policy.key, payload['raw'])
+            rows_to_save.append((policy.key, payload['raw'], policy.to_compact()))
         if old_policy and not self.policy_changed(old_policy, policy, verbose):
             return UpdateStatus.UNCHANGED
         else:
             return UpdateStatus.GOOD
 
+    @instrumentation.traced('gossip.add_channel_updates')
     def add_channel_updates(self, payloads, max_age=None) -> CategorizedChannelUpdates:
         orphaned = []
         expired = []
         deprecated = []
         unchanged = []
         good = []
+        rows_to_save = []
         for payload in payloads:
-            r = self.add_channel_update(payload, max_age=max_age, verbose=False)
+            r = self._add_channel_update(payload, max_age=max_age, verify=False, verbose=False, rows_to_save=rows_to_save)
             if r == UpdateStatus.ORPHANED:
                 orphaned.append(payload)
             elif r == UpdateStatus.EXPIRED:
@@ -459,6 +668,8 @@ class ChannelDB(SqlDB):
                 unchanged.append(payload)
             elif r == UpdateStatus.GOOD:
                 good.append(payload)
+        if rows_to_save:
+            self._db_save_policies(rows_to_save)
         self.update_counts()
         return CategorizedChannelUpdates(
             orphaned=orphaned,
@@ -474,36 +685,42 @@ class ChannelDB(SqlDB):
         c.execute(create_address)
         c.execute(create_policy)
         c.execute(create_channel_info)
+        # databases created before the 'compact' column existed
+        for table in ('node_info', 'policy', 'channel_info'):
+            columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+            if 'compact' not in columns:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN compact BLOB")
         self.conn.commit()
 
     @sql
-    def _db_save_policy(self, key: bytes, msg: bytes):
-        # 'msg' is a 'channel_update' message
+    def _db_save_policies(self, rows: Sequence[Tuple[bytes, bytes, bytes]]):
+        # rows of (key, msg, compact). 'msg' is a 'channel_update' message
         c = self.conn.cursor()
-        c.execute("""REPLACE INTO policy (key, msg) VALUES (?,?)""", [key, msg])
+        c.executemany("""REPLACE INTO policy (key, msg, compact) VALUES (?,?,?)""", rows)
 
     @sql
-    def _db_delete_policy(self, node_id: bytes, short_channel_id: ShortChannelID):
-        key = short_channel_id + node_id
+    def _db_delete_policies(self, keys: Sequence[Tuple[bytes, ShortChannelID]]):
         c = self.conn.cursor()
-        c.execute("""DELETE FROM policy WHERE key=?""", (key,))
+        c.executemany("""DELETE FROM policy WHERE key=?""",
+                      [(short_channel_id + node_id,) for node_id, short_channel_id in keys])
 
     @sql
-    def _db_save_channel(self, short_channel_id: ShortChannelID, msg: bytes):
-        # 'msg' is a 'channel_announcement' message
+    def _db_save_channels(self, rows: Sequence[Tuple[ShortChannelID, bytes, bytes]]):
+        # rows of (short_channel_id, msg, compact). 'msg' is a 'channel_announcement' message
         c = self.conn.cursor()
-        c.execute("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", [short_channel_id, msg])
+        c.executemany("REPLACE INTO channel_info (short_channel_id, msg, compact) VALUES (?,?,?)", rows)
 
     @sql
-    def _db_delete_channel(self, short_channel_id: ShortChannelID):
+    def _db_delete_channels(self, short_channel_ids: Sequence[ShortChannelID]):
         c = self.conn.cursor()
-        c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
+        c.executemany("""DELETE FROM channel_info WHERE short_channel_id=?""",
+                      [(short_channel_id,) for short_channel_id in short_channel_ids])
 
     @sql
-    def _db_save_node_info(self, node_id: bytes, msg: bytes):
-        # 'msg' is a 'node_announcement' message
+    def _db_save_node_infos(self, rows: Sequence[Tuple[bytes, bytes, bytes]]):
+        # rows of (node_id, msg, compact). 'msg' is a 'node_announcement' message
         c = self.conn.cursor()
-        c.execute("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", [node_id, msg])
+        c.executemany("REPLACE INTO node_info (node_id, msg, compact) VALUES (?,?,?)", rows)
 
     @sql
     def _db_save_node_address(self, peer: LNPeerAddr, timestamp: int):
@@ -513,12 +730,10 @@ class ChannelDB(SqlDB):
 
     @sql
     def _db_save_node_addresses(self, node_addresses: Sequence[LNPeerAddr]):
+        # note: keeps the timestamp of addresses that are already known
         c = self.conn.cursor()
-        for addr in node_addresses:
-            c.execute("SELECT * FROM address WHERE node_id=? AND host=? AND port=?", (addr.pubkey, addr.host, addr.port))
-            r = c.fetchall()
-            if r == []:
-                c.execute("INSERT INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)", (addr.pubkey, addr.host, addr.port, 0))
+        c.executemany("INSERT OR IGNORE INTO address (node_id, host, port, timestamp) VALUES (?,?,?,?)",
+                      [(addr.pubkey, addr.host, addr.port, 0) for addr in node_addresses])
 
     def verify_channel_update(self, payload):
         short_channel_id = payload['short_channel_id']
@@ -528,11 +743,14 @@ class ChannelDB(SqlDB):
         if not verify_sig_for_channel_update(payload, payload['start_node']):
             raise Exception(f'failed verifying channel update for {short_channel_id}')
 
+    @instrumentation.traced('gossip.add_node_announcement')
     def add_node_announcement(self, msg_payloads):
         # note: signatures have already been verified.
         if type(msg_payloads) is dict:
             msg_payloads = [msg_payloads]
         new_nodes = {}
+        node_info_rows = []
+        node_addresses_to_save = []
         for msg_payload in msg_payloads:
             try:
                 node_info, node_addresses = NodeInfo.from_msg(msg_payload)
@@ -553,11 +771,15 @@ class ChannelDB(SqlDB):
             with self.lock:
                 self._nodes[node_id] = node_info
             if 'raw' in msg_payload:
-                self._db_save_node_info(node_id, msg_payload['raw'])
+                node_info_rows.append((node_id, msg_payload['raw'], node_info.to_compact()))
             with self.lock:
                 for addr in node_addresses:
                     self._addresses[node_id].add(NodeAddress(addr.host, addr.port, 0))
-            self._db_save_node_addresses(node_addresses)
+            node_addresses_to_save.extend(node_addresses)
+        if node_info_rows:
+            self._db_save_node_infos(node_info_rows)
+        if node_addresses_to_save:
+            self._db_save_node_addresses(node_addresses_to_save)
 
         self.logger.debug("on_node_announcement: %d/%d"%(len(new_nodes), len(msg_payloads)))
         self.update_counts()
@@ -574,9 +796,10 @@ class ChannelDB(SqlDB):
             for key in old_policies:
                 node_id, scid = key
                 with self.lock:
-                    self._policies.pop(key)
-                self._db_delete_policy(*key)
+                    self._pop_policy(key)
                 self._update_num_policies_for_chan(scid)
+                self._note_channel_changed(scid)
+            self._db_delete_policies(old_policies)
             self.update_counts()
             self.logger.info(f'Deleting {len(old_policies)} old policies')
 
@@ -585,10 +808,31 @@ class ChannelDB(SqlDB):
             orphaned_chans = self._chans_with_0_policies.copy()
         if orphaned_chans:
             for short_channel_id in orphaned_chans:
-                self.remove_channel(short_channel_id)
+                self._remove_channel(short_channel_id)
+            self._db_delete_channels(list(orphaned_chans))
             self.update_counts()
             self.logger.info(f'Deleting {len(orphaned_chans)} orphaned channels')
 
+    def _set_policy(self, key: Tuple[bytes, ShortChannelID], policy: Policy) -> None:
+        # note: needs self.lock
+        self._pop_policy(key)
+        self._policies[key] = policy
+        node_id = key[0]
+        if node_id not in self._policy_stats:
+            self._policy_stats[node_id] = _NodePolicyAggregate()
+        self._policy_stats[node_id].add(policy)
+
+    def _pop_policy(self, key: Tuple[bytes, ShortChannelID]) -> Optional[Policy]:
+        # note: needs self.lock
+        policy = self._policies.pop(key, None)
+        if policy is not None:
+            node_id = key[0]
+            aggregate = self._policy_stats[node_id]
+            aggregate.remove(policy)
+            if not len(aggregate):
+                del self._policy_stats[node_id]
+        return policy
+
     def add_channel_update_for_private_channel(self, msg_payload: dict, start_node_id: bytes):
         if not verify_sig_for_channel_update(msg_payload, start_node_id):
             return  # ignore
@@ -597,6 +841,11 @@ class ChannelDB(SqlDB):
         self._channel_updates_for_private_channels[(start_node_id, short_channel_id)] = msg_payload
 
     def remove_channel(self, short_channel_id: ShortChannelID):
+        self._remove_channel(short_channel_id)
+        # delete from database
+        self._db_delete_channels([short_channel_id])
+
+    def _remove_channel(self, short_channel_id: ShortChannelID):
         # FIXME what about rm-ing policies?
         with self.lock:
             channel_info = self._channels.pop(short_channel_id, None)
@@ -604,8 +853,7 @@ class ChannelDB(SqlDB):
                 self._channels_for_node[channel_info.node1_id].remove(channel_info.short_channel_id)
                 self._channels_for_node[channel_info.node2_id].remove(channel_info.short_channel_id)
         self._update_num_policies_for_chan(short_channel_id)
-        # delete from database
-        self._db_delete_channel(short_channel_id)
+        self._note_channel_changed(short_channel_id)
 
     def get_node_addresses(self, node_id):
         return self._addresses.get(node_id)
@@ -615,9 +863,8 @@ class ChannelDB(SqlDB):
     def load_data(self):
         if self.data_loaded.is_set():
             return
-        # Note: this method takes several seconds... mostly due to lnmsg.decode_msg being slow.
-        #       I believe lnmsg (and lightning.json) will need a rewrite anyway, so instead of tweaking
-        #       load_data() here, that should be done. see #6006
+        # note: records are loaded from their 'compact' form. Only rows written before
+        #       that column existed need lnmsg.decode_msg, which is slow; they get converted.
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
         for x in c:
@@ -630,36 +877,61 @@ class ChannelDB(SqlDB):
             return newest_ts
         sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
         self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
-        c.execute("""SELECT * FROM channel_info""")
-        for short_channel_id, msg in c:
+        c.execute("""SELECT short_channel_id, compact FROM channel_info WHERE compact IS NOT NULL""")
+        for short_channel_id, compact in c:
+            ci = ChannelInfo.from_compact(short_channel_id, compact)
+            self._channels[ci.short_channel_id] = ci
+        c.execute("""SELECT node_id, compact FROM node_info WHERE compact IS NOT NULL""")
+        for node_id, compact in c:
+            self._nodes[node_id] = NodeInfo.from_compact(node_id, compact)
+        c.execute("""SELECT key, compact FROM policy WHERE compact IS NOT NULL""")
+        for key, compact in c:
+            p = Policy.from_compact(key, compact)
+            self._set_policy((p.start_node, p.short_channel_id), p)
+        self._load_and_convert_legacy_rows()
+        for channel_info in self._channels.values():
+            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
+            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            self._update_num_policies_for_chan(channel_info.short_channel_id)
+        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
+        self._reset_channel_changelog()
+        self.update_counts()
+        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
+        self.logger.info(f'num_channels_partitioned_by_policy_count. '
+                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
+        self.data_loaded.set()
+        util.trigger_callback('gossip_db_loaded')
+
+    def _load_and_convert_legacy_rows(self) -> None:
+        c = self.conn.cursor()
+        converted = []  # type: List[Tuple[str, str, bytes, Optional[bytes]]]  # (table, key column, key, compact)
+        c.execute("""SELECT short_channel_id, msg FROM channel_info WHERE compact IS NULL""")
+        for short_channel_id, msg in c.fetchall():
             try:
                 ci = ChannelInfo.from_raw_msg(msg)
             except IncompatibleOrInsaneFeatures:
                 continue
             self._channels[ShortChannelID.normalize(short_channel_id)] = ci
-        c.execute("""SELECT * FROM node_info""")
-        for node_id, msg in c:
+            converted.append(('channel_info', 'short_channel_id', short_channel_id, ci.to_compact()))
+        c.execute("""SELECT node_id, msg FROM node_info WHERE compact IS NULL""")
+        for node_id, msg in c.fetchall():
             try:
                 node_info, node_addresses = NodeInfo.from_raw_msg(msg)
             except IncompatibleOrInsaneFeatures:
                 continue
             # don't load node_addresses because they dont have timestamps
             self._nodes[node_id] = node_info
-        c.execute("""SELECT * FROM policy""")
-        for key, msg in c:
+            converted.append(('node_info', 'node_id', node_id, node_info.to_compact()))
+        c.execute("""SELECT key, msg FROM policy WHERE compact IS NULL""")
+        for key, msg in c.fetchall():
             p = Policy.from_raw_msg(key, msg)
-            self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
-            self._update_num_policies_for_chan(channel_info.short_channel_id)
-        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
-        self.update_counts()
-        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
-        self.logger.info(f'num_channels_partitioned_by_policy_count. '
-                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
-        self.data_loaded.set()
-        util.trigger_callback('gossip_db_loaded')
+            self._set_policy((p.start_node, p.short_channel_id), p)
+            converted.append(('policy', 'key', key, p.to_compact()))
+        if converted:
+            self.logger.info(f'converting {len(converted)} gossip db rows to compact form')
+            for table, key_column, key, compact in converted:
+                c.execute(f"UPDATE {table} SET compact=? WHERE {key_column}=?", (compact, key))
+            self.conn.commit()
 
     def _update_num_policies_for_chan(self, short_channel_id: ShortChannelID) -> None:
         channel_info = self.get_channel_info(short_channel_id)
@@ -768,6 +1040,14 @@ class ChannelDB(SqlDB):
         with self.lock:
             return self._policies.copy()
 
+    def get_node_policy_stats(self, *, min_num_channels: int = 1) -> Dict[bytes, NodePolicyStats]:
+        """Returns statistics over the policies of each node that
+        announced at least min_num_channels policies."""
+        with self.lock:
+            return {node_id: aggregate.get_stats()
+                    for node_id, aggregate in self._policy_stats.items()
+                    if len(aggregate) >= min_num_channels}
+
     def to_dict(self) -> dict:
         """ Generates a graph representation in terms of a dictionary.
 
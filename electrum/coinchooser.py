@@ -30,6 +30,7 @@ from decimal import Decimal
 from .bitcoin import sha256, COIN, is_address
 from .transaction import Transaction, TxOutput, PartialTransaction, PartialTxInput, PartialTxOutput
 from .util import NotEnoughFunds
+from . import instrumentation
 from .logging import Logger
 
 
@@ -265,6 +266,7 @@ class CoinChooserBase(Logger):
 
         return total_weight
 
+    @instrumentation.traced('coinselection.make_tx')
     def make_tx(self, *, coins: Sequence[PartialTxInput], inputs: List[PartialTxInput],
                 outputs: List[PartialTxOutput], change_addrs: Sequence[str],
                 fee_estimator_vb: Callable, dust_threshold: int) -> PartialTransaction:
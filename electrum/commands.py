@@ -42,6 +42,7 @@ from .import util, ecc
 from .util import (bfh, bh2u, format_satoshis, json_decode, json_normalize,
                    is_hash256_str, is_hex_str, to_bytes)
 from . import bitcoin
+from . import instrumentation
 from .bitcoin import is_address,  hash_160, COIN
 from .bip32 import BIP32Node
 from .i18n import _
@@ -89,6 +90,9 @@ class Command:
         self.requires_network = 'n' in s
         self.requires_wallet = 'w' in s
         self.requires_password = 'p' in s
+        # only uses the wallet and local data, and never awaits the event loop:
+        # the daemon runs it in a worker thread (see Daemon.run_in_worker)
+        self.runs_in_worker = 't' in s
         self.description = func.__doc__
         self.help = self.description.split('.')[0] if self.description else None
         varnames = func.__code__.co_varnames[1:func.__code__.co_argcount]
@@ -105,6 +109,8 @@ class Command:
         # sanity checks
         if self.requires_password:
             assert self.requires_wallet
+        if self.runs_in_worker:
+            assert not self.requires_network
         for varname in ('wallet_path', 'wallet'):
             if varname in varnames:
                 assert varname in self.options
@@ -132,6 +138,7 @@ def command(s):
                 if 'wallet' in cmd.options:
                     wallet_path = kwargs.get('wallet', None)
                     if isinstance(wallet_path, str):
+                        await daemon.wake_wallet(wallet_path)
                         wallet = daemon.get_wallet(wallet_path)
                         if wallet is None:
                             raise Exception('wallet not loaded')
@@ -141,6 +148,8 @@ def command(s):
                 raise Exception('wallet not loaded')
             if cmd.requires_password and password is None and wallet.has_password():
                 raise Exception('Password required')
+            if daemon and cmd.runs_in_worker:
+                return await daemon.run_in_worker(func, *args, **kwargs)
             return await func(*args, **kwargs)
         return func_wrapper
     return decorator
@@ -216,8 +225,11 @@ class Commands:
     @command('n')
     async def list_wallets(self):
         """List wallets open in daemon"""
-        return [{'path': path, 'synchronized': w.is_up_to_date()}
-                for path, w in self.daemon.get_wallets().items()]
+        return ([{'path': path, 'synchronized': w.is_up_to_date(), 'hibernated': False}
+                 for path, w in self.daemon.get_wallets().items()]
+                # hibernated wallets were synchronized when they were evicted
+                + [{'path': path, 'synchronized': True, 'hibernated': True}
+                   for path in self.daemon.get_hibernated_wallets()])
 
     @command('n')
     async def load_wallet(self, wallet_path=None, password=None):
@@ -327,7 +339,7 @@ class Commands:
         sh = bitcoin.address_to_scripthash(address)
         return await self.network.get_history_for_scripthash(sh)
 
-    @command('w')
+    @command('wt')
     async def listunspent(self, wallet: Abstract_Wallet = None):
         """List unspent outputs. Returns the list of unspent transaction
         outputs in your wallet."""
@@ -384,7 +396,7 @@ class Commands:
         tx.sign(keypairs)
         return tx.serialize()
 
-    @command('wp')
+    @command('wpt')
     async def signtransaction(self, tx, privkey=None, password=None, wallet: Abstract_Wallet = None):
         """Sign a transaction. The wallet keys will be used unless a private key is provided."""
         tx = tx_from_any(tx)
@@ -427,7 +439,7 @@ class Commands:
         """Unfreeze address. Unfreeze the funds at one of your wallet\'s address"""
         return wallet.set_frozen_state_of_addresses([address], False)
 
-    @command('wp')
+    @command('wpt')
     async def getprivatekeys(self, address, password=None, wallet: Abstract_Wallet = None):
         """Get private keys of addresses. You may pass a single wallet address, or a list of wallet addresses."""
         if isinstance(address, str):
@@ -464,7 +476,7 @@ class Commands:
         """Return the public keys for a wallet address. """
         return wallet.get_public_keys(address)
 
-    @command('w')
+    @command('wt')
     async def getbalance(self, wallet: Abstract_Wallet = None):
         """Return the balance of your wallet. """
         c, u, x = wallet.get_balance()
@@ -500,6 +512,36 @@ class Commands:
         """Return the list of known servers (candidates for connecting)."""
         return self.network.get_servers()
 
+    @command('n')
+    async def getnetworkstats(self):
+        """Return request latency histograms, in-flight requests, timeouts and
+        errors, per method and per server, and connection statistics per server."""
+        return self.network.get_network_stats()
+
+    @command('')
+    async def start_profiling(self, sampling_file=None):
+        """Start collecting timing statistics (spans) and counters of
+        wallet, synchronizer, routing and gossip operations.
+        If sampling_file is given, also sample the stacks of all threads,
+        and write them as collapsed stacks to that file on stop_profiling."""
+        instrumentation.set_enabled(True)
+        if sampling_file:
+            instrumentation.start_sampling(sampling_file)
+        return True
+
+    @command('')
+    async def stop_profiling(self):
+        """Stop collecting timing statistics. Returns the number of
+        stack samples written, if the sampling profiler was running."""
+        instrumentation.set_enabled(False)
+        return instrumentation.stop_sampling()
+
+    @command('')
+    async def getprofile(self, reset=False):
+        """Return count, mean, max and percentiles of the durations (in seconds)
+        of each span, and the value of each counter."""
+        return instrumentation.get_stats(reset=reset)
+
     @command('')
     async def version(self):
         """Return the version of Electrum."""
@@ -569,7 +611,7 @@ class Commands:
                    imax=imax)
         return tx.serialize() if tx else None
 
-    @command('wp')
+    @command('wpt')
     async def signmessage(self, address, message, password=None, wallet: Abstract_Wallet = None):
         """Sign a message with a key. Use quotes if your message contains
         whitespaces"""
@@ -583,7 +625,7 @@ class Commands:
         message = util.to_bytes(message)
         return ecc.verify_message_with_address(address, sig, message)
 
-    @command('wp')
+    @command('wpt')
     async def payto(self, destination, amount, fee=None, feerate=None, from_addr=None, from_coins=None, change_addr=None,
                     nocheck=False, unsigned=False, rbf=None, password=None, locktime=None, addtransaction=False, wallet: Abstract_Wallet = None):
         """Create a transaction. """
@@ -611,7 +653,7 @@ class Commands:
             await self.addtransaction(result, wallet=wallet)
         return result
 
-    @command('wp')
+    @command('wpt')
     async def paytomany(self, outputs, fee=None, feerate=None, from_addr=None, from_coins=None, change_addr=None,
                         nocheck=False, unsigned=False, rbf=None, password=None, locktime=None, addtransaction=False, wallet: Abstract_Wallet = None):
         """Create a multi-output transaction. """
@@ -642,7 +684,7 @@ class Commands:
             await self.addtransaction(result, wallet=wallet)
         return result
 
-    @command('w')
+    @command('wt')
     async def onchain_history(self, year=None, show_addresses=False, show_fiat=False, wallet: Abstract_Wallet = None):
         """Wallet onchain history. Returns the transaction history of your wallet."""
         kwargs = {
@@ -691,7 +733,7 @@ class Commands:
                 results[key] = value
         return results
 
-    @command('w')
+    @command('wt')
     async def listaddresses(self, receiving=False, change=False, labels=False, frozen=False, unused=False, funded=False, balance=False, wallet: Abstract_Wallet = None):
         """List wallet addresses. Returns the list of all addresses in your wallet. Use optional arguments to filter the results."""
         out = []
@@ -745,7 +787,7 @@ class Commands:
         encrypted = public_key.encrypt_message(message)
         return encrypted.decode('utf-8')
 
-    @command('wp')
+    @command('wpt')
     async def decrypt(self, pubkey, encrypted, password=None, wallet: Abstract_Wallet = None) -> str:
         """Decrypt a message encrypted with a public key."""
         if not is_hex_str(pubkey):
@@ -755,7 +797,7 @@ class Commands:
         decrypted = wallet.decrypt_message(pubkey, encrypted, password)
         return decrypted.decode('utf-8')
 
-    @command('w')
+    @command('wt')
     async def getrequest(self, key, wallet: Abstract_Wallet = None):
         """Return a payment request"""
         r = wallet.get_request(key)
@@ -768,7 +810,7 @@ class Commands:
     #    """<Not implemented>"""
     #    pass
 
-    @command('w')
+    @command('wt')
     async def list_requests(self, pending=False, expired=False, paid=False, wallet: Abstract_Wallet = None):
         """List the payment requests you made."""
         if pending:
@@ -894,6 +936,20 @@ class Commands:
             await self._notifier.stop_watching_addr(address)
         return True
 
+    async def stop_notifier(self):
+        """Stops the notify command, saving the events not delivered yet."""
+        if hasattr(self, "_notifier"):
+            await self._notifier.stop()
+
+    @command('n')
+    async def getwebhookstats(self):
+        """Return the number of events delivered, queued and dropped by
+        the notify command, failed requests and the delivery latency histogram.
+        """
+        if not hasattr(self, "_notifier"):
+            return {}
+        return self._notifier.webhooks.get_stats()
+
     @command('wn')
     async def is_synchronized(self, wallet: Abstract_Wallet = None):
         """ return wallet synchronization status """
@@ -1217,6 +1273,8 @@ command_options = {
     'to_height':   (None, "Only show transactions that confirmed before given block height"),
     'iknowwhatimdoing': (None, "Acknowledge that I understand the full implications of what I am about to do"),
     'gossip':      (None, "Apply command to gossip node instead of wallet"),
+    'sampling_file': (None, "Also sample stacks, and write them as collapsed stacks to this file"),
+    'reset':       (None, "Reset the statistics after returning them"),
 }
 
 
@@ -360,7 +360,7 @@ def chacha20_poly1305_decrypt(
     assert isinstance(key, (bytes, bytearray))
     assert isinstance(nonce, (bytes, bytearray))
     assert isinstance(associated_data, (bytes, bytearray, type(None)))
-    assert isinstance(data, (bytes, bytearray))
+    assert isinstance(data, (bytes, bytearray, memoryview))
     if HAS_CRYPTODOME:
         cipher = CD_ChaCha20_Poly1305.new(key=key, nonce=nonce)
         if associated_data is not None:
@@ -25,30 +25,38 @@
 import asyncio
 import ast
 import os
+import shutil
 import time
 import traceback
 import sys
 import threading
-from typing import Dict, Optional, Tuple, Iterable, Callable, Union, Sequence, Mapping
+from typing import Dict, Optional, Tuple, Iterable, Callable, Union, Sequence, Mapping, NamedTuple, Set
 from base64 import b64decode, b64encode
 from collections import defaultdict
 import concurrent
 from concurrent import futures
 import json
+import weakref
+import zlib
 
 import aiohttp
 from aiohttp import web, client_exceptions
-from aiorpcx import TaskGroup
+from aiorpcx import TaskGroup, run_in_thread
 
 from . import util
+from . import instrumentation
 from .network import Network
+from .network_stats import to_prometheus_text
 from .util import (json_decode, to_bytes, to_string, profiler, standardize_path, constant_time_compare)
-from .invoices import PR_PAID, PR_EXPIRED
+from .invoices import Invoice, PR_PAID, PR_EXPIRED, PR_UNKNOWN, PR_UNPAID, pr_tooltips
 from .util import log_exceptions, ignore_exceptions, randrange
+from .util import JSONRPC_METHOD_NOT_FOUND, JsonRPCMethodNotFound
 from .wallet import Wallet, Abstract_Wallet
+from .lnworker import LNWallet
 from .storage import WalletStorage
 from .wallet_db import WalletDB
 from .commands import known_commands, Commands
+from .synchronizer import HibernationWatcher, history_status
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
 from .logging import get_logger, Logger
@@ -56,6 +64,46 @@ from .logging import get_logger, Logger
 
 _logger = get_logger(__name__)
 
+# bulk sweep tx uploads are larger than aiohttp's default limit of 1 MB
+WATCHTOWER_MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# threads running the commands that block on wallet or storage code ('rpc_workers')
+DEFAULT_RPC_WORKERS = 4
+# commands of the same wallet running at a time in the worker threads
+# ('rpc_wallet_concurrency'), so that one busy wallet cannot starve the others
+DEFAULT_RPC_WALLET_CONCURRENCY = 2
+# JSON-RPC 2.0 error code for malformed entries of a batch
+JSONRPC_INVALID_REQUEST = -32600
+# commands of the same batch running at a time
+JSONRPC_BATCH_CONCURRENCY = 8
+# seconds between two heartbeats on the status streams of the PayServer
+PAYSERVER_HEARTBEAT_INTERVAL = 10
+# default maximum number of open status streams ('payserver_max_connections')
+PAYSERVER_MAX_CONNECTIONS = 1000
+# maximum number of payment requests followed by one status stream
+PAYSERVER_MAX_KEYS_PER_STREAM = 100
+# seconds between two checks for idle wallets to hibernate ('wallet_hibernate_after')
+WALLET_HIBERNATION_CHECK_INTERVAL = 60
+
+_worker_local = threading.local()
+
+
+def _init_command_worker(loop: asyncio.AbstractEventLoop) -> None:
+    _worker_local.is_worker = True
+    # code scheduling work on the event loop from the worker finds the daemon's loop
+    asyncio.set_event_loop(loop)
+
+
+def _run_in_command_worker(coro):
+    """Runs a command coroutine to completion, in a worker thread.
+    Commands marked to run in workers never suspend; one that does is a bug.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise Exception("command awaited the event loop in a worker thread")
+
 
 class DaemonNotRunning(Exception):
     pass
@@ -172,30 +220,30 @@ class AuthenticatedServer(Logger):
         username, _, password = credentials.partition(':')
         if not (constant_time_compare(username, self.rpc_user)
                 and constant_time_compare(password, self.rpc_password)):
-            await asyncio.sleep(0.050)
+            # throttle brute-forcing, without serializing valid requests
+            async with self.auth_lock:
+                await asyncio.sleep(0.050)
             raise AuthenticationCredentialsInvalid('Invalid Credentials')
 
-    async def handle(self, request):
-        async with self.auth_lock:
-            try:
-                await self.authenticate(request.headers)
-            except AuthenticationInvalidOrMissing:
-                return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
-                                    text='Unauthorized', status=401)
-            except AuthenticationCredentialsInvalid:
-                return web.Response(text='Forbidden', status=403)
-        try:
-            request = await request.text()
-            request = json.loads(request)
-            method = request['method']
-            _id = request['id']
-            params = request.get('params', [])  # type: Union[Sequence, Mapping]
-            if method not in self._methods:
-                raise Exception(f"attempting to use unregistered method: {method}")
-            f = self._methods[method]
-        except Exception as e:
-            self.logger.exception("invalid request")
-            return web.Response(text='Invalid Request', status=500)
+    def _parse_request(self, request) -> Tuple[Callable, Union[Sequence, Mapping]]:
+        method = request['method']
+        params = request.get('params', [])  # type: Union[Sequence, Mapping]
+        if method not in self._methods:
+            raise JsonRPCMethodNotFound(f"attempting to use unregistered method: {method}")
+        return self._methods[method], params
+
+    @classmethod
+    def _error_response(cls, _id, code: int, message: str) -> dict:
+        return {
+            'id': _id,
+            'jsonrpc': '2.0',
+            'error': {
+                'code': code,
+                'message': message,
+            },
+        }
+
+    async def _call(self, _id, f, params) -> dict:
         response = {
             'id': _id,
             'jsonrpc': '2.0',
@@ -211,7 +259,61 @@ class AuthenticatedServer(Logger):
                 'code': 1,
                 'message': str(e),
             }
-        return web.json_response(response)
+        return response
+
+    async def _handle_batch_item(self, request, semaphore: asyncio.Semaphore) -> Optional[dict]:
+        # malformed entries get an error response, the others are still executed.
+        # Entries without an id are notifications, that get no response.
+        is_notification = isinstance(request, dict) and 'method' in request and 'id' not in request
+        try:
+            _id = request.get('id')
+            f, params = self._parse_request(request)
+        except JsonRPCMethodNotFound as e:
+            self.logger.info(f"invalid request in batch: {e!r}")
+            if is_notification:
+                return None
+            return self._error_response(_id, JSONRPC_METHOD_NOT_FOUND, 'Method not found')
+        except Exception as e:
+            self.logger.info(f"invalid request in batch: {e!r}")
+            _id = request.get('id') if isinstance(request, dict) else None
+            return self._error_response(_id, JSONRPC_INVALID_REQUEST, 'Invalid Request')
+        async with semaphore:
+            response = await self._call(_id, f, params)
+        return None if is_notification else response
+
+    async def handle(self, request):
+        try:
+            await self.authenticate(request.headers)
+        except AuthenticationInvalidOrMissing:
+            return web.Response(headers={"WWW-Authenticate": "Basic realm=Electrum"},
+                                text='Unauthorized', status=401)
+        except AuthenticationCredentialsInvalid:
+            return web.Response(text='Forbidden', status=403)
+        try:
+            request = await request.text()
+            request = json.loads(request)
+            if isinstance(request, list):
+                if not request:
+                    raise Exception("empty batch")
+            else:
+                _id = request['id']
+                f, params = self._parse_request(request)
+        except JsonRPCMethodNotFound as e:
+            self.logger.info(f"invalid request: {e!r}")
+            return web.json_response(self._error_response(_id, JSONRPC_METHOD_NOT_FOUND, 'Method not found'))
+        except Exception as e:
+            self.logger.exception("invalid request")
+            return web.Response(text='Invalid Request', status=500)
+        if isinstance(request, list):
+            # the commands of a batch run concurrently; responses are in request order
+            semaphore = asyncio.Semaphore(JSONRPC_BATCH_CONCURRENCY)
+            responses = await asyncio.gather(*[self._handle_batch_item(item, semaphore) for item in request])
+            responses = [response for response in responses if response is not None]
+            if not responses:
+                # a batch of notifications only
+                return web.Response(status=204)
+            return web.json_response(responses)
+        return web.json_response(await self._call(_id, f, params))
 
 
 class CommandsServer(AuthenticatedServer):
@@ -291,10 +393,11 @@ class WatchTowerServer(AuthenticatedServer):
         watchtower_password = self.config.get('watchtower_password', '')
         AuthenticatedServer.__init__(self, watchtower_user, watchtower_password)
         self.lnwatcher = network.local_watchtower
-        self.app = web.Application()
+        self.app = web.Application(client_max_size=WATCHTOWER_MAX_REQUEST_SIZE)
         self.app.router.add_post("/", self.handle)
         self.register_method(self.get_ctn)
         self.register_method(self.add_sweep_tx)
+        self.register_method(self.add_sweep_txs)
 
     async def run(self):
         self.runner = web.AppRunner(self.app)
@@ -308,6 +411,9 @@ class WatchTowerServer(AuthenticatedServer):
     async def add_sweep_tx(self, *args):
         return await self.lnwatcher.sweepstore.add_sweep_tx(*args)
 
+    async def add_sweep_txs(self, *args):
+        return await self.lnwatcher.sweepstore.add_sweep_txs(*args)
+
 
 class PayServer(Logger):
 
@@ -316,37 +422,51 @@ class PayServer(Logger):
         self.addr = netaddress
         self.daemon = daemon
         self.config = daemon.config
-        self.pending = defaultdict(asyncio.Event)
-        util.register_callback(self.on_payment, ['request_status'])
+        # request key -> queues of the status streams following it
+        self._status_queues = defaultdict(set)  # type: Dict[str, Set[asyncio.Queue]]
+        self.num_streams = 0
+        self.max_streams = self.config.get('payserver_max_connections', PAYSERVER_MAX_CONNECTIONS)
+        util.register_callback(self.on_request_status, ['request_status'])
 
     @property
-    def wallet(self):
-        # FIXME specify wallet somehow?
-        return list(self.daemon.get_wallets().values())[0]
+    def wallet_path(self) -> str:
+        # the wallet of the requests created by the server ('payserver_wallet')
+        return standardize_path(self.config.get('payserver_wallet') or self.config.get_wallet_path())
+
+    async def get_wallet(self) -> Abstract_Wallet:
+        await self.daemon.wake_wallet(self.wallet_path)
+        wallet = self.daemon.get_wallet(self.wallet_path)
+        if wallet is None:
+            raise web.HTTPServiceUnavailable(text='wallet not loaded')
+        return wallet
 
-    async def on_payment(self, evt, wallet, key, status):
-        if status == PR_PAID:
-            self.pending[key].set()
+    async def on_request_status(self, evt, wallet, key, status):
+        for queue in self._status_queues.get(key, ()):
+            queue.put_nowait((wallet, key, status))
 
-    @ignore_exceptions
-    @log_exceptions
-    async def run(self):
+    def make_app(self) -> web.Application:
         root = self.config.get('payserver_root', '/r')
         app = web.Application()
         app.add_routes([web.get('/api/get_invoice', self.get_request)])
         app.add_routes([web.get('/api/get_status', self.get_status)])
+        app.add_routes([web.get('/api/events', self.get_events)])
         app.add_routes([web.get('/bip70/{key}.bip70', self.get_bip70_request)])
         app.add_routes([web.static(root, os.path.join(os.path.dirname(__file__), 'www'))])
         if self.config.get('payserver_allow_create_invoice'):
             app.add_routes([web.post('/api/create_invoice', self.create_request)])
-        runner = web.AppRunner(app)
+        return app
+
+    @ignore_exceptions
+    @log_exceptions
+    async def run(self):
+        runner = web.AppRunner(self.make_app())
         await runner.setup()
         site = web.TCPSite(runner, host=str(self.addr.host), port=self.addr.port, ssl_context=self.config.get_ssl_context())
         await site.start()
 
     async def create_request(self, request):
         params = await request.post()
-        wallet = self.wallet
+        wallet = await self.get_wallet()
         if 'amount_sat' not in params or not params['amount_sat'].isdigit():
             raise web.HTTPUnsupportedMediaType()
         amount = int(params['amount_sat'])
@@ -360,47 +480,161 @@ class PayServer(Logger):
 
     async def get_request(self, r):
         key = r.query_string
-        request = self.wallet.get_formatted_request(key)
+        wallet = await self.get_wallet()
+        request = wallet.get_formatted_request(key)
         return web.json_response(request)
 
     async def get_bip70_request(self, r):
         from .paymentrequest import make_request
         key = r.match_info['key']
-        request = self.wallet.get_request(key)
+        wallet = await self.get_wallet()
+        request = wallet.get_request(key)
         if not request:
             return web.HTTPNotFound()
         pr = make_request(self.config, request)
         return web.Response(body=pr.SerializeToString(), content_type='application/bitcoin-paymentrequest')
 
+    async def _find_wallet(self, key: str) -> Optional[Abstract_Wallet]:
+        path = self.daemon.find_request_wallet_path(key)
+        if path is None:
+            return None
+        await self.daemon.wake_wallet(path)
+        return self.daemon.get_wallet(path)
+
+    def _open_stream(self, keys: Sequence[str]) -> asyncio.Queue:
+        if self.num_streams >= self.max_streams:
+            raise web.HTTPServiceUnavailable(text='too many connections')
+        self.num_streams += 1
+        queue = asyncio.Queue()
+        for key in keys:
+            self._status_queues[key].add(queue)
+        return queue
+
+    def _close_stream(self, keys: Sequence[str], queue: asyncio.Queue) -> None:
+        self.num_streams -= 1
+        for key in keys:
+            queues = self._status_queues.get(key)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self._status_queues[key]
+
     async def get_status(self, request):
-        ws = web.WebSocketResponse()
-        await ws.prepare(request)
         key = request.query_string
-        info = self.wallet.get_formatted_request(key)
-        if not info:
-            await ws.send_str('unknown invoice')
-            await ws.close()
-            return ws
-        if info.get('status') == PR_PAID:
-            await ws.send_str(f'paid')
-            await ws.close()
-            return ws
-        if info.get('status') == PR_EXPIRED:
-            await ws.send_str(f'expired')
+        queue = self._open_stream([key])
+        try:
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            wallet = await self._find_wallet(key)
+            info = wallet.get_formatted_request(key) if wallet else None
+            if not info:
+                await ws.send_str('unknown invoice')
+                await ws.close()
+                return ws
+            if info.get('status') == PR_PAID:
+                await ws.send_str(f'paid')
+                await ws.close()
+                return ws
+            if info.get('status') == PR_EXPIRED:
+                await ws.send_str(f'expired')
+                await ws.close()
+                return ws
+            while True:
+                try:
+                    wallet, key, status = await asyncio.wait_for(queue.get(), PAYSERVER_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    # send data on the websocket, to keep it alive
+                    await ws.send_str('waiting')
+                    continue
+                if status == PR_PAID:
+                    break
+            await ws.send_str('paid')
             await ws.close()
             return ws
-        while True:
-            try:
-                await asyncio.wait_for(self.pending[key].wait(), 1)
-                break
-            except asyncio.TimeoutError:
-                # send data on the websocket, to keep it alive
-                await ws.send_str('waiting')
-        await ws.send_str('paid')
-        await ws.close()
-        return ws
+        finally:
+            self._close_stream([key], queue)
+
+    async def get_events(self, request):
+        """Server-Sent Events stream of the status of the payment requests
+        given as 'key' query parameters. The current status of each request
+        is sent first, then every change.
+        """
+        keys = list(dict.fromkeys(request.query.getall('key', [])))
+        if not keys or len(keys) > PAYSERVER_MAX_KEYS_PER_STREAM:
+            raise web.HTTPBadRequest(text='invalid number of keys')
+        queue = self._open_stream(keys)
+        try:
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                                   'Cache-Control': 'no-cache'})
+            await response.prepare(request)
+            statuses = {}
+            requests = {}  # type: Dict[str, Invoice]
+
+            async def send_status(key, status):
+                if statuses.get(key) == status:
+                    return
+                statuses[key] = status
+                data = json.dumps({'key': key, 'status': status, 'status_str': pr_tooltips.get(status)})
+                await response.write(f'event: request_status\ndata: {data}\n\n'.encode('utf8'))
+
+            for key in keys:
+                wallet = await self._find_wallet(key)
+                if wallet:
+                    requests[key] = wallet.get_request(key)
+                await send_status(key, wallet.get_request_status(key) if wallet else PR_UNKNOWN)
+            # a timer, not a timeout on the queue, which would be reset by every event
+            next_check = time.monotonic() + PAYSERVER_HEARTBEAT_INTERVAL
+            while True:
+                try:
+                    wallet, key, status = await asyncio.wait_for(queue.get(), max(0, next_check - time.monotonic()))
+                except asyncio.TimeoutError:
+                    next_check = time.monotonic() + PAYSERVER_HEARTBEAT_INTERVAL
+                    # requests expire without a notification. A payment would
+                    # have been notified, even for the request of a hibernated wallet.
+                    for key, req in requests.items():
+                        if statuses[key] == PR_UNPAID and req.exp > 0 and req.time + req.exp < time.time():
+                            await send_status(key, PR_EXPIRED)
+                    await response.write(b': heartbeat\n\n')
+                    continue
+                req = wallet.get_request(key)
+                if req:
+                    requests[key] = req
+                await send_status(key, status)
+        finally:
+            self._close_stream(keys, queue)
 
 
+class MetricsServer(Logger):
+    """Serves network statistics in the prometheus text format."""
+
+    def __init__(self, network: 'Network', netaddress):
+        Logger.__init__(self)
+        self.addr = netaddress
+        self.network = network
+        self.config = network.config
+
+    @ignore_exceptions
+    @log_exceptions
+    async def run(self):
+        app = web.Application()
+        app.add_routes([web.get('/metrics', self.get_metrics)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host=str(self.addr.host), port=self.addr.port, ssl_context=self.config.get_ssl_context())
+        await site.start()
+
+    async def get_metrics(self, request):
+        text = to_prometheus_text(self.network.get_network_stats())
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+
+class HibernatedWallet(NamedTuple):
+    # for encrypted wallet files, which cannot be read back without the password:
+    # the storage encryption key and the zlib-compressed wallet db. None otherwise.
+    pubkey: Optional[str]
+    data: Optional[bytes]
+
 
 class Daemon(Logger):
 
@@ -427,6 +661,23 @@ class Daemon(Logger):
         self.gui_object = None
         # path -> wallet;   make sure path is standardized.
         self._wallets = {}  # type: Dict[str, Abstract_Wallet]
+        # commands that block on wallet or storage code run in these threads,
+        # to keep the event loop responsive
+        self.command_executor = futures.ThreadPoolExecutor(
+            max_workers=config.get('rpc_workers', DEFAULT_RPC_WORKERS),
+            thread_name_prefix='CommandWorker',
+            initializer=_init_command_worker,
+            initargs=(self.asyncio_loop,))
+        self._wallet_semaphores = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[Abstract_Wallet, asyncio.Semaphore]
+        # wallets idle for 'wallet_hibernate_after' seconds are evicted from memory,
+        # and reloaded on the next command or on activity on their addresses
+        self.hibernate_after = config.get('wallet_hibernate_after', 0)
+        self._hibernated_wallets = {}  # type: Dict[str, HibernatedWallet]
+        self._waking_wallets = {}  # type: Dict[str, asyncio.Future]
+        # payment request key -> path of its wallet, hibernated wallets included
+        self._request_wallet_paths = {}  # type: Dict[str, str]
+        self._wallet_last_used = {}  # type: Dict[str, float]
+        self.hibernation_watcher = None  # type: Optional[HibernationWatcher]
         daemon_jobs = []
         # Setup commands server
         self.commands_server = None
@@ -445,6 +696,16 @@ class Daemon(Logger):
         if not config.get('offline') and watchtower_address:
             self.watchtower = WatchTowerServer(self.network, watchtower_address)
             daemon_jobs.append(self.watchtower.run)
+        # prometheus metrics
+        self.metrics_server = None
+        metrics_address = self.config.get_netaddress('metrics_address')
+        if self.network and metrics_address:
+            self.metrics_server = MetricsServer(self.network, metrics_address)
+            daemon_jobs.append(self.metrics_server.run())
+        if self.hibernate_after:
+            daemon_jobs.append(self._hibernate_idle_wallets())
+            if self.network:
+                self.hibernation_watcher = HibernationWatcher(self.network, self._on_hibernated_wallet_activity)
         if self.network:
             self.network.start(jobs=[self.fx.run])
             # prepare lightning functionality, also load channel db early
@@ -469,12 +730,15 @@ class Daemon(Logger):
         finally:
             self.logger.info("taskgroup stopped.")
 
+    @instrumentation.traced('wallet.load')
     def load_wallet(self, path, password, *, manual_upgrades=True) -> Optional[Abstract_Wallet]:
         path = standardize_path(path)
         # wizard will be launched if we return
         if path in self._wallets:
             wallet = self._wallets[path]
             return wallet
+        if path in self._hibernated_wallets:
+            return self._wake_wallet(path)
         storage = WalletStorage(path)
         if not storage.file_exists():
             return
@@ -492,23 +756,56 @@ class Daemon(Logger):
             return
         wallet = Wallet(db, storage, config=self.config)
         wallet.start_network(self.network)
-        self._wallets[path] = wallet
+        self.add_wallet(wallet)
         return wallet
 
     def add_wallet(self, wallet: Abstract_Wallet) -> None:
         path = wallet.storage.path
         path = standardize_path(path)
         self._wallets[path] = wallet
+        self._wallet_last_used[path] = time.monotonic()
+        self._index_requests(path, wallet)
 
     def get_wallet(self, path: str) -> Optional[Abstract_Wallet]:
         path = standardize_path(path)
-        return self._wallets.get(path)
+        if path in self._hibernated_wallets:
+            return self._wake_wallet(path)
+        wallet = self._wallets.get(path)
+        if wallet:
+            self._wallet_last_used[path] = time.monotonic()
+        return wallet
 
     def get_wallets(self) -> Dict[str, Abstract_Wallet]:
         return dict(self._wallets)  # copy
 
+    def get_hibernated_wallets(self) -> Sequence[str]:
+        return list(self._hibernated_wallets)
+
+    def _index_requests(self, path: str, wallet: Abstract_Wallet) -> None:
+        for key in wallet.receive_requests:
+            self._request_wallet_paths[key] = path
+
+    def find_request_wallet_path(self, key: str) -> Optional[str]:
+        """Returns the path of the wallet, loaded or hibernated, that has
+        the payment request key.
+        """
+        path = self._request_wallet_paths.get(key)
+        if path in self._hibernated_wallets:
+            return path
+        wallet = self._wallets.get(path)
+        if wallet and wallet.get_request(key):
+            return path
+        # the request may have been created after its wallet was indexed
+        for path, wallet in self._wallets.items():
+            if wallet.get_request(key):
+                self._request_wallet_paths[key] = path
+                return path
+
     def delete_wallet(self, path: str) -> bool:
         self.stop_wallet(path)
+        archive_dir = LNWallet.get_htlc_archive_dir(path)
+        if os.path.exists(archive_dir):
+            shutil.rmtree(archive_dir)
         if os.path.exists(path):
             os.unlink(path)
             return True
@@ -517,12 +814,149 @@ class Daemon(Logger):
     def stop_wallet(self, path: str) -> bool:
         """Returns True iff a wallet was found."""
         path = standardize_path(path)
+        self._wallet_last_used.pop(path, None)
+        self._request_wallet_paths = {key: p for key, p in self._request_wallet_paths.items() if p != path}
+        if self._hibernated_wallets.pop(path, None) is not None:
+            if self.hibernation_watcher:
+                self.hibernation_watcher.unwatch(path)
+            return True
         wallet = self._wallets.pop(path, None)
         if not wallet:
             return False
         wallet.stop()
         return True
 
+    def can_hibernate(self, wallet: Abstract_Wallet) -> bool:
+        if not wallet.storage:
+            return False
+        if wallet.network and (not wallet.is_up_to_date() or wallet.get_unverified_txs()):
+            return False
+        # lightning needs the wallet for its channels and peers
+        if wallet.lnworker and wallet.lnworker.channels:
+            return False
+        # the pay server serves the requests of its wallet
+        if self.pay_server and standardize_path(wallet.storage.path) == self.pay_server.wallet_path:
+            return False
+        return True
+
+    @instrumentation.traced('wallet.hibernate')
+    def hibernate_wallet(self, path: str) -> None:
+        """Evicts a loaded wallet from memory. Its addresses are watched,
+        so that it is woken up if one of them gets a new transaction.
+        """
+        path = standardize_path(path)
+        wallet = self._wallets.pop(path)
+        # including the requests created since the wallet was loaded
+        self._index_requests(path, wallet)
+        statuses = {addr: history_status(wallet.db.get_addr_history(addr))
+                    for addr in wallet.get_addresses()}
+        wallet.stop()
+        if wallet.storage.is_encrypted():
+            hibernated = HibernatedWallet(pubkey=wallet.storage.pubkey,
+                                          data=zlib.compress(wallet.db.dump().encode('utf8')))
+        else:
+            hibernated = HibernatedWallet(pubkey=None, data=None)
+        self._hibernated_wallets[path] = hibernated
+        if self.hibernation_watcher:
+            self.hibernation_watcher.watch(path, statuses)
+        self.logger.info(f"hibernated wallet {path}")
+
+    @staticmethod
+    def _read_hibernated_wallet(path: str, hibernated: HibernatedWallet,
+                                config: SimpleConfig) -> Optional[Abstract_Wallet]:
+        storage = WalletStorage(path)
+        if not storage.file_exists():
+            return
+        if hibernated.data is not None:
+            # what storage.decrypt() sets, without needing the password
+            storage.pubkey = hibernated.pubkey
+            storage.decrypted = zlib.decompress(hibernated.data).decode('utf8')
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        return Wallet(db, storage, config=config)
+
+    def _add_woken_wallet(self, path: str, wallet: Optional[Abstract_Wallet]) -> Optional[Abstract_Wallet]:
+        self._hibernated_wallets.pop(path)
+        if self.hibernation_watcher:
+            self.hibernation_watcher.unwatch(path)
+        if wallet is None:
+            return
+        wallet.start_network(self.network)
+        self.add_wallet(wallet)
+        self.logger.info(f"woke up wallet {path}")
+        return wallet
+
+    @instrumentation.traced('wallet.wake')
+    def _wake_wallet(self, path: str) -> Optional[Abstract_Wallet]:
+        wallet = self._read_hibernated_wallet(path, self._hibernated_wallets[path], self.config)
+        return self._add_woken_wallet(path, wallet)
+
+    async def wake_wallet(self, path: str) -> None:
+        """Wakes up path if it is hibernated. Unlike get_wallet, the wallet
+        file is read and decrypted in a thread, not on the event loop.
+        """
+        path = standardize_path(path)
+        fut = self._waking_wallets.get(path)
+        if fut is None:
+            if path not in self._hibernated_wallets:
+                return
+            fut = asyncio.ensure_future(self._wake_wallet_in_thread(path))
+            self._waking_wallets[path] = fut
+            fut.add_done_callback(lambda f: self._waking_wallets.pop(path, None))
+        await asyncio.shield(fut)
+
+    @instrumentation.traced('wallet.wake')
+    async def _wake_wallet_in_thread(self, path: str) -> None:
+        hibernated = self._hibernated_wallets[path]
+        wallet = await run_in_thread(self._read_hibernated_wallet, path, hibernated, self.config)
+        if self._hibernated_wallets.get(path) is not hibernated:
+            return  # woken up by get_wallet, or stopped, meanwhile
+        self._add_woken_wallet(path, wallet)
+
+    @ignore_exceptions
+    @log_exceptions
+    async def _wake_wallet_on_activity(self, path: str) -> None:
+        await self.wake_wallet(path)
+
+    def _on_hibernated_wallet_activity(self, path: str) -> None:
+        # called by the hibernation watcher, on the event loop
+        asyncio.ensure_future(self._wake_wallet_on_activity(path))
+
+    def hibernate_idle_wallets(self) -> None:
+        if self.gui_object:
+            return  # wallets may be open in windows
+        now = time.monotonic()
+        for path, wallet in list(self._wallets.items()):
+            if now - self._wallet_last_used.get(path, now) < self.hibernate_after:
+                continue
+            if self.can_hibernate(wallet):
+                self.hibernate_wallet(path)
+
+    async def _hibernate_idle_wallets(self):
+        while True:
+            await asyncio.sleep(WALLET_HIBERNATION_CHECK_INTERVAL)
+            self.hibernate_idle_wallets()
+
+    async def run_in_worker(self, func, *args, **kwargs):
+        """Awaits the command coroutine func(*args, **kwargs) in a worker thread.
+        At most 'rpc_wallet_concurrency' commands of the same wallet run at a time.
+        """
+        if getattr(_worker_local, 'is_worker', False):
+            # nested command call, already in a worker
+            return await func(*args, **kwargs)
+        wallet = kwargs.get('wallet')
+        if wallet is None:
+            return await self._run_in_worker(func, args, kwargs)
+        semaphore = self._wallet_semaphores.get(wallet)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.config.get('rpc_wallet_concurrency', DEFAULT_RPC_WALLET_CONCURRENCY))
+            self._wallet_semaphores[wallet] = semaphore
+        async with semaphore:
+            return await self._run_in_worker(func, args, kwargs)
+
+    async def _run_in_worker(self, func, args, kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.command_executor, _run_in_command_worker, func(*args, **kwargs))
+
     def run_daemon(self):
         self.running = True
         try:
@@ -546,9 +980,17 @@ class Daemon(Logger):
         # stop network/wallets
         for k, wallet in self._wallets.items():
             wallet.stop()
+        if self.commands_server:
+            self.logger.info("stopping notifier")
+            fut = asyncio.run_coroutine_threadsafe(self.commands_server.cmd_runner.stop_notifier(), self.asyncio_loop)
+            try:
+                fut.result(timeout=2)
+            except concurrent.futures.TimeoutError:
+                self.logger.info("timeout while stopping notifier")
         if self.network:
             self.logger.info("shutting down network")
             self.network.stop()
+        self.command_executor.shutdown(wait=False)
         self.logger.info("stopping taskgroup")
         fut = asyncio.run_coroutine_threadsafe(self.taskgroup.cancel_remaining(), self.asyncio_loop)
         try:
@@ -0,0 +1,221 @@
+# Copyright (C) 2020 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+"""
+instrumentation.py contains named spans and counters that can be turned on
+and off at runtime, and a sampling profiler writing collapsed stacks.
+
+While disabled, spans and counters cost a single check of a global.
+Note: this module must only depend on the standard library,
+as it is imported by util.
+"""
+
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict, Optional
+
+
+# number of most recent durations per span used to compute percentiles
+SPAN_SAMPLES = 1000
+
+_enabled = False
+_lock = threading.Lock()
+_spans = {}  # type: Dict[str, _SpanStats]
+_counters = defaultdict(int)  # type: Dict[str, int]
+_sampling_profiler = None  # type: Optional[SamplingProfiler]
+
+
+class _SpanStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=SPAN_SAMPLES)
+
+    def add(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.recent.append(duration)
+
+    def to_json(self) -> dict:
+        recent = sorted(self.recent)
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(len(recent) * p / 100))]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'max': self.max,
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+        }
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def set_enabled(enabled: bool) -> None:
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def record_span(name: str, duration: float) -> None:
+    """Records a duration (in seconds) for span name."""
+    if not _enabled:
+        return
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = _SpanStats()
+        stats.add(duration)
+
+
+def count(name: str, n: int = 1) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+class _Span:
+    __slots__ = ('name', 'start_time')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc):
+        record_span(self.name, time.perf_counter() - self.start_time)
+
+
+class _NoopSpan:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str):
+    """Context manager timing its body as span name.
+    e.g.:  with instrumentation.span('wallet.sign'): ...
+    """
+    return _Span(name) if _enabled else _NOOP_SPAN
+
+
+def traced(name: str) -> Callable:
+    """Decorator timing each call of a function or coroutine as span name."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                start_time = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record_span(name, time.perf_counter() - start_time)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                start_time = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    record_span(name, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
+
+
+def get_stats(*, reset: bool = False) -> dict:
+    with _lock:
+        stats = {
+            'enabled': _enabled,
+            'spans': {name: s.to_json() for name, s in sorted(_spans.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+        if reset:
+            _spans.clear()
+            _counters.clear()
+    return stats
+
+
+def reset() -> None:
+    get_stats(reset=True)
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of all other threads every interval seconds.
+    On stop(), the samples are written to path as collapsed stacks
+    (one 'frame;frame;...;frame count' line per distinct stack),
+    the input format of flamegraph tools.
+    """
+
+    def __init__(self, path: str, *, interval: float = 0.01):
+        threading.Thread.__init__(self, name='SamplingProfiler', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stacks = defaultdict(int)  # type: Dict[str, int]
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ';'.join(reversed(frames)).replace(' ', '_')
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                self.stacks[self._collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+
+    def stop(self) -> int:
+        """Stops sampling, writes the file and returns the number of samples."""
+        self._stopping.set()
+        self.join()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write(f"{stack} {n}\n")
+        return sum(self.stacks.values())
+
+
+def start_sampling(path: str, *, interval: float = 0.01) -> None:
+    global _sampling_profiler
+    if _sampling_profiler is not None:
+        raise Exception('sampling profiler already running')
+    _sampling_profiler = SamplingProfiler(path, interval=interval)
+    _sampling_profiler.start()
+
+
+def stop_sampling() -> Optional[int]:
+    """Returns the number of samples written, or None if not sampling."""
+    global _sampling_profiler
+    if _sampling_profiler is None:
+        return None
+    profiler, _sampling_profiler = _sampling_profiler, None
+    return profiler.stop()
@@ -29,6 +29,7 @@ import sys
 import traceback
 import asyncio
 import socket
+import time
 from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
@@ -70,6 +71,10 @@ BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 1_000_000  # in bytes
 
+# Cheap requests that all interfaces make, not only the main one.
+# Their round-trip times are comparable across servers, and feed the server scores.
+LATENCY_PROBE_METHODS = {'server.version', 'server.ping', 'blockchain.estimatefee', 'blockchain.block.header'}
+
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
 assert PREFERRED_NETWORK_PROTOCOL in _KNOWN_NETWORK_PROTOCOLS
@@ -164,6 +169,10 @@ class NotificationSession(RPCSession):
         # aiorpcx. the timeout arg here in most cases should not be set
         msg_id = next(self._msg_counter)
         self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+        method = args[0]
+        self._on_request_started(method)
+        start_time = time.monotonic()
+        answered = timed_out = error = False
         try:
             # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
@@ -171,13 +180,39 @@ class NotificationSession(RPCSession):
                 super().send_request(*args, **kwargs),
                 timeout)
         except (TaskTimeout, asyncio.TimeoutError) as e:
+            timed_out = True
             raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
         except CodeMessageError as e:
+            answered = error = True
             self.maybe_log(f"--> {repr(e)} (id: {msg_id})")
             raise
         else:
+            answered = True
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
+        finally:
+            duration = time.monotonic() - start_time if answered else None
+            self._on_request_finished(method, duration, timed_out=timed_out, error=error)
+
+    def _on_request_started(self, method: str) -> None:
+        if not self.interface: return
+        self.interface.network.stats.request_started(self.interface.diagnostic_name(), method)
+
+    def _on_request_finished(self, method: str, duration: Optional[float], *,
+                             timed_out: bool, error: bool) -> None:
+        """duration is None if the request was not answered"""
+        if not self.interface: return
+        network = self.interface.network
+        server = self.interface.server
+        network.stats.request_finished(server.net_addr_str(), method, duration,
+                                       timed_out=timed_out, error=error)
+        # only the main interface makes the other requests; counting them would penalize it
+        if method not in LATENCY_PROBE_METHODS:
+            return
+        if timed_out:
+            network.server_scores.add_timeout(server)
+        elif duration is not None:
+            network.server_scores.add_response(server, duration)
 
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
@@ -699,6 +734,7 @@ class Interface(Logger):
             # header processing done
             util.trigger_callback('blockchain_updated')
             util.trigger_callback('network_updated')
+            self.network.update_server_tip_lags()
             await self.network.switch_unwanted_fork_interface()
             await self.network.switch_lagging_interface()
 
@@ -55,7 +55,7 @@ from .lnutil import (Outpoint, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKey
                      received_htlc_trim_threshold_sat, make_commitment_output_to_remote_address)
 from .lnsweep import create_sweeptxs_for_our_ctx, create_sweeptxs_for_their_ctx
 from .lnsweep import create_sweeptx_for_their_revoked_htlc, SweepInfo
-from .lnhtlc import HTLCManager
+from .lnhtlc import HTLCManager, HTLCArchive
 from .lnmsg import encode_msg, decode_msg
 from .address_synchronizer import TX_HEIGHT_LOCAL
 from .lnutil import CHANNEL_OPENING_TIMEOUT
@@ -665,27 +665,58 @@ class Channel(AbstractChannel):
 
     def get_payments(self):
         out = []
-        for direction, htlc in self.hm.all_htlcs_ever():
-            htlc_proposer = LOCAL if direction is SENT else REMOTE
-            if self.hm.was_htlc_failed(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
-                status = 'failed'
-            elif self.hm.was_htlc_preimage_released(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
-                status = 'settled'
-            else:
-                status = 'inflight'
-            rhash = htlc.payment_hash.hex()
-            out.append((rhash, self.channel_id, htlc, direction, status))
+        # htlcs may move from the log to the archive in the meantime
+        with self.hm.lock:
+            if self.hm.archive is not None:
+                for htlc_proposer, log_action, htlc in self.hm.archive.iter_htlcs():
+                    direction = SENT if htlc_proposer == LOCAL else RECEIVED
+                    status = 'settled' if log_action == 'settles' else 'failed'
+                    out.append((htlc.payment_hash.hex(), self.channel_id, htlc, direction, status))
+            for direction, htlc in self.hm.all_htlcs_ever(include_archived=False):
+                htlc_proposer = LOCAL if direction is SENT else REMOTE
+                if self.hm.was_htlc_failed(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
+                    status = 'failed'
+                elif self.hm.was_htlc_preimage_released(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
+                    status = 'settled'
+                else:
+                    status = 'inflight'
+                rhash = htlc.payment_hash.hex()
+                out.append((rhash, self.channel_id, htlc, direction, status))
         return out
 
     def get_settled_payments(self):
         out = defaultdict(list)
-        for direction, htlc in self.hm.all_htlcs_ever():
-            htlc_proposer = LOCAL if direction is SENT else REMOTE
-            if self.hm.was_htlc_preimage_released(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
-                rhash = htlc.payment_hash.hex()
-                out[rhash].append((self.channel_id, htlc, direction))
+        with self.hm.lock:
+            if self.hm.archive is not None:
+                for htlc_proposer, htlc in self.hm.archive.settled_htlcs():
+                    direction = SENT if htlc_proposer == LOCAL else RECEIVED
+                    out[htlc.payment_hash.hex()].append((self.channel_id, htlc, direction))
+            for direction, htlc in self.hm.all_htlcs_ever(include_archived=False):
+                htlc_proposer = LOCAL if direction is SENT else REMOTE
+                if self.hm.was_htlc_preimage_released(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
+                    rhash = htlc.payment_hash.hex()
+                    out[rhash].append((self.channel_id, htlc, direction))
         return out
 
+    def set_htlc_archive(self, archive: Optional[HTLCArchive]) -> None:
+        self.hm.set_archive(archive)
+
+    def get_htlc_archive_records(self, *, min_htlcs: int = 1) -> Sequence[Sequence]:
+        """Returns the archive records of the settled and failed HTLCs
+        that can no longer change. See HTLCArchive.append.
+        """
+        return self.hm.get_records_to_archive(min_htlcs=min_htlcs)
+
+    def remove_archived_htlcs(self, records: Sequence[Sequence]) -> int:
+        """Moves the HTLCs of records appended to the HTLC archive out of
+        the channel state. Returns the number of archived HTLCs.
+        """
+        with self.db_lock:
+            archived = self.hm.remove_archived_htlcs(records)
+            for htlc_id in archived[LOCAL]:
+                self.onion_keys.pop(htlc_id, None)
+        return len(archived[LOCAL]) + len(archived[REMOTE])
+
     def open_with_first_pcp(self, remote_pcp: bytes, remote_sig: bytes) -> None:
         with self.db_lock:
             self.config[REMOTE].current_per_commitment_point = remote_pcp
@@ -1220,7 +1251,7 @@ class Channel(AbstractChannel):
     def total_msat(self, direction: Direction) -> int:
         """Return the cumulative total msat amount received/sent so far."""
         assert type(direction) is Direction
-        return htlcsum(self.hm.all_settled_htlcs_ever_by_direction(LOCAL, direction))
+        return self.hm.get_settled_amount_msat_by_direction(LOCAL, direction)
 
     def settle_htlc(self, preimage: bytes, htlc_id: int) -> None:
         """Settle/fulfill a pending received HTLC.
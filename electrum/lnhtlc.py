@@ -1,17 +1,290 @@
 from copy import deepcopy
-from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, Set
+from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, Set, Iterator, Callable
+import base64
 import threading
+import bisect
+import json
+import os
 
 from .lnutil import SENT, RECEIVED, LOCAL, REMOTE, HTLCOwner, UpdateAddHtlc, Direction, FeeUpdate
 from .util import bh2u, bfh
+from .crypto import chacha20_poly1305_encrypt, chacha20_poly1305_decrypt
+from .logging import Logger
 
 if TYPE_CHECKING:
     from .json_db import StoredDict
 
 
+class _RemovalIndex:
+    """The htlcs of one proposer that got removed (settled or failed)
+    in the ctxs of one party, ordered by the ctn they got removed at.
+    Lets us answer per-ctn queries without going over the whole log.
+    """
+
+    def __init__(self, adds: Dict[int, UpdateAddHtlc]):
+        self._adds = adds
+        self._ctns = []  # type: List[int]  # ascending
+        self._htlc_ids = []  # type: List[List[int]]  # htlcs removed exactly at self._ctns[i]
+        # total amount removed up to and including self._ctns[i].
+        # computed lazily; might be shorter than self._ctns
+        self._cum_amount_msat = []  # type: List[int]
+
+    def add(self, ctn: int, htlc_id: int) -> None:
+        # note: removals are typically added in increasing ctn order
+        if not self._ctns or self._ctns[-1] < ctn:
+            self._ctns.append(ctn)
+            self._htlc_ids.append([htlc_id])
+            return
+        i = bisect.bisect_left(self._ctns, ctn)
+        if self._ctns[i] == ctn:
+            self._htlc_ids[i].append(htlc_id)
+        else:
+            self._ctns.insert(i, ctn)
+            self._htlc_ids.insert(i, [htlc_id])
+        del self._cum_amount_msat[i:]
+
+    def remove(self, ctn: int, htlc_id: int) -> None:
+        i = bisect.bisect_left(self._ctns, ctn)
+        self._htlc_ids[i].remove(htlc_id)
+        if not self._htlc_ids[i]:
+            del self._ctns[i]
+            del self._htlc_ids[i]
+        del self._cum_amount_msat[i:]
+
+    def htlc_ids_at_ctn(self, ctn: int) -> Sequence[int]:
+        i = bisect.bisect_left(self._ctns, ctn)
+        if i < len(self._ctns) and self._ctns[i] == ctn:
+            return self._htlc_ids[i]
+        return []
+
+    def htlc_ids_up_to_ctn(self, ctn: int) -> Iterator[int]:
+        for i in range(bisect.bisect_right(self._ctns, ctn)):
+            yield from self._htlc_ids[i]
+
+    def htlc_ids_after_ctn(self, ctn: int) -> Iterator[int]:
+        for i in range(bisect.bisect_right(self._ctns, ctn), len(self._ctns)):
+            yield from self._htlc_ids[i]
+
+    def amount_msat_up_to_ctn(self, ctn: int) -> int:
+        n = bisect.bisect_right(self._ctns, ctn)
+        cum = self._cum_amount_msat
+        while len(cum) < n:
+            i = len(cum)
+            total = cum[-1] if cum else 0
+            cum.append(total + sum(self._adds[htlc_id].amount_msat for htlc_id in self._htlc_ids[i]))
+        return cum[n-1] if n else 0
+
+
+class HTLCArchive(Logger):
+    """Append-only file holding the HTLCs that got compacted out of
+    the log of a channel (see HTLCManager.archive_removed_htlcs).
+    The file is only read, once, when a query at an old ctn needs archived HTLCs.
+    Listing the archived HTLCs streams the file instead.
+
+    Each line is a json list:
+    [htlc_proposer, log_action, amount_msat, payment_hash, cltv_expiry, htlc_id, timestamp,
+     locked_in_local_ctn, locked_in_remote_ctn, removed_local_ctn, removed_remote_ctn]
+    If the archive is encrypted, each line is "<key_id>:<base64 of nonce and ciphertext>",
+    so that lines encrypted with an older key can still be read while the archive is re-encrypted.
+
+    Records of htlcs that are still in the log (see is_in_log) are ignored: the wallet file
+    was not saved after they got archived, and they will be archived again.
+    """
+
+    def __init__(self, path: str, *, keys: Dict[str, bytes] = None, key_id: Optional[str] = None):
+        Logger.__init__(self)
+        self.path = path
+        self.keys = dict(keys or {})  # key_id -> key, to read encrypted lines
+        self.key_id = key_id  # key new lines are encrypted with. plaintext if None
+        self.lock = threading.RLock()
+        self._loaded = False
+        self._settled = None  # type: Optional[List[Tuple[HTLCOwner, UpdateAddHtlc]]]
+        # (htlc_proposer, htlc_id) -> whether the htlc is in the log. set by the HTLCManager
+        self.is_in_log = lambda htlc_proposer, htlc_id: False  # type: Callable[[HTLCOwner, int], bool]
+
+    def _encode_record(self, record: Sequence, key_id: Optional[str]) -> str:
+        data = json.dumps(record)
+        if key_id is None:
+            return data
+        nonce = os.urandom(12)
+        ciphertext = chacha20_poly1305_encrypt(key=self.keys[key_id], nonce=nonce, data=data.encode('utf-8'))
+        return key_id + ':' + base64.b64encode(nonce + ciphertext).decode('ascii')
+
+    def _decode_record(self, line: str) -> Sequence:
+        if not line.startswith('['):
+            key_id, _, data = line.partition(':')
+            try:
+                data = base64.b64decode(data)
+                line = chacha20_poly1305_decrypt(key=self.keys[key_id], nonce=data[:12], data=data[12:]).decode('utf-8')
+            except Exception as e:
+                raise ValueError(f'cannot decrypt record: {e!r}') from e
+        return json.loads(line)
+
+    def iter_records(self) -> Iterator[Sequence]:
+        """Yields the records, reading the file as it goes.
+        Duplicate records (see _add_record) are skipped.
+        """
+        if not os.path.exists(self.path):
+            return
+        seen = {LOCAL: set(), REMOTE: set()}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = self._decode_record(line.strip())
+                except ValueError:
+                    # last line might be incomplete if we crashed while appending
+                    self.logger.warning(f'skipping malformed record in {self.path}')
+                    continue
+                htlc_proposer, htlc_id = HTLCOwner(record[0]), record[5]
+                if htlc_id in seen[htlc_proposer]:
+                    continue
+                seen[htlc_proposer].add(htlc_id)
+                yield record
+
+    @classmethod
+    def _htlc_from_record(cls, record: Sequence) -> Tuple[HTLCOwner, str, UpdateAddHtlc]:
+        htlc_proposer, log_action, amount_msat, payment_hash, cltv_expiry, htlc_id, timestamp = record[:7]
+        htlc = UpdateAddHtlc(
+            amount_msat=amount_msat,
+            payment_hash=payment_hash,
+            cltv_expiry=cltv_expiry,
+            htlc_id=htlc_id,
+            timestamp=timestamp)
+        return HTLCOwner(htlc_proposer), log_action, htlc
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self._adds = {LOCAL: {}, REMOTE: {}}  # type: Dict[HTLCOwner, Dict[int, UpdateAddHtlc]]
+        self._locked_in = {LOCAL: {}, REMOTE: {}}  # type: Dict[HTLCOwner, Dict[int, Dict[HTLCOwner, int]]]
+        self._log_actions = {LOCAL: {}, REMOTE: {}}  # type: Dict[HTLCOwner, Dict[int, str]]
+        self._removals = {}  # type: Dict[Tuple[HTLCOwner, HTLCOwner, str], _RemovalIndex]
+        for htlc_proposer in (LOCAL, REMOTE):
+            for log_action in ('settles', 'fails'):
+                for ctx_owner in (LOCAL, REMOTE):
+                    self._removals[(ctx_owner, htlc_proposer, log_action)] = _RemovalIndex(self._adds[htlc_proposer])
+        for record in self.iter_records():
+            if not self.is_in_log(HTLCOwner(record[0]), record[5]):
+                self._add_record(record)
+        self._loaded = True
+
+    def _add_record(self, record: Sequence) -> None:
+        htlc_proposer, log_action, htlc = self._htlc_from_record(record)
+        locked_in_local, locked_in_remote, removed_local, removed_remote = record[7:]
+        htlc_id = htlc.htlc_id
+        if htlc_id in self._adds[htlc_proposer]:
+            # already archived; the wallet file was not saved after the previous compaction
+            return
+        self._adds[htlc_proposer][htlc_id] = htlc
+        self._locked_in[htlc_proposer][htlc_id] = {LOCAL: locked_in_local, REMOTE: locked_in_remote}
+        self._log_actions[htlc_proposer][htlc_id] = log_action
+        self._removals[(LOCAL, htlc_proposer, log_action)].add(removed_local, htlc_id)
+        self._removals[(REMOTE, htlc_proposer, log_action)].add(removed_remote, htlc_id)
+
+    def append(self, records: Sequence[Sequence]) -> None:
+        """Durably appends records. Must return before the records are removed from the log.
+        Only writes the file, so that it can be called from a thread.
+        """
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(self._encode_record(record, self.key_id) + '\n' for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+            self._settled = None  # records might be duplicates; read again when needed
+
+    def add_records(self, records: Sequence[Sequence]) -> None:
+        """Adds appended records to what was loaded, once they got removed from the log."""
+        with self.lock:
+            if self._loaded:
+                for record in records:
+                    self._add_record(record)
+
+    def reencrypt(self, keys: Dict[str, bytes], key_id: Optional[str]) -> None:
+        """Rewrites the archive, encrypted with key_id, or in plaintext if key_id is None.
+        keys must contain key_id and the keys the archive is currently encrypted with.
+        """
+        with self.lock:
+            self.keys = dict(keys)
+            if os.path.exists(self.path):
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    for record in self.iter_records():
+                        f.write(self._encode_record(record, key_id) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            self.key_id = key_id
+
+    def remove(self) -> None:
+        with self.lock:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._loaded = False
+            self._settled = None
+
+    def iter_htlcs(self) -> Iterator[Tuple[HTLCOwner, str, UpdateAddHtlc]]:
+        """Yields (htlc_proposer, log_action, htlc), reading the file as it goes."""
+        for record in self.iter_records():
+            htlc_proposer, log_action, htlc = self._htlc_from_record(record)
+            if not self.is_in_log(htlc_proposer, htlc.htlc_id):
+                yield htlc_proposer, log_action, htlc
+
+    def settled_htlcs(self) -> Sequence[Tuple[HTLCOwner, UpdateAddHtlc]]:
+        """Returns (htlc_proposer, htlc) for the settled htlcs.
+        Kept in memory, as the payment history needs them whenever the channel changes.
+        """
+        with self.lock:
+            if self._settled is None:
+                self._settled = [(HTLCOwner(record[0]), self._htlc_from_record(record)[2])
+                                 for record in self.iter_records() if record[1] == 'settles']
+            return [(htlc_proposer, htlc) for htlc_proposer, htlc in self._settled
+                    if not self.is_in_log(htlc_proposer, htlc.htlc_id)]
+
+    def get_htlc(self, htlc_proposer: HTLCOwner, htlc_id: int) -> Optional[UpdateAddHtlc]:
+        with self.lock:
+            self._load()
+            return self._adds[htlc_proposer].get(htlc_id)
+
+    def get_log_action(self, htlc_proposer: HTLCOwner, htlc_id: int) -> Optional[str]:
+        with self.lock:
+            self._load()
+            return self._log_actions[htlc_proposer].get(htlc_id)
+
+    def htlcs_active_at_ctn(self, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner,
+                            ctn: int) -> Dict[int, UpdateAddHtlc]:
+        with self.lock:
+            self._load()
+            d = {}
+            for log_action in ('settles', 'fails'):
+                for htlc_id in self._removals[(ctx_owner, htlc_proposer, log_action)].htlc_ids_after_ctn(ctn):
+                    if self._locked_in[htlc_proposer][htlc_id][ctx_owner] <= ctn:
+                        d[htlc_id] = self._adds[htlc_proposer][htlc_id]
+            return d
+
+    def htlcs_removed_at_ctn(self, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, log_action: str,
+                             ctn: int) -> Sequence[UpdateAddHtlc]:
+        with self.lock:
+            self._load()
+            removals = self._removals[(ctx_owner, htlc_proposer, log_action)]
+            return [self._adds[htlc_proposer][htlc_id] for htlc_id in removals.htlc_ids_at_ctn(ctn)]
+
+    def settled_htlcs_up_to_ctn(self, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner,
+                                ctn: int) -> Sequence[UpdateAddHtlc]:
+        with self.lock:
+            self._load()
+            settles = self._removals[(ctx_owner, htlc_proposer, 'settles')]
+            return [self._adds[htlc_proposer][htlc_id] for htlc_id in settles.htlc_ids_up_to_ctn(ctn)]
+
+    def settled_amount_msat_up_to_ctn(self, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, ctn: int) -> int:
+        with self.lock:
+            self._load()
+            return self._removals[(ctx_owner, htlc_proposer, 'settles')].amount_msat_up_to_ctn(ctn)
+
+
 class HTLCManager:
 
-    def __init__(self, log:'StoredDict', *, initial_feerate=None):
+    def __init__(self, log:'StoredDict', *, initial_feerate=None, archive: HTLCArchive = None):
 
         if len(log) == 0:
             initial = {
@@ -33,6 +306,15 @@ class HTLCManager:
             log['unfulfilled_htlcs'] = {}  # htlc_id -> onion_packet
         if 'fail_htlc_reasons' not in log:
             log['fail_htlc_reasons'] = {}  # htlc_id -> error_bytes, failure_message
+        if 'archived' not in log:
+            log['archived'] = {
+                # all archived htlcs got removed from whose ctx at or before this ctn
+                'removed_ctn': {LOCAL: -1, REMOTE: -1},
+                # "side who offered htlc" -> total
+                'settled_msat': {LOCAL: 0, REMOTE: 0},
+                'num_settled': {LOCAL: 0, REMOTE: 0},
+                'num_failed': {LOCAL: 0, REMOTE: 0},
+            }
 
         # maybe bootstrap fee_updates if initial_feerate was provided
         if initial_feerate is not None:
@@ -42,7 +324,11 @@ class HTLCManager:
                     log[sub]['fee_updates'][0] = FeeUpdate(rate=initial_feerate, ctn_local=0, ctn_remote=0)
         self.log = log
         self.lock = threading.RLock()
+        self.set_archive(archive)
+        # changes whenever the set of settled htlcs changes (not persisted)
+        self._settles_version = 0
         self._init_maybe_active_htlc_ids()
+        self._init_removal_indexes()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -109,6 +395,8 @@ class HTLCManager:
         if not self.is_htlc_active_at_ctn(ctx_owner=REMOTE, ctn=next_ctn, htlc_proposer=REMOTE, htlc_id=htlc_id):
             raise Exception(f"(local) cannot remove htlc that is not there...")
         self.log[REMOTE]['settles'][htlc_id] = {LOCAL: None, REMOTE: next_ctn}
+        self._removals[(REMOTE, REMOTE, 'settles')].add(next_ctn, htlc_id)
+        self._settles_version += 1
 
     @with_lock
     def recv_settle(self, htlc_id: int) -> None:
@@ -116,6 +404,8 @@ class HTLCManager:
         if not self.is_htlc_active_at_ctn(ctx_owner=LOCAL, ctn=next_ctn, htlc_proposer=LOCAL, htlc_id=htlc_id):
             raise Exception(f"(remote) cannot remove htlc that is not there...")
         self.log[LOCAL]['settles'][htlc_id] = {LOCAL: next_ctn, REMOTE: None}
+        self._removals[(LOCAL, LOCAL, 'settles')].add(next_ctn, htlc_id)
+        self._settles_version += 1
 
     @with_lock
     def send_fail(self, htlc_id: int) -> None:
@@ -123,6 +413,7 @@ class HTLCManager:
         if not self.is_htlc_active_at_ctn(ctx_owner=REMOTE, ctn=next_ctn, htlc_proposer=REMOTE, htlc_id=htlc_id):
             raise Exception(f"(local) cannot remove htlc that is not there...")
         self.log[REMOTE]['fails'][htlc_id] = {LOCAL: None, REMOTE: next_ctn}
+        self._removals[(REMOTE, REMOTE, 'fails')].add(next_ctn, htlc_id)
 
     @with_lock
     def recv_fail(self, htlc_id: int) -> None:
@@ -130,6 +421,7 @@ class HTLCManager:
         if not self.is_htlc_active_at_ctn(ctx_owner=LOCAL, ctn=next_ctn, htlc_proposer=LOCAL, htlc_id=htlc_id):
             raise Exception(f"(remote) cannot remove htlc that is not there...")
         self.log[LOCAL]['fails'][htlc_id] = {LOCAL: next_ctn, REMOTE: None}
+        self._removals[(LOCAL, LOCAL, 'fails')].add(next_ctn, htlc_id)
 
     @with_lock
     def send_update_fee(self, feerate: int) -> None:
@@ -181,6 +473,7 @@ class HTLCManager:
                 if ctns is None: continue
                 if ctns[REMOTE] is None and ctns[LOCAL] <= self.ctn_latest(LOCAL):
                     ctns[REMOTE] = self.ctn_latest(REMOTE) + 1
+                    self._removals[(REMOTE, LOCAL, log_action)].add(ctns[REMOTE], int(htlc_id))
         self._update_maybe_active_htlc_ids()
         # fee updates
         for k, fee_update in list(self.log[REMOTE]['fee_updates'].items()):
@@ -202,6 +495,7 @@ class HTLCManager:
                 if ctns is None: continue
                 if ctns[LOCAL] is None and ctns[REMOTE] <= self.ctn_latest(REMOTE):
                     ctns[LOCAL] = self.ctn_latest(LOCAL) + 1
+                    self._removals[(LOCAL, REMOTE, log_action)].add(ctns[LOCAL], int(htlc_id))
         self._update_maybe_active_htlc_ids()
         # fee updates
         for k, fee_update in list(self.log[LOCAL]['fee_updates'].items()):
@@ -217,8 +511,6 @@ class HTLCManager:
         #   not "removed and revoked from all ctxs of both parties". (self._maybe_active_htlc_ids)
         #   It is guaranteed that those htlcs are in the set, but older htlcs might be there too:
         #   there is a sanity margin of 1 ctn -- this relaxes the care needed re order of method calls.
-        # - balance_delta is in sync with maybe_active_htlc_ids. When htlcs are removed from the latter,
-        #   balance_delta is updated to reflect that htlc.
         sanity_margin = 1
         for htlc_proposer in (LOCAL, REMOTE):
             for log_action in ('settles', 'fails'):
@@ -230,42 +522,60 @@ class HTLCManager:
                             and ctns[REMOTE] is not None
                             and ctns[REMOTE] <= self.ctn_oldest_unrevoked(REMOTE) - sanity_margin):
                         self._maybe_active_htlc_ids[htlc_proposer].remove(htlc_id)
-                        if log_action == 'settles':
-                            htlc = self.log[htlc_proposer]['adds'][htlc_id]  # type: UpdateAddHtlc
-                            self._balance_delta -= htlc.amount_msat * htlc_proposer
 
     @with_lock
     def _init_maybe_active_htlc_ids(self):
         # first idx is "side who offered htlc":
         self._maybe_active_htlc_ids = {LOCAL: set(), REMOTE: set()}  # type: Dict[HTLCOwner, Set[int]]
         # add all htlcs
-        self._balance_delta = 0  # the balance delta of LOCAL since channel open
         for htlc_proposer in (LOCAL, REMOTE):
             for htlc_id in self.log[htlc_proposer]['adds']:
                 self._maybe_active_htlc_ids[htlc_proposer].add(htlc_id)
         # remove old htlcs
         self._update_maybe_active_htlc_ids()
 
+    @with_lock
+    def _init_removal_indexes(self):
+        # (ctx_owner, htlc_proposer, log_action) -> _RemovalIndex
+        self._removals = {}  # type: Dict[Tuple[HTLCOwner, HTLCOwner, str], _RemovalIndex]
+        for htlc_proposer in (LOCAL, REMOTE):
+            adds = self.log[htlc_proposer]['adds']
+            for log_action in ('settles', 'fails'):
+                for ctx_owner in (LOCAL, REMOTE):
+                    self._removals[(ctx_owner, htlc_proposer, log_action)] = _RemovalIndex(adds)
+                for htlc_id, ctns in self.log[htlc_proposer][log_action].items():
+                    for ctx_owner in (LOCAL, REMOTE):
+                        if ctns[ctx_owner] is not None:
+                            self._removals[(ctx_owner, htlc_proposer, log_action)].add(ctns[ctx_owner], int(htlc_id))
+
     @with_lock
     def discard_unsigned_remote_updates(self):
         """Discard updates sent by the remote, that the remote itself
         did not yet sign (i.e. there was no corresponding commitment_signed msg)
         """
         # htlcs added
-        for htlc_id, ctns in list(self.log[REMOTE]['locked_in'].items()):
+        # note: unsigned htlcs are the newest ones, and they are in _maybe_active_htlc_ids
+        discarded_htlc_ids = []
+        for htlc_id in list(self._maybe_active_htlc_ids[REMOTE]):
+            ctns = self.log[REMOTE]['locked_in'][htlc_id]
             if ctns[LOCAL] > self.ctn_latest(LOCAL):
                 del self.log[REMOTE]['locked_in'][htlc_id]
                 del self.log[REMOTE]['adds'][htlc_id]
                 self._maybe_active_htlc_ids[REMOTE].discard(htlc_id)
-        if self.log[REMOTE]['locked_in']:
-            self.log[REMOTE]['next_htlc_id'] = max([int(x) for x in self.log[REMOTE]['locked_in'].keys()]) + 1
-        else:
-            self.log[REMOTE]['next_htlc_id'] = 0
+                discarded_htlc_ids.append(int(htlc_id))
+        if discarded_htlc_ids:
+            self.log[REMOTE]['next_htlc_id'] = min(discarded_htlc_ids)
         # htlcs removed
         for log_action in ('settles', 'fails'):
-            for htlc_id, ctns in list(self.log[LOCAL][log_action].items()):
-                if ctns[LOCAL] > self.ctn_latest(LOCAL):
-                    del self.log[LOCAL][log_action][htlc_id]
+            removals = self._removals[(LOCAL, LOCAL, log_action)]
+            for htlc_id in list(removals.htlc_ids_after_ctn(self.ctn_latest(LOCAL))):
+                ctns = self.log[LOCAL][log_action][htlc_id]
+                removals.remove(ctns[LOCAL], htlc_id)
+                if ctns[REMOTE] is not None:
+                    self._removals[(REMOTE, LOCAL, log_action)].remove(ctns[REMOTE], htlc_id)
+                del self.log[LOCAL][log_action][htlc_id]
+                if log_action == 'settles':
+                    self._settles_version += 1
         # fee updates
         for k, fee_update in list(self.log[REMOTE]['fee_updates'].items()):
             if fee_update.ctn_local > self.ctn_latest(LOCAL):
@@ -292,9 +602,104 @@ class HTLCManager:
         return {int(ctn): [bfh(msg) for msg in messages]
                 for ctn, messages in self.log['unacked_local_updates2'].items()}
 
+    ##### Archiving:
+
+    def set_archive(self, archive: Optional[HTLCArchive]) -> None:
+        self.archive = archive
+        if archive is not None:
+            archive.is_in_log = lambda htlc_proposer, htlc_id: htlc_id in self.log[htlc_proposer]['adds']
+
+    def _is_archived_at_ctn(self, ctx_owner: HTLCOwner, ctn: int) -> bool:
+        """Returns whether archived htlcs might matter for ctx_owner's ctx at ctn."""
+        return self.archive is not None and ctn < self.log['archived']['removed_ctn'][ctx_owner]
+
+    @with_lock
+    def get_records_to_archive(self, *, min_htlcs: int = 1) -> Sequence[Sequence]:
+        """Returns the archive records of the htlcs that got irrevocably removed
+        from both ctxs, or nothing if fewer than min_htlcs htlcs could be archived.
+        """
+        if self.archive is None:
+            return []
+        oldest_unrevoked = {sub: self.ctn_oldest_unrevoked(sub) for sub in (LOCAL, REMOTE)}
+        candidates = []
+        for htlc_proposer in (LOCAL, REMOTE):
+            for log_action in ('settles', 'fails'):
+                removals = self._removals[(LOCAL, htlc_proposer, log_action)]
+                for htlc_id in removals.htlc_ids_up_to_ctn(oldest_unrevoked[LOCAL]):
+                    ctns = self.log[htlc_proposer][log_action][htlc_id]
+                    if ctns[REMOTE] is None or ctns[REMOTE] > oldest_unrevoked[REMOTE]:
+                        continue
+                    if htlc_proposer == REMOTE and (htlc_id in self.log['unfulfilled_htlcs']
+                                                    or htlc_id in self.log['fail_htlc_reasons']):
+                        continue
+                    candidates.append((htlc_proposer, log_action, htlc_id))
+        if not candidates or len(candidates) < min_htlcs:
+            return []
+        records = []
+        for htlc_proposer, log_action, htlc_id in candidates:
+            htlc = self.log[htlc_proposer]['adds'][htlc_id]
+            locked_in = self.log[htlc_proposer]['locked_in'][htlc_id]
+            removed = self.log[htlc_proposer][log_action][htlc_id]
+            records.append([int(htlc_proposer), log_action, htlc.amount_msat, htlc.payment_hash.hex(),
+                            htlc.cltv_expiry, htlc_id, htlc.timestamp,
+                            locked_in[LOCAL], locked_in[REMOTE], removed[LOCAL], removed[REMOTE]])
+        return records
+
+    @with_lock
+    def remove_archived_htlcs(self, records: Sequence[Sequence]) -> Dict[HTLCOwner, Sequence[int]]:
+        """Removes the htlcs of records appended to the archive from the log,
+        keeping only summary totals. Returns the removed htlc_ids, by proposer.
+        """
+        archived = {LOCAL: [], REMOTE: []}
+        summary = self.log['archived']
+        for record in records:
+            htlc_proposer, log_action, htlc_id = HTLCOwner(record[0]), record[1], record[5]
+            htlc = self.log[htlc_proposer]['adds'][htlc_id]
+            removed = self.log[htlc_proposer][log_action][htlc_id]
+            for ctx_owner in (LOCAL, REMOTE):
+                self._removals[(ctx_owner, htlc_proposer, log_action)].remove(removed[ctx_owner], htlc_id)
+                summary['removed_ctn'][ctx_owner] = max(summary['removed_ctn'][ctx_owner], removed[ctx_owner])
+            if log_action == 'settles':
+                summary['settled_msat'][htlc_proposer] += htlc.amount_msat
+                summary['num_settled'][htlc_proposer] += 1
+            else:
+                summary['num_failed'][htlc_proposer] += 1
+            del self.log[htlc_proposer][log_action][htlc_id]
+            del self.log[htlc_proposer]['locked_in'][htlc_id]
+            del self.log[htlc_proposer]['adds'][htlc_id]
+            self._maybe_active_htlc_ids[htlc_proposer].discard(htlc_id)
+            archived[htlc_proposer].append(htlc_id)
+        self.archive.add_records(records)
+        return archived
+
+    @with_lock
+    def archive_removed_htlcs(self, *, min_htlcs: int = 1) -> Dict[HTLCOwner, Sequence[int]]:
+        """Moves htlcs that got irrevocably removed from both ctxs to the archive,
+        keeping only summary totals in the log. Nothing is done if fewer than
+        min_htlcs htlcs could be archived.
+        Returns the archived htlc_ids, by proposer.
+        """
+        records = self.get_records_to_archive(min_htlcs=min_htlcs)
+        if not records:
+            return {LOCAL: [], REMOTE: []}
+        # write archive first; if we crash before the wallet file is saved,
+        # the records are ignored while the htlcs are still in the log
+        self.archive.append(records)
+        return self.remove_archived_htlcs(records)
+
+    def _archived_settled_amount_msat(self, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, ctn: int) -> int:
+        if self._is_archived_at_ctn(ctx_owner, ctn):
+            return self.archive.settled_amount_msat_up_to_ctn(ctx_owner, htlc_proposer, ctn)
+        return self.log['archived']['settled_msat'][htlc_proposer]
+
     ##### Queries re HTLCs:
 
+    @with_lock
     def get_htlc_by_id(self, htlc_proposer: HTLCOwner, htlc_id: int) -> UpdateAddHtlc:
+        if htlc_id not in self.log[htlc_proposer]['adds'] and self.archive is not None:
+            htlc = self.archive.get_htlc(htlc_proposer, int(htlc_id))
+            if htlc is not None:
+                return htlc
         return self.log[htlc_proposer]['adds'][htlc_id]
 
     @with_lock
@@ -305,7 +710,11 @@ class HTLCManager:
             return False
         settles = self.log[htlc_proposer]['settles']
         fails = self.log[htlc_proposer]['fails']
-        ctns = self.log[htlc_proposer]['locked_in'][htlc_id]
+        ctns = self.log[htlc_proposer]['locked_in'].get(htlc_id)
+        if ctns is None:
+            if self._is_archived_at_ctn(ctx_owner, ctn):
+                return htlc_id in self.archive.htlcs_active_at_ctn(ctx_owner, htlc_proposer, ctn)
+            return False
         if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
             not_settled = htlc_id not in settles or settles[htlc_id][ctx_owner] is None or settles[htlc_id][ctx_owner] > ctn
             not_failed = htlc_id not in fails or fails[htlc_id][ctx_owner] is None or fails[htlc_id][ctx_owner] > ctn
@@ -331,12 +740,17 @@ class HTLCManager:
         party = subject if direction == SENT else subject.inverted()
         if ctn >= self.ctn_oldest_unrevoked(subject):
             considered_htlc_ids = self._maybe_active_htlc_ids[party]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_htlc_ids = self.log[party]['locked_in']
+        else:
+            # ctn is old; htlcs active at ctn might have been removed since
+            considered_htlc_ids = set(self._maybe_active_htlc_ids[party])
+            for log_action in ('settles', 'fails'):
+                considered_htlc_ids.update(self._removals[(subject, party, log_action)].htlc_ids_after_ctn(ctn))
         for htlc_id in considered_htlc_ids:
             htlc_id = int(htlc_id)
             if self.is_htlc_active_at_ctn(ctx_owner=subject, ctn=ctn, htlc_proposer=party, htlc_id=htlc_id):
                 d[htlc_id] = self.log[party]['adds'][htlc_id]
+        if self._is_archived_at_ctn(subject, ctn):
+            d.update(self.archive.htlcs_active_at_ctn(subject, party, ctn))
         return d
 
     @with_lock
@@ -368,17 +782,31 @@ class HTLCManager:
         ctn = self.ctn_latest(subject) + 1
         return self.htlcs(subject, ctn)
 
+    @with_lock
+    def _get_archived_log_action(self, htlc_proposer: HTLCOwner, htlc_id: int) -> Optional[str]:
+        if self.archive is None or htlc_id in self.log[htlc_proposer]['adds']:
+            return None
+        return self.archive.get_log_action(htlc_proposer, int(htlc_id))
+
+    def get_settles_version(self) -> int:
+        """Returns a number that changes whenever an htlc gets settled,
+        or a settle gets discarded. Archiving htlcs does not change it.
+        """
+        return self._settles_version
+
+    @with_lock
     def was_htlc_preimage_released(self, *, htlc_id: int, htlc_proposer: HTLCOwner) -> bool:
         settles = self.log[htlc_proposer]['settles']
         if htlc_id not in settles:
-            return False
+            return self._get_archived_log_action(htlc_proposer, htlc_id) == 'settles'
         return settles[htlc_id][htlc_proposer] is not None
 
+    @with_lock
     def was_htlc_failed(self, *, htlc_id: int, htlc_proposer: HTLCOwner) -> bool:
         """Returns whether an HTLC has been (or will be if we already know) failed."""
         fails = self.log[htlc_proposer]['fails']
         if htlc_id not in fails:
-            return False
+            return self._get_archived_log_action(htlc_proposer, htlc_id) == 'fails'
         return fails[htlc_id][htlc_proposer] is not None
 
     @with_lock
@@ -393,11 +821,24 @@ class HTLCManager:
         # subject's ctx
         # party is the proposer of the HTLCs
         party = subject if direction == SENT else subject.inverted()
-        d = []
-        for htlc_id, ctns in self.log[party]['settles'].items():
-            if ctns[subject] is not None and ctns[subject] <= ctn:
-                d.append(self.log[party]['adds'][htlc_id])
-        return d
+        settles = self._removals[(subject, party, 'settles')]
+        htlcs = [self.log[party]['adds'][htlc_id] for htlc_id in settles.htlc_ids_up_to_ctn(ctn)]
+        if self.archive is not None and self.log['archived']['num_settled'][party]:
+            htlcs = self.archive.settled_htlcs_up_to_ctn(subject, party, ctn) + htlcs
+        return htlcs
+
+    @with_lock
+    def get_settled_amount_msat_by_direction(self, subject: HTLCOwner, direction: Direction,
+                                             ctn: int = None) -> int:
+        """Return the total amount of all HTLCs that have been ever settled in
+        subject's ctx up to ctn, filtered to only "direction".
+        """
+        assert type(subject) is HTLCOwner
+        if ctn is None:
+            ctn = self.ctn_oldest_unrevoked(subject)
+        party = subject if direction == SENT else subject.inverted()
+        return (self._archived_settled_amount_msat(subject, party, ctn)
+                + self._removals[(subject, party, 'settles')].amount_msat_up_to_ctn(ctn))
 
     @with_lock
     def all_settled_htlcs_ever(self, subject: HTLCOwner, ctn: int = None) \
@@ -413,9 +854,13 @@ class HTLCManager:
         return sent + received
 
     @with_lock
-    def all_htlcs_ever(self) -> Sequence[Tuple[Direction, UpdateAddHtlc]]:
+    def all_htlcs_ever(self, *, include_archived: bool = True) -> Sequence[Tuple[Direction, UpdateAddHtlc]]:
         sent = [(SENT, htlc) for htlc in self.log[LOCAL]['adds'].values()]
         received = [(RECEIVED, htlc) for htlc in self.log[REMOTE]['adds'].values()]
+        if include_archived and self.archive is not None:
+            archived = list(self.archive.iter_htlcs())
+            sent = [(SENT, htlc) for proposer, _, htlc in archived if proposer == LOCAL] + sent
+            received = [(RECEIVED, htlc) for proposer, _, htlc in archived if proposer == REMOTE] + received
         return sent + received
 
     @with_lock
@@ -427,43 +872,22 @@ class HTLCManager:
         if ctn is None:
             ctn = self.ctn_oldest_unrevoked(ctx_owner)
         balance = initial_balance_msat
-        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
-            balance += self._balance_delta * whose
-            considered_sent_htlc_ids = self._maybe_active_htlc_ids[whose]
-            considered_recv_htlc_ids = self._maybe_active_htlc_ids[-whose]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_sent_htlc_ids = self.log[whose]['settles']
-            considered_recv_htlc_ids = self.log[-whose]['settles']
         # sent htlcs
-        for htlc_id in considered_sent_htlc_ids:
-            ctns = self.log[whose]['settles'].get(htlc_id, None)
-            if ctns is None: continue
-            if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
-                htlc = self.log[whose]['adds'][htlc_id]
-                balance -= htlc.amount_msat
+        balance -= self._archived_settled_amount_msat(ctx_owner, whose, ctn)
+        balance -= self._removals[(ctx_owner, whose, 'settles')].amount_msat_up_to_ctn(ctn)
         # recv htlcs
-        for htlc_id in considered_recv_htlc_ids:
-            ctns = self.log[-whose]['settles'].get(htlc_id, None)
-            if ctns is None: continue
-            if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
-                htlc = self.log[-whose]['adds'][htlc_id]
-                balance += htlc.amount_msat
+        balance += self._archived_settled_amount_msat(ctx_owner, -whose, ctn)
+        balance += self._removals[(ctx_owner, -whose, 'settles')].amount_msat_up_to_ctn(ctn)
         return balance
 
     @with_lock
     def _get_htlcs_that_got_removed_exactly_at_ctn(
             self, ctn: int, *, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, log_action: str,
     ) -> Sequence[UpdateAddHtlc]:
-        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
-            considered_htlc_ids = self._maybe_active_htlc_ids[htlc_proposer]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_htlc_ids = self.log[htlc_proposer][log_action]
-        htlcs = []
-        for htlc_id in considered_htlc_ids:
-            ctns = self.log[htlc_proposer][log_action].get(htlc_id, None)
-            if ctns is None: continue
-            if ctns[ctx_owner] == ctn:
-                htlcs.append(self.log[htlc_proposer]['adds'][htlc_id])
+        removals = self._removals[(ctx_owner, htlc_proposer, log_action)]
+        htlcs = [self.log[htlc_proposer]['adds'][htlc_id] for htlc_id in removals.htlc_ids_at_ctn(ctn)]
+        if self.archive is not None and ctn <= self.log['archived']['removed_ctn'][ctx_owner]:
+            htlcs = list(self.archive.htlcs_removed_at_ctn(ctx_owner, htlc_proposer, log_action, ctn)) + htlcs
         return htlcs
 
     def received_in_ctn(self, local_ctn: int) -> Sequence[UpdateAddHtlc]:
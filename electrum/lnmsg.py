@@ -1,7 +1,9 @@
 import os
 import csv
 import io
-from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional
+import re
+import struct
+from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional, NamedTuple
 from collections import OrderedDict
 
 from .lnutil import OnionFailureCodeMetaFlag
@@ -17,21 +19,6 @@ class MsgInvalidFieldOrder(MalformedMsg): pass
 class UnexpectedFieldSizeForEncoder(MalformedMsg): pass
 
 
-def _num_remaining_bytes_to_read(fd: io.BytesIO) -> int:
-    cur_pos = fd.tell()
-    end_pos = fd.seek(0, io.SEEK_END)
-    fd.seek(cur_pos)
-    return end_pos - cur_pos
-
-
-def _assert_can_read_at_least_n_bytes(fd: io.BytesIO, n: int) -> None:
-    # note: it's faster to read n bytes and then check if we read n, than
-    #       to assert we can read at least n and then read n bytes.
-    nremaining = _num_remaining_bytes_to_read(fd)
-    if nremaining < n:
-        raise UnexpectedEndOfStream(f"wants to read {n} bytes but only {nremaining} bytes left")
-
-
 def write_bigsize_int(i: int) -> bytes:
     assert i >= 0, i
     if i < 0xfd:
@@ -233,22 +220,6 @@ def _write_field(*, fd: io.BytesIO, field_type: str, count: Union[int, str],
         raise Exception(f"tried to write {len(value)} bytes, but only wrote {nbytes_written}!?")
 
 
-def _read_tlv_record(*, fd: io.BytesIO) -> Tuple[int, bytes]:
-    if not fd: raise Exception()
-    tlv_type = _read_field(fd=fd, field_type="varint", count=1)
-    tlv_len = _read_field(fd=fd, field_type="varint", count=1)
-    tlv_val = _read_field(fd=fd, field_type="byte", count=tlv_len)
-    return tlv_type, tlv_val
-
-
-def _write_tlv_record(*, fd: io.BytesIO, tlv_type: int, tlv_val: bytes) -> None:
-    if not fd: raise Exception()
-    tlv_len = len(tlv_val)
-    _write_field(fd=fd, field_type="varint", count=1, value=tlv_type)
-    _write_field(fd=fd, field_type="varint", count=1, value=tlv_len)
-    _write_field(fd=fd, field_type="byte", count=tlv_len, value=tlv_val)
-
-
 def _resolve_field_count(field_count_str: str, *, vars_dict: dict, allow_any=False) -> Union[int, str]:
     """Returns an evaluated field count, typically an int.
     If allow_any is True, the return value can be a str with value=="...".
@@ -280,6 +251,291 @@ def _parse_msgtype_intvalue_for_onion_wire(value: str) -> int:
     return msg_type_int
 
 
+def read_bigsize_int_at(data: bytes, pos: int) -> Tuple[Optional[int], int]:
+    """Same as read_bigsize_int, but reads from 'data' at offset 'pos'.
+    Returns the value (None if there is nothing left to read) and the offset after it.
+    """
+    n = len(data)
+    if pos >= n:
+        return None, pos  # end of data
+    first = data[pos]
+    if first < 0xfd:
+        return first, pos + 1
+    elif first == 0xfd:
+        size, min_val, max_val = 2, 0xfd, 0x1_0000
+    elif first == 0xfe:
+        size, min_val, max_val = 4, 0x1_0000, 0x1_0000_0000
+    else:
+        size, min_val, max_val = 8, 0x1_0000_0000, None
+    end = pos + 1 + size
+    if end > n:
+        raise UnexpectedEndOfStream()
+    val = int.from_bytes(data[pos+1:end], byteorder="big", signed=False)
+    if val < min_val or (max_val is not None and val >= max_val):
+        raise FieldEncodingNotMinimal()
+    return val, end
+
+
+def _read_field_at(data: bytes, pos: int, field_type: str, count: Union[int, str]) -> Tuple[Union[bytes, int], int]:
+    # generic (slow) path of the compiled decoders, used for unusual field definitions
+    with io.BytesIO(data) as fd:
+        fd.seek(pos)
+        value = _read_field(fd=fd, field_type=field_type, count=count)
+        return value, fd.tell()
+
+
+def _encode_field(value: Union[bytes, int], field_type: str, count: Union[int, str]) -> bytes:
+    # generic (slow) path of the compiled encoders, used for unusual values and field definitions
+    with io.BytesIO() as fd:
+        _write_field(fd=fd, field_type=field_type, count=count, value=value)
+        return fd.getvalue()
+
+
+_FIELD_TYPE_LEN = {
+    'byte': 1,
+    'chain_hash': 32,
+    'channel_id': 32,
+    'sha256': 32,
+    'signature': 64,
+    'point': 33,
+    'short_channel_id': 8,
+}
+_UINT_STRUCT_FORMAT = {'u8': 'B', 'u16': 'H', 'u32': 'I', 'u64': 'Q'}
+_UINT_LEN = {'u8': 1, 'u16': 2, 'u32': 4, 'u64': 8}
+_TRUNCATED_UINT_LEN = {'tu16': 2, 'tu32': 4, 'tu64': 8}
+
+
+class _FieldDef(NamedTuple):
+    name: str
+    type: str
+    count: str  # as in the csv: "", a number, the name of an earlier field, or "..."
+    optional: bool
+
+    def static_count(self) -> Optional[int]:
+        if self.count == "":
+            return 1
+        try:
+            return int(self.count)
+        except ValueError:
+            return None
+
+    def struct_format(self) -> Optional[str]:
+        """Returns the struct format of the field if it has a fixed size, else None."""
+        count = self.static_count()
+        if not count:
+            return None
+        if self.type in _UINT_STRUCT_FORMAT:
+            return _UINT_STRUCT_FORMAT[self.type] if count == 1 else None
+        if self.type in _FIELD_TYPE_LEN:
+            return f"{count * _FIELD_TYPE_LEN[self.type]}s"
+        return None
+
+
+class _SchemeCompiler:
+    """Generates the source of a decode or encode function specialized
+    for one message (or TLV record) scheme, and compiles it.
+
+    The generated code works on bytes and offsets, and unpacks/packs
+    consecutive fixed-size fields with a single struct call. Anything
+    unusual is delegated to _read_field/_write_field, so that the
+    behaviour is the same as interpreting the scheme field by field.
+    """
+
+    def __init__(self, fields: Sequence[_FieldDef], *, allow_any: bool):
+        self.fields = fields
+        self.allow_any = allow_any
+        self.lines = []  # type: List[str]
+        self.namespace = {
+            'UnexpectedEndOfStream': UnexpectedEndOfStream,
+            'FieldEncodingNotMinimal': FieldEncodingNotMinimal,
+            'MsgTrailingGarbage': MsgTrailingGarbage,
+            'UnknownMsgFieldType': UnknownMsgFieldType,
+            'read_bigsize_int_at': read_bigsize_int_at,
+            'write_bigsize_int': write_bigsize_int,
+            '_read_field_at': _read_field_at,
+            '_encode_field': _encode_field,
+            '_resolve_field_count': _resolve_field_count,
+        }
+
+    def _const(self, value) -> str:
+        name = f"_k{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def _emit(self, line: str, indent: int) -> None:
+        self.lines.append("    " * indent + line)
+
+    def _emit_count(self, field: _FieldDef, vars_name: str, indent: int) -> str:
+        """Emits code resolving the count of 'field' and returns an expression for it."""
+        count = field.static_count()
+        if count is not None:
+            return repr(count)
+        if field.count == "...":
+            if not self.allow_any:
+                self._emit(f"_resolve_field_count('...', vars_dict={vars_name})", indent)  # raises
+            return repr("...")
+        self._emit(f"cnt = {vars_name}[{field.count!r}]", indent)
+        self._emit("if not isinstance(cnt, int): cnt = int.from_bytes(cnt, byteorder='big')", indent)
+        return "cnt"
+
+    def compile(self, func_name: str, filename: str) -> Callable:
+        src = "\n".join(self.lines) + "\n"
+        exec(compile(src, filename, "exec"), self.namespace)
+        return self.namespace[func_name]
+
+    # decoding
+
+    def gen_decoder(self, func_name: str, *, start: int, trailing_garbage_msg: Optional[str]) -> None:
+        self._emit(f"def {func_name}(data):", 0)
+        self._emit("parsed = {}", 1)
+        self._emit(f"pos = {start}", 1)
+        self._emit("n = len(data)", 1)
+        run = []  # type: List[_FieldDef]
+        for field in self.fields:
+            if field.name == "tlvs":
+                self._flush_decode_run(run, 1)
+                self._emit(f"parsed[{field.type!r}] = read_tlv_stream(data, pos, {field.type!r})", 1)
+                self._emit("pos = n", 1)
+            elif field.optional:
+                self._flush_decode_run(run, 1)
+                # optional fields are only present if there is data left for them
+                self._emit("try:", 1)
+                if field.struct_format():
+                    self._flush_decode_run([field], 2)
+                else:
+                    self._gen_decode_field(field, 2)
+                self._emit("except UnexpectedEndOfStream:", 1)
+                self._emit("return parsed", 2)
+            elif field.struct_format():
+                run.append(field)
+            else:
+                self._flush_decode_run(run, 1)
+                self._gen_decode_field(field, 1)
+        self._flush_decode_run(run, 1)
+        if trailing_garbage_msg is not None:
+            self._emit("if pos < n:", 1)
+            self._emit(f"raise MsgTrailingGarbage({trailing_garbage_msg!r})", 2)
+        self._emit("return parsed", 1)
+
+    def _flush_decode_run(self, run: List[_FieldDef], indent: int) -> None:
+        if not run:
+            return
+        st = struct.Struct(">" + "".join(field.struct_format() for field in run))
+        self._emit(f"if pos + {st.size} > n: raise UnexpectedEndOfStream()", indent)
+        targets = "".join(f"parsed[{field.name!r}], " for field in run)
+        self._emit(f"{targets}= {self._const(st)}.unpack_from(data, pos)", indent)
+        self._emit(f"pos += {st.size}", indent)
+        run.clear()
+
+    def _gen_decode_field(self, field: _FieldDef, indent: int) -> None:
+        count = self._emit_count(field, "parsed", indent)
+        target = f"parsed[{field.name!r}]"
+        if count == "0":
+            self._emit(f"{target} = b''", indent)
+        elif field.type in _TRUNCATED_UINT_LEN and count == "1":
+            self._emit(f"raw = data[pos:pos+{_TRUNCATED_UINT_LEN[field.type]}]", indent)
+            self._emit("if len(raw) > 0 and raw[0] == 0x00: raise FieldEncodingNotMinimal()", indent)
+            self._emit(f"{target} = int.from_bytes(raw, byteorder='big', signed=False)", indent)
+            self._emit("pos += len(raw)", indent)
+        elif field.type == 'varint' and count == "1":
+            self._emit("val, pos = read_bigsize_int_at(data, pos)", indent)
+            self._emit("if val is None: raise UnexpectedEndOfStream()", indent)
+            self._emit(f"{target} = val", indent)
+        elif count == "'...'" and self.allow_any and field.type not in (
+                *_UINT_LEN, *_TRUNCATED_UINT_LEN, 'varint'):
+            self._emit(f"{target} = data[pos:]", indent)
+            self._emit("pos = n", indent)
+        elif count == "cnt" and field.type in _FIELD_TYPE_LEN:
+            self._emit(f"size = cnt * {_FIELD_TYPE_LEN[field.type]}", indent)
+            self._emit("if pos + size > n: raise UnexpectedEndOfStream()", indent)
+            self._emit(f"{target} = data[pos:pos+size]", indent)
+            self._emit("pos += size", indent)
+        else:
+            self._emit(f"{target}, pos = _read_field_at(data, pos, {field.type!r}, {count})", indent)
+
+    # encoding
+
+    def gen_encoder(self, func_name: str, *, prefix: bytes, default_missing_to_zero: bool) -> None:
+        """If default_missing_to_zero is False, missing fields raise KeyError."""
+        self._emit(f"def {func_name}(kwargs):", 0)
+        self._emit(f"parts = [{prefix!r}]", 1)
+        run = []  # type: List[_FieldDef]
+        for field in self.fields:
+            if field.name == "tlvs":
+                self._flush_encode_run(run, default_missing_to_zero, 1)
+                self._emit(f"if {field.type!r} in kwargs:", 1)
+                self._emit(f"parts.append(write_tlv_stream({field.type!r}, kwargs[{field.type!r}]))", 2)
+            elif field.optional:
+                self._flush_encode_run(run, default_missing_to_zero, 1)
+                count = self._emit_count(field, "kwargs", 1)
+                self._emit(f"if {field.name!r} not in kwargs:", 1)
+                self._emit("return b''.join(parts)", 2)  # optional feature field not present
+                if field.struct_format():
+                    self._flush_encode_run([field], default_missing_to_zero, 1)
+                else:
+                    self._gen_encode_field(field, count, f"kwargs[{field.name!r}]", 1)
+            elif field.struct_format():
+                run.append(field)
+            else:
+                self._flush_encode_run(run, default_missing_to_zero, 1)
+                count = self._emit_count(field, "kwargs", 1)
+                self._gen_encode_field(field, count, self._value_expr(field, default_missing_to_zero), 1)
+        self._flush_encode_run(run, default_missing_to_zero, 1)
+        self._emit("return b''.join(parts)", 1)
+
+    @staticmethod
+    def _value_expr(field: _FieldDef, default_missing_to_zero: bool) -> str:
+        if default_missing_to_zero:
+            return f"kwargs.get({field.name!r}, 0)"
+        return f"kwargs[{field.name!r}]"
+
+    def _flush_encode_run(self, run: List[_FieldDef], default_missing_to_zero: bool, indent: int) -> None:
+        if not run:
+            return
+        conds = []
+        for i, field in enumerate(run):
+            self._emit(f"v{i} = {self._value_expr(field, default_missing_to_zero)}", indent)
+            if field.type in _UINT_LEN:
+                conds.append(f"v{i}.__class__ is int and 0 <= v{i} < {1 << (8 * _UINT_LEN[field.type])}")
+            else:
+                conds.append(f"v{i}.__class__ is bytes and len(v{i}) == {field.static_count() * _FIELD_TYPE_LEN[field.type]}")
+        st = struct.Struct(">" + "".join(field.struct_format() for field in run))
+        args = ", ".join(f"v{i}" for i in range(len(run)))
+        self._emit(f"if {' and '.join(conds)}:", indent)
+        self._emit(f"parts.append({self._const(st)}.pack({args}))", indent + 1)
+        self._emit("else:", indent)
+        for i, field in enumerate(run):
+            self._emit(f"parts.append(_encode_field(v{i}, {field.type!r}, {field.static_count()}))", indent + 1)
+        run.clear()
+
+    def _gen_encode_field(self, field: _FieldDef, count: str, value_expr: str, indent: int) -> None:
+        self._emit(f"val = {value_expr}", indent)
+        if count == "0":
+            return
+        if field.type in _TRUNCATED_UINT_LEN and count == "1":
+            self._emit("if val.__class__ is int:", indent)
+            self._emit(f"parts.append(val.to_bytes({_TRUNCATED_UINT_LEN[field.type]}, byteorder='big', signed=False).lstrip(b'\\x00'))", indent + 1)
+        elif field.type == 'varint' and count == "1":
+            self._emit("if val.__class__ is int:", indent)
+            self._emit("parts.append(write_bigsize_int(val))", indent + 1)
+        elif count == "'...'" and self.allow_any and field.type not in (
+                *_UINT_LEN, *_TRUNCATED_UINT_LEN, 'varint'):
+            self._emit("if val.__class__ is bytes:", indent)
+            self._emit("parts.append(val)", indent + 1)
+        elif count == "cnt" and field.type in _FIELD_TYPE_LEN:
+            self._emit(f"if val.__class__ is bytes and len(val) == cnt * {_FIELD_TYPE_LEN[field.type]}:", indent)
+            self._emit("parts.append(val)", indent + 1)
+        else:
+            self._emit(f"parts.append(_encode_field(val, {field.type!r}, {count}))", indent)
+            return
+        self._emit("else:", indent)
+        self._emit(f"parts.append(_encode_field(val, {field.type!r}, {count}))", indent + 1)
+
+
+def _func_name(prefix: str, name: str) -> str:
+    return prefix + re.sub(r"\W", "_", name)
+
+
 class LNSerializer:
 
     def __init__(self, *, for_onion_wire: bool = False):
@@ -342,48 +598,88 @@ class LNSerializer:
                     self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name][tlv_record_type].append(tuple(row))
                 else:
                     pass  # TODO
-
-    def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
-        scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
-        for tlv_record_type, scheme in scheme_map.items():  # note: tlv_record_type is monotonically increasing
-            tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
-            if tlv_record_name not in kwargs:
+        self._compile_schemes()
+
+    def _compile_schemes(self) -> None:
+        # msg_type_bytes -> (msg_type_name, decoder)
+        self._msg_decoders = {}  # type: Dict[bytes, Tuple[str, Callable[[bytes], dict]]]
+        # msg_type_name -> encoder
+        self._msg_encoders = {}  # type: Dict[str, Callable[[dict], bytes]]
+        # tlv_stream_name -> tlv_record_type -> (tlv_record_name, decoder)
+        self._tlv_record_decoders = {}  # type: Dict[str, Dict[int, Tuple[str, Callable[[bytes], dict]]]]
+        # tlv_stream_name -> [(tlv_record_name, tlv_record_type_bytes, encoder)], by increasing type
+        self._tlv_record_encoders = {}  # type: Dict[str, List[Tuple[str, bytes, Callable[[dict], bytes]]]]
+
+        def new_compiler(fields: Sequence[_FieldDef], *, allow_any: bool) -> _SchemeCompiler:
+            compiler = _SchemeCompiler(fields, allow_any=allow_any)
+            compiler.namespace['read_tlv_stream'] = self._read_tlv_stream_at
+            compiler.namespace['write_tlv_stream'] = self._write_tlv_stream_to_bytes
+            return compiler
+
+        for msg_type_bytes, scheme in self.msg_scheme_from_type.items():
+            # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+            msg_type_name = scheme[0][1]
+            fields = [_FieldDef(row[2], row[3], row[4], len(row) > 5) for row in scheme[1:]]
+            compiler = new_compiler(fields, allow_any=False)
+            compiler.gen_decoder(_func_name("decode_", msg_type_name), start=2, trailing_garbage_msg=None)
+            decoder = compiler.compile(_func_name("decode_", msg_type_name), f"<lnmsg decoder {msg_type_name}>")
+            compiler = new_compiler(fields, allow_any=False)
+            compiler.gen_encoder(_func_name("encode_", msg_type_name), prefix=msg_type_bytes, default_missing_to_zero=True)
+            encoder = compiler.compile(_func_name("encode_", msg_type_name), f"<lnmsg encoder {msg_type_name}>")
+            self._msg_decoders[msg_type_bytes] = (msg_type_name, decoder)
+            self._msg_encoders[msg_type_name] = encoder
+
+        for tlv_stream_name, scheme_map in self.in_tlv_stream_get_tlv_record_scheme_from_type.items():
+            self._tlv_record_decoders[tlv_stream_name] = {}
+            self._tlv_record_encoders[tlv_stream_name] = []
+            for tlv_record_type, scheme in scheme_map.items():
+                # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
+                tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
+                fields = [_FieldDef(row[3], row[4], row[5], False) for row in scheme[1:]]
+                func_suffix = f"{tlv_stream_name}__{tlv_record_name}"
+                compiler = new_compiler(fields, allow_any=True)
+                compiler.gen_decoder(
+                    _func_name("decode_", func_suffix), start=0,
+                    trailing_garbage_msg=f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
+                decoder = compiler.compile(_func_name("decode_", func_suffix), f"<lnmsg decoder {tlv_stream_name}/{tlv_record_name}>")
+                compiler = new_compiler(fields, allow_any=True)
+                compiler.gen_encoder(_func_name("encode_", func_suffix), prefix=b"", default_missing_to_zero=False)
+                encoder = compiler.compile(_func_name("encode_", func_suffix), f"<lnmsg encoder {tlv_stream_name}/{tlv_record_name}>")
+                self._tlv_record_decoders[tlv_stream_name][tlv_record_type] = (tlv_record_name, decoder)
+                self._tlv_record_encoders[tlv_stream_name].append(
+                    (tlv_record_name, write_bigsize_int(tlv_record_type), encoder))
+
+    def _write_tlv_stream_to_bytes(self, tlv_stream_name: str, records: Dict[str, Dict[str, Any]]) -> bytes:
+        parts = []
+        for tlv_record_name, tlv_type_bytes, encoder in self._tlv_record_encoders[tlv_stream_name]:
+            # note: tlv_record_type is monotonically increasing
+            if tlv_record_name not in records:
                 continue
-            with io.BytesIO() as tlv_record_fd:
-                for row in scheme:
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=kwargs[tlv_record_name],
-                                                           allow_any=True)
-                        field_value = kwargs[tlv_record_name][field_name]
-                        _write_field(fd=tlv_record_fd,
-                                     field_type=field_type,
-                                     count=field_count,
-                                     value=field_value)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
-                _write_tlv_record(fd=fd, tlv_type=tlv_record_type, tlv_val=tlv_record_fd.getvalue())
-
-    def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+            tlv_val = encoder(records[tlv_record_name])
+            parts.append(tlv_type_bytes)
+            parts.append(write_bigsize_int(len(tlv_val)))
+            parts.append(tlv_val)
+        return b"".join(parts)
+
+    def _read_tlv_stream_at(self, data: bytes, pos: int, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+        """Reads a TLV stream that spans from 'pos' to the end of 'data'."""
         parsed = {}  # type: Dict[str, Dict[str, Any]]
-        scheme_map = self.in_tlv_stream_get_tlv_record_scheme_from_type[tlv_stream_name]
+        record_decoders = self._tlv_record_decoders[tlv_stream_name]
         last_seen_tlv_record_type = -1  # type: int
-        while _num_remaining_bytes_to_read(fd) > 0:
-            tlv_record_type, tlv_record_val = _read_tlv_record(fd=fd)
+        n = len(data)
+        while pos < n:
+            tlv_record_type, pos = read_bigsize_int_at(data, pos)
+            tlv_len, pos = read_bigsize_int_at(data, pos)
+            if tlv_len is None or pos + tlv_len > n:
+                raise UnexpectedEndOfStream()
+            tlv_record_val = data[pos:pos+tlv_len]
+            pos += tlv_len
             if not (tlv_record_type > last_seen_tlv_record_type):
                 raise MsgInvalidFieldOrder(f"TLV records must be monotonically increasing by type. "
                                            f"cur: {tlv_record_type}. prev: {last_seen_tlv_record_type}")
             last_seen_tlv_record_type = tlv_record_type
             try:
-                scheme = scheme_map[tlv_record_type]
+                tlv_record_name, decoder = record_decoders[tlv_record_type]
             except KeyError:
                 if tlv_record_type % 2 == 0:
                     # unknown "even" type: hard fail
@@ -391,74 +687,21 @@ class LNSerializer:
                 else:
                     # unknown "odd" type: skip it
                     continue
-            tlv_record_name = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name][tlv_record_type]
-            parsed[tlv_record_name] = {}
-            with io.BytesIO(tlv_record_val) as tlv_record_fd:
-                for row in scheme:
-                    #print(f"row: {row!r}")
-                    if row[0] == "tlvtype":
-                        pass
-                    elif row[0] == "tlvdata":
-                        # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
-                        assert tlv_stream_name == row[1]
-                        assert tlv_record_name == row[2]
-                        field_name = row[3]
-                        field_type = row[4]
-                        field_count_str = row[5]
-                        field_count = _resolve_field_count(field_count_str,
-                                                           vars_dict=parsed[tlv_record_name],
-                                                           allow_any=True)
-                        #print(f">> count={field_count}. parsed={parsed}")
-                        parsed[tlv_record_name][field_name] = _read_field(fd=tlv_record_fd,
-                                                                          field_type=field_type,
-                                                                          count=field_count)
-                    else:
-                        raise Exception(f"unexpected row in scheme: {row!r}")
-                if _num_remaining_bytes_to_read(tlv_record_fd) > 0:
-                    raise MsgTrailingGarbage(f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
+            parsed[tlv_record_name] = decoder(tlv_record_val)
         return parsed
 
+    def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
+        fd.write(self._write_tlv_stream_to_bytes(tlv_stream_name, kwargs))
+
+    def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+        return self._read_tlv_stream_at(fd.read(), 0, tlv_stream_name)
+
     def encode_msg(self, msg_type: str, **kwargs) -> bytes:
         """
         Encode kwargs into a Lightning message (bytes)
         of the type given in the msg_type string
         """
-        #print(f">>> encode_msg. msg_type={msg_type}, payload={kwargs!r}")
-        msg_type_bytes = self.msg_type_from_name[msg_type]
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
-        with io.BytesIO() as fd:
-            fd.write(msg_type_bytes)
-            for row in scheme:
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    #print(f">>> encode_msg. msgdata. field_name={field_name!r}. field_type={field_type!r}. field_count_str={field_count_str!r}")
-                    field_count = _resolve_field_count(field_count_str, vars_dict=kwargs)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        if tlv_stream_name in kwargs:
-                            self.write_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name, **(kwargs[tlv_stream_name]))
-                        continue
-                    try:
-                        field_value = kwargs[field_name]
-                    except KeyError:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            field_value = 0  # default mandatory fields to zero
-                    #print(f">>> encode_msg. writing field: {field_name}. value={field_value!r}. field_type={field_type!r}. count={field_count!r}")
-                    _write_field(fd=fd,
-                                 field_type=field_type,
-                                 count=field_count,
-                                 value=field_value)
-                    #print(f">>> encode_msg. so far: {fd.getvalue().hex()}")
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
-            return fd.getvalue()
+        return self._msg_encoders[msg_type](kwargs)
 
     def decode_msg(self, data: bytes) -> Tuple[str, dict]:
         """
@@ -467,43 +710,9 @@ class LNSerializer:
 
         Returns message type string and parsed message contents dict
         """
-        #print(f"decode_msg >>> {data.hex()}")
         assert len(data) >= 2
-        msg_type_bytes = data[:2]
-        msg_type_int = int.from_bytes(msg_type_bytes, byteorder="big", signed=False)
-        scheme = self.msg_scheme_from_type[msg_type_bytes]
-        assert scheme[0][2] == msg_type_int
-        msg_type_name = scheme[0][1]
-        parsed = {}
-        with io.BytesIO(data[2:]) as fd:
-            for row in scheme:
-                #print(f"row: {row!r}")
-                if row[0] == "msgtype":
-                    pass
-                elif row[0] == "msgdata":
-                    field_name = row[2]
-                    field_type = row[3]
-                    field_count_str = row[4]
-                    field_count = _resolve_field_count(field_count_str, vars_dict=parsed)
-                    if field_name == "tlvs":
-                        tlv_stream_name = field_type
-                        d = self.read_tlv_stream(fd=fd, tlv_stream_name=tlv_stream_name)
-                        parsed[tlv_stream_name] = d
-                        continue
-                    #print(f">> count={field_count}. parsed={parsed}")
-                    try:
-                        parsed[field_name] = _read_field(fd=fd,
-                                                         field_type=field_type,
-                                                         count=field_count)
-                    except UnexpectedEndOfStream as e:
-                        if len(row) > 5:
-                            break  # optional feature field not present
-                        else:
-                            raise
-                else:
-                    raise Exception(f"unexpected row in scheme: {row!r}")
-        return msg_type_name, parsed
-
+        msg_type_name, decoder = self._msg_decoders[data[:2]]
+        return msg_type_name, decoder(data)
 
 _inst = LNSerializer()
 encode_msg = _inst.encode_msg
@@ -25,6 +25,7 @@
 
 import io
 import hashlib
+from collections import OrderedDict
 from typing import Sequence, List, Tuple, NamedTuple, TYPE_CHECKING
 from enum import IntEnum, IntFlag
 
@@ -43,11 +44,13 @@ HOPS_DATA_SIZE = 1300      # also sometimes called routingInfoSize in bolt-04
 LEGACY_PER_HOP_FULL_SIZE = 65
 NUM_STREAM_BYTES = 2 * HOPS_DATA_SIZE
 PER_HOP_HMAC_SIZE = 32
+PROCESSED_ONION_CACHE_SIZE = 5000
 
 
 class UnsupportedOnionPacketVersion(Exception): pass
 class InvalidOnionMac(Exception): pass
 class InvalidOnionPubkey(Exception): pass
+class ReplayedOnion(Exception): pass
 
 
 class LegacyHopDataPayload:
@@ -244,11 +247,10 @@ def new_onion_packet(payment_path_pubkeys: Sequence[bytes], session_key: bytes,
         rho_key = get_bolt04_onion_key(b'rho', hop_shared_secrets[i])
         mu_key = get_bolt04_onion_key(b'mu', hop_shared_secrets[i])
         hops_data[i].hmac = next_hmac
-        stream_bytes = generate_cipher_stream(rho_key, HOPS_DATA_SIZE)
         hop_data_bytes = hops_data[i].to_bytes()
         mix_header = mix_header[:-len(hop_data_bytes)]
         mix_header = hop_data_bytes + mix_header
-        mix_header = xor_bytes(mix_header, stream_bytes)
+        mix_header = xor_with_cipher_stream(rho_key, mix_header)
         if i == num_hops - 1 and len(filler) != 0:
             mix_header = mix_header[:-len(filler)] + filler
         packet = mix_header + associated_data
@@ -330,18 +332,30 @@ def generate_cipher_stream(stream_key: bytes, num_bytes: int) -> bytes:
                             data=bytes(num_bytes))
 
 
+def xor_with_cipher_stream(stream_key: bytes, data: bytes) -> bytes:
+    """Same as xor_bytes(data, generate_cipher_stream(stream_key, len(data))),
+    but lets the cipher do the xor, without materializing the stream.
+    """
+    return chacha20_encrypt(key=stream_key,
+                            nonce=bytes(8),
+                            data=data)
+
+
 class ProcessedOnionPacket(NamedTuple):
     are_we_final: bool
     hop_data: OnionHopsDataSingle
     next_packet: OnionPacket
+    shared_secret: bytes = None
 
 
-# TODO replay protection
 def process_onion_packet(onion_packet: OnionPacket, associated_data: bytes,
                          our_onion_private_key: bytes) -> ProcessedOnionPacket:
-    if not ecc.ECPubkey.is_pubkey_bytes(onion_packet.public_key):
+    try:
+        public_key = ecc.ECPubkey(onion_packet.public_key)
+    except Exception:
         raise InvalidOnionPubkey()
-    shared_secret = get_ecdh(our_onion_private_key, onion_packet.public_key)
+    shared_secret = sha256((public_key * int.from_bytes(our_onion_private_key, byteorder="big"))
+                           .get_public_key_bytes())
 
     # check message integrity
     mu_key = get_bolt04_onion_key(b'mu', shared_secret)
@@ -352,16 +366,14 @@ def process_onion_packet(onion_packet: OnionPacket, associated_data: bytes,
 
     # peel an onion layer off
     rho_key = get_bolt04_onion_key(b'rho', shared_secret)
-    stream_bytes = generate_cipher_stream(rho_key, NUM_STREAM_BYTES)
     padded_header = onion_packet.hops_data + bytes(HOPS_DATA_SIZE)
-    next_hops_data = xor_bytes(padded_header, stream_bytes)
+    next_hops_data = xor_with_cipher_stream(rho_key, padded_header)
     next_hops_data_fd = io.BytesIO(next_hops_data)
 
     # calc next ephemeral key
     blinding_factor = sha256(onion_packet.public_key + shared_secret)
     blinding_factor_int = int.from_bytes(blinding_factor, byteorder="big")
-    next_public_key_int = ecc.ECPubkey(onion_packet.public_key) * blinding_factor_int
-    next_public_key = next_public_key_int.get_public_key_bytes()
+    next_public_key = (public_key * blinding_factor_int).get_public_key_bytes()
 
     hop_data = OnionHopsDataSingle.from_fd(next_hops_data_fd)
     next_onion_packet = OnionPacket(
@@ -375,7 +387,50 @@ def process_onion_packet(onion_packet: OnionPacket, associated_data: bytes,
     else:
         # we are an intermediate node; forwarding
         are_we_final = False
-    return ProcessedOnionPacket(are_we_final, hop_data, next_onion_packet)
+    return ProcessedOnionPacket(are_we_final, hop_data, next_onion_packet, shared_secret)
+
+
+class ProcessedOnionCache:
+    """Bounded cache of processed onion packets, keyed by the ephemeral
+    public key of the onion.
+
+    The onion of an incoming HTLC is processed every time the htlc_switch
+    looks at the HTLC, until the HTLC is resolved; each time would otherwise
+    cost two EC multiplications. The cache also protects against replays:
+    a shared secret must not be used by more than one HTLC (bolt-04).
+    Note that replays are only detected while the onion is in the cache.
+    """
+
+    def __init__(self, max_size: int = PROCESSED_ONION_CACHE_SIZE):
+        self.max_size = max_size
+        # ephemeral pubkey -> (htlc_key, onion_hash, processed_onion)
+        self._cache = OrderedDict()  # type: OrderedDict[bytes, Tuple[bytes, bytes, ProcessedOnionPacket]]
+        self.hits = 0
+        self.misses = 0
+
+    def process_onion_packet(self, onion_packet: OnionPacket, associated_data: bytes,
+                             our_onion_private_key: bytes, *, htlc_key: bytes) -> ProcessedOnionPacket:
+        """Like process_onion_packet, for the HTLC identified by htlc_key.
+        Raises ReplayedOnion if the onion was already used by a different HTLC.
+        """
+        public_key = onion_packet.public_key
+        onion_hash = sha256(onion_packet.hops_data + onion_packet.hmac + associated_data)
+        item = self._cache.get(public_key)
+        if item is not None:
+            cached_htlc_key, cached_onion_hash, processed_onion = item
+            if cached_htlc_key != htlc_key:
+                raise ReplayedOnion()
+            if cached_onion_hash == onion_hash:
+                self._cache.move_to_end(public_key)
+                self.hits += 1
+                return processed_onion
+        self.misses += 1
+        processed_onion = process_onion_packet(onion_packet, associated_data, our_onion_private_key)
+        self._cache[public_key] = (htlc_key, onion_hash, processed_onion)
+        self._cache.move_to_end(public_key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return processed_onion
 
 
 class FailedToDecodeOnionError(Exception): pass
@@ -413,7 +468,8 @@ class OnionRoutingFailureMessage:
 
 def construct_onion_error(reason: OnionRoutingFailureMessage,
                           onion_packet: OnionPacket,
-                          our_onion_private_key: bytes) -> bytes:
+                          our_onion_private_key: bytes,
+                          *, shared_secret: bytes = None) -> bytes:
     # create payload
     failure_msg = reason.to_bytes()
     failure_len = len(failure_msg)
@@ -424,14 +480,14 @@ def construct_onion_error(reason: OnionRoutingFailureMessage,
     error_packet += pad_len.to_bytes(2, byteorder="big")
     error_packet += bytes(pad_len)
     # add hmac
-    shared_secret = get_ecdh(our_onion_private_key, onion_packet.public_key)
+    if shared_secret is None:
+        shared_secret = get_ecdh(our_onion_private_key, onion_packet.public_key)
     um_key = get_bolt04_onion_key(b'um', shared_secret)
     hmac_ = hmac_oneshot(um_key, msg=error_packet, digest=hashlib.sha256)
     error_packet = hmac_ + error_packet
     # obfuscate
     ammag_key = get_bolt04_onion_key(b'ammag', shared_secret)
-    stream_bytes = generate_cipher_stream(ammag_key, len(error_packet))
-    error_packet = xor_bytes(error_packet, stream_bytes)
+    error_packet = xor_with_cipher_stream(ammag_key, error_packet)
     return error_packet
 
 
@@ -443,8 +499,7 @@ def _decode_onion_error(error_packet: bytes, payment_path_pubkeys: Sequence[byte
     for i in range(num_hops):
         ammag_key = get_bolt04_onion_key(b'ammag', hop_shared_secrets[i])
         um_key = get_bolt04_onion_key(b'um', hop_shared_secrets[i])
-        stream_bytes = generate_cipher_stream(ammag_key, len(error_packet))
-        error_packet = xor_bytes(error_packet, stream_bytes)
+        error_packet = xor_with_cipher_stream(ammag_key, error_packet)
         hmac_computed = hmac_oneshot(um_key, msg=error_packet[32:], digest=hashlib.sha256)
         hmac_found = error_packet[:32]
         if hmac_computed == hmac_found:
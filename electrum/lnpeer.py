@@ -29,9 +29,9 @@ from . import transaction
 from .transaction import Transaction, TxOutput, PartialTxOutput, match_script_against_template
 from .logging import Logger
 from .lnonion import (new_onion_packet, decode_onion_error, OnionFailureCode, calc_hops_data_for_payment,
-                      process_onion_packet, OnionPacket, construct_onion_error, OnionRoutingFailureMessage,
+                      OnionPacket, construct_onion_error, OnionRoutingFailureMessage,
                       ProcessedOnionPacket, UnsupportedOnionPacketVersion, InvalidOnionMac, InvalidOnionPubkey,
-                      OnionFailureCodeMetaFlag)
+                      OnionFailureCodeMetaFlag, ReplayedOnion)
 from .lnchannel import Channel, RevokeAndAck, htlcsum, RemoteCtnTooFarInFuture, ChannelState, PeerState
 from . import lnutil
 from .lnutil import (Outpoint, LocalConfig, RECEIVED, UpdateAddHtlc,
@@ -62,6 +62,23 @@ if TYPE_CHECKING:
 LN_P2P_NETWORK_TIMEOUT = 20
 
 
+def verify_channel_announcement(payload: dict) -> bool:
+    h = sha256d(payload['raw'][2+256:])
+    pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
+    sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
+    for pubkey, sig in zip(pubkeys, sigs):
+        if not ecc.verify_signature(pubkey, sig, h):
+            return False
+    return True
+
+
+def verify_node_announcement(payload: dict) -> bool:
+    pubkey = payload['node_id']
+    signature = payload['signature']
+    h = sha256d(payload['raw'][66:])
+    return ecc.verify_signature(pubkey, signature, h)
+
+
 class Peer(Logger):
     LOGGING_SHORTCUT = 'P'
 
@@ -87,8 +104,6 @@ class Peer(Logger):
         self.channel_db = lnworker.network.channel_db
         self.ping_time = 0
         self.reply_channel_range = asyncio.Queue()
-        # gossip uses a single queue to preserve message order
-        self.gossip_queue = asyncio.Queue()
         self.ordered_messages = ['accept_channel', 'funding_signed', 'funding_created', 'accept_channel', 'channel_reestablish', 'closing_signed']
         self.ordered_message_queues = defaultdict(asyncio.Queue) # for messsage that are ordered
         self.temp_id_to_id = {}   # to forward error messages
@@ -247,14 +262,20 @@ class Peer(Logger):
         self.maybe_set_initialized()
 
     def on_node_announcement(self, payload):
-        self.gossip_queue.put_nowait(('node_announcement', payload))
+        self.submit_gossip('node_announcement', payload)
 
     def on_channel_announcement(self, payload):
-        self.gossip_queue.put_nowait(('channel_announcement', payload))
+        self.submit_gossip('channel_announcement', payload)
 
     def on_channel_update(self, payload):
         self.maybe_save_remote_update(payload)
-        self.gossip_queue.put_nowait(('channel_update', payload))
+        self.submit_gossip('channel_update', payload)
+
+    def submit_gossip(self, name: str, payload: dict) -> None:
+        # gossip from all peers is verified and stored by LNGossip
+        lngossip = self.network.lngossip
+        if lngossip:
+            lngossip.submit_gossip(self, name, payload)
 
     def maybe_save_remote_update(self, payload):
         for chan in self.channels.values():
@@ -289,74 +310,15 @@ class Peer(Logger):
             await group.spawn(self._message_loop())
             await group.spawn(self.htlc_switch())
             await group.spawn(self.query_gossip())
-            await group.spawn(self.process_gossip())
 
-    async def process_gossip(self):
-        await self.channel_db.data_loaded.wait()
-        # verify in peer's TaskGroup so that we fail the connection
-        while True:
-            await asyncio.sleep(5)
-            chan_anns = []
-            chan_upds = []
-            node_anns = []
-            while True:
-                name, payload = await self.gossip_queue.get()
-                if name == 'channel_announcement':
-                    chan_anns.append(payload)
-                elif name == 'channel_update':
-                    chan_upds.append(payload)
-                elif name == 'node_announcement':
-                    node_anns.append(payload)
-                else:
-                    raise Exception('unknown message')
-                if self.gossip_queue.empty():
-                    break
-            self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
-            # note: data processed in chunks to avoid taking sql lock for too long
-            # channel announcements
-            for chan_anns_chunk in chunks(chan_anns, 300):
-                self.verify_channel_announcements(chan_anns_chunk)
-                self.channel_db.add_channel_announcement(chan_anns_chunk)
-            # node announcements
-            for node_anns_chunk in chunks(node_anns, 100):
-                self.verify_node_announcements(node_anns_chunk)
-                self.channel_db.add_node_announcement(node_anns_chunk)
-            # channel updates
-            for chan_upds_chunk in chunks(chan_upds, 1000):
-                categorized_chan_upds = self.channel_db.add_channel_updates(
-                    chan_upds_chunk, max_age=self.network.lngossip.max_age)
-                orphaned = categorized_chan_upds.orphaned
-                if orphaned:
-                    self.logger.info(f'adding {len(orphaned)} unknown channel ids')
-                    orphaned_ids = [c['short_channel_id'] for c in orphaned]
-                    await self.network.lngossip.add_new_ids(orphaned_ids)
-                    # Save (some bounded number of) orphan channel updates for later
-                    # as it might be for our own direct channel with this peer
-                    # (and we might not yet know the short channel id for that)
-                    for chan_upd_payload in orphaned:
-                        short_channel_id = ShortChannelID(chan_upd_payload['short_channel_id'])
-                        self.orphan_channel_updates[short_channel_id] = chan_upd_payload
-                        while len(self.orphan_channel_updates) > 25:
-                            self.orphan_channel_updates.popitem(last=False)
-                if categorized_chan_upds.good:
-                    self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
-
-    def verify_channel_announcements(self, chan_anns):
-        for payload in chan_anns:
-            h = sha256d(payload['raw'][2+256:])
-            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
-            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
-            for pubkey, sig in zip(pubkeys, sigs):
-                if not ecc.verify_signature(pubkey, sig, h):
-                    raise Exception('signature failed')
-
-    def verify_node_announcements(self, node_anns):
-        for payload in node_anns:
-            pubkey = payload['node_id']
-            signature = payload['signature']
-            h = sha256d(payload['raw'][66:])
-            if not ecc.verify_signature(pubkey, signature, h):
-                raise Exception('signature failed')
+    def save_orphan_channel_update(self, payload: dict) -> None:
+        # Save (some bounded number of) orphan channel updates for later
+        # as it might be for our own direct channel with this peer
+        # (and we might not yet know the short channel id for that)
+        short_channel_id = ShortChannelID(payload['short_channel_id'])
+        self.orphan_channel_updates[short_channel_id] = payload
+        while len(self.orphan_channel_updates) > 25:
+            self.orphan_channel_updates.popitem(last=False)
 
     async def query_gossip(self):
         try:
@@ -480,6 +442,8 @@ class Peer(Logger):
             raise GracefulDisconnect(f'initialize failed: {repr(e)}') from e
         async for msg in self.transport.read_messages():
             self.process_message(msg)
+            # our replies are written out in batches; don't let them pile up
+            await self.transport.drain()
             await asyncio.sleep(.01)
 
     def on_reply_short_channel_ids_end(self, payload):
@@ -1553,15 +1517,23 @@ class Peer(Logger):
                     preimage = None
                     onion_packet_bytes = bytes.fromhex(onion_packet_hex)
                     onion_packet = None
+                    processed_onion = None
                     try:
                         onion_packet = OnionPacket.from_bytes(onion_packet_bytes)
-                        processed_onion = process_onion_packet(onion_packet, associated_data=payment_hash, our_onion_private_key=self.privkey)
+                        processed_onion = self.lnworker.processed_onions.process_onion_packet(
+                            onion_packet,
+                            associated_data=payment_hash,
+                            our_onion_private_key=self.privkey,
+                            htlc_key=chan.channel_id + htlc.htlc_id.to_bytes(8, byteorder="big"))
                     except UnsupportedOnionPacketVersion:
                         error_reason = OnionRoutingFailureMessage(code=OnionFailureCode.INVALID_ONION_VERSION, data=sha256(onion_packet_bytes))
                     except InvalidOnionPubkey:
                         error_reason = OnionRoutingFailureMessage(code=OnionFailureCode.INVALID_ONION_KEY, data=sha256(onion_packet_bytes))
                     except InvalidOnionMac:
                         error_reason = OnionRoutingFailureMessage(code=OnionFailureCode.INVALID_ONION_HMAC, data=sha256(onion_packet_bytes))
+                    except ReplayedOnion:
+                        self.logger.info(f"replayed onion in htlc {htlc.htlc_id}")
+                        error_reason = OnionRoutingFailureMessage(code=OnionFailureCode.TEMPORARY_NODE_FAILURE, data=b'')
                     except Exception as e:
                         self.logger.info(f"error processing onion packet: {e!r}")
                         error_reason = OnionRoutingFailureMessage(code=OnionFailureCode.INVALID_ONION_VERSION, data=sha256(onion_packet_bytes))
@@ -1599,7 +1571,9 @@ class Peer(Logger):
                             done.add(htlc_id)
                     if error_reason or error_bytes:
                         if onion_packet and error_reason:
-                            error_bytes = construct_onion_error(error_reason, onion_packet, our_onion_private_key=self.privkey)
+                            error_bytes = construct_onion_error(
+                                error_reason, onion_packet, our_onion_private_key=self.privkey,
+                                shared_secret=processed_onion.shared_secret if processed_onion else None)
                         if error_bytes:
                             self.fail_htlc(
                                 chan=chan,
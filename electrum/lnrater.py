@@ -6,21 +6,16 @@ lnrater.py contains Lightning Network node rating functionality.
 """
 
 import asyncio
-from collections import defaultdict
 from pprint import pformat
 from random import choices
-from statistics import mean, median, stdev
 from typing import TYPE_CHECKING, Dict, NamedTuple, Tuple, List
 import time
 
 from .logging import Logger
 from .util import profiler
-from .lnrouter import fee_for_edge_msat
 
 if TYPE_CHECKING:
     from .network import Network
-    from .channel_db import Policy
-    from .lnchannel import ShortChannelID
     from .lnworker import LNWallet
 
 
@@ -80,7 +75,6 @@ class LNRater(Logger):
 
         self._node_stats: Dict[bytes, NodeStats] = {}  # node_id -> NodeStats
         self._node_ratings: Dict[bytes, float] = {}  # node_id -> float
-        self._policies_by_nodes: Dict[bytes, List[Tuple[ShortChannelID, Policy]]] = defaultdict(list)  # node_id -> (short_channel_id, policy)
         self._last_analyzed = 0  # timestamp
         self._last_progress_percent = 0
 
@@ -118,83 +112,61 @@ class LNRater(Logger):
 
     async def _analyze_graph(self):
         await self.channel_db.data_loaded.wait()
-        self._collect_policies_by_node()
-        loop = asyncio.get_running_loop()
-        # the analysis is run in an executor because it's costly
-        await loop.run_in_executor(None, self._collect_purged_stats)
+        self._collect_purged_stats()
         self._rate_nodes()
         now = time.time()
         self._last_analyzed = now
 
-    def _collect_policies_by_node(self):
-        policies = self.channel_db.get_node_policies()
-        for pv, p in policies.items():
-            # append tuples of ShortChannelID and Policy
-            self._policies_by_nodes[pv[0]].append((pv[1], p))
-
     @profiler
     def _collect_purged_stats(self):
-        """Traverses through the graph and sorts out nodes."""
+        """Sorts out nodes, using the policy statistics the channel db
+        keeps up to date as gossip arrives."""
         current_height = self.network.get_local_height()
-        node_infos = self.channel_db.get_node_infos()
+        # save some time for nodes we are not interested in:
+        policy_stats = self.channel_db.get_node_policy_stats(min_num_channels=EXCLUDE_NUM_CHANNELS)
+        self._node_stats = {}
+        for n, stats in policy_stats.items():
+            # use policies synonymously to channels
+            num_channels = stats.number_channels
+
+            # analyze block heights
+            node_age_bh = current_height - stats.min_block_height
+            if node_age_bh < EXCLUDE_NODE_AGE:
+                continue
+            mean_channel_age_bh = current_height - stats.mean_block_height
+            if mean_channel_age_bh < EXCLUDE_MEAN_CHANNEL_AGE:
+                continue
+            blocks_since_last_channel = current_height - stats.max_block_height
+            if blocks_since_last_channel > EXCLUDE_BLOCKS_LAST_CHANNEL:
+                continue
 
-        for n, channel_policies in self._policies_by_nodes.items():
-            try:
-                # use policies synonymously to channels
-                num_channels = len(channel_policies)
-
-                # save some time for nodes we are not interested in:
-                if num_channels < EXCLUDE_NUM_CHANNELS:
-                    continue
-
-                # analyze block heights
-                block_heights = [p[0].block_height for p in channel_policies]
-                node_age_bh = current_height - min(block_heights)
-                if node_age_bh < EXCLUDE_NODE_AGE:
-                    continue
-                mean_channel_age_bh = current_height - mean(block_heights)
-                if mean_channel_age_bh < EXCLUDE_MEAN_CHANNEL_AGE:
-                    continue
-                blocks_since_last_channel = current_height - max(block_heights)
-                if blocks_since_last_channel > EXCLUDE_BLOCKS_LAST_CHANNEL:
-                    continue
-
-                # analyze capacities
-                capacities = [p[1].htlc_maximum_msat for p in channel_policies]
-                if None in capacities:
-                    continue
-                total_capacity = sum(capacities)
-
-                mean_capacity = total_capacity / num_channels if num_channels else 0
-                if mean_capacity < EXCLUDE_MEAN_CAPACITY_MSAT:
-                    continue
-                median_capacity = median(capacities)
-
-                # analyze fees
-                effective_fee_rates = [fee_for_edge_msat(
-                    FEE_AMOUNT_MSAT,
-                    p[1].fee_base_msat,
-                    p[1].fee_proportional_millionths) / FEE_AMOUNT_MSAT for p in channel_policies]
-                mean_fees_rate = mean(effective_fee_rates)
-                if mean_fees_rate > EXCLUCE_EFFECTIVE_FEE_RATE:
-                    continue
-
-                self._node_stats[n] = NodeStats(
-                    number_channels=num_channels,
-                    total_capacity_msat=total_capacity,
-                    median_capacity_msat=median_capacity,
-                    mean_capacity_msat=mean_capacity,
-                    node_age_block_height=node_age_bh,
-                    mean_channel_age_block_height=mean_channel_age_bh,
-                    blocks_since_last_channel=blocks_since_last_channel,
-                    mean_fee_rate=mean_fees_rate
-                )
-
-            except Exception as e:
-                self.logger.exception("Could not use channel policies for "
-                                      "calculating statistics.")
-                self.logger.debug(pformat(channel_policies))
+            # analyze capacities
+            if stats.num_capacity_unknown:
                 continue
+            total_capacity = stats.total_capacity_msat
+            mean_capacity = total_capacity / num_channels
+            if mean_capacity < EXCLUDE_MEAN_CAPACITY_MSAT:
+                continue
+
+            # analyze fees
+            # (FEE_AMOUNT_MSAT is a multiple of a million, so the mean of the
+            # effective fee rates is the effective fee rate of the mean fees)
+            mean_fees_rate = (stats.mean_fee_base_msat
+                              + FEE_AMOUNT_MSAT * stats.mean_fee_proportional_millionths / 1_000_000
+                              ) / FEE_AMOUNT_MSAT
+            if mean_fees_rate > EXCLUCE_EFFECTIVE_FEE_RATE:
+                continue
+
+            self._node_stats[n] = NodeStats(
+                number_channels=num_channels,
+                total_capacity_msat=total_capacity,
+                median_capacity_msat=stats.median_capacity_msat,
+                mean_capacity_msat=mean_capacity,
+                node_age_block_height=node_age_bh,
+                mean_channel_age_block_height=mean_channel_age_bh,
+                blocks_since_last_channel=blocks_since_last_channel,
+                mean_fee_rate=mean_fees_rate
+            )
 
         self.logger.info(f"node statistics done, calculated statistics"
                          f"for {len(self._node_stats)} nodes")
@@ -23,9 +23,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
+import heapq
+import threading
+from array import array
 from collections import defaultdict
-from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
+from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set, Iterable
 import time
 import attr
 
@@ -135,6 +137,157 @@ def is_fee_sane(fee_msat: int, *, payment_amount_msat: int) -> bool:
     return False
 
 
+class RoutingGraph:
+    """Compact snapshot of the public channel graph, used for path finding.
+
+    Channels and nodes are numbered; per-channel and per-direction data is
+    kept in flat arrays. Direction 0 is the edge starting at node1, direction 1
+    the one starting at node2; the directed edge of channel c is 2*c+direction.
+    The snapshot is refreshed incrementally using the ChannelDB changelog.
+    """
+
+    NO_HTLC_MAX = 2**64 - 1
+    FLAG_HAS_POLICY = 1
+    FLAG_DISABLED = 2
+
+    def __init__(self, channel_db: ChannelDB):
+        self.channel_db = channel_db
+        self._changelog_position = -1
+        self._clear()
+
+    def _clear(self):
+        # nodes
+        self.node_ids = []  # type: List[bytes]
+        self._node_idx = {}  # type: Dict[bytes, int]
+        self._chans_for_node = []  # type: List[List[int]]
+        # channels
+        self.scids = []  # type: List[Optional[ShortChannelID]]  # None for removed channels
+        self._chan_idx = {}  # type: Dict[ShortChannelID, int]
+        self._chan_node1 = array('l')
+        self._chan_node2 = array('l')
+        self._capacity_sat = array('q')  # -1 if unknown
+        # directed edges
+        self._flags = array('B')
+        self._cltv_expiry_delta = array('L')
+        self._htlc_minimum_msat = array('Q')
+        self._htlc_maximum_msat = array('Q')
+        self._fee_base_msat = array('Q')
+        self._fee_proportional_millionths = array('Q')
+
+    def refresh(self) -> None:
+        position, changed = self.channel_db.get_channels_changed_since(self._changelog_position)
+        if changed is None:
+            self._rebuild()
+        else:
+            for short_channel_id in changed:
+                self._update_channel(short_channel_id)
+        self._changelog_position = position
+
+    @profiler
+    def _rebuild(self) -> None:
+        self._clear()
+        for short_channel_id in self.channel_db.get_channel_ids():
+            self._update_channel(short_channel_id)
+
+    def _get_or_add_node(self, node_id: bytes) -> int:
+        idx = self._node_idx.get(node_id)
+        if idx is None:
+            idx = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self._node_idx[node_id] = idx
+            self._chans_for_node.append([])
+        return idx
+
+    def _update_channel(self, short_channel_id: ShortChannelID) -> None:
+        channel_info = self.channel_db.get_channel_info(short_channel_id)
+        c = self._chan_idx.get(short_channel_id)
+        if channel_info is None:
+            if c is not None:  # channel got removed
+                del self._chan_idx[short_channel_id]
+                self.scids[c] = None
+                self._chans_for_node[self._chan_node1[c]].remove(c)
+                self._chans_for_node[self._chan_node2[c]].remove(c)
+                self._flags[2 * c] = self._flags[2 * c + 1] = 0
+            return
+        if c is None:
+            c = len(self.scids)
+            n1 = self._get_or_add_node(channel_info.node1_id)
+            n2 = self._get_or_add_node(channel_info.node2_id)
+            self.scids.append(short_channel_id)
+            self._chan_idx[short_channel_id] = c
+            self._chan_node1.append(n1)
+            self._chan_node2.append(n2)
+            self._capacity_sat.append(-1)
+            self._chans_for_node[n1].append(c)
+            self._chans_for_node[n2].append(c)
+            for _ in range(2):
+                self._flags.append(0)
+                self._cltv_expiry_delta.append(0)
+                self._htlc_minimum_msat.append(0)
+                self._htlc_maximum_msat.append(self.NO_HTLC_MAX)
+                self._fee_base_msat.append(0)
+                self._fee_proportional_millionths.append(0)
+        capacity_sat = channel_info.capacity_sat
+        self._capacity_sat[c] = capacity_sat if capacity_sat is not None else -1
+        for direction, start_node in enumerate((channel_info.node1_id, channel_info.node2_id)):
+            self._set_policy(2 * c + direction,
+                             self.channel_db.get_policy_for_node(short_channel_id, start_node))
+
+    def _set_policy(self, e: int, policy: Optional[Policy]) -> None:
+        if policy is None:
+            self._flags[e] = 0
+            return
+        self._flags[e] = self.FLAG_HAS_POLICY | (self.FLAG_DISABLED if policy.is_disabled() else 0)
+        self._cltv_expiry_delta[e] = policy.cltv_expiry_delta
+        self._htlc_minimum_msat[e] = policy.htlc_minimum_msat
+        htlc_maximum_msat = policy.htlc_maximum_msat
+        self._htlc_maximum_msat[e] = min(htlc_maximum_msat, self.NO_HTLC_MAX) \
+            if htlc_maximum_msat is not None else self.NO_HTLC_MAX
+        self._fee_base_msat[e] = policy.fee_base_msat
+        self._fee_proportional_millionths[e] = policy.fee_proportional_millionths
+
+    def get_node_idx(self, node_id: bytes) -> Optional[int]:
+        return self._node_idx.get(node_id)
+
+    def incoming_edges(self, node_idx: int) -> Iterable[Tuple[int, int, int]]:
+        """Yields (channel_idx, edge_idx, start_node_idx) for the edges ending at node_idx."""
+        chan_node1 = self._chan_node1
+        chan_node2 = self._chan_node2
+        for c in self._chans_for_node[node_idx]:
+            if chan_node1[c] == node_idx:
+                yield c, 2 * c + 1, chan_node2[c]
+            else:
+                yield c, 2 * c, chan_node1[c]
+
+    def edge_cost(self, c: int, e: int, payment_amt_msat: int, *,
+                  ignore_costs: bool = False) -> Tuple[float, int]:
+        """Same as LNPathFinder._edge_cost, for public edges that are not ours."""
+        flags = self._flags
+        # channels that did not publish both policies often return temporary channel failure
+        if flags[e] != self.FLAG_HAS_POLICY or not flags[e ^ 1] & self.FLAG_HAS_POLICY:
+            return float('inf'), 0
+        if payment_amt_msat < self._htlc_minimum_msat[e]:
+            return float('inf'), 0  # payment amount too little
+        capacity_sat = self._capacity_sat[c]
+        if capacity_sat >= 0 and payment_amt_msat // 1000 > capacity_sat:
+            return float('inf'), 0  # payment amount too large
+        if payment_amt_msat > self._htlc_maximum_msat[e]:
+            return float('inf'), 0  # payment amount too large
+        cltv_expiry_delta = self._cltv_expiry_delta[e]
+        # see RouteEdge.is_sane_to_use
+        if cltv_expiry_delta > 14 * 144:
+            return float('inf'), 0
+        fee_msat = fee_for_edge_msat(payment_amt_msat, self._fee_base_msat[e],
+                                     self._fee_proportional_millionths[e])
+        if not is_fee_sane(fee_msat, payment_amount_msat=payment_amt_msat):
+            return float('inf'), 0  # thanks but no thanks
+        base_cost = 500
+        if ignore_costs:
+            return base_cost, 0
+        cltv_cost = cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
+        return base_cost + fee_msat + cltv_cost, fee_msat
+
+
 BLACKLIST_DURATION = 3600
 
 class LNPathFinder(Logger):
@@ -143,6 +296,8 @@ class LNPathFinder(Logger):
         Logger.__init__(self)
         self.channel_db = channel_db
         self.blacklist = dict() # short_chan_id -> timestamp
+        self.graph = RoutingGraph(channel_db)
+        self._graph_lock = threading.Lock()
 
     def add_to_blacklist(self, short_channel_id: ShortChannelID):
         self.logger.info(f'blacklisting channel {short_channel_id}')
@@ -200,83 +355,126 @@ class LNPathFinder(Logger):
         overall_cost = base_cost + fee_msat + cltv_cost
         return overall_cost, fee_msat
 
+    def _my_channels_for_node(self, node_id: bytes,
+                              my_channels: Dict[ShortChannelID, 'Channel']) -> Iterable[Tuple[ShortChannelID, bytes]]:
+        """Yields (short_channel_id, other_node_id) for our own channels that involve node_id."""
+        for scid, chan in my_channels.items():
+            local_pubkey = chan.get_local_pubkey()
+            if node_id == chan.node_id:
+                yield scid, local_pubkey
+            elif node_id == local_pubkey:
+                yield scid, chan.node_id
+
     def get_distances(self, nodeA: bytes, nodeB: bytes,
                       invoice_amount_msat: int, *,
-                      my_channels: Dict[ShortChannelID, 'Channel'] = None
+                      my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                      excluded: Iterable[ShortChannelID] = ()
                       ) -> Dict[bytes, PathEdge]:
-        # note: we don't lock self.channel_db, so while the path finding runs,
-        #       the underlying graph could potentially change... (not good but maybe ~OK?)
-
+        # note: the graph snapshot is refreshed before the search, so updates
+        #       that arrive while the path finding runs are only seen next time.
+        if my_channels is None:
+            my_channels = {}
+        with self._graph_lock:
+            self.graph.refresh()
+            return self._get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                       excluded=set(excluded))
+
+    def _get_distances(self, nodeA: bytes, nodeB: bytes,
+                       invoice_amount_msat: int, *,
+                       my_channels: Dict[ShortChannelID, 'Channel'],
+                       excluded: Set[ShortChannelID] = None) -> Dict[bytes, PathEdge]:
         # run Dijkstra
         # The search is run in the REVERSE direction, from nodeB to nodeA,
         # to properly calculate compound routing fees.
+        graph = self.graph
+        node_ids = graph.node_ids
+        scids = graph.scids
+        now = int(time.time())
+        blacklist = {scid for scid, t in self.blacklist.items() if now - t < BLACKLIST_DURATION}
+        if excluded:
+            blacklist |= excluded
         distance_from_start = defaultdict(lambda: float('inf'))
         distance_from_start[nodeB] = 0
         prev_node = {}  # type: Dict[bytes, PathEdge]
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
+        nodes_to_explore = [(0, invoice_amount_msat, nodeB)]  # order of fields (in tuple) matters!
 
+        def relax(edge_channel_id, edge_startnode, edge_cost, fee_for_edge_msat):
+            alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+            if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
+                distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                prev_node[edge_startnode] = PathEdge(node_id=edge_endnode,
+                                                     short_channel_id=ShortChannelID(edge_channel_id))
+                amount_to_forward_msat = amount_msat + fee_for_edge_msat
+                heapq.heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
+        while nodes_to_explore:
+            dist_to_edge_endnode, amount_msat, edge_endnode = heapq.heappop(nodes_to_explore)
             if edge_endnode == nodeA:
                 break
             if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
+                # heapq does not implement decrease_priority,
                 # so instead of decreasing priorities, we add items again into the queue.
                 # so there are duplicates in the queue, that we discard now:
                 continue
-            for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode, my_channels=my_channels):
-                assert isinstance(edge_channel_id, bytes)
-                if self.is_blacklisted(edge_channel_id):
+            # public channels, from the graph snapshot
+            node_idx = graph.get_node_idx(edge_endnode)
+            if node_idx is not None:
+                for c, e, start_idx in graph.incoming_edges(node_idx):
+                    edge_channel_id = scids[c]
+                    if edge_channel_id in blacklist or edge_channel_id in my_channels:
+                        continue
+                    edge_startnode = node_ids[start_idx]
+                    edge_cost, fee_for_edge_msat = graph.edge_cost(
+                        c, e, amount_msat, ignore_costs=(edge_startnode == nodeA))
+                    if edge_cost == float('inf'):
+                        continue
+                    relax(edge_channel_id, edge_startnode, edge_cost, fee_for_edge_msat)
+            # our own channels
+            for edge_channel_id, edge_startnode in self._my_channels_for_node(edge_endnode, my_channels):
+                if edge_channel_id in blacklist:
                     continue
-                channel_info = self.channel_db.get_channel_info(edge_channel_id, my_channels=my_channels)
-                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
-                is_mine = edge_channel_id in my_channels
-                if is_mine:
-                    if edge_startnode == nodeA:  # payment outgoing, on our channel
-                        if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
-                            continue
-                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
-                        assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
-                        if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
-                            continue
+                if edge_startnode == nodeA:  # payment outgoing, on our channel
+                    if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
+                        continue
+                else:  # payment incoming, on our channel. (funny business, cycle weirdness)
+                    assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
+                    if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
+                        continue
                 edge_cost, fee_for_edge_msat = self._edge_cost(
                     edge_channel_id,
                     start_node=edge_startnode,
                     end_node=edge_endnode,
                     payment_amt_msat=amount_msat,
                     ignore_costs=(edge_startnode == nodeA),
-                    is_mine=is_mine,
+                    is_mine=True,
                     my_channels=my_channels)
-                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
-                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
-                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
-                    prev_node[edge_startnode] = PathEdge(node_id=edge_endnode,
-                                                         short_channel_id=ShortChannelID(edge_channel_id))
-                    amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                    nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+                relax(edge_channel_id, edge_startnode, edge_cost, fee_for_edge_msat)
 
         return prev_node
 
     @profiler
     def find_path_for_payment(self, nodeA: bytes, nodeB: bytes,
                               invoice_amount_msat: int, *,
-                              my_channels: Dict[ShortChannelID, 'Channel'] = None) \
+                              my_channels: Dict[ShortChannelID, 'Channel'] = None,
+                              excluded: Iterable[ShortChannelID] = ()) \
             -> Optional[LNPaymentPath]:
-        """Return a path from nodeA to nodeB."""
+        """Return a path from nodeA to nodeB, that does not use the channels in excluded."""
         assert type(nodeA) is bytes
         assert type(nodeB) is bytes
         assert type(invoice_amount_msat) is int
         if my_channels is None:
             my_channels = {}
 
-        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels,
+                                       excluded=excluded)
 
         if nodeA not in prev_node:
             return None  # no path found
+        return self._backtrack_path(prev_node, nodeA, nodeB)
 
+    @classmethod
+    def _backtrack_path(cls, prev_node: Dict[bytes, PathEdge], nodeA: bytes, nodeB: bytes) -> LNPaymentPath:
         # backtrack from search_end (nodeA) to search_start (nodeB)
         # FIXME paths cannot be longer than 20 edges (onion packet)...
         edge_startnode = nodeA
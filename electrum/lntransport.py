@@ -17,6 +17,12 @@ from . import ecc
 from .util import bh2u, MySocksProxy
 
 
+READ_CHUNK_SIZE = 2 ** 16
+# pending writes are coalesced until the end of the current event loop iteration,
+# or until there are this many bytes
+WRITE_BUFFER_FLUSH_SIZE = 2 ** 16
+
+
 class HandshakeState(object):
     prologue = b"lightning"
     protocol_name = b"Noise_XK_secp256k1_ChaChaPoly_SHA256"
@@ -93,6 +99,15 @@ class LNTransportBase:
     writer: StreamWriter
     privkey: bytes
 
+    def __init__(self):
+        self._write_buffer = bytearray()
+        self._flush_scheduled = False
+        # per-connection statistics; bytes are counted after the handshake
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.msgs_sent = 0
+        self.msgs_received = 0
+
     def name(self) -> str:
         raise NotImplementedError()
 
@@ -102,32 +117,72 @@ class LNTransportBase:
         c = aead_encrypt(self.sk, self.sn(), b'', msg)
         assert len(lc) == 18
         assert len(c) == len(msg) + 16
-        self.writer.write(lc+c)
+        self._write_buffer += lc
+        self._write_buffer += c
+        self.msgs_sent += 1
+        if len(self._write_buffer) >= WRITE_BUFFER_FLUSH_SIZE:
+            self._flush_write_buffer()
+        elif not self._flush_scheduled:
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:  # no event loop in this thread
+                loop = None
+            if loop is None or not loop.is_running():
+                self._flush_write_buffer()
+            else:
+                loop.call_soon(self._flush_write_buffer)
+                self._flush_scheduled = True
+
+    def _flush_write_buffer(self) -> None:
+        self._flush_scheduled = False
+        if not self._write_buffer:
+            return
+        data = self._write_buffer
+        self._write_buffer = bytearray()
+        self.bytes_sent += len(data)
+        self.writer.write(data)
+
+    async def drain(self) -> None:
+        """Writes out pending messages, and waits until the write buffer
+        of the connection is below its high-water mark.
+        """
+        self._flush_write_buffer()
+        await self.writer.drain()
 
     async def read_messages(self):
-        read_buffer = b''
+        read_buffer = bytearray()
+        offset = 0  # start of unprocessed data in read_buffer
+        length = None  # length of the current message, once its header is decrypted
+        rn_l, rk_l = self.rn()
+        rn_m, rk_m = self.rn()
         while True:
-            rn_l, rk_l = self.rn()
-            rn_m, rk_m = self.rn()
-            while True:
-                if len(read_buffer) >= 18:
-                    lc = read_buffer[:18]
-                    l = aead_decrypt(rk_l, rn_l, b'', lc)
-                    length = int.from_bytes(l, 'big')
-                    offset = 18 + length + 16
-                    if len(read_buffer) >= offset:
-                        c = read_buffer[18:offset]
-                        read_buffer = read_buffer[offset:]
-                        msg = aead_decrypt(rk_m, rn_m, b'', c)
-                        yield msg
-                        break
-                try:
-                    s = await self.reader.read(2**10)
-                except:
-                    s = None
-                if not s:
-                    raise LightningPeerConnectionClosed()
-                read_buffer += s
+            if length is None and len(read_buffer) - offset >= 18:
+                l = aead_decrypt(rk_l, rn_l, b'', bytes(read_buffer[offset:offset+18]))
+                length = int.from_bytes(l, 'big')
+                offset += 18
+            if length is not None and len(read_buffer) - offset >= length + 16:
+                end = offset + length + 16
+                with memoryview(read_buffer) as view:
+                    msg = aead_decrypt(rk_m, rn_m, b'', view[offset:end])
+                offset = end
+                length = None
+                self.msgs_received += 1
+                yield msg
+                rn_l, rk_l = self.rn()
+                rn_m, rk_m = self.rn()
+                continue
+            # need more data. first drop what we have processed;
+            # what is left is less than a message
+            del read_buffer[:offset]
+            offset = 0
+            try:
+                s = await self.reader.read(READ_CHUNK_SIZE)
+            except:
+                s = None
+            if not s:
+                raise LightningPeerConnectionClosed()
+            self.bytes_received += len(s)
+            read_buffer += s
 
     def rn(self):
         o = self._rn, self.rk
@@ -153,6 +208,7 @@ class LNTransportBase:
         self.s_ck = ck
 
     def close(self):
+        self._flush_write_buffer()
         self.writer.close()
 
 
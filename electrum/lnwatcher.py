@@ -5,8 +5,9 @@
 from typing import NamedTuple, Iterable, TYPE_CHECKING
 import os
 import asyncio
+import itertools
 from enum import IntEnum, auto
-from typing import NamedTuple, Dict
+from typing import NamedTuple, Dict, Set, Optional
 
 from . import util
 from .sql_db import SqlDB, sql
@@ -46,11 +47,14 @@ create_channel_info="""
 CREATE TABLE IF NOT EXISTS channel_info (
 outpoint VARCHAR(34) NOT NULL,
 address VARCHAR(32),
+ctn INTEGER,
 PRIMARY KEY(outpoint)
 )"""
 
 
 class SweepStore(SqlDB):
+    # losing a sweep tx can mean losing funds
+    SYNCHRONOUS = 'FULL'
 
     def __init__(self, path, network):
         super().__init__(network.asyncio_loop, path)
@@ -59,6 +63,10 @@ class SweepStore(SqlDB):
         c = self.conn.cursor()
         c.execute(create_channel_info)
         c.execute(create_sweep_txs)
+        # databases created before the uploaded ctn was stored
+        columns = [row[1] for row in c.execute("PRAGMA table_info(channel_info)")]
+        if 'ctn' not in columns:
+            c.execute("ALTER TABLE channel_info ADD COLUMN ctn INTEGER")
         self.conn.commit()
 
     @sql
@@ -78,7 +86,34 @@ class SweepStore(SqlDB):
         c = self.conn.cursor()
         assert Transaction(raw_tx).is_complete()
         c.execute("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", (funding_outpoint, ctn, prevout, bfh(raw_tx)))
-        self.conn.commit()
+        if self._has_channel(funding_outpoint) and ctn > self._get_ctn(funding_outpoint):
+            self._set_ctn(funding_outpoint, ctn)
+
+    @sql
+    def add_sweep_txs(self, funding_outpoint, address, from_ctn, to_ctn, sweep_txs):
+        """Adds the sweep txs of ctns from_ctn..to_ctn, in one transaction.
+        Txs of ctns we already have are skipped, so that a batch can be resent.
+        Some ctns have no sweep txs; the batch still covers them.
+        Returns the ctn we have after the batch.
+        """
+        if not self._has_channel(funding_outpoint):
+            self._add_channel(funding_outpoint, address)
+        ctn = self._get_ctn(funding_outpoint)
+        if from_ctn > ctn + 1:
+            raise Exception(f'sweep txs are missing for ctns {ctn + 1} to {from_ctn - 1}')
+        rows = []
+        for tx_ctn, prevout, raw_tx in sweep_txs:
+            if not from_ctn <= tx_ctn <= to_ctn:
+                raise Exception(f'ctn {tx_ctn} not in batch range {from_ctn}-{to_ctn}')
+            if tx_ctn <= ctn:
+                continue
+            assert Transaction(raw_tx).is_complete()
+            rows.append((funding_outpoint, tx_ctn, prevout, bfh(raw_tx)))
+        c = self.conn.cursor()
+        c.executemany("""INSERT INTO sweep_txs (funding_outpoint, ctn, prevout, tx) VALUES (?,?,?,?)""", rows)
+        if to_ctn > ctn:
+            self._set_ctn(funding_outpoint, to_ctn)
+        return self._get_ctn(funding_outpoint)
 
     @sql
     def get_num_tx(self, funding_outpoint):
@@ -90,26 +125,36 @@ class SweepStore(SqlDB):
     def get_ctn(self, outpoint, addr):
         if not self._has_channel(outpoint):
             self._add_channel(outpoint, addr)
+        return self._get_ctn(outpoint)
+
+    def _get_ctn(self, outpoint):
+        # the last ctn that was uploaded. channels added before it was stored
+        # fall back to the last ctn that has sweep txs.
         c = self.conn.cursor()
+        c.execute("SELECT ctn FROM channel_info WHERE outpoint=?", (outpoint,))
+        r = c.fetchone()
+        if r and r[0] is not None:
+            return int(r[0])
         c.execute("SELECT max(ctn) FROM sweep_txs WHERE funding_outpoint=?", (outpoint,))
         return int(c.fetchone()[0] or 0)
 
+    def _set_ctn(self, outpoint, ctn):
+        c = self.conn.cursor()
+        c.execute("UPDATE channel_info SET ctn=? WHERE outpoint=?", (ctn, outpoint))
+
     @sql
     def remove_sweep_tx(self, funding_outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM sweep_txs WHERE funding_outpoint=?", (funding_outpoint,))
-        self.conn.commit()
 
     def _add_channel(self, outpoint, address):
         c = self.conn.cursor()
         c.execute("INSERT INTO channel_info (address, outpoint) VALUES (?,?)", (address, outpoint))
-        self.conn.commit()
 
     @sql
     def remove_channel(self, outpoint):
         c = self.conn.cursor()
         c.execute("DELETE FROM channel_info WHERE outpoint=?", (outpoint,))
-        self.conn.commit()
 
     def _has_channel(self, outpoint):
         c = self.conn.cursor()
@@ -140,6 +185,15 @@ class LNWatcher(AddressSynchronizer):
         self.config = network.config
         self.callbacks = {} # address -> lambda: coroutine
         self.network = network
+        # callbacks are only run for the addresses affected by an event.
+        # addresses discovered while inspecting a channel (e.g. spender outputs)
+        # are indexed to the address of the callback that watches them.
+        self._callback_by_address = {}  # type: Dict[str, str]
+        self._dirty = set()  # type: Set[str]
+        # callbacks that need to run on each new block (e.g. pending timelocks)
+        self._height_sensitive = set()  # type: Set[str]
+        self._last_height = None  # type: Optional[int]
+        self._processing = False
         util.register_callback(
             self.on_network_update,
             ['network_updated', 'blockchain_updated', 'verified', 'wallet_updated', 'fee'])
@@ -166,27 +220,108 @@ class LNWatcher(AddressSynchronizer):
 
     def remove_callback(self, address):
         self.callbacks.pop(address, None)
+        self._dirty.discard(address)
+        self._height_sensitive.discard(address)
+        for addr, key in list(self._callback_by_address.items()):
+            if key == address:
+                self._callback_by_address.pop(addr, None)
 
     def add_callback(self, address, callback):
         self.add_address(address)
         self.callbacks[address] = callback
+        self._callback_by_address[address] = address
+        # unknown callbacks are re-run on each block, until told otherwise
+        self._height_sensitive.add(address)
+        self._dirty.add(address)
+
+    def _index_address(self, address: str, key: str) -> None:
+        self._callback_by_address.setdefault(address, key)
+
+    def _mark_addresses_dirty(self, addresses: Iterable[str]) -> None:
+        for addr in addresses:
+            key = self._callback_by_address.get(addr)
+            if key is not None:
+                self._dirty.add(key)
+
+    def _mark_tx_dirty(self, tx_hash: str) -> None:
+        self._mark_addresses_dirty(itertools.chain(
+            self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)))
+
+    def add_transaction(self, tx, *, allow_unrelated=False):
+        tx_was_added = super().add_transaction(tx, allow_unrelated=allow_unrelated)
+        if tx_was_added:
+            self._mark_tx_dirty(tx.txid())
+        return tx_was_added
+
+    def remove_transaction(self, tx_hash):
+        self._mark_tx_dirty(tx_hash)
+        super().remove_transaction(tx_hash)
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        super().receive_history_callback(addr, hist, tx_fees)
+        self._mark_addresses_dirty([addr])
+
+    def undo_verifications(self, blockchain, above_height):
+        txs = super().undo_verifications(blockchain, above_height)
+        for tx_hash in txs:
+            self._mark_tx_dirty(tx_hash)
+        return txs
 
     @log_exceptions
     async def on_network_update(self, event, *args):
         if event in ('verified', 'wallet_updated'):
             if args[0] != self:
                 return
+        if event == 'verified':
+            self._mark_tx_dirty(args[1])
+        elif event == 'fee':
+            self._dirty |= self._height_sensitive
+        else:
+            # a new block only affects callbacks that depend on the height
+            height = self.get_local_height()
+            if height != self._last_height:
+                self._last_height = height
+                self._dirty |= self._height_sensitive
         if not self.synchronizer:
             self.logger.info("synchronizer not set yet")
             return
-        for address, callback in list(self.callbacks.items()):
-            await callback()
+        await self._run_dirty_callbacks()
+
+    async def _run_dirty_callbacks(self):
+        # callbacks marked dirty while we await are picked up by the running loop
+        if self._processing:
+            return
+        self._processing = True
+        retry = set()
+        dirty = set()
+        try:
+            while self._dirty:
+                dirty, self._dirty = self._dirty, set()
+                while dirty:
+                    address = dirty.pop()
+                    callback = self.callbacks.get(address)
+                    if callback is None:
+                        continue
+                    try:
+                        await callback()
+                    except Exception:
+                        # do not let one channel hold up the others
+                        self.logger.exception(f'callback failed for {address}')
+                        retry.add(address)
+                        continue
+                    # callbacks return early while we are syncing
+                    if not self.is_up_to_date():
+                        retry.add(address)
+        finally:
+            # not processed if we got cancelled
+            self._dirty |= retry | dirty
+            self._processing = False
 
     async def check_onchain_situation(self, address, funding_outpoint):
         # early return if address has not been added yet
         if not self.is_mine(address):
             return
-        spenders = self.inspect_tx_candidate(funding_outpoint, 0)
+        spenders = self.inspect_tx_candidate(funding_outpoint, 0, key=address)
         # inspect_tx_candidate might have added new addresses, in which case we return ealy
         if not self.is_up_to_date():
             return
@@ -203,6 +338,11 @@ class LNWatcher(AddressSynchronizer):
                 keep_watching = True
         else:
             keep_watching = True
+        # an open channel with a deeply mined funding tx does not change with new blocks
+        if closing_txid is None and self.is_deeply_mined(funding_txid):
+            self._height_sensitive.discard(address)
+        else:
+            self._height_sensitive.add(address)
         await self.update_channel_state(
             funding_outpoint=funding_outpoint,
             funding_txid=funding_txid,
@@ -221,7 +361,7 @@ class LNWatcher(AddressSynchronizer):
                                    closing_height: TxMinedInfo, keep_watching: bool) -> None:
         raise NotImplementedError()  # implemented by subclasses
 
-    def inspect_tx_candidate(self, outpoint, n):
+    def inspect_tx_candidate(self, outpoint, n, *, key: str = None):
         prev_txid, index = outpoint.split(':')
         txid = self.db.get_spent_outpoint(prev_txid, int(index))
         result = {outpoint:txid}
@@ -234,10 +374,12 @@ class LNWatcher(AddressSynchronizer):
             self.channel_status[outpoint] = 'closed (deep)'
         tx = self.db.get_transaction(txid)
         for i, o in enumerate(tx.outputs()):
+            if key is not None and o.address:
+                self._index_address(o.address, key)
             if not self.is_mine(o.address):
                 self.add_address(o.address)
             elif n < 2:
-                r = self.inspect_tx_candidate(txid+':%d'%i, n+1)
+                r = self.inspect_tx_candidate(txid+':%d'%i, n+1, key=key)
                 result.update(r)
         return result
 
@@ -7,14 +7,15 @@ import os
 from decimal import Decimal
 import random
 import time
-from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, NamedTuple, Union, Mapping, Any
+from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, NamedTuple, Union, Mapping, Any, Callable, Set
 import threading
 import socket
 import aiohttp
 import json
 from datetime import datetime, timezone
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import itertools
 import concurrent
 from concurrent import futures
 import urllib.parse
@@ -25,9 +26,10 @@ from aiorpcx import run_in_thread, TaskGroup, NetAddress
 
 from . import constants, util
 from . import keystore
+from . import instrumentation
 from .util import profiler
 from .invoices import PR_TYPE_LN, PR_UNPAID, PR_EXPIRED, PR_PAID, PR_INFLIGHT, PR_FAILED, PR_ROUTING, LNInvoice, LN_EXPIRY_NEVER
-from .util import NetworkRetryManager, JsonRPCClient
+from .util import NetworkRetryManager, JsonRPCClient, JsonRPCMethodNotFound
 from .lnutil import LN_MAX_FUNDING_SAT
 from .keystore import BIP32_KeyStore
 from .bitcoin import COIN
@@ -36,11 +38,11 @@ from .crypto import sha256
 from .bip32 import BIP32Node
 from .util import bh2u, bfh, InvoiceError, resolve_dns_srv, is_ip_address, log_exceptions
 from .util import ignore_exceptions, make_aiohttp_session, SilentTaskGroup
-from .util import timestamp_to_datetime, random_shuffled_copy
+from .util import timestamp_to_datetime, random_shuffled_copy, chunks
 from .util import MyEncoder, is_private_netaddress
 from .logging import Logger
 from .lntransport import LNTransport, LNResponderTransport
-from .lnpeer import Peer, LN_P2P_NETWORK_TIMEOUT
+from .lnpeer import Peer, LN_P2P_NETWORK_TIMEOUT, verify_channel_announcement, verify_node_announcement
 from .lnaddr import lnencode, LnAddr, lndecode
 from .ecc import der_sig_from_sig_string
 from .lnchannel import Channel
@@ -60,7 +62,8 @@ from .lnutil import (Outpoint, LNPeerAddr,
                      BarePaymentAttemptLog, derive_payment_secret_from_payment_preimage)
 from .lnutil import ln_dummy_address, ln_compare_features, IncompatibleLightningFeatures
 from .transaction import PartialTxOutput, PartialTransaction, PartialTxInput
-from .lnonion import OnionFailureCode, process_onion_packet, OnionPacket, OnionRoutingFailureMessage
+from .lnonion import (OnionFailureCode, process_onion_packet, OnionPacket, OnionRoutingFailureMessage,
+                      ProcessedOnionCache)
 from .lnmsg import decode_msg
 from .i18n import _
 from .lnrouter import (RouteEdge, LNPaymentRoute, LNPaymentPath, is_route_sane_to_use,
@@ -71,6 +74,7 @@ from .lnwatcher import LNWalletWatcher
 from .crypto import pw_encode_with_version_and_mac, pw_decode_with_version_and_mac
 from .lnutil import ChannelBackupStorage
 from .lnchannel import ChannelBackup
+from .lnhtlc import HTLCArchive
 from .channel_db import UpdateStatus
 from .submarine_swaps import SwapManager
 
@@ -84,6 +88,12 @@ SAVED_PR_STATUS = [PR_PAID, PR_UNPAID, PR_INFLIGHT] # status that are persisted
 
 NUM_PEERS_TARGET = 4
 
+# settled and failed htlcs are moved out of the channel state in batches
+HTLC_ARCHIVE_INTERVAL = 600
+HTLC_ARCHIVE_MIN_HTLCS = 100
+# number of ctns whose sweep txs are sent to the watchtower in one request
+WATCHTOWER_SYNC_BATCH_SIZE = 50
+
 
 FALLBACK_NODE_LIST_TESTNET = (
     LNPeerAddr(host='203.132.95.10', port=9735, pubkey=bfh('038863cf8ab91046230f561cd5b386cbff8309fa02e3f0c3ed161a3aeb64a643b9')),
@@ -441,6 +451,9 @@ class LNWorker(Logger, NetworkRetryManager[LNPeerAddr]):
 class LNGossip(LNWorker):
     max_age = 14*24*3600
     LOGGING_SHORTCUT = 'g'
+    GOSSIP_BATCH_INTERVAL = 5  # seconds
+    GOSSIP_VERIFY_CHUNK_SIZE = 50
+    SEEN_GOSSIP_MAX_SIZE = 200_000
 
     def __init__(self):
         seed = os.urandom(32)
@@ -450,11 +463,121 @@ class LNGossip(LNWorker):
         self.features |= LnFeatures.GOSSIP_QUERIES_OPT
         self.features |= LnFeatures.GOSSIP_QUERIES_REQ
         self.unknown_ids = set()
+        # gossip from all peers goes through a single queue, to preserve message order
+        self.gossip_queue = asyncio.Queue()  # type: asyncio.Queue[Tuple[Peer, str, dict]]
+        # sha256 of raw gossip messages we already have (or are about to process)
+        self._seen_gossip = OrderedDict()  # type: OrderedDict[bytes, None]
+        # note: libsecp256k1 releases the GIL, so signatures get verified in parallel
+        self._gossip_verifier = futures.ThreadPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1),
+            thread_name_prefix='gossip_verifier')
 
     def start_network(self, network: 'Network'):
         assert network
         super().start_network(network)
         asyncio.run_coroutine_threadsafe(self.taskgroup.spawn(self.maintain_db()), self.network.asyncio_loop)
+        asyncio.run_coroutine_threadsafe(self.taskgroup.spawn(self.process_gossip()), self.network.asyncio_loop)
+
+    def stop(self):
+        super().stop()
+        self._gossip_verifier.shutdown(wait=False)
+
+    def submit_gossip(self, peer: Peer, name: str, payload: dict) -> None:
+        """Queues a gossip message received from peer.
+        Messages that were already received (from any peer) are dropped
+        here, so that their signatures do not get verified again.
+        """
+        key = sha256(payload['raw'])
+        if key in self._seen_gossip:
+            self._seen_gossip.move_to_end(key)
+            return
+        self._seen_gossip[key] = None
+        while len(self._seen_gossip) > self.SEEN_GOSSIP_MAX_SIZE:
+            self._seen_gossip.popitem(last=False)
+        self.gossip_queue.put_nowait((peer, name, payload))
+
+    async def process_gossip(self):
+        await self.channel_db.data_loaded.wait()
+        while True:
+            await asyncio.sleep(self.GOSSIP_BATCH_INTERVAL)
+            chan_anns = []  # type: List[Tuple[Peer, dict]]
+            chan_upds = []  # type: List[Tuple[Peer, dict]]
+            node_anns = []  # type: List[Tuple[Peer, dict]]
+            while True:
+                peer, name, payload = await self.gossip_queue.get()
+                if name == 'channel_announcement':
+                    chan_anns.append((peer, payload))
+                elif name == 'channel_update':
+                    chan_upds.append((peer, payload))
+                elif name == 'node_announcement':
+                    node_anns.append((peer, payload))
+                else:
+                    raise Exception('unknown message')
+                if self.gossip_queue.empty():
+                    break
+            self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
+            instrumentation.count('gossip.channel_announcements_received', len(chan_anns))
+            instrumentation.count('gossip.node_announcements_received', len(node_anns))
+            instrumentation.count('gossip.channel_updates_received', len(chan_upds))
+            # note: data processed in chunks to avoid taking sql lock for too long,
+            #       and we yield to the event loop in between
+            # channel announcements
+            chan_anns = await self._verify_gossip(chan_anns, verify_channel_announcement)
+            for chan_anns_chunk in chunks(chan_anns, 300):
+                self.channel_db.add_channel_announcement([payload for peer, payload in chan_anns_chunk])
+                await asyncio.sleep(0)
+            # node announcements
+            node_anns = await self._verify_gossip(node_anns, verify_node_announcement)
+            for node_anns_chunk in chunks(node_anns, 100):
+                self.channel_db.add_node_announcement([payload for peer, payload in node_anns_chunk])
+                await asyncio.sleep(0)
+            # channel updates
+            for chan_upds_chunk in chunks(chan_upds, 1000):
+                categorized_chan_upds = self.channel_db.add_channel_updates(
+                    [payload for peer, payload in chan_upds_chunk], max_age=self.max_age)
+                orphaned = categorized_chan_upds.orphaned
+                if orphaned:
+                    self.logger.info(f'adding {len(orphaned)} unknown channel ids')
+                    await self.add_new_ids([c['short_channel_id'] for c in orphaned])
+                    orphaned_ids = set(id(payload) for payload in orphaned)
+                    for peer, payload in chan_upds_chunk:
+                        if id(payload) not in orphaned_ids:
+                            continue
+                        # we will want this update again, once we know the channel
+                        self._seen_gossip.pop(sha256(payload['raw']), None)
+                        peer.save_orphan_channel_update(payload)
+                if categorized_chan_upds.good:
+                    self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
+                await asyncio.sleep(0)
+
+    @instrumentation.traced('gossip.verify')
+    async def _verify_gossip(
+            self,
+            msgs: List[Tuple[Peer, dict]],
+            verify_func: Callable[[dict], bool],
+    ) -> List[Tuple[Peer, dict]]:
+        """Verifies the signatures of msgs in the worker pool.
+        Returns the valid ones, and disconnects peers that sent invalid ones.
+        """
+        if not msgs:
+            return []
+        def verify_chunk(chunk: List[Tuple[Peer, dict]]) -> List[bool]:
+            return [verify_func(payload) for peer, payload in chunk]
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self._gossip_verifier, verify_chunk, chunk)
+            for chunk in chunks(msgs, self.GOSSIP_VERIFY_CHUNK_SIZE)])
+        verified = []
+        bad_peers = set()
+        for (peer, payload), is_valid in zip(msgs, itertools.chain.from_iterable(results)):
+            if is_valid:
+                verified.append((peer, payload))
+            else:
+                bad_peers.add(peer)
+        for peer in bad_peers:
+            peer.logger.info('Disconnecting: gossip signature verification failed')
+            peer.close_and_cleanup()
+        return verified
 
     async def maintain_db(self):
         await self.channel_db.data_loaded.wait()
@@ -524,20 +647,32 @@ class LNWallet(LNWorker):
         self.sweep_address = wallet.get_new_sweep_address_for_channel()
         self.logs = defaultdict(list)  # type: Dict[str, List[PaymentAttemptLog]]  # key is RHASH  # (not persisted)
         self.is_routing = set()        # (not persisted) keys of invoices that are in PR_ROUTING state
+        self.processed_onions = ProcessedOnionCache()  # (not persisted) onions of incoming htlcs
         # used in tests
         self.enable_htlc_settle = asyncio.Event()
         self.enable_htlc_settle.set()
 
         # note: accessing channels (besides simple lookup) needs self.lock!
+        self._htlc_archive_lock = threading.RLock()
         self._channels = {}  # type: Dict[bytes, Channel]
         channels = self.db.get_dict("channels")
         for channel_id, c in random_shuffled_copy(channels.items()):
-            self._channels[bfh(channel_id)] = Channel(c, sweep_address=self.sweep_address, lnworker=self)
+            chan = Channel(c, sweep_address=self.sweep_address, lnworker=self)
+            chan.set_htlc_archive(self.get_htlc_archive(chan.channel_id))
+            self._channels[bfh(channel_id)] = chan
 
         self.pending_payments = defaultdict(asyncio.Future)  # type: Dict[bytes, asyncio.Future[BarePaymentAttemptLog]]
 
         self.swap_manager = SwapManager(wallet=self.wallet, lnworker=self)
 
+        # history indexes (not persisted). channels are only re-read if they changed.
+        self._history_lock = threading.RLock()
+        self._settled_payments_by_channel = {}  # type: Dict[bytes, Tuple[int, Mapping[str, list]]]  # chan_id -> settles version, settled payments
+        self._settled_payments = defaultdict(dict)  # type: Dict[str, Dict[bytes, list]]  # RHASH -> chan_id -> plist
+        self._lightning_history = {}  # type: Dict[bytes, dict]
+        self._dirty_payment_hashes = set()  # type: Set[str]
+        self._channel_onchain_history = {}  # type: Dict[bytes, Tuple[tuple, List[dict]]]
+
     @property
     def channels(self) -> Mapping[bytes, Channel]:
         """Returns a read-only copy of channels."""
@@ -547,6 +682,69 @@ class LNWallet(LNWorker):
     def get_channel_by_id(self, channel_id: bytes) -> Optional[Channel]:
         return self._channels.get(channel_id, None)
 
+    @staticmethod
+    def get_htlc_archive_dir(wallet_path: str) -> str:
+        return wallet_path + '_htlc_archive'
+
+    def get_htlc_archive(self, channel_id: bytes) -> Optional[HTLCArchive]:
+        storage = self.wallet.storage
+        if not storage or not storage.path:
+            return None
+        return HTLCArchive(os.path.join(self.get_htlc_archive_dir(storage.path), channel_id.hex()),
+                           keys=self._get_htlc_archive_keys(),
+                           key_id=self.db.get('htlc_archive_key_id'))
+
+    def _get_htlc_archive_keys(self) -> Dict[str, bytes]:
+        return {key_id: bfh(key) for key_id, key in self.db.get_dict('htlc_archive_keys').items()}
+
+    def reencrypt_htlc_archives(self) -> None:
+        """Re-encrypts the HTLC archives with a new key, kept in the wallet file.
+        Called when the storage password changes. If the storage is not
+        encrypted, the archives are written in plaintext, like the wallet file.
+        """
+        with self._htlc_archive_lock:
+            keys = self.db.get_dict('htlc_archive_keys')
+            key_id = None
+            if self.wallet.has_storage_encryption():
+                key = os.urandom(32)
+                key_id = sha256(key)[:4].hex()
+                keys[key_id] = key.hex()
+                # the key must be saved before anything is encrypted with it
+                self.wallet.save_db()
+            all_keys = self._get_htlc_archive_keys()
+            for chan in self.channels.values():
+                if chan.hm.archive is not None:
+                    chan.hm.archive.reencrypt(all_keys, key_id)
+            self.db.put('htlc_archive_key_id', key_id)
+            for old_key_id in list(keys):
+                if old_key_id != key_id:
+                    keys.pop(old_key_id)
+            self.wallet.save_db()
+
+    async def _archive_htlcs(self) -> None:
+        if self.wallet.has_storage_encryption() and self.db.get('htlc_archive_key_id') is None:
+            # archive written before the storage got encrypted
+            await run_in_thread(self.reencrypt_htlc_archives)
+        num_archived = 0
+        for chan in list(self.channels.values()):
+            records = chan.get_htlc_archive_records(min_htlcs=HTLC_ARCHIVE_MIN_HTLCS)
+            if not records:
+                continue
+            # the archive is written with fsync in a thread; the channel state
+            # is only changed here, on the event loop, once that returned
+            await run_in_thread(chan.hm.archive.append, records)
+            num_archived += chan.remove_archived_htlcs(records)
+        if num_archived:
+            self.logger.info(f'archived {num_archived} htlcs')
+            await run_in_thread(self.wallet.save_db)
+
+    @ignore_exceptions
+    @log_exceptions
+    async def archive_htlcs(self):
+        while True:
+            await asyncio.sleep(HTLC_ARCHIVE_INTERVAL)
+            await self._archive_htlcs()
+
     @ignore_exceptions
     @log_exceptions
     async def sync_with_local_watchtower(self):
@@ -577,6 +775,7 @@ class LNWallet(LNWorker):
                     watchtower = JsonRPCClient(session, watchtower_url)
                     watchtower.add_method('get_ctn')
                     watchtower.add_method('add_sweep_tx')
+                    watchtower.add_method('add_sweep_txs')
                     for chan in self.channels.values():
                         await self.sync_channel_with_watchtower(chan, watchtower)
             except aiohttp.client_exceptions.ClientConnectorError:
@@ -587,10 +786,27 @@ class LNWallet(LNWorker):
         addr = chan.get_funding_address()
         current_ctn = chan.get_oldest_unrevoked_ctn(REMOTE)
         watchtower_ctn = await watchtower.get_ctn(outpoint, addr)
-        for ctn in range(watchtower_ctn + 1, current_ctn):
-            sweeptxs = chan.create_sweeptxs(ctn)
-            for tx in sweeptxs:
-                await watchtower.add_sweep_tx(outpoint, ctn, tx.inputs()[0].prevout.to_str(), tx.serialize())
+        # upload the backlog in batches of ctns. a batch is stored in one
+        # transaction, and ctns the tower already has are skipped.
+        for from_ctn in range(watchtower_ctn + 1, current_ctn, WATCHTOWER_SYNC_BATCH_SIZE):
+            to_ctn = min(from_ctn + WATCHTOWER_SYNC_BATCH_SIZE, current_ctn) - 1
+            sweep_txs = [(ctn, tx.inputs()[0].prevout.to_str(), tx.serialize())
+                         for ctn in range(from_ctn, to_ctn + 1)
+                         for tx in chan.create_sweeptxs(ctn)]
+            result = None
+            try:
+                result = await watchtower.add_sweep_txs(outpoint, addr, from_ctn, to_ctn, sweep_txs)
+            except JsonRPCMethodNotFound:
+                # remote tower without bulk upload
+                self.logger.info('watchtower has no bulk upload, sending sweep txs one by one')
+                for sweep_tx in sweep_txs:
+                    result = await watchtower.add_sweep_tx(outpoint, *sweep_tx)
+                    if isinstance(result, str) and result.startswith('Error'):
+                        break
+            if isinstance(result, str) and result.startswith('Error'):
+                # retried at the next sync
+                self.logger.warning(f'watchtower upload failed for {outpoint}: {result}')
+                return
 
     def start_network(self, network: 'Network'):
         assert network
@@ -611,6 +827,7 @@ class LNWallet(LNWorker):
                 self.reestablish_peers_and_channels(),
                 self.sync_with_local_watchtower(),
                 self.sync_with_remote_watchtower(),
+                self.archive_htlcs(),
         ]:
             tg_coro = self.taskgroup.spawn(coro)
             asyncio.run_coroutine_threadsafe(tg_coro, self.network.asyncio_loop)
@@ -626,15 +843,46 @@ class LNWallet(LNWorker):
             util.trigger_callback('channel', self.wallet, chan)
         super().peer_closed(peer)
 
-    def get_settled_payments(self):
-        # return one item per payment_hash
-        # note: with AMP we will have several channels per payment
-        out = defaultdict(list)
-        for chan in self.channels.values():
-            d = chan.get_settled_payments()
-            for k, v in d.items():
-                out[k] += v
-        return out
+    def _update_settled_payments(self) -> Set[str]:
+        """Re-reads the settled payments of the channels that changed since
+        the last call. Returns the payment hashes that were affected.
+        """
+        changed = set()
+        channels = self.channels
+        for chan_id in list(self._settled_payments_by_channel):
+            if chan_id not in channels:
+                changed |= self._set_settled_payments_of_channel(chan_id, None, {})
+        for chan_id, chan in channels.items():
+            version = chan.hm.get_settles_version()
+            cached = self._settled_payments_by_channel.get(chan_id)
+            if cached and cached[0] == version:
+                continue
+            changed |= self._set_settled_payments_of_channel(chan_id, version, chan.get_settled_payments())
+        return changed
+
+    def _set_settled_payments_of_channel(self, chan_id: bytes, version: Optional[int],
+                                         settled: Mapping[str, list]) -> Set[str]:
+        changed = set()
+        _, old_settled = self._settled_payments_by_channel.pop(chan_id, (None, {}))
+        for key in old_settled:
+            if key not in settled:
+                by_channel = self._settled_payments[key]
+                del by_channel[chan_id]
+                if not by_channel:
+                    del self._settled_payments[key]
+                changed.add(key)
+        for key, plist in settled.items():
+            if old_settled.get(key) != plist:
+                self._settled_payments[key][chan_id] = plist
+                changed.add(key)
+        if version is not None:
+            self._settled_payments_by_channel[chan_id] = version, settled
+        return changed
+
+    def _mark_payment_dirty(self, payment_hash: bytes) -> None:
+        # its history item is recomputed by the next get_lightning_history
+        with self._history_lock:
+            self._dirty_payment_hashes.add(payment_hash.hex())
 
     def get_payment_value(self, info: Optional['PaymentInfo'], plist):
         amount_msat = 0
@@ -646,32 +894,48 @@ class LNWallet(LNWorker):
         timestamp = min([htlc.timestamp for chan_id, htlc, _direction in plist])
         return amount_msat, fee_msat, timestamp
 
+    def _get_lightning_history_item(self, key: str, plist) -> dict:
+        payment_hash = bytes.fromhex(key)
+        info = self.get_payment_info(payment_hash)
+        amount_msat, fee_msat, timestamp = self.get_payment_value(info, plist)
+        if info is not None:
+            direction = ('sent' if info.direction == SENT else 'received') if len(plist)==1 else 'self-payment'
+        else:
+            direction = 'forwarding'
+        preimage = self.get_preimage(payment_hash).hex()
+        return {
+            'type': 'payment',
+            'label': None,
+            'timestamp': timestamp or 0,
+            'date': timestamp_to_datetime(timestamp),
+            'direction': direction,
+            'amount_msat': amount_msat,
+            'fee_msat': fee_msat,
+            'payment_hash': key,
+            'preimage': preimage,
+        }
+
     def get_lightning_history(self):
+        with self._history_lock:
+            changed = self._update_settled_payments() | self._dirty_payment_hashes
+            self._dirty_payment_hashes = set()
+            for key in changed:
+                by_channel = self._settled_payments.get(key)
+                plist = sum(by_channel.values(), []) if by_channel else []
+                if len(plist) == 0:
+                    self._lightning_history.pop(bytes.fromhex(key), None)
+                    continue
+                self._lightning_history[bytes.fromhex(key)] = self._get_lightning_history_item(key, plist)
+            cached_items = list(self._lightning_history.items())
         out = {}
-        for key, plist in self.get_settled_payments().items():
-            if len(plist) == 0:
-                continue
-            payment_hash = bytes.fromhex(key)
-            info = self.get_payment_info(payment_hash)
-            amount_msat, fee_msat, timestamp = self.get_payment_value(info, plist)
-            if info is not None:
-                label = self.wallet.get_label(key)
-                direction = ('sent' if info.direction == SENT else 'received') if len(plist)==1 else 'self-payment'
+        for payment_hash, item in cached_items:
+            # labels and swaps can change without us noticing, so they are not cached
+            item = dict(item)
+            key = item['payment_hash']
+            if item['direction'] == 'forwarding':
+                item['label'] = _('Forwarding')
             else:
-                direction = 'forwarding'
-                label = _('Forwarding')
-            preimage = self.get_preimage(payment_hash).hex()
-            item = {
-                'type': 'payment',
-                'label': label,
-                'timestamp': timestamp or 0,
-                'date': timestamp_to_datetime(timestamp),
-                'direction': direction,
-                'amount_msat': amount_msat,
-                'fee_msat': fee_msat,
-                'payment_hash': key,
-                'preimage': preimage,
-            }
+                item['label'] = self.wallet.get_label(key)
             # add group_id to swap transactions
             swap = self.swap_manager.get_swap(payment_hash)
             if swap:
@@ -685,53 +949,61 @@ class LNWallet(LNWorker):
             out[payment_hash] = item
         return out
 
-    def get_onchain_history(self):
-        out = {}
-        # add funding events
-        for chan in self.channels.values():
-            item = chan.get_funding_height()
-            if item is None:
-                continue
+    def _get_channel_onchain_history(self, chan: Channel) -> List[dict]:
+        # only recomputed if the funding or closing tx, or the balance changed
+        cache_key = (chan.get_funding_height(), chan.get_closing_height(), chan.hm.get_settles_version())
+        cached = self._channel_onchain_history.get(chan.channel_id)
+        if cached and cached[0] == cache_key:
+            return cached[1]
+        items = []
+        item = chan.get_funding_height()
+        if item is not None:
             funding_txid, funding_height, funding_timestamp = item
-            item = {
+            items.append({
                 'channel_id': bh2u(chan.channel_id),
                 'type': 'channel_opening',
-                'label': self.wallet.get_label_for_txid(funding_txid) or (_('Open channel') + ' ' + chan.get_id_for_log()),
+                'label': _('Open channel') + ' ' + chan.get_id_for_log(),
                 'txid': funding_txid,
                 'amount_msat': chan.balance(LOCAL, ctn=0),
                 'direction': 'received',
                 'timestamp': funding_timestamp,
                 'fee_msat': None,
-            }
-            out[funding_txid] = item
+            })
             item = chan.get_closing_height()
-            if item is None:
-                continue
-            closing_txid, closing_height, closing_timestamp = item
-            item = {
-                'channel_id': bh2u(chan.channel_id),
-                'txid': closing_txid,
-                'label': self.wallet.get_label_for_txid(closing_txid) or (_('Close channel') + ' ' + chan.get_id_for_log()),
-                'type': 'channel_closure',
-                'amount_msat': -chan.balance_minus_outgoing_htlcs(LOCAL),
-                'direction': 'sent',
-                'timestamp': closing_timestamp,
-                'fee_msat': None,
-            }
-            out[closing_txid] = item
+            if item is not None:
+                closing_txid, closing_height, closing_timestamp = item
+                items.append({
+                    'channel_id': bh2u(chan.channel_id),
+                    'txid': closing_txid,
+                    'label': _('Close channel') + ' ' + chan.get_id_for_log(),
+                    'type': 'channel_closure',
+                    'amount_msat': -chan.balance_minus_outgoing_htlcs(LOCAL),
+                    'direction': 'sent',
+                    'timestamp': closing_timestamp,
+                    'fee_msat': None,
+                })
+        self._channel_onchain_history[chan.channel_id] = cache_key, items
+        return items
+
+    def get_onchain_history(self):
+        out = {}
+        # add funding events
+        with self._history_lock:
+            channels = self.channels
+            for chan_id in list(self._channel_onchain_history):
+                if chan_id not in channels:
+                    del self._channel_onchain_history[chan_id]
+            items = [item for chan in channels.values() for item in self._get_channel_onchain_history(chan)]
+        for item in items:
+            item = dict(item)
+            item['label'] = self.wallet.get_label_for_txid(item['txid']) or item['label']
+            out[item['txid']] = item
         # add info about submarine swaps
-        settled_payments = self.get_settled_payments()
         current_height = self.wallet.get_local_height()
         for payment_hash_hex, swap in self.swap_manager.swaps.items():
             txid = swap.spending_txid if swap.is_reverse else swap.funding_txid
             if txid is None:
                 continue
-            if payment_hash_hex in settled_payments:
-                plist = settled_payments[payment_hash_hex]
-                info = self.get_payment_info(bytes.fromhex(payment_hash_hex))
-                amount_msat, fee_msat, timestamp = self.get_payment_value(info, plist)
-            else:
-                amount_msat = 0
             label = 'Reverse swap' if swap.is_reverse else 'Forward swap'
             delta = current_height - swap.locktime
             if not swap.is_redeemed and swap.spending_txid is None and delta < 0:
@@ -828,6 +1100,7 @@ class LNWallet(LNWorker):
         return chan, funding_tx
 
     def add_channel(self, chan: Channel):
+        chan.set_htlc_archive(self.get_htlc_archive(chan.channel_id))
         with self.lock:
             self._channels[chan.channel_id] = chan
         self.lnwatcher.add_channel(chan.funding_outpoint.to_str(), chan.get_funding_address())
@@ -909,13 +1182,21 @@ class LNWallet(LNWorker):
         self.logs[key] = log = []
         success = False
         reason = ''
+        next_route = None  # type: Optional[LNPaymentRoute]  # candidate, not tried yet
+        alternative = None  # type: Optional[asyncio.Task]  # candidate being computed
         for i in range(attempts):
             try:
-                # note: path-finding runs in a separate thread so that we don't block the asyncio loop
-                # graph updates might occur during the computation
                 self.set_invoice_status(key, PR_ROUTING)
                 util.trigger_callback('invoice_status', self.wallet, key)
-                route = await run_in_thread(partial(self._create_route_from_invoice, lnaddr, full_path=full_path))
+                if next_route is None:
+                    # note: path-finding runs in a separate thread so that we don't block the asyncio loop
+                    # graph updates might occur during the computation
+                    route = await run_in_thread(partial(self._create_route_from_invoice, lnaddr, full_path=full_path))
+                else:
+                    route, next_route = next_route, None
+                if not full_path and i + 1 < attempts:
+                    # look for an alternative while the HTLC is in flight
+                    alternative = asyncio.ensure_future(self._find_alternative_route(lnaddr, route))
                 self.set_invoice_status(key, PR_INFLIGHT)
                 util.trigger_callback('invoice_status', self.wallet, key)
                 payment_attempt_log = await self._pay_to_route(route, lnaddr)
@@ -928,8 +1209,14 @@ class LNWallet(LNWorker):
             success = payment_attempt_log.success
             if success:
                 break
+            if alternative:
+                next_route, alternative = await alternative, None
+            if next_route and not self._is_candidate_route_usable(next_route, payment_attempt_log):
+                next_route = None
         else:
             reason = _('Failed after {} attempts').format(attempts)
+        if alternative:
+            alternative.cancel()
         util.trigger_callback('invoice_status', self.wallet, key)
         if success:
             util.trigger_callback('payment_succeeded', self.wallet, key)
@@ -983,6 +1270,37 @@ class LNWallet(LNWorker):
                                  preimage=payment_attempt.preimage,
                                  failure_details=failure_log)
 
+    async def _find_alternative_route(self, lnaddr: LnAddr, route: LNPaymentRoute) -> Optional[LNPaymentRoute]:
+        """Returns a route that does not use the public channels of route."""
+        excluded = [edge.short_channel_id for edge in route
+                    if self.get_channel_by_short_id(edge.short_channel_id) is None]
+        if not excluded:
+            return None
+        try:
+            return await run_in_thread(partial(
+                self._create_route_from_invoice, lnaddr, excluded=excluded))
+        except Exception as e:
+            # not fatal: a route is looked for again if the HTLC fails
+            self.logger.info(f"could not find an alternative route: {e!r}")
+            return None
+
+    def _is_candidate_route_usable(self, route: LNPaymentRoute, failed_attempt: PaymentAttemptLog) -> bool:
+        """Whether the candidate route can be tried right away, or if the failed
+        attempt tells us it will not work (or that its fees might be outdated).
+        """
+        failure_details = failed_attempt.failure_details
+        if failure_details is None or failure_details.sender_idx is None:
+            return False  # we don't know what went wrong; recompute
+        failed_route = failed_attempt.route
+        try:
+            erring_channel = failed_route[failure_details.sender_idx + 1].short_channel_id
+        except IndexError:
+            return False  # error reported by destination
+        path_finder = self.network.path_finder
+        return not any(edge.short_channel_id == erring_channel
+                       or path_finder.is_blacklisted(edge.short_channel_id)
+                       for edge in route)
+
     def handle_error_code_from_failed_htlc(self, failure_msg, sender_idx, route, peer):
         code, data = failure_msg.code, failure_msg.data
         self.logger.info(f"UPDATE_FAIL_HTLC {repr(code)} {data}")
@@ -1066,7 +1384,9 @@ class LNWallet(LNWorker):
 
     @profiler
     def _create_route_from_invoice(self, decoded_invoice: 'LnAddr',
-                                   *, full_path: LNPaymentPath = None) -> LNPaymentRoute:
+                                   *, full_path: LNPaymentPath = None,
+                                   excluded: Sequence[ShortChannelID] = ()) -> LNPaymentRoute:
+        """The public channels in excluded are not used."""
         amount_msat = decoded_invoice.get_amount_msat()
         invoice_pubkey = decoded_invoice.pubkey.serialize()
         # use 'r' field from invoice
@@ -1095,7 +1415,8 @@ class LNWallet(LNWorker):
             else:
                 # find path now on public graph, to border node
                 path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, border_node_pubkey, amount_msat,
-                                                                      my_channels=scid_to_my_channels)
+                                                                      my_channels=scid_to_my_channels,
+                                                                      excluded=excluded)
             if not path:
                 continue
             try:
@@ -1139,7 +1460,8 @@ class LNWallet(LNWorker):
                 path = full_path
             else:  # find path now
                 path = self.network.path_finder.find_path_for_payment(self.node_keypair.pubkey, invoice_pubkey, amount_msat,
-                                                                      my_channels=scid_to_my_channels)
+                                                                      my_channels=scid_to_my_channels,
+                                                                      excluded=excluded)
             if not path:
                 raise NoPathFound()
             route = self.network.path_finder.create_route_from_path(path, self.node_keypair.pubkey,
@@ -1282,6 +1604,7 @@ class LNWallet(LNWorker):
 
     def payment_sent(self, chan, payment_hash: bytes):
         self.set_payment_status(payment_hash, PR_PAID)
+        self._mark_payment_dirty(payment_hash)
         preimage = self.get_preimage(payment_hash)
         f = self.pending_payments.get(payment_hash)
         if f and not f.cancelled():
@@ -1298,6 +1621,7 @@ class LNWallet(LNWorker):
 
     def payment_received(self, chan, payment_hash: bytes):
         self.set_payment_status(payment_hash, PR_PAID)
+        self._mark_payment_dirty(payment_hash)
         util.trigger_callback('request_status', self.wallet, payment_hash.hex(), PR_PAID)
         util.trigger_callback('ln_payment_completed', payment_hash, chan.channel_id)
 
@@ -1405,6 +1729,8 @@ class LNWallet(LNWorker):
         with self.lock:
             self._channels.pop(chan_id)
             self.db.get('channels').pop(chan_id.hex())
+        if chan.hm.archive:
+            chan.hm.archive.remove()
         for addr in chan.get_wallet_addresses_channel_might_want_reserved():
             self.wallet.set_reserved_state_of_address(addr, reserved=False)
 
@@ -26,13 +26,14 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, deque
 import threading
 import socket
 import json
 import sys
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
+from typing import (NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any,
+                    Callable, Awaitable, TypeVar)
 import traceback
 import concurrent
 from concurrent import futures
@@ -56,6 +57,7 @@ from .blockchain import Blockchain, HEADER_SIZE
 from .interface import (Interface, PREFERRED_NETWORK_PROTOCOL,
                         RequestTimedOut, NetworkTimeout, BUCKET_NAME_OF_ONION_SERVERS,
                         NetworkException, RequestCorrupted, ServerAddr)
+from .network_stats import NetworkStats, ConnectionStats
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 from .i18n import _
@@ -70,10 +72,27 @@ if TYPE_CHECKING:
 
 _logger = get_logger(__name__)
 
+T = TypeVar('T')
+
 
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_STICKY_SERVERS = 4
 NUM_RECENT_SERVERS = 20
+# max number of servers we keep (persisted) latency/failure statistics for
+NUM_SCORED_SERVERS = 200
+# smoothing factor of the exponentially weighted moving averages in ServerScore
+SERVER_SCORE_EWMA_ALPHA = 0.2
+# the main server is only replaced if a candidate scores better by this factor
+SERVER_SWITCH_SCORE_RATIO = 0.5
+# min seconds between two score-based switches of the main server
+SERVER_SWITCH_MIN_INTERVAL = 600
+# min number of measured requests before a server's score is trusted for switching
+SERVER_SCORE_MIN_REQUESTS = 20
+# number of recent response times per method used to compute the hedging delay
+HEDGE_LATENCY_WINDOW = 200
+# below this many samples, DEFAULT_HEDGE_DELAY is used as hedging delay
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAY = 1.0  # seconds
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -142,6 +161,159 @@ def pick_random_server(hostmap=None, *, allowed_protocols: Iterable[str],
     return random.choice(eligible) if eligible else None
 
 
+class ServerScore:
+    """Measured quality of a server, as seen by us. Lower score() is better."""
+
+    # latency assumed for servers we have no measurements for
+    DEFAULT_LATENCY = 1.0
+    # seconds added to the score for a timeout rate of 1
+    TIMEOUT_PENALTY = 10.0
+    # seconds added to the score per block the server lags behind
+    TIP_LAG_PENALTY = 2.0
+
+    def __init__(self, *, latency: float = None, timeout_rate: float = 0.0,
+                 num_requests: int = 0, num_timeouts: int = 0, tip_lag: int = 0,
+                 last_success: float = 0, last_seen: float = 0):
+        self.latency = latency  # EWMA of request round-trip time, in seconds
+        self.timeout_rate = timeout_rate  # EWMA of the fraction of requests that timed out
+        self.num_requests = num_requests
+        self.num_timeouts = num_timeouts
+        self.tip_lag = tip_lag  # blocks behind the best tip of connected servers
+        self.last_success = last_success  # unix ts
+        self.last_seen = last_seen  # unix ts
+
+    def add_response(self, rtt: float, *, now: float = None) -> None:
+        if now is None:
+            now = time.time()
+        a = SERVER_SCORE_EWMA_ALPHA
+        self.latency = rtt if self.latency is None else (1 - a) * self.latency + a * rtt
+        self.timeout_rate = (1 - a) * self.timeout_rate
+        self.num_requests += 1
+        self.last_success = self.last_seen = now
+
+    def add_timeout(self, *, now: float = None) -> None:
+        if now is None:
+            now = time.time()
+        a = SERVER_SCORE_EWMA_ALPHA
+        self.timeout_rate = (1 - a) * self.timeout_rate + a
+        self.num_requests += 1
+        self.num_timeouts += 1
+        self.last_seen = now
+
+    def score(self) -> float:
+        latency = self.latency if self.latency is not None else self.DEFAULT_LATENCY
+        return (latency
+                + self.TIMEOUT_PENALTY * self.timeout_rate
+                + self.TIP_LAG_PENALTY * self.tip_lag)
+
+    def to_json(self) -> dict:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_json(cls, d: dict) -> 'ServerScore':
+        return cls(**d)
+
+
+class ServerScorecard:
+    """Per-server ServerScores, persisted in the 'server_scores' file.
+    Updated from the network thread, but may be read from any thread.
+    """
+
+    # min seconds between two writes of the file by maybe_save()
+    SAVE_INTERVAL = 60
+
+    def __init__(self, config: SimpleConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = time.time()
+        self._scores = self._read()  # type: Dict[ServerAddr, ServerScore]
+
+    def _path(self) -> Optional[str]:
+        if not self.config.path:
+            return None
+        return os.path.join(self.config.path, "server_scores")
+
+    def _read(self) -> Dict[ServerAddr, ServerScore]:
+        path = self._path()
+        if not path:
+            return {}
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.loads(f.read())
+            return {ServerAddr.from_str(k): ServerScore.from_json(v) for k, v in data.items()}
+        except:
+            return {}
+
+    def maybe_save(self) -> None:
+        if time.time() - self._last_saved >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        path = self._path()
+        with self.lock:
+            self._last_saved = time.time()
+            if not path or not self._dirty:
+                return
+            # forget about the servers we have not talked to for the longest time
+            servers = sorted(self._scores, key=lambda s: self._scores[s].last_seen, reverse=True)
+            self._scores = {s: self._scores[s] for s in servers[:NUM_SCORED_SERVERS]}
+            data = {str(s): score.to_json() for s, score in self._scores.items()}
+            self._dirty = False
+        s = json.dumps(data, indent=4, sort_keys=True)
+        try:
+            with open(path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
+    def _get_or_create(self, server: ServerAddr) -> ServerScore:
+        score = self._scores.get(server)
+        if score is None:
+            score = self._scores[server] = ServerScore()
+        self._dirty = True
+        return score
+
+    def add_response(self, server: ServerAddr, rtt: float) -> None:
+        with self.lock:
+            self._get_or_create(server).add_response(rtt)
+
+    def add_timeout(self, server: ServerAddr) -> None:
+        with self.lock:
+            self._get_or_create(server).add_timeout()
+
+    def set_tip_lag(self, server: ServerAddr, tip_lag: int) -> None:
+        with self.lock:
+            score = self._scores.get(server)
+            if score is not None and score.tip_lag == tip_lag:
+                return
+            self._get_or_create(server).tip_lag = tip_lag
+
+    def clear_tip_lag(self, server: ServerAddr) -> None:
+        # the lag is only known while we are connected
+        with self.lock:
+            score = self._scores.get(server)
+            if score is not None and score.tip_lag:
+                score.tip_lag = 0
+                self._dirty = True
+
+    def get(self, server: ServerAddr) -> Optional[ServerScore]:
+        with self.lock:
+            return self._scores.get(server)
+
+    def score(self, server: ServerAddr) -> float:
+        """Score of server. Servers we know nothing about get
+        a neutral score, so that they still get tried.
+        """
+        with self.lock:
+            score = self._scores.get(server)
+            return score.score() if score else ServerScore().score()
+
+    def sort_servers(self, servers: Iterable[ServerAddr]) -> List[ServerAddr]:
+        """Returns servers, best first. The sort is stable."""
+        return sorted(servers, key=self.score)
+
+
 class NetworkParameters(NamedTuple):
     server: ServerAddr
     proxy: Optional[dict]
@@ -306,6 +478,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         self.server_peers = {}  # returned by interface (servers that the main interface knows about)
         self._recent_servers = self._read_recent_servers()  # note: needs self.recent_servers_lock
+        self.server_scores = ServerScorecard(self.config)
+        self.stats = NetworkStats()
+        self._last_server_switch_time = 0
+        # response times of hedgeable requests, per method
+        self._hedge_latencies = defaultdict(lambda: deque(maxlen=HEDGE_LATENCY_WINDOW))  # type: Dict[str, deque]
 
         self.banner = ''
         self.donation_address = ''
@@ -556,6 +733,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.recent_servers_lock:
             recent_servers = list(self._recent_servers)
         recent_servers = [s for s in recent_servers if s.protocol in self._allowed_protocols]
+        recent_servers = self.server_scores.sort_servers(recent_servers)
         if len(connected_servers & set(recent_servers)) < NUM_STICKY_SERVERS:
             for server in recent_servers:
                 if server in connected_servers:
@@ -563,10 +741,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 if not self._can_retry_addr(server, now=now):
                     continue
                 return server
-        # try all servers we know about, pick one at random
+        # try all servers we know about, pick one at random,
+        # but prefer those that performed well in the past
         hostmap = self.get_servers()
         servers = list(set(filter_protocol(hostmap, allowed_protocols=self._allowed_protocols)) - connected_servers)
         random.shuffle(servers)
+        servers = self.server_scores.sort_servers(servers)
         for server in servers:
             if not self._can_retry_addr(server, now=now):
                 continue
@@ -634,9 +814,52 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             with self.interfaces_lock: interfaces = list(self.interfaces.values())
             filtered = list(filter(lambda iface: iface.tip_header == best_header, interfaces))
             if filtered:
-                chosen_iface = random.choice(filtered)
+                random.shuffle(filtered)
+                chosen_iface = min(filtered, key=lambda iface: self.server_scores.score(iface.server))
                 await self.switch_to_interface(chosen_iface.server)
 
+    async def _maybe_switch_to_a_better_server(self) -> None:
+        """If auto_connect, switch to a connected server (within fork) that
+        scores much better than the main one. To avoid flapping, we require
+        a large margin, and we do not switch more often than every
+        SERVER_SWITCH_MIN_INTERVAL seconds.
+        """
+        if not self.auto_connect or self.oneserver:
+            return
+        main_iface = self.interface
+        if not main_iface or not main_iface.blockchain:
+            return
+        now = time.time()
+        if now - self._last_server_switch_time < SERVER_SWITCH_MIN_INTERVAL:
+            return
+        main_score = self.server_scores.get(main_iface.server)
+        if main_score is None or main_score.num_requests < SERVER_SCORE_MIN_REQUESTS:
+            return
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        candidates = []
+        for iface in interfaces:
+            if iface == main_iface or iface.blockchain != main_iface.blockchain or iface.tip < main_iface.tip:
+                continue
+            score = self.server_scores.get(iface.server)
+            if score is None or score.num_requests < SERVER_SCORE_MIN_REQUESTS:
+                continue
+            candidates.append((score.score(), iface))
+        if not candidates:
+            return
+        best_score, best_iface = min(candidates, key=lambda x: x[0])
+        if best_score < SERVER_SWITCH_SCORE_RATIO * main_score.score():
+            self.logger.info(f"switching to better scoring server {best_iface.server} "
+                             f"({best_score:.3f} vs {main_score.score():.3f})")
+            await self.switch_to_interface(best_iface.server)
+
+    def update_server_tip_lags(self) -> None:
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        if not interfaces:
+            return
+        best_tip = max(iface.tip for iface in interfaces)
+        for iface in interfaces:
+            self.server_scores.set_tip_lag(iface.server, best_tip - iface.tip)
+
     async def switch_unwanted_fork_interface(self) -> None:
         """If auto_connect, maybe switch to another fork/chain."""
         if not self.auto_connect or not self.interface:
@@ -693,6 +916,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             assert i.ready.done(), "interface we are switching to is not ready yet"
             blockchain_updated = i.blockchain != self.blockchain()
             self.interface = i
+            self._last_server_switch_time = time.time()
             await i.taskgroup.spawn(self._request_server_info(i))
             util.trigger_callback('default_server_changed')
             self.default_server_changed_event.set()
@@ -729,8 +953,33 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         if server == self.default_server:
             self._set_status('disconnected')
         await self._close_interface(interface)
+        self._record_disconnect(interface)
+        self.server_scores.clear_tip_lag(server)
         util.trigger_callback('network_updated')
 
+    def _record_disconnect(self, interface: Interface) -> None:
+        session = interface.session
+        self.stats.session_closed(
+            interface.diagnostic_name(),
+            was_connected=interface.ready.done() and not interface.ready.cancelled(),
+            bytes_sent=session.send_size if session else 0,
+            bytes_received=session.recv_size if session else 0)
+
+    def get_network_stats(self) -> dict:
+        """Request and connection statistics, per method and per server."""
+        stats = self.stats.to_json()
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        # add traffic of live sessions
+        for iface in interfaces:
+            session = iface.session
+            if not session:
+                continue
+            conn_stats = stats['connections'].setdefault(iface.diagnostic_name(), ConnectionStats().to_json())
+            conn_stats['bytes_sent'] += session.send_size
+            conn_stats['bytes_received'] += session.recv_size
+        stats['num_connected_servers'] = len(interfaces)
+        return stats
+
     def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic) -> int:
         if self.oneserver and not self.auto_connect:
             return request_type.MOST_RELAXED
@@ -748,6 +997,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             self.logger.info(f"connecting to {server} as new interface")
             self._set_status('connecting')
         self._trying_addr_now(server)
+        self.stats.connection_attempt(server.net_addr_str())
 
         interface = Interface(network=self, server=server, proxy=self.proxy)
         # note: using longer timeouts here as DNS can sometimes be slow!
@@ -762,6 +1012,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             with self.interfaces_lock:
                 assert server not in self.interfaces
                 self.interfaces[server] = interface
+            self.stats.connected(server.net_addr_str())
         finally:
             try: self._connecting.remove(server)
             except KeyError: pass
@@ -841,17 +1092,104 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 raise UntrustedServerReturnedError(original_exception=e) from e
         return wrapper
 
+    def _get_hedge_delay(self, method: str) -> float:
+        """Seconds to wait for the main interface before hedging a request.
+        This is the 'network_hedge_percentile' percentile of recent response times.
+        """
+        latencies = sorted(self._hedge_latencies[method])
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        percentile = self.config.get('network_hedge_percentile', 95)
+        idx = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[idx]
+
+    def _get_interface_to_hedge_on(self, main_iface: Interface) -> Optional[Interface]:
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        candidates = [iface for iface in interfaces
+                      if iface != main_iface and iface.ready.done() and not iface.ready.cancelled()
+                      and iface.blockchain == main_iface.blockchain]
+        if not candidates:
+            return None
+        random.shuffle(candidates)
+        return min(candidates, key=lambda iface: self.server_scores.score(iface.server))
+
+    async def _maybe_hedge(self, method: str, request: Callable[[Interface], Awaitable[T]]) -> T:
+        """Runs request on the main interface. If hedging is enabled
+        ('network_hedged_requests'), and the main interface has not answered
+        within the hedging delay, the request is also sent to a second interface.
+        The first valid answer wins. Answers are validated by request itself,
+        which must raise if they are not acceptable.
+        If no answer is valid, the exception of the main interface is raised.
+        """
+        main_iface = self.interface
+        if not self.config.get('network_hedged_requests', False):
+            return await request(main_iface)
+        start_time = time.monotonic()
+        main_fut = asyncio.ensure_future(request(main_iface))
+        iface_by_fut = {main_fut: main_iface}
+        pending = {main_fut}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self._get_hedge_delay(method))
+            if not done:
+                hedge_iface = self._get_interface_to_hedge_on(main_iface)
+                if hedge_iface:
+                    self.logger.info(f"hedging {method} request on {hedge_iface.server}")
+                    hedge_fut = asyncio.ensure_future(request(hedge_iface))
+                    iface_by_fut[hedge_fut] = hedge_iface
+                    pending.add(hedge_fut)
+            while True:
+                for fut in done:
+                    if fut.cancelled():
+                        continue
+                    if fut.exception() is None:
+                        self._hedge_latencies[method].append(time.monotonic() - start_time)
+                        return fut.result()
+                    if fut is not main_fut:
+                        iface_by_fut[fut].logger.info(f"hedged {method} request failed: {repr(fut.exception())}")
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # all requests failed; main_fut is done, as nothing is pending
+            return main_fut.result()  # raises
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    def _check_merkle_against_local_headers(self, tx_hash: str, merkle: dict) -> None:
+        """Raises RequestCorrupted if merkle does not match the header we have
+        for its block. If we do not have that header yet, the verifier will check.
+        """
+        from .verifier import verify_tx_is_in_block, MerkleVerificationFailure
+        tx_height = merkle['block_height']
+        header = self.blockchain().read_header(tx_height)
+        if header is None:
+            return
+        try:
+            verify_tx_is_in_block(tx_hash, merkle['merkle'], merkle['pos'], header, tx_height)
+        except MerkleVerificationFailure as e:
+            raise RequestCorrupted(f"merkle proof for {tx_hash} does not verify: {e!r}") from e
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
-        return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
+        async def request(iface: Interface) -> dict:
+            res = await iface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
+            if iface != self.interface:
+                self._check_merkle_against_local_headers(tx_hash, res)
+            return res
+        return await self._maybe_hedge('blockchain.transaction.get_merkle', request)
 
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
             timeout = self.get_network_timeout_seconds(NetworkTimeout.Urgent)
+        await self._maybe_hedge(
+            'blockchain.transaction.broadcast',
+            lambda iface: self._broadcast_transaction_on_interface(iface, tx, timeout=timeout))
+
+    async def _broadcast_transaction_on_interface(self, iface: Interface, tx: 'Transaction', *, timeout) -> None:
         try:
-            out = await self.interface.session.send_request('blockchain.transaction.broadcast', [tx.serialize()], timeout=timeout)
+            out = await iface.session.send_request('blockchain.transaction.broadcast', [tx.serialize()], timeout=timeout)
             # note: both 'out' and exception messages are untrusted input from the server
         except (RequestTimedOut, asyncio.CancelledError, asyncio.TimeoutError):
             raise  # pass-through
@@ -1021,7 +1359,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     @best_effort_reliable
     @catch_server_exceptions
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
-        return await self.interface.get_transaction(tx_hash=tx_hash, timeout=timeout)
+        # note: Interface.get_transaction checks the txid of the response
+        return await self._maybe_hedge(
+            'blockchain.transaction.get',
+            lambda iface: iface.get_transaction(tx_hash=tx_hash, timeout=timeout))
 
     @best_effort_reliable
     @catch_server_exceptions
@@ -1167,6 +1508,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting.clear()
+        self.server_scores.save()
         if not full_shutdown:
             util.trigger_callback('network_updated')
 
@@ -1205,9 +1547,12 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                     await self._close_interface(iface)
         async def maintain_main_interface():
             await self._ensure_there_is_a_main_interface()
+            if self.is_connected():
+                await self._maybe_switch_to_a_better_server()
             if self.is_connected():
                 if self.config.is_fee_estimates_update_required():
                     await self.interface.taskgroup.spawn(self._request_fee_estimates, self.interface)
+            self.server_scores.maybe_save()
 
         while True:
             try:
@@ -0,0 +1,172 @@
+# Copyright (C) 2020 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+"""
+network_stats.py collects statistics about the requests we send to
+electrum servers, and about our connections to them.
+"""
+
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_json(self) -> dict:
+        # cumulative counts, as in prometheus histograms
+        buckets = {}
+        total = 0
+        for le, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], self.counts):
+            total += count
+            buckets[str(le)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.in_flight = 0
+        self.num_timeouts = 0
+        self.num_errors = 0
+
+    def to_json(self) -> dict:
+        return {
+            'latency': self.latency.to_json(),
+            'in_flight': self.in_flight,
+            'timeouts': self.num_timeouts,
+            'errors': self.num_errors,
+        }
+
+
+class ConnectionStats:
+
+    def __init__(self):
+        self.num_connection_attempts = 0
+        self.num_connects = 0
+        self.num_disconnects = 0
+        # of closed sessions; see Network.get_network_stats for live ones
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def to_json(self) -> dict:
+        return {
+            'connection_attempts': self.num_connection_attempts,
+            'connects': self.num_connects,
+            'disconnects': self.num_disconnects,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class NetworkStats:
+    """Counters are updated from the network thread, but may be read from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._by_method = defaultdict(RequestStats)  # type: Dict[str, RequestStats]
+        self._by_server = defaultdict(RequestStats)  # type: Dict[str, RequestStats]
+        self._connections = defaultdict(ConnectionStats)  # type: Dict[str, ConnectionStats]
+
+    def request_started(self, server: str, method: str) -> None:
+        with self.lock:
+            self._by_method[method].in_flight += 1
+            self._by_server[server].in_flight += 1
+
+    def request_finished(self, server: str, method: str, duration: Optional[float], *,
+                         timed_out: bool = False, error: bool = False) -> None:
+        """duration is None if the request was not answered,
+        e.g. because it timed out or got cancelled.
+        """
+        with self.lock:
+            for stats in (self._by_method[method], self._by_server[server]):
+                stats.in_flight -= 1
+                if timed_out:
+                    stats.num_timeouts += 1
+                if duration is not None:
+                    stats.latency.add(duration)
+                if error:
+                    stats.num_errors += 1
+
+    def connection_attempt(self, server: str) -> None:
+        with self.lock:
+            self._connections[server].num_connection_attempts += 1
+
+    def connected(self, server: str) -> None:
+        with self.lock:
+            self._connections[server].num_connects += 1
+
+    def session_closed(self, server: str, *, was_connected: bool,
+                       bytes_sent: int, bytes_received: int) -> None:
+        with self.lock:
+            stats = self._connections[server]
+            if was_connected:
+                stats.num_disconnects += 1
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                'methods': {k: v.to_json() for k, v in self._by_method.items()},
+                'servers': {k: v.to_json() for k, v in self._by_server.items()},
+                'connections': {k: v.to_json() for k, v in self._connections.items()},
+            }
+
+
+def _escape_label_value(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _add_request_metrics(lines: List[str], label: str, stats_by_key: Dict[str, dict]) -> None:
+    prefix = f'electrum_{label}_request'
+    lines.append(f'# TYPE {prefix}_duration_seconds histogram')
+    for key, stats in sorted(stats_by_key.items()):
+        key = _escape_label_value(key)
+        latency = stats['latency']
+        for le, count in latency['buckets'].items():
+            lines.append(f'{prefix}_duration_seconds_bucket{{{label}="{key}",le="{le}"}} {count}')
+        lines.append(f'{prefix}_duration_seconds_sum{{{label}="{key}"}} {latency["sum"]}')
+        lines.append(f'{prefix}_duration_seconds_count{{{label}="{key}"}} {latency["count"]}')
+    for name, metric_type, field in (('in_flight', 'gauge', 'in_flight'),
+                                     ('timeouts_total', 'counter', 'timeouts'),
+                                     ('errors_total', 'counter', 'errors')):
+        lines.append(f'# TYPE {prefix}s_{name} {metric_type}')
+        for key, stats in sorted(stats_by_key.items()):
+            lines.append(f'{prefix}s_{name}{{{label}="{_escape_label_value(key)}"}} {stats[field]}')
+
+
+def to_prometheus_text(stats: dict) -> str:
+    """Formats the output of Network.get_network_stats in the
+    prometheus text exposition format.
+    """
+    lines = []  # type: List[str]
+    _add_request_metrics(lines, 'method', stats['methods'])
+    _add_request_metrics(lines, 'server', stats['servers'])
+    for name, field in (('connection_attempts_total', 'connection_attempts'),
+                        ('connects_total', 'connects'),
+                        ('disconnects_total', 'disconnects'),
+                        ('sent_bytes_total', 'bytes_sent'),
+                        ('received_bytes_total', 'bytes_received')):
+        lines.append(f'# TYPE electrum_server_{name} counter')
+        for server, conn_stats in sorted(stats['connections'].items()):
+            lines.append(f'electrum_server_{name}{{server="{_escape_label_value(server)}"}} {conn_stats[field]}')
+    lines.append('# TYPE electrum_connected_servers gauge')
+    lines.append(f'electrum_connected_servers {stats["num_connected_servers"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+#
+# Local HTTP server printing the webhooks it receives, e.g. to test the notify command:
+#   webhook_receiver.py 8080 [error_rate]
+#   electrum notify <address> http://127.0.0.1:8080/
+
+import sys
+import asyncio
+
+from electrum.util import print_msg, create_and_start_event_loop
+from electrum.webhooks import WebhookReceiver
+
+
+try:
+    port = int(sys.argv[1])
+    error_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+except Exception:
+    print("usage: webhook_receiver <port> [error_rate]")
+    sys.exit(1)
+
+
+class PrintingReceiver(WebhookReceiver):
+
+    async def handle(self, request):
+        response = await super().handle(request)
+        if response.status == 200:
+            print_msg(f"{request.path} {self.received[-1][1]}")
+        else:
+            print_msg(f"{request.path} injected error")
+        return response
+
+
+loop, stopping_fut, loop_thread = create_and_start_event_loop()
+receiver = PrintingReceiver(error_rate=error_rate)
+asyncio.run_coroutine_threadsafe(receiver.start(port=port), loop).result()
+print_msg(f"listening on {receiver.url}")
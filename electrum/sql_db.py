@@ -20,8 +20,20 @@ def sql(func):
 
 
 class SqlDB(Logger):
-    
+
+    # requests already waiting in the queue are run together, in one
+    # transaction, and their results are handed back to the event loop at once
+    MAX_REQUESTS_PER_BATCH = 1000
+    # sqlite keeps this many prepared statements around, keyed by their sql
+    STATEMENT_CACHE_SIZE = 256
+    JOURNAL_MODE = 'WAL'
+    SYNCHRONOUS = 'NORMAL'  # with WAL, this does not risk corruption, only the latest commits
+
     def __init__(self, asyncio_loop: asyncio.BaseEventLoop, path, commit_interval=None):
+        """If commit_interval is None, every batch of requests is committed
+        before the results are returned, so awaited writes are on disk.
+        Otherwise we commit once at least commit_interval requests ran.
+        """
         Logger.__init__(self)
         self.asyncio_loop = asyncio_loop
         self.path = path
@@ -36,32 +48,72 @@ class SqlDB(Logger):
 
     def run_sql(self):
         self.logger.info("SQL thread started")
-        self.conn = sqlite3.connect(self.path)
+        self.conn = sqlite3.connect(self.path, cached_statements=self.STATEMENT_CACHE_SIZE)
+        self.conn.execute(f"PRAGMA journal_mode={self.JOURNAL_MODE}")
+        self.conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS}")
         self.logger.info("Creating database")
         self.create_database()
         i = 0
         while self.asyncio_loop.is_running():
             try:
-                future, func, args, kwargs = self.db_requests.get(timeout=0.1)
+                requests = [self.db_requests.get(timeout=0.1)]
             except queue.Empty:
                 continue
-            try:
-                result = func(self, *args, **kwargs)
-            except BaseException as e:
-                self.asyncio_loop.call_soon_threadsafe(future.set_exception, e)
-                continue
-            if not future.cancelled():
-                self.asyncio_loop.call_soon_threadsafe(future.set_result, result)
-            # note: in sweepstore session.commit() is called inside
-            # the sql-decorated methods, so commiting to disk is awaited
+            while len(requests) < self.MAX_REQUESTS_PER_BATCH:
+                try:
+                    requests.append(self.db_requests.get_nowait())
+                except queue.Empty:
+                    break
+            results = []
+            for future, func, args, kwargs in requests:
+                try:
+                    results.append((future, self._run_request(func, args, kwargs), None))
+                except BaseException as e:
+                    results.append((future, None, e))
             if self.commit_interval:
-                i = (i + 1) % self.commit_interval
-                if i == 0:
+                i += len(requests)
+                if i >= self.commit_interval:
+                    i = 0
                     self.conn.commit()
+            elif self.conn.in_transaction:
+                self.conn.commit()
+            self.asyncio_loop.call_soon_threadsafe(self._set_results, results)
         # write
         self.conn.commit()
         self.conn.close()
         self.logger.info("SQL thread terminated")
 
+    def _run_request(self, func, args, kwargs):
+        # Each request runs in its own savepoint, so that the writes of a
+        # failing request are undone without affecting the rest of the batch.
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute("SAVEPOINT request")
+        try:
+            result = func(self, *args, **kwargs)
+        except BaseException:
+            self._end_savepoint(rollback=True)
+            raise
+        self._end_savepoint(rollback=False)
+        return result
+
+    def _end_savepoint(self, *, rollback: bool):
+        try:
+            if rollback:
+                self.conn.execute("ROLLBACK TO request")
+            self.conn.execute("RELEASE request")
+        except sqlite3.OperationalError:
+            pass  # the request committed, which released the savepoint
+
+    @staticmethod
+    def _set_results(results):
+        for future, result, exc in results:
+            if future.cancelled():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
     def create_database(self):
         raise NotImplementedError()
@@ -24,18 +24,20 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple
+from typing import Dict, List, TYPE_CHECKING, Tuple, Callable, Optional
 from collections import defaultdict
 import logging
 
 from aiorpcx import TaskGroup, run_in_thread, RPCError
 
 from . import util
+from . import instrumentation
 from .transaction import Transaction, PartialTransaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy
+from .util import bh2u, NetworkJobOnDefaultServer, random_shuffled_copy
 from .bitcoin import address_to_scripthash, is_address
 from .logging import Logger
 from .interface import GracefulDisconnect
+from .webhooks import WebhookDispatcher
 
 if TYPE_CHECKING:
     from .network import Network
@@ -157,6 +159,7 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_histories
                 and not self.requested_tx)
 
+    @instrumentation.traced('sync.address_status')
     async def _on_address_status(self, addr, status):
         history = self.wallet.db.get_addr_history(addr)
         if history_status(history) == status:
@@ -207,6 +210,7 @@ class Synchronizer(SynchronizerBase):
             for tx_hash in transaction_hashes:
                 await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
 
+    @instrumentation.traced('sync.get_transaction')
     async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
         self._requests_sent += 1
         try:
@@ -224,7 +228,9 @@ class Synchronizer(SynchronizerBase):
         if tx_hash != tx.txid():
             raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
         tx_height = self.requested_tx.pop(tx_hash)
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
+        instrumentation.count('sync.tx_bytes_received', len(raw_tx) // 2)
+        with instrumentation.span('sync.receive_tx_callback'):
+            self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(raw_tx)}")
         # callbacks
         util.trigger_callback('new_transaction', self.wallet, tx)
@@ -257,12 +263,18 @@ class Synchronizer(SynchronizerBase):
 
 class Notifier(SynchronizerBase):
     """Watch addresses. Every time the status of an address changes,
-    an HTTP POST is sent to the corresponding URL.
+    an HTTP POST is sent to the corresponding URL, by a WebhookDispatcher.
     """
     def __init__(self, network):
         SynchronizerBase.__init__(self, network)
         self.watched_addresses = defaultdict(list)  # type: Dict[str, List[str]]
         self._start_watching_queue = asyncio.Queue()  # type: asyncio.Queue[Tuple[str, str]]
+        self.webhooks = WebhookDispatcher(network.config, proxy=network.proxy)
+        asyncio.run_coroutine_threadsafe(self.webhooks.run(), self.asyncio_loop)
+
+    async def stop(self):
+        await super().stop()
+        await self.webhooks.stop()
 
     async def main(self):
         # resend existing subscriptions if we were restarted
@@ -285,14 +297,66 @@ class Notifier(SynchronizerBase):
         if addr not in self.watched_addresses:
             return
         self.logger.info(f'new status for addr {addr}')
-        headers = {'content-type': 'application/json'}
-        data = {'address': addr, 'status': status}
         for url in self.watched_addresses[addr]:
-            try:
-                async with make_aiohttp_session(proxy=self.network.proxy, headers=headers) as session:
-                    async with session.post(url, json=data, headers=headers) as resp:
-                        await resp.text()
-            except Exception as e:
-                self.logger.info(repr(e))
+            self.webhooks.post(url, {'address': addr, 'status': status})
+
+
+class HibernationWatcher(SynchronizerBase):
+    """Watch the addresses of hibernated wallets, in place of their Synchronizer.
+    When the status of an address differs from the one the wallet had when it
+    was hibernated, call on_activity with the key of the wallet.
+    """
+    def __init__(self, network: 'Network', on_activity: Callable[[str], None]):
+        self.on_activity = on_activity
+        self.watched_addresses = {}  # type: Dict[str, Tuple[str, Optional[str]]]  # addr -> (key, status)
+        self.addresses_by_key = defaultdict(list)  # type: Dict[str, List[str]]
+        SynchronizerBase.__init__(self, network)
+
+    def _reset(self):
+        super()._reset()
+        # latest status received for each subscribed address
+        self.statuses = {}  # type: Dict[str, Optional[str]]
+        self._start_watching_queue = asyncio.Queue()  # type: asyncio.Queue[str]
+
+    async def main(self):
+        # resend existing subscriptions if we were restarted
+        for addr in list(self.watched_addresses):
+            await self._add_address(addr)
+        # main loop
+        while True:
+            addr = await self._start_watching_queue.get()
+            if addr in self.statuses:
+                # already subscribed, e.g. by a previous hibernation of the wallet
+                self._check_status(addr)
             else:
-                self.logger.info(f'Got Response for {addr}')
+                await self._add_address(addr)
+
+    def watch(self, key: str, statuses: Dict[str, Optional[str]]) -> None:
+        """Start watching addresses, with their current statuses.
+        Must be called from the event loop.
+        """
+        for addr, status in statuses.items():
+            self.watched_addresses[addr] = key, status
+            self.addresses_by_key[key].append(addr)
+            self._start_watching_queue.put_nowait(addr)
+
+    def unwatch(self, key: str) -> None:
+        for addr in self.addresses_by_key.pop(key, []):
+            self.watched_addresses.pop(addr, None)
+        # The server subscriptions are kept, as protocol 1.4 has no unsubscribe.
+        # They are reused: the synchronizer of the woken up wallet gets the
+        # statuses from the session cache, without sending requests, and a
+        # later hibernation of the wallet finds them in self.statuses.
+
+    def _check_status(self, addr: str) -> None:
+        if addr not in self.watched_addresses:
+            return
+        key, status = self.watched_addresses[addr]
+        if self.statuses[addr] != status:
+            self.logger.info(f'new status for addr {addr}, waking up wallet')
+            self.unwatch(key)
+            self.on_activity(key)
+
+    async def _on_address_status(self, addr, status):
+        self.statuses[addr] = status
+        self._check_status(addr)
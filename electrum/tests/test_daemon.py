@@ -0,0 +1,383 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from electrum import daemon, util, wallet
+from electrum.commands import Commands
+from electrum.daemon import AuthenticatedServer, Daemon, PayServer
+from electrum.invoices import PR_EXPIRED, PR_PAID, PR_UNKNOWN, PR_UNPAID
+from electrum.lnworker import LNWallet
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import HibernationWatcher
+from electrum.util import create_and_start_event_loop, standardize_path
+from electrum.wallet import restore_wallet_from_text
+
+from . import ElectrumTestCase
+
+
+class FakeRequest:
+
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.headers = headers or {}
+
+    async def text(self):
+        return json.dumps(self.body)
+
+
+class TestAuthenticatedServer(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        # an empty password disables authentication
+        self.server = AuthenticatedServer('user', '')
+        async def add(a, b):
+            return a + b
+        async def fail():
+            raise Exception('failed')
+        self.server.register_method(add)
+        self.server.register_method(fail)
+
+    def tearDown(self):
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    def handle(self, body, headers=None):
+        fut = asyncio.run_coroutine_threadsafe(self.server.handle(FakeRequest(body, headers)), self.asyncio_loop)
+        return fut.result()
+
+    def test_single_request(self):
+        response = self.handle({'id': 1, 'method': 'add', 'params': [1, 2]})
+        self.assertEqual({'id': 1, 'jsonrpc': '2.0', 'result': 3}, json.loads(response.body))
+        response = self.handle({'id': 2, 'method': 'add', 'params': {'a': 1, 'b': 2}})
+        self.assertEqual(3, json.loads(response.body)['result'])
+        response = self.handle({'method': 'add', 'params': [1, 2]})
+        self.assertEqual(500, response.status)
+        response = self.handle({'id': 3, 'method': 'unknown'})
+        self.assertEqual((3, -32601), (json.loads(response.body)['id'], json.loads(response.body)['error']['code']))
+
+    def test_batch(self):
+        response = self.handle([
+            {'id': 1, 'method': 'add', 'params': [1, 2]},
+            {'id': 2, 'method': 'fail'},
+            {'id': 3, 'method': 'unknown'},
+            'not a request',
+            {'id': 5, 'method': 'add', 'params': [3, 4]},
+        ])
+        responses = json.loads(response.body)
+        self.assertEqual(5, len(responses))
+        self.assertEqual({'id': 1, 'jsonrpc': '2.0', 'result': 3}, responses[0])
+        self.assertEqual({'code': 1, 'message': 'failed'}, responses[1]['error'])
+        self.assertEqual((3, -32601), (responses[2]['id'], responses[2]['error']['code']))
+        self.assertEqual((None, -32600), (responses[3]['id'], responses[3]['error']['code']))
+        self.assertEqual({'id': 5, 'jsonrpc': '2.0', 'result': 7}, responses[4])
+        self.assertEqual(500, self.handle([]).status)
+
+    def test_batch_notifications(self):
+        calls = []
+        async def notify(x):
+            calls.append(x)
+        self.server.register_method(notify)
+        response = self.handle([
+            {'method': 'notify', 'params': [1]},
+            {'method': 'unknown'},
+            {'id': 1, 'method': 'add', 'params': [1, 2]},
+        ])
+        self.assertEqual([{'id': 1, 'jsonrpc': '2.0', 'result': 3}], json.loads(response.body))
+        self.assertEqual([1], calls)
+        # no response at all to a batch of notifications
+        response = self.handle([{'method': 'notify', 'params': [2]}])
+        self.assertEqual((204, None), (response.status, response.body))
+        self.assertEqual([1, 2], calls)
+
+    def test_batch_concurrency(self):
+        running = []
+        max_running = 0
+        async def slow():
+            nonlocal max_running
+            running.append(1)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+        self.server.register_method(slow)
+        response = self.handle([{'id': i, 'method': 'slow'} for i in range(20)])
+        self.assertEqual(list(range(20)), [r['id'] for r in json.loads(response.body)])
+        self.assertEqual(daemon.JSONRPC_BATCH_CONCURRENCY, max_running)
+
+    def test_invalid_credentials(self):
+        self.server.rpc_password = 'secret'
+        response = self.handle({'id': 1, 'method': 'add', 'params': [1, 2]})
+        self.assertEqual(401, response.status)
+        response = self.handle({'id': 1, 'method': 'add', 'params': [1, 2]},
+                               headers={'Authorization': 'Basic dXNlcjp3cm9uZw=='})  # user:wrong
+        self.assertEqual(403, response.status)
+        response = self.handle({'id': 1, 'method': 'add', 'params': [1, 2]},
+                               headers={'Authorization': 'Basic dXNlcjpzZWNyZXQ='})  # user:secret
+        self.assertEqual(3, json.loads(response.body)['result'])
+
+
+class FakeWallet:
+
+    def __init__(self, requests, *, exp=3600):
+        self.requests = requests
+        self.exp = exp
+
+    def get_request(self, key):
+        if key in self.requests:
+            return SimpleNamespace(time=int(time.time()), exp=self.exp)
+
+    def get_request_status(self, key):
+        return self.requests[key]
+
+
+class FakeDaemon:
+
+    def __init__(self, config, wallets):
+        self.config = config
+        self.wallets = wallets
+
+    def find_request_wallet_path(self, key):
+        for path, wallet in enumerate(self.wallets):
+            if wallet.get_request(key):
+                return path
+
+    async def wake_wallet(self, path):
+        pass
+
+    def get_wallet(self, path):
+        return self.wallets[path or 0]
+
+
+class TestPayServer(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'payserver_max_connections': 1})
+        self.wallets = [FakeWallet({'a': PR_UNPAID}), FakeWallet({'b': PR_UNPAID})]
+        self.server = PayServer(FakeDaemon(self.config, self.wallets), None)
+        # the static files are not part of the source tree
+        static = web.static
+        patcher = mock.patch.object(web, 'static', lambda prefix, path: static(prefix, self.electrum_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        util.unregister_callback(self.server.on_request_status)
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    def test_events(self):
+        async def read_event(response):
+            lines = []
+            while not lines or lines[-1] != b'\n':
+                lines.append(await response.content.readline())
+            return json.loads(lines[1][len(b'data: '):])
+
+        async def f():
+            async with TestClient(TestServer(self.server.make_app())) as client:
+                response = await client.get('/api/events', params=[('key', 'a'), ('key', 'b'), ('key', 'c')])
+                self.assertEqual('text/event-stream', response.headers['Content-Type'])
+                events = [await read_event(response) for i in range(3)]
+                self.assertEqual([('a', PR_UNPAID), ('b', PR_UNPAID), ('c', PR_UNKNOWN)],
+                                 [(event['key'], event['status']) for event in events])
+                # a second stream is over the connection limit
+                self.assertEqual(503, (await client.get('/api/events', params={'key': 'a'})).status)
+                util.trigger_callback('request_status', self.wallets[1], 'b', PR_PAID)
+                self.assertEqual({'key': 'b', 'status': PR_PAID, 'status_str': 'Paid'}, await read_event(response))
+                response.close()
+            self.assertEqual(0, self.server.num_streams)
+            self.assertEqual({}, self.server._status_queues)
+
+        asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result(timeout=10)
+
+    def test_events_expiry_is_checked_on_a_timer(self):
+        self.wallets[1].exp = 1
+
+        async def f():
+            async with TestClient(TestServer(self.server.make_app())) as client:
+                response = await client.get('/api/events', params=[('key', 'a'), ('key', 'b')])
+                t0 = time.monotonic()
+                # events keep coming, more often than the expiry checks
+                while time.monotonic() - t0 < 2:
+                    util.trigger_callback('request_status', self.wallets[0], 'a', PR_UNPAID)
+                    await asyncio.sleep(0.01)
+                data = await response.content.read(4096)
+                response.close()
+            self.assertIn(b'"key": "b", "status": %d' % PR_EXPIRED, data)
+            self.assertNotIn(b'"key": "a", "status": %d' % PR_EXPIRED, data)
+
+        with mock.patch.object(daemon, 'PAYSERVER_HEARTBEAT_INTERVAL', 0.1):
+            asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result(timeout=10)
+
+    def test_events_invalid_keys(self):
+        async def f():
+            async with TestClient(TestServer(self.server.make_app())) as client:
+                self.assertEqual(400, (await client.get('/api/events')).status)
+        asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result(timeout=10)
+
+
+class TestDaemon(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path, 'offline': True})
+        self.daemon = Daemon(self.config, listen_jsonrpc=False)
+
+    def tearDown(self):
+        self.daemon.command_executor.shutdown()
+        asyncio.run_coroutine_threadsafe(self.daemon.taskgroup.cancel_remaining(), self.asyncio_loop).result()
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_commands_run_in_worker_threads(self, mock_save_db):
+        w = restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                     gap_limit=2,
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     config=self.config)['wallet']
+        cmds = Commands(config=self.config, daemon=self.daemon)
+        threads = []
+        def get_balance():
+            threads.append(threading.current_thread().name)
+            return 0, 0, 0
+        with mock.patch.object(w, 'get_balance', get_balance):
+            self.assertEqual({'confirmed': '0'}, cmds._run('getbalance', (), wallet=w))
+            # commands not marked as blocking run on the event loop
+            self.assertEqual(w.get_addresses()[0], cmds._run('getunusedaddress', (), wallet=w))
+        self.assertEqual(1, len(threads))
+        self.assertTrue(threads[0].startswith('CommandWorker'))
+
+    def test_run_in_worker_raises_if_command_suspends(self):
+        async def suspends():
+            await asyncio.sleep(0)
+        fut = asyncio.run_coroutine_threadsafe(self.daemon.run_in_worker(suspends), self.asyncio_loop)
+        with self.assertRaises(Exception):
+            fut.result()
+
+    def _test_hibernation(self, password):
+        path = os.path.join(self.electrum_path, 'wallet')
+        restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                 gap_limit=2, path=path, password=password, config=self.config)
+        w = self.daemon.load_wallet(path, password)
+        w.set_label(w.get_addresses()[0], 'label')
+        self.daemon.hibernate_after = 3600
+        self.daemon.hibernate_idle_wallets()
+        self.assertEqual([path], list(self.daemon.get_wallets()))
+        self.daemon._wallet_last_used[path] -= 3600
+        self.daemon.hibernate_idle_wallets()
+        self.assertEqual({}, self.daemon.get_wallets())
+        self.assertEqual([path], self.daemon.get_hibernated_wallets())
+        # the next command wakes the wallet up
+        w2 = self.daemon.get_wallet(path)
+        self.assertIsNot(w, w2)
+        self.assertEqual(w.get_addresses(), w2.get_addresses())
+        self.assertEqual('label', w2.get_label(w.get_addresses()[0]))
+        self.assertEqual(bool(password), w2.storage.is_encrypted())
+        self.assertEqual([], self.daemon.get_hibernated_wallets())
+        # and can still be saved
+        w2.set_label(w.get_addresses()[0], 'new label')
+        self.daemon.stop_wallet(path)
+        self.assertEqual('new label', self.daemon.load_wallet(path, password).get_label(w.get_addresses()[0]))
+
+    def test_hibernation(self):
+        self._test_hibernation(None)
+
+    def test_hibernation_encrypted(self):
+        self._test_hibernation('secret')
+
+    def test_hibernated_wallet_wakes_up_on_activity(self):
+        class MockNetwork:
+            asyncio_loop = self.asyncio_loop
+            interface = None
+        self.daemon.hibernation_watcher = HibernationWatcher(MockNetwork(), self.daemon._on_hibernated_wallet_activity)
+        self.addCleanup(util.unregister_callback, self.daemon.hibernation_watcher._restart)
+        path = standardize_path(os.path.join(self.electrum_path, 'wallet'))
+        restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                 gap_limit=2, path=path, config=self.config)
+        w = self.daemon.load_wallet(path, None)
+        addr = w.get_addresses()[0]
+        threads = []
+        read_hibernated_wallet = Daemon._read_hibernated_wallet
+        def read_in_thread(*args):
+            threads.append(threading.current_thread())
+            return read_hibernated_wallet(*args)
+
+        async def f():
+            self.daemon.hibernate_wallet(path)
+            self.assertEqual([path], self.daemon.get_hibernated_wallets())
+            await self.daemon.hibernation_watcher._on_address_status(addr, None)
+            # an unchanged status does not wake the wallet up
+            await asyncio.sleep(0.01)
+            self.assertEqual([path], self.daemon.get_hibernated_wallets())
+            await self.daemon.hibernation_watcher._on_address_status(addr, 'new status')
+            while path not in self.daemon.get_wallets():
+                await asyncio.sleep(0.01)
+        with mock.patch.object(Daemon, '_read_hibernated_wallet', staticmethod(read_in_thread)):
+            asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result(timeout=10)
+        self.assertEqual([], self.daemon.get_hibernated_wallets())
+        self.assertEqual({}, self.daemon.hibernation_watcher.watched_addresses)
+        self.assertIsNot(w, self.daemon.get_wallet(path))
+        # the wallet was read in a thread, not on the event loop
+        self.assertEqual(1, len(threads))
+        self.assertNotIn(threads[0], (self._loop_thread, threading.current_thread()))
+
+    def test_pay_server_wallet_is_not_hibernated(self):
+        path = standardize_path(os.path.join(self.electrum_path, 'wallet'))
+        restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                 gap_limit=2, path=path, config=self.config)
+        w = self.daemon.load_wallet(path, None)
+        self.assertTrue(self.daemon.can_hibernate(w))
+        self.config.set_key('payserver_wallet', path)
+        self.daemon.pay_server = PayServer(self.daemon, None)
+        self.addCleanup(util.unregister_callback, self.daemon.pay_server.on_request_status)
+        self.assertFalse(self.daemon.can_hibernate(w))
+
+    def test_request_index_includes_hibernated_wallets(self):
+        path = standardize_path(os.path.join(self.electrum_path, 'wallet'))
+        restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                 gap_limit=2, path=path, config=self.config)
+        w = self.daemon.load_wallet(path, None)
+        addr = w.get_addresses()[0]
+        self.assertIsNone(self.daemon.find_request_wallet_path(addr))
+        # a request created after the wallet was loaded
+        w.add_payment_request(w.make_payment_request(addr, 1000, 'test', 3600))
+        self.assertEqual(path, self.daemon.find_request_wallet_path(addr))
+        self.daemon.hibernate_wallet(path)
+        self.assertEqual(path, self.daemon.find_request_wallet_path(addr))
+        self.daemon.stop_wallet(path)
+        self.assertIsNone(self.daemon.find_request_wallet_path(addr))
+
+    def test_stop_saves_queued_webhooks(self):
+        cmds = Commands(config=self.config, daemon=self.daemon)
+        cmds._notifier = mock.Mock(stop=mock.AsyncMock())
+        self.daemon.commands_server = mock.Mock(cmd_runner=cmds)
+        # the daemon was not locked, there is no lockfile
+        with mock.patch.object(daemon, 'remove_lockfile'):
+            self.daemon.on_stop()
+        cmds._notifier.stop.assert_awaited_once()
+
+    def test_delete_wallet_removes_htlc_archive(self):
+        path = os.path.join(self.electrum_path, 'wallet')
+        restore_wallet_from_text('xpub6CCWFbvCbqF92kGwm9nV7t7RvVoQUKaq5USMdyVP6jvv1NgN52KAX6NNYCeE8Ca7JQC4K5tZcnQrubQcjJ6iixfPs4pwAQJAQgTt6hBjg11',
+                                 gap_limit=2, path=path, config=self.config)
+        self.daemon.load_wallet(path, None)
+        archive_dir = LNWallet.get_htlc_archive_dir(path)
+        os.makedirs(archive_dir)
+        with open(os.path.join(archive_dir, '00' * 32), 'w') as f:
+            f.write('[]\n')
+        self.assertTrue(self.daemon.delete_wallet(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(archive_dir))
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+
+from electrum import instrumentation
+
+from . import ElectrumTestCase
+
+
+class TestInstrumentation(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        instrumentation.reset()
+        instrumentation.set_enabled(True)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        instrumentation.set_enabled(False)
+        instrumentation.reset()
+        super().tearDown()
+
+    def test_disabled(self):
+        instrumentation.set_enabled(False)
+        with instrumentation.span('a'):
+            pass
+        instrumentation.count('b')
+        self.assertEqual({'enabled': False, 'spans': {}, 'counters': {}}, instrumentation.get_stats())
+
+    def test_spans_and_counters(self):
+        for i in range(100):
+            instrumentation.record_span('a', i / 1000)
+        with instrumentation.span('b'):
+            pass
+        instrumentation.count('c')
+        instrumentation.count('c', 5)
+        stats = instrumentation.get_stats(reset=True)
+        span_a = stats['spans']['a']
+        self.assertEqual(100, span_a['count'])
+        self.assertAlmostEqual(0.0495, span_a['mean'])
+        self.assertEqual(0.099, span_a['max'])
+        self.assertEqual(0.05, span_a['p50'])
+        self.assertEqual(0.09, span_a['p90'])
+        self.assertEqual(0.099, span_a['p99'])
+        self.assertEqual(1, stats['spans']['b']['count'])
+        self.assertEqual({'c': 6}, stats['counters'])
+        # reset
+        self.assertEqual({'enabled': True, 'spans': {}, 'counters': {}}, instrumentation.get_stats())
+
+    def test_traced(self):
+        @instrumentation.traced('f')
+        def f(x):
+            return x + 1
+
+        @instrumentation.traced('g')
+        async def g(x):
+            return x + 2
+
+        self.assertEqual(2, f(1))
+        self.assertEqual(3, self.loop.run_until_complete(g(1)))
+        instrumentation.set_enabled(False)
+        self.assertEqual(2, f(1))
+        spans = instrumentation.get_stats()['spans']
+        self.assertEqual(1, spans['f']['count'])
+        self.assertEqual(1, spans['g']['count'])
+
+    def test_sampling_profiler(self):
+        path = os.path.join(self.electrum_path, 'stacks.txt')
+        instrumentation.start_sampling(path, interval=0.001)
+        with self.assertRaises(Exception):
+            instrumentation.start_sampling(path)
+        t0 = time.time()
+        while time.time() - t0 < 0.1:
+            pass
+        num_samples = instrumentation.stop_sampling()
+        self.assertIsNone(instrumentation.stop_sampling())
+        self.assertGreater(num_samples, 0)
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(num_samples, sum(int(line.rsplit(' ', 1)[1]) for line in lines))
+        self.assertTrue(any('test_instrumentation.py:test_sampling_profiler' in line for line in lines))
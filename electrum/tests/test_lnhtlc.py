@@ -1,9 +1,10 @@
 from pprint import pprint
+import os
 import unittest
 from typing import NamedTuple
 
-from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction
-from electrum.lnhtlc import HTLCManager
+from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction, UpdateAddHtlc
+from electrum.lnhtlc import HTLCManager, HTLCArchive
 from electrum.json_db import StoredDict
 
 from . import ElectrumTestCase
@@ -12,6 +13,38 @@ class H(NamedTuple):
     owner : str
     htlc_id : int
 
+def make_htlc(htlc_id: int, amount_msat: int) -> UpdateAddHtlc:
+    return UpdateAddHtlc(amount_msat=amount_msat, payment_hash=bytes([amount_msat % 256]) * 32,
+                         cltv_expiry=500 + htlc_id, timestamp=1600000000 + htlc_id, htlc_id=htlc_id)
+
+def sign_both_ways_(A: HTLCManager, B: HTLCManager):
+    A.send_ctx()
+    B.recv_ctx()
+    B.send_rev()
+    A.recv_rev()
+    B.send_ctx()
+    A.recv_ctx()
+    A.send_rev()
+    B.recv_rev()
+
+def add_and_remove_htlcs(A: HTLCManager, B: HTLCManager, htlc_ids):
+    """Both sides add an htlc, and the other side settles (even ids) or fails (odd ids) it."""
+    for i in htlc_ids:
+        B.recv_htlc(A.send_htlc(make_htlc(i, 1000 * (i + 1))))
+        A.recv_htlc(B.send_htlc(make_htlc(i, 10 * (i + 1))))
+        sign_both_ways_(A, B)
+        if i % 2 == 0:
+            B.send_settle(i)
+            A.recv_settle(i)
+            B.recv_settle(i)
+            A.send_settle(i)
+        else:
+            B.send_fail(i)
+            A.recv_fail(i)
+            A.send_fail(i)
+            B.recv_fail(i)
+        sign_both_ways_(A, B)
+
 class TestHTLCManager(ElectrumTestCase):
     def test_adding_htlcs_race(self):
         A = HTLCManager(StoredDict({}, None, []))
@@ -246,3 +279,191 @@ class TestHTLCManager(ElectrumTestCase):
         B.send_rev()
         A.recv_rev()
         self.assertEqual({2: [b"upd_msg2"]}, A.get_unacked_local_updates())
+
+    def test_queries_at_old_ctns_match_full_log(self):
+        A = HTLCManager(StoredDict({}, None, []))
+        B = HTLCManager(StoredDict({}, None, []))
+        A.channel_open_finished()
+        B.channel_open_finished()
+        add_and_remove_htlcs(A, B, range(6))
+
+        def check(hm: HTLCManager):
+            for ctx_owner in (LOCAL, REMOTE):
+                for ctn in range(hm.ctn_latest(ctx_owner) + 1):
+                    for direction in (SENT, RECEIVED):
+                        party = ctx_owner if direction == SENT else ctx_owner.inverted()
+                        expected = {int(htlc_id): htlc for htlc_id, htlc in hm.log[party]['adds'].items()
+                                    if hm.is_htlc_active_at_ctn(ctx_owner=ctx_owner, ctn=ctn,
+                                                                htlc_proposer=party, htlc_id=htlc_id)}
+                        self.assertEqual(expected, hm.htlcs_by_direction(ctx_owner, direction, ctn))
+                        settled = [hm.log[party]['adds'][htlc_id]
+                                   for htlc_id, ctns in hm.log[party]['settles'].items()
+                                   if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn]
+                        self.assertEqual(sorted(settled), sorted(hm.all_settled_htlcs_ever_by_direction(ctx_owner, direction, ctn)))
+                        self.assertEqual(sum(htlc.amount_msat for htlc in settled),
+                                         hm.get_settled_amount_msat_by_direction(ctx_owner, direction, ctn))
+                    balance = 10**9
+                    balance -= sum(hm.log[LOCAL]['adds'][htlc_id].amount_msat
+                                   for htlc_id, ctns in hm.log[LOCAL]['settles'].items()
+                                   if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn)
+                    balance += sum(hm.log[REMOTE]['adds'][htlc_id].amount_msat
+                                   for htlc_id, ctns in hm.log[REMOTE]['settles'].items()
+                                   if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn)
+                    self.assertEqual(balance, hm.get_balance_msat(LOCAL, ctx_owner=ctx_owner, ctn=ctn,
+                                                                  initial_balance_msat=10**9))
+
+        check(A)
+        check(B)
+        # caches rebuilt from the log agree as well
+        check(HTLCManager(A.log))
+        self.assertEqual(6, len(A.all_settled_htlcs_ever(LOCAL)))
+        self.assertEqual(6, len(A.all_settled_htlcs_ever(REMOTE)))
+
+        # unsigned remote updates get discarded from the caches too
+        B.recv_htlc(A.send_htlc(make_htlc(6, 7000)))
+        sign_both_ways_(A, B)
+        A.recv_htlc(B.send_htlc(make_htlc(6, 70)))
+        A.recv_settle(6)
+        A.discard_unsigned_remote_updates()
+        self.assertEqual(6, A.get_next_htlc_id(REMOTE))
+        self.assertEqual({}, A.log[LOCAL]['settles'].get(6, {}))
+        check(A)
+        check(HTLCManager(A.log))
+
+    def test_archive_removed_htlcs(self):
+        A = HTLCManager(StoredDict({}, None, []), archive=HTLCArchive(os.path.join(self.electrum_path, 'archive', 'A')))
+        B = HTLCManager(StoredDict({}, None, []))
+        A.channel_open_finished()
+        B.channel_open_finished()
+        add_and_remove_htlcs(A, B, range(6))
+        # still in flight
+        B.recv_htlc(A.send_htlc(make_htlc(6, 7000)))
+        sign_both_ways_(A, B)
+
+        def snapshot(hm: HTLCManager):
+            d = {}
+            for ctx_owner in (LOCAL, REMOTE):
+                for ctn in range(hm.ctn_latest(ctx_owner) + 2):
+                    d[(ctx_owner, ctn)] = (
+                        hm.htlcs_by_direction(ctx_owner, SENT, ctn),
+                        hm.htlcs_by_direction(ctx_owner, RECEIVED, ctn),
+                        hm.get_balance_msat(LOCAL, ctx_owner=ctx_owner, ctn=ctn, initial_balance_msat=10**9),
+                        hm.get_settled_amount_msat_by_direction(ctx_owner, SENT, ctn),
+                        sorted(hm.all_settled_htlcs_ever(ctx_owner, ctn)),
+                        sorted(hm._get_htlcs_that_got_removed_exactly_at_ctn(
+                            ctn, ctx_owner=ctx_owner, htlc_proposer=LOCAL, log_action='fails')),
+                    )
+            d['all'] = sorted(hm.all_htlcs_ever())
+            d['status'] = [(hm.was_htlc_preimage_released(htlc_id=i, htlc_proposer=sub),
+                            hm.was_htlc_failed(htlc_id=i, htlc_proposer=sub))
+                           for sub in (LOCAL, REMOTE) for i in range(7)]
+            return d
+
+        before = snapshot(A)
+        settles_version = A.get_settles_version()
+        # not enough htlcs to archive
+        self.assertEqual({LOCAL: [], REMOTE: []}, A.archive_removed_htlcs(min_htlcs=13))
+        archived = A.archive_removed_htlcs(min_htlcs=12)
+        self.assertEqual(list(range(6)), sorted(archived[LOCAL]))
+        self.assertEqual(list(range(6)), sorted(archived[REMOTE]))
+        self.assertEqual([6], [int(htlc_id) for htlc_id in A.log[LOCAL]['adds']])
+        self.assertEqual(0, len(A.log[REMOTE]['adds']))
+        self.assertEqual(before, snapshot(A))
+        self.assertEqual(settles_version, A.get_settles_version())
+        # archive is read lazily after a restart
+        A2 = HTLCManager(A.log, archive=HTLCArchive(A.archive.path))
+        self.assertEqual(before, snapshot(A2))
+        # duplicate records (e.g. wallet file not saved after archiving) are ignored
+        A.archive.append([[1, 'settles', 1, '00' * 32, 0, 0, 0, 0, 0, 0, 0]])
+        self.assertEqual(before, snapshot(HTLCManager(A.log, archive=HTLCArchive(A.archive.path))))
+        # the channel keeps working
+        A.recv_settle(6)
+        B.send_settle(6)
+        sign_both_ways_(A, B)
+        self.assertEqual(10**9 - 1000 - 3000 - 5000 - 7000 + 10 + 30 + 50,
+                         A.get_balance_msat(LOCAL, initial_balance_msat=10**9))
+
+    def test_archive_not_saved_in_wallet_file(self):
+        path = os.path.join(self.electrum_path, 'archive', 'A')
+
+        def make_channel(archive):
+            A = HTLCManager(StoredDict({}, None, []), archive=archive)
+            B = HTLCManager(StoredDict({}, None, []))
+            A.channel_open_finished()
+            B.channel_open_finished()
+            add_and_remove_htlcs(A, B, range(4))
+            return A
+        A = make_channel(HTLCArchive(path))
+        # same channel, as saved in the wallet file before archiving
+        saved_log = make_channel(None).log
+        expected = sorted(A.all_htlcs_ever())
+        settled = sorted(A.all_settled_htlcs_ever(LOCAL))
+        balance = A.get_balance_msat(LOCAL, initial_balance_msat=10**9)
+        num_archived = sum(map(len, A.archive_removed_htlcs().values()))
+        self.assertTrue(num_archived)
+        # we crashed before the wallet file got saved
+        A2 = HTLCManager(saved_log, archive=HTLCArchive(path))
+        self.assertEqual(8, len(A2.log[LOCAL]['adds']) + len(A2.log[REMOTE]['adds']))
+        self.assertEqual(expected, sorted(A2.all_htlcs_ever()))
+        self.assertEqual([], list(A2.archive.iter_htlcs()))
+        self.assertEqual([], A2.archive.settled_htlcs())
+        for ctn in range(A2.ctn_latest(LOCAL) + 1):
+            self.assertEqual(A.all_settled_htlcs_ever(LOCAL, ctn), A2.all_settled_htlcs_ever(LOCAL, ctn))
+            self.assertEqual(A.get_balance_msat(LOCAL, ctn=ctn, initial_balance_msat=10**9),
+                             A2.get_balance_msat(LOCAL, ctn=ctn, initial_balance_msat=10**9))
+        # the htlcs get archived again
+        self.assertEqual(num_archived, sum(map(len, A2.archive_removed_htlcs().values())))
+        self.assertEqual(expected, sorted(A2.all_htlcs_ever()))
+        self.assertEqual(sorted(A.archive.settled_htlcs()), sorted(A2.archive.settled_htlcs()))
+        A3 = HTLCManager(A2.log, archive=HTLCArchive(path))
+        self.assertEqual(expected, sorted(A3.all_htlcs_ever()))
+        self.assertEqual(settled, sorted(A3.all_settled_htlcs_ever(LOCAL)))
+        self.assertEqual(balance, A3.get_balance_msat(LOCAL, initial_balance_msat=10**9))
+
+    def test_archive_encryption(self):
+        path = os.path.join(self.electrum_path, 'archive', 'A')
+        keys = {'k1': os.urandom(32), 'k2': os.urandom(32)}
+        A = HTLCManager(StoredDict({}, None, []), archive=HTLCArchive(path, keys=keys, key_id='k1'))
+        B = HTLCManager(StoredDict({}, None, []))
+        A.channel_open_finished()
+        B.channel_open_finished()
+        add_and_remove_htlcs(A, B, range(4))
+        expected = sorted(A.all_htlcs_ever())
+        num_archived = sum(map(len, A.archive_removed_htlcs().values()))
+        self.assertEqual(expected, sorted(A.all_htlcs_ever()))
+
+        def lines():
+            with open(path, 'r', encoding='utf-8') as f:
+                return [line[:3] for line in f]
+        self.assertEqual(['k1:'] * num_archived, lines())
+        # re-encrypted with a new key; the old one is no longer needed
+        A.archive.reencrypt(keys, 'k2')
+        self.assertEqual(['k2:'] * num_archived, lines())
+        A2 = HTLCManager(A.log, archive=HTLCArchive(path, keys={'k2': keys['k2']}, key_id='k2'))
+        self.assertEqual(expected, sorted(A2.all_htlcs_ever()))
+        self.assertEqual([], list(HTLCArchive(path, keys={'k1': keys['k1']}).iter_records()))
+        # storage encryption disabled
+        A.archive.reencrypt(keys, None)
+        self.assertTrue(all(line.startswith('[') for line in lines()))
+        self.assertEqual(expected, sorted(HTLCManager(A.log, archive=HTLCArchive(path)).all_htlcs_ever()))
+        self.assertEqual([(REMOTE, 0), (REMOTE, 2), (LOCAL, 0), (LOCAL, 2)],
+                         sorted((proposer, htlc.htlc_id) for proposer, htlc in A.archive.settled_htlcs()))
+
+    def test_settles_version(self):
+        A = HTLCManager(StoredDict({}, None, []))
+        B = HTLCManager(StoredDict({}, None, []))
+        A.channel_open_finished()
+        B.channel_open_finished()
+        versions = {A.get_settles_version()}
+        add_and_remove_htlcs(A, B, range(2))
+        self.assertNotIn(A.get_settles_version(), versions)
+        versions.add(A.get_settles_version())
+        B.recv_htlc(A.send_htlc(make_htlc(2, 3000)))
+        sign_both_ways_(A, B)
+        A.recv_settle(2)
+        self.assertNotIn(A.get_settles_version(), versions)
+        versions.add(A.get_settles_version())
+        # the remote did not sign their settle
+        A.discard_unsigned_remote_updates()
+        self.assertFalse(A.was_htlc_preimage_released(htlc_id=2, htlc_proposer=LOCAL))
+        self.assertNotIn(A.get_settles_version(), versions)
@@ -383,3 +383,41 @@ class TestLNMsg(TestCaseForTestnet):
                                   {'chains': b'CI\x7f\xd7\xf8&\x95q\x08\xf4\xa3\x0f\xd9\xce\xc3\xae\xbay\x97 \x84\xe9\x0e\xad\x01\xea3\t\x00\x00\x00\x00'}
                           }}),
                          decode_msg(bfh("001000022200000302aaa2012043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea330900000000")))
+
+    def test_encode_decode_msg__reply_channel_range(self):
+        # "reply_channel_range" mixes fixed-size fields, a field sized by an earlier field,
+        # and a TLV stream with "..." sized fields.
+        chain_hash = bytes(range(32))
+        msg = encode_msg(
+            "reply_channel_range",
+            chain_hash=chain_hash,
+            first_blocknum=600_000,
+            number_of_blocks=1000,
+            complete=1,
+            len=3,
+            encoded_short_ids=b'\x00\x01\x02',
+            reply_channel_range_tlvs={
+                'timestamps_tlv': {'encoding_type': 0, 'encoded_timestamps': b'\xaa' * 8},
+                'checksums_tlv': {'checksums': b'\xbb' * 8},
+            })
+        self.assertEqual(bfh("0108") + chain_hash + bfh("000927c0000003e8010003000102010900aaaaaaaaaaaaaaaa0308bbbbbbbbbbbbbbbb"),
+                         msg)
+        self.assertEqual(('reply_channel_range',
+                          {'chain_hash': chain_hash,
+                           'first_blocknum': 600_000,
+                           'number_of_blocks': 1000,
+                           'complete': b'\x01',
+                           'len': 3,
+                           'encoded_short_ids': b'\x00\x01\x02',
+                           'reply_channel_range_tlvs': {
+                               'timestamps_tlv': {'encoding_type': 0, 'encoded_timestamps': b'\xaa' * 8},
+                               'checksums_tlv': {'checksums': b'\xbb' * 8}}}),
+                         decode_msg(msg))
+        # "encoded_short_ids" is shorter than "len"
+        with self.assertRaises(UnexpectedEndOfStream):
+            decode_msg(msg[:2 + 32 + 4 + 4 + 1 + 2 + 2])
+        with self.assertRaises(UnexpectedFieldSizeForEncoder):
+            encode_msg("reply_channel_range", len=3, encoded_short_ids=b'\x00\x01')
+        # unknown even TLV record in the message
+        with self.assertRaises(UnknownMandatoryTLVRecordType):
+            decode_msg(msg[:2 + 32 + 4 + 4 + 1 + 2 + 3] + bfh("0200"))
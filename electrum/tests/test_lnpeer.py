@@ -5,6 +5,7 @@ import os
 from contextlib import contextmanager
 from collections import defaultdict
 import logging
+import threading
 import concurrent
 from concurrent import futures
 import unittest
@@ -14,23 +15,24 @@ from aiorpcx import TaskGroup
 
 from electrum import constants
 from electrum.network import Network
-from electrum.ecc import ECPrivkey
+from electrum.ecc import ECPrivkey, sig_string_from_r_and_s
 from electrum import simple_config, lnutil
 from electrum.lnaddr import lnencode, LnAddr, lndecode
 from electrum.bitcoin import COIN, sha256
+from electrum.crypto import sha256d
 from electrum.util import bh2u, create_and_start_event_loop, NetworkRetryManager
-from electrum.lnpeer import Peer
+from electrum.lnpeer import Peer, verify_node_announcement
 from electrum.lnutil import LNPeerAddr, Keypair, privkey_to_pubkey
 from electrum.lnutil import LightningPeerConnectionClosed, RemoteMisbehaving
 from electrum.lnutil import PaymentFailure, LnFeatures, HTLCOwner
 from electrum.lnchannel import ChannelState, PeerState, Channel
 from electrum.lnrouter import LNPathFinder, PathEdge, LNPathInconsistent
 from electrum.channel_db import ChannelDB
-from electrum.lnworker import LNWallet, NoPathFound
+from electrum.lnworker import LNWallet, LNGossip, NoPathFound
 from electrum.lnmsg import encode_msg, decode_msg
 from electrum.logging import console_stderr_handler, Logger
 from electrum.lnworker import PaymentInfo, RECEIVED, PR_UNPAID
-from electrum.lnonion import OnionFailureCode
+from electrum.lnonion import OnionFailureCode, ProcessedOnionCache
 
 from .test_lnchannel import create_test_channels
 from .test_bitcoin import needs_test_with_all_chacha20_implementations
@@ -122,6 +124,9 @@ class MockLNWallet(Logger, NetworkRetryManager[LNPeerAddr]):
         self.features = LnFeatures(0)
         self.features |= LnFeatures.OPTION_DATA_LOSS_PROTECT_OPT
         self.pending_payments = defaultdict(asyncio.Future)
+        self.processed_onions = ProcessedOnionCache()
+        self._history_lock = threading.RLock()
+        self._dirty_payment_hashes = set()
         for chan in chans:
             chan.lnworker = self
         self._peers = {}  # bytes -> Peer
@@ -166,10 +171,13 @@ class MockLNWallet(Logger, NetworkRetryManager[LNPeerAddr]):
     await_payment = LNWallet.await_payment
     payment_received = LNWallet.payment_received
     payment_sent = LNWallet.payment_sent
+    _mark_payment_dirty = LNWallet._mark_payment_dirty
     payment_failed = LNWallet.payment_failed
     save_preimage = LNWallet.save_preimage
     get_preimage = LNWallet.get_preimage
     _create_route_from_invoice = LNWallet._create_route_from_invoice
+    _is_candidate_route_usable = LNWallet._is_candidate_route_usable
+    _find_alternative_route = LNWallet._find_alternative_route
     _check_invoice = staticmethod(LNWallet._check_invoice)
     _pay_to_route = LNWallet._pay_to_route
     _pay = LNWallet._pay
@@ -195,6 +203,9 @@ class MockTransport:
         while True:
             yield await self.queue.get()
 
+    async def drain(self):
+        pass
+
 class NoFeaturesTransport(MockTransport):
     """
     This answers the init message with a init that doesn't signal any features.
@@ -629,5 +640,42 @@ class TestPeer(ElectrumTestCase):
             run(f())
 
 
+    def test_gossip_ingestion_dedupes_and_verifies(self):
+        class MockGossipPeer:
+            def __init__(self):
+                self.logger = Logger().logger
+                self.closed = False
+            def close_and_cleanup(self):
+                self.closed = True
+        privkey = ECPrivkey.generate_random_key()
+        def node_announcement(timestamp, *, sign=True):
+            raw = encode_msg('node_announcement', flen=0, timestamp=timestamp,
+                             node_id=privkey.get_public_key_bytes(compressed=True),
+                             rgb_color=b'\x00' * 3, alias=b'\x00' * 32, addrlen=0)
+            if sign:
+                sig = privkey.sign(sha256d(raw[66:]), sig_string_from_r_and_s)
+                raw = raw[:2] + sig + raw[66:]
+            payload = decode_msg(raw)[1]
+            payload['raw'] = raw
+            return payload
+        async def f():
+            lngossip = LNGossip()
+            honest_peer, bad_peer = MockGossipPeer(), MockGossipPeer()
+            good, bad = node_announcement(1), node_announcement(2, sign=False)
+            lngossip.submit_gossip(honest_peer, 'node_announcement', good)
+            lngossip.submit_gossip(bad_peer, 'node_announcement', dict(good))
+            lngossip.submit_gossip(bad_peer, 'node_announcement', bad)
+            # the same message from the second peer was dropped
+            self.assertEqual(2, lngossip.gossip_queue.qsize())
+            msgs = [(peer, payload) for peer, name, payload in
+                    [lngossip.gossip_queue.get_nowait() for i in range(2)]]
+            verified = await lngossip._verify_gossip(msgs, verify_node_announcement)
+            self.assertEqual([(honest_peer, good)], verified)
+            self.assertFalse(honest_peer.closed)
+            self.assertTrue(bad_peer.closed)
+            lngossip._gossip_verifier.shutdown()
+        run(f())
+
+
 def run(coro):
     return asyncio.run_coroutine_threadsafe(coro, loop=asyncio.get_event_loop()).result()
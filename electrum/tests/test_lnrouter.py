@@ -6,11 +6,13 @@ import asyncio
 from electrum.util import bh2u, bfh, create_and_start_event_loop
 from electrum.lnonion import (OnionHopsDataSingle, new_onion_packet,
                               process_onion_packet, _decode_onion_error, decode_onion_error,
-                              OnionFailureCode, OnionPacket)
-from electrum import bitcoin, lnrouter
+                              OnionFailureCode, OnionPacket, ProcessedOnionCache, ReplayedOnion,
+                              InvalidOnionMac, OnionRoutingFailureMessage, construct_onion_error)
+from electrum import bitcoin, lnrouter, ecc
 from electrum.constants import BitcoinTestnet
 from electrum.simple_config import SimpleConfig
 from electrum.lnrouter import PathEdge
+from electrum.lnutil import ShortChannelID
 
 from . import TestCaseForTestnet
 from .test_bitcoin import needs_test_with_all_chacha20_implementations
@@ -92,11 +94,77 @@ class Test_LNRouter(TestCaseForTestnet):
         self.assertEqual(b'\x02bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb', route[0].node_id)
         self.assertEqual(bfh('0000000000000003'),                 route[0].short_channel_id)
 
+        # the routing graph snapshot picks up policy changes incrementally
+        cdb.add_channel_update({'short_channel_id': bfh('0000000000000003'), 'message_flags': b'\x00', 'channel_flags': b'\x02', 'cltv_expiry_delta': 10, 'htlc_minimum_msat': 250, 'fee_base_msat': 100, 'fee_proportional_millionths': 150, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 100})
+        self.assertIsNone(path_finder.find_path_for_payment(start_node, b'\x02eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee', 100000))
+        cdb.add_channel_update({'short_channel_id': bfh('0000000000000003'), 'message_flags': b'\x00', 'channel_flags': b'\x00', 'cltv_expiry_delta': 10, 'htlc_minimum_msat': 250, 'fee_base_msat': 100, 'fee_proportional_millionths': 150, 'chain_hash': BitcoinTestnet.rev_genesis_bytes(), 'timestamp': 200})
+        self.assertEqual(path, path_finder.find_path_for_payment(start_node, b'\x02eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee', 100000))
+        # per-node policy statistics follow the policies
+        node_policy_stats = cdb.get_node_policy_stats()
+        self.assertEqual(len(cdb.get_node_policies()), sum(stats.number_channels for stats in node_policy_stats.values()))
+        self.assertEqual(3, node_policy_stats[b'\x02bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb'].number_channels)
+        self.assertEqual({node_id for node_id, stats in node_policy_stats.items() if stats.number_channels >= 3},
+                         set(cdb.get_node_policy_stats(min_num_channels=3)))
+
+        # excluded channels are avoided
+        start_node, end_node = b'\x02bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb', b'\x02eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee'
+        self.assertEqual([PathEdge(node_id=end_node, short_channel_id=bfh('0000000000000002'))],
+                         path_finder.find_path_for_payment(start_node, end_node, 100000))
+        self.assertEqual([PathEdge(node_id=b'\x02cccccccccccccccccccccccccccccccc', short_channel_id=bfh('0000000000000001')),
+                          PathEdge(node_id=b'\x02dddddddddddddddddddddddddddddddd', short_channel_id=bfh('0000000000000004')),
+                          PathEdge(node_id=end_node, short_channel_id=bfh('0000000000000005')),
+                         ], path_finder.find_path_for_payment(start_node, end_node, 100000,
+                                                              excluded=[ShortChannelID(bfh('0000000000000002'))]))
+
         # need to duplicate tear_down here, as we also need to wait for the sql thread to stop
         self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
         self._loop_thread.join(timeout=1)
         cdb.sql_thread.join(timeout=1)
 
+    def test_channel_db_compact_records(self):
+        from electrum.channel_db import ChannelInfo, Policy, NodeInfo
+        ci = ChannelInfo(short_channel_id=ShortChannelID(bfh('0000000000000001')),
+                         node1_id=b'\x02' + 32 * b'b', node2_id=b'\x03' + 32 * b'c', capacity_sat=None)
+        self.assertEqual(ci, ChannelInfo.from_compact(ci.short_channel_id, ci.to_compact()))
+        for htlc_maximum_msat in (None, 0, 2**64 - 1):
+            policy = Policy(key=bfh('0000000000000001') + b'\x02' + 32 * b'b', cltv_expiry_delta=144,
+                            htlc_minimum_msat=1000, htlc_maximum_msat=htlc_maximum_msat,
+                            fee_base_msat=1000, fee_proportional_millionths=1, channel_flags=3,
+                            message_flags=1, timestamp=1600000000)
+            self.assertEqual(policy, Policy.from_compact(policy.key, policy.to_compact()))
+        for features, alias in ((0, ''), (1 << 17 | 1 << 7, 'alias \u26a1')):
+            node_info = NodeInfo(node_id=b'\x02' + 32 * b'b', features=features, timestamp=1600000000, alias=alias)
+            self.assertEqual(node_info, NodeInfo.from_compact(node_info.node_id, node_info.to_compact()))
+
+    def test_node_policy_stats(self):
+        from statistics import median
+        from electrum.channel_db import Policy, _NodePolicyAggregate, FLAG_DISABLE
+        def policy(block_height, htlc_maximum_msat, fee_proportional_millionths, disabled=False):
+            scid = ShortChannelID.from_components(block_height, 1, 0)
+            return Policy(key=scid + b'\x02' + 32 * b'b', cltv_expiry_delta=144,
+                          htlc_minimum_msat=1000, htlc_maximum_msat=htlc_maximum_msat,
+                          fee_base_msat=block_height % 7, fee_proportional_millionths=fee_proportional_millionths,
+                          channel_flags=FLAG_DISABLE if disabled else 0, message_flags=1, timestamp=1600000000)
+        policies = [policy(100 + i, 10**6 * (i % 5 + 1), (i * 37) % 11, disabled=(i % 4 == 0)) for i in range(20)]
+        aggregate = _NodePolicyAggregate()
+        for p in policies:
+            aggregate.add(p)
+        aggregate.add(policy(500, None, 1))
+        aggregate.remove(policy(500, None, 1))
+        aggregate.remove(policies[3])
+        policies.pop(3)
+        stats = aggregate.get_stats()
+        self.assertEqual(19, stats.number_channels)
+        self.assertEqual(0, stats.num_capacity_unknown)
+        self.assertEqual(5, stats.num_disabled)
+        self.assertEqual(sum(p.htlc_maximum_msat for p in policies), stats.total_capacity_msat)
+        self.assertEqual(median(p.htlc_maximum_msat for p in policies), stats.median_capacity_msat)
+        self.assertEqual(100, stats.min_block_height)
+        self.assertEqual(119, stats.max_block_height)
+        self.assertAlmostEqual(sum(p.short_channel_id.block_height for p in policies) / 19, stats.mean_block_height)
+        self.assertAlmostEqual(sum(p.fee_base_msat for p in policies) / 19, stats.mean_fee_base_msat)
+        self.assertEqual(median(p.fee_proportional_millionths for p in policies), stats.median_fee_proportional_millionths)
+
     @needs_test_with_all_chacha20_implementations
     def test_new_onion_packet_legacy(self):
         # test vector from bolt-04
@@ -306,3 +374,55 @@ class Test_LNRouter(TestCaseForTestnet):
         self.assertEqual(4, index_of_sender)
         self.assertEqual(OnionFailureCode.TEMPORARY_NODE_FAILURE, failure_msg.code)
         self.assertEqual(b'', failure_msg.data)
+
+    @needs_test_with_all_chacha20_implementations
+    def test_processed_onion_cache(self):
+        privkeys = [bytes([0x41 + i]) * 32 for i in range(3)]
+        pubkeys = [ecc.ECPrivkey(privkey).get_public_key_bytes() for privkey in privkeys]
+        hops_data = [
+            OnionHopsDataSingle(is_tlv_payload=True, payload={
+                "amt_to_forward": {"amt_to_forward": i},
+                "outgoing_cltv_value": {"outgoing_cltv_value": i},
+                "short_channel_id": {"short_channel_id": bytes([i]) * 8},
+            }) for i in range(3)]
+        associated_data = bytes(32)
+        packet1 = new_onion_packet(pubkeys, bfh('41' * 32), hops_data, associated_data)
+        packet2 = new_onion_packet(pubkeys, bfh('42' * 32), hops_data, associated_data)
+        cache = ProcessedOnionCache(max_size=1)
+        processed = cache.process_onion_packet(packet1, associated_data, privkeys[0], htlc_key=b'htlc1')
+        expected = process_onion_packet(packet1, associated_data, privkeys[0])
+        self.assertEqual(expected.hop_data.to_bytes(), processed.hop_data.to_bytes())
+        self.assertEqual(expected.next_packet.to_bytes(), processed.next_packet.to_bytes())
+        self.assertIs(processed, cache.process_onion_packet(packet1, associated_data, privkeys[0], htlc_key=b'htlc1'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # same onion in another htlc
+        with self.assertRaises(ReplayedOnion):
+            cache.process_onion_packet(packet1, associated_data, privkeys[0], htlc_key=b'htlc2')
+        # tampered onions are not served from the cache
+        with self.assertRaises(InvalidOnionMac):
+            cache.process_onion_packet(packet1, bytes([1]) * 32, privkeys[0], htlc_key=b'htlc1')
+        # bounded
+        cache.process_onion_packet(packet2, associated_data, privkeys[0], htlc_key=b'htlc2')
+        cache.process_onion_packet(packet1, associated_data, privkeys[0], htlc_key=b'htlc3')
+        self.assertEqual((1, 4), (cache.hits, cache.misses))
+
+    @needs_test_with_all_chacha20_implementations
+    def test_construct_onion_error_with_shared_secret(self):
+        privkeys = [bytes([0x41 + i]) * 32 for i in range(2)]
+        pubkeys = [ecc.ECPrivkey(privkey).get_public_key_bytes() for privkey in privkeys]
+        hops_data = [
+            OnionHopsDataSingle(is_tlv_payload=True, payload={
+                "amt_to_forward": {"amt_to_forward": i},
+                "outgoing_cltv_value": {"outgoing_cltv_value": i},
+                "short_channel_id": {"short_channel_id": bytes([i]) * 8},
+            }) for i in range(2)]
+        session_key = bfh('41' * 32)
+        packet = new_onion_packet(pubkeys, session_key, hops_data, bytes(32))
+        processed = process_onion_packet(packet, bytes(32), privkeys[0])
+        reason = OnionRoutingFailureMessage(code=OnionFailureCode.TEMPORARY_NODE_FAILURE, data=b'')
+        error_packet = construct_onion_error(reason, packet, privkeys[0])
+        self.assertEqual(error_packet, construct_onion_error(reason, packet, privkeys[0],
+                                                             shared_secret=processed.shared_secret))
+        failure_msg, index_of_sender = decode_onion_error(error_packet, pubkeys, session_key)
+        self.assertEqual(0, index_of_sender)
+        self.assertEqual(OnionFailureCode.TEMPORARY_NODE_FAILURE, failure_msg.code)
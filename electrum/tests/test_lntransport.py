@@ -70,3 +70,52 @@ class TestLNTransport(ElectrumTestCase):
         finally:
             server.close()
             loop.run_until_complete(server.wait_closed())
+
+    @needs_test_with_all_chacha20_implementations
+    def test_coalesced_writes_and_counters(self):
+        loop = asyncio.get_event_loop()
+        responder_key = ECPrivkey.generate_random_key()
+        initiator_key = ECPrivkey.generate_random_key()
+        messages = [bytes([i % 256]) * i for i in range(200)]
+        received = []
+        responder_done = asyncio.Event()
+        responder_transport = []
+        async def cb(reader, writer):
+            t = LNResponderTransport(responder_key.get_secret_bytes(), reader, writer)
+            await t.handshake()
+            responder_transport.append(t)
+            async for msg in t.read_messages():
+                received.append(msg)
+                if len(received) == len(messages):
+                    break
+            responder_done.set()
+        server_future = asyncio.ensure_future(asyncio.start_server(cb, '127.0.0.1', 42899))
+        loop.run_until_complete(server_future)
+        server = server_future.result()  # type: asyncio.Server
+        async def connect():
+            peer_addr = LNPeerAddr('127.0.0.1', 42899, responder_key.get_public_key_bytes())
+            t = LNTransport(initiator_key.get_secret_bytes(), peer_addr, proxy=None)
+            await t.handshake()
+            num_writes = 0
+            orig_write = t.writer.write
+            def write(data):
+                nonlocal num_writes
+                num_writes += 1
+                orig_write(data)
+            t.writer.write = write
+            for msg in messages:
+                t.send_bytes(msg)
+            await t.drain()
+            return t, num_writes
+        try:
+            t, num_writes = loop.run_until_complete(connect())
+            loop.run_until_complete(responder_done.wait())
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        self.assertEqual(messages, received)
+        self.assertEqual(1, num_writes)
+        self.assertEqual(len(messages), t.msgs_sent)
+        self.assertEqual(len(messages), responder_transport[0].msgs_received)
+        self.assertEqual(sum(len(msg) + 34 for msg in messages), t.bytes_sent)
+        self.assertEqual(t.bytes_sent, responder_transport[0].bytes_received)
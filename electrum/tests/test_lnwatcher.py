@@ -0,0 +1,160 @@
+import asyncio
+import os
+from collections import Counter
+
+from electrum.lnwatcher import LNWatcher, SweepStore
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop
+
+from . import ElectrumTestCase
+
+
+class MockNetwork:
+    def __init__(self, config, asyncio_loop=None):
+        self.config = config
+        self.asyncio_loop = asyncio_loop
+        self.height = 100
+
+    def get_local_height(self):
+        return self.height
+
+    def notify(self, key):
+        pass
+
+
+class MockSynchronizer:
+    def add(self, address):
+        pass
+
+
+class TestLNWatcher(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.network = MockNetwork(self.config)
+        self.watcher = LNWatcher(self.network)
+        self.watcher.network = self.network
+        self.watcher.synchronizer = MockSynchronizer()
+        self.watcher.set_up_to_date(True)
+        self.calls = Counter()
+
+    def tearDown(self):
+        self.watcher.synchronizer = None
+        self.watcher.stop()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        super().tearDown()
+
+    def add_callback(self, address, *, fail=False):
+        async def callback():
+            self.calls[address] += 1
+            if fail:
+                raise Exception('callback failed')
+        self.watcher.add_callback(address, callback)
+        self.watcher.set_up_to_date(True)
+
+    def run_event(self, event, *args):
+        coro = self.watcher.on_network_update(event, *args)
+        asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result()
+
+    def test_only_affected_callbacks_run(self):
+        addresses = ['addr%d' % i for i in range(5)]
+        for addr in addresses:
+            self.add_callback(addr)
+        self.run_event('network_updated')
+        self.assertEqual({addr: 1 for addr in addresses}, self.calls)
+        # a wallet update without changes does not run any callback
+        self.run_event('wallet_updated', self.watcher)
+        self.assertEqual({addr: 1 for addr in addresses}, self.calls)
+        # a history change only runs the callback watching that address
+        self.watcher.receive_history_callback('addr2', [], {})
+        self.watcher._index_address('spender_output', 'addr3')
+        self.watcher.receive_history_callback('spender_output', [], {})
+        self.run_event('wallet_updated', self.watcher)
+        self.assertEqual(2, self.calls['addr2'])
+        self.assertEqual(2, self.calls['addr3'])
+        self.assertEqual(1, self.calls['addr0'])
+
+    def test_new_block_runs_height_sensitive_callbacks(self):
+        for addr in ['addr0', 'addr1']:
+            self.add_callback(addr)
+        self.run_event('blockchain_updated')
+        self.watcher._height_sensitive.discard('addr0')
+        # same height: nothing to do
+        self.run_event('blockchain_updated')
+        self.assertEqual({'addr0': 1, 'addr1': 1}, self.calls)
+        self.network.height += 1
+        self.run_event('blockchain_updated')
+        self.assertEqual({'addr0': 1, 'addr1': 2}, self.calls)
+
+    def test_failing_callback_does_not_stop_the_others(self):
+        addresses = ['addr%d' % i for i in range(5)]
+        for addr in addresses:
+            self.add_callback(addr, fail=(addr == 'addr2'))
+        self.run_event('network_updated')
+        self.assertEqual({addr: 1 for addr in addresses}, self.calls)
+        # the failed callback is retried with the next event
+        self.assertEqual({'addr2'}, self.watcher._dirty)
+        self.run_event('wallet_updated', self.watcher)
+        self.assertEqual(2, self.calls['addr2'])
+        self.assertEqual(1, self.calls['addr0'])
+
+    def test_removed_callback_is_not_run(self):
+        self.add_callback('addr0')
+        self.watcher._index_address('spender_output', 'addr0')
+        self.watcher.remove_callback('addr0')
+        self.watcher.receive_history_callback('spender_output', [], {})
+        self.run_event('wallet_updated', self.watcher)
+        self.assertEqual({}, self.calls)
+
+
+class TestSweepStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        network = MockNetwork(SimpleConfig({'electrum_path': self.electrum_path}), self.asyncio_loop)
+        self.sweepstore = SweepStore(os.path.join(self.electrum_path, "watchtower_db"), network)
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        self.sweepstore.sql_thread.join(timeout=1)
+        super().tearDown()
+
+    def run_sql(self, coro):
+        async def f():
+            return await coro
+        return asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result()
+
+    def test_add_sweep_txs(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        outpoint = 'aa' * 32 + ':0'
+        batch = [(ctn, 'bb' * 32 + ':%d' % i, raw_tx) for ctn in range(1, 4) for i in range(2)]
+        self.assertEqual(3, self.run_sql(self.sweepstore.add_sweep_txs(outpoint, 'addr', 1, 3, batch)))
+        self.assertEqual(6, self.run_sql(self.sweepstore.get_num_tx(outpoint)))
+        self.assertEqual([(outpoint, 'addr')], self.run_sql(self.sweepstore.list_channels()))
+        # resending an overlapping batch only adds the new ctns
+        batch = [(ctn, 'bb' * 32 + ':0', raw_tx) for ctn in range(2, 6)]
+        self.assertEqual(5, self.run_sql(self.sweepstore.add_sweep_txs(outpoint, 'addr', 2, 5, batch)))
+        self.assertEqual(8, self.run_sql(self.sweepstore.get_num_tx(outpoint)))
+        self.assertEqual(5, self.run_sql(self.sweepstore.get_ctn(outpoint, 'addr')))
+        # a batch must not leave a gap
+        with self.assertRaises(Exception):
+            self.run_sql(self.sweepstore.add_sweep_txs(outpoint, 'addr', 7, 7, [(7, 'bb' * 32 + ':0', raw_tx)]))
+        self.assertEqual(8, self.run_sql(self.sweepstore.get_num_tx(outpoint)))
+
+    def test_add_sweep_txs_with_empty_ctns(self):
+        raw_tx = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+        outpoint = 'aa' * 32 + ':0'
+        # ctns 2 and 3 have no sweep txs
+        batch = [(1, 'bb' * 32 + ':0', raw_tx)]
+        self.assertEqual(3, self.run_sql(self.sweepstore.add_sweep_txs(outpoint, 'addr', 1, 3, batch)))
+        self.assertEqual(3, self.run_sql(self.sweepstore.get_ctn(outpoint, 'addr')))
+        # so the next batch does not leave a gap
+        batch = [(4, 'bb' * 32 + ':0', raw_tx)]
+        self.assertEqual(5, self.run_sql(self.sweepstore.add_sweep_txs(outpoint, 'addr', 4, 5, batch)))
+        self.assertEqual(5, self.run_sql(self.sweepstore.get_ctn(outpoint, 'addr')))
+        self.assertEqual(2, self.run_sql(self.sweepstore.get_num_tx(outpoint)))
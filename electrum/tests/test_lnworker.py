@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from collections import defaultdict
+from unittest import mock
+
+from electrum import lnworker
+from electrum.lnutil import RECEIVED, REMOTE, SENT, UpdateAddHtlc
+from electrum.lnworker import LNWallet, PaymentInfo
+from electrum.invoices import PR_PAID
+from electrum.logging import get_logger
+from electrum.util import JsonRPCMethodNotFound
+
+from . import ElectrumTestCase
+
+
+class MockChannel:
+
+    def __init__(self, channel_id: bytes):
+        self.channel_id = channel_id
+        self.hm = self
+        self.settled = {}
+        self.settles_version = 0
+
+    def get_settles_version(self):
+        return self.settles_version
+
+    def get_settled_payments(self):
+        return self.settled
+
+    def settle(self, payment_hash: bytes, amount_msat: int, direction):
+        htlc = UpdateAddHtlc(amount_msat=amount_msat, payment_hash=payment_hash, cltv_expiry=500,
+                             timestamp=1600000000, htlc_id=0)
+        key = payment_hash.hex()
+        # a new mapping, as the channels return theirs
+        self.settled = dict(self.settled)
+        self.settled[key] = self.settled.get(key, []) + [(self.channel_id, htlc, direction)]
+        self.settles_version += 1
+
+
+class MockWallet:
+
+    def __init__(self):
+        self.labels = {}
+
+    def get_label(self, key):
+        return self.labels.get(key, '')
+
+
+class MockSwapManager:
+
+    def get_swap(self, payment_hash):
+        return None
+
+
+class MockLNWallet:
+
+    def __init__(self):
+        self._history_lock = threading.RLock()
+        self._settled_payments_by_channel = {}
+        self._settled_payments = defaultdict(dict)
+        self._lightning_history = {}
+        self._dirty_payment_hashes = set()
+        self.channels = {}
+        self.payment_info = {}
+        self.wallet = MockWallet()
+        self.swap_manager = MockSwapManager()
+
+    def get_payment_info(self, payment_hash):
+        return self.payment_info.get(payment_hash)
+
+    def get_preimage(self, payment_hash):
+        return bytes(32)
+
+    get_lightning_history = LNWallet.get_lightning_history
+    get_payment_value = LNWallet.get_payment_value
+    _get_lightning_history_item = LNWallet._get_lightning_history_item
+    _update_settled_payments = LNWallet._update_settled_payments
+    _set_settled_payments_of_channel = LNWallet._set_settled_payments_of_channel
+    _mark_payment_dirty = LNWallet._mark_payment_dirty
+
+
+class TestLightningHistory(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.lnworker = MockLNWallet()
+        self.chan1 = MockChannel(b'\x01' * 32)
+        self.chan2 = MockChannel(b'\x02' * 32)
+        self.lnworker.channels = {self.chan1.channel_id: self.chan1, self.chan2.channel_id: self.chan2}
+
+    def history(self):
+        return {payment_hash: (item['direction'], item['amount_msat'], item['label'])
+                for payment_hash, item in self.lnworker.get_lightning_history().items()}
+
+    def test_settled_payments_of_changed_channels(self):
+        h1, h2 = b'\x11' * 32, b'\x22' * 32
+        self.assertEqual({}, self.history())
+        self.chan1.settle(h1, 1000, RECEIVED)
+        self.assertEqual({h1: ('forwarding', 1000, 'Forwarding')}, self.history())
+        # a payment going through both channels
+        self.chan2.settle(h2, 3000, RECEIVED)
+        self.chan1.settle(h2, 2000, SENT)
+        self.assertEqual({h1: ('forwarding', 1000, 'Forwarding'), h2: ('forwarding', 1000, 'Forwarding')},
+                         self.history())
+        # the index is only updated for the channels whose version changed
+        self.chan2.settled = {}
+        self.assertEqual(1000, self.history()[h2][1])
+
+    def test_removed_channel(self):
+        h1, h2 = b'\x11' * 32, b'\x22' * 32
+        self.chan1.settle(h1, 1000, RECEIVED)
+        self.chan2.settle(h2, 3000, RECEIVED)
+        self.chan1.settle(h2, 2000, SENT)
+        self.history()
+        del self.lnworker.channels[self.chan1.channel_id]
+        self.assertEqual({h2: ('forwarding', 3000, 'Forwarding')}, self.history())
+        self.assertEqual({h2.hex()}, set(self.lnworker._settled_payments))
+        self.assertEqual([self.chan2.channel_id], list(self.lnworker._settled_payments_by_channel))
+
+    def test_payment_info_and_labels(self):
+        h1 = b'\x11' * 32
+        self.chan1.settle(h1, 1000, RECEIVED)
+        self.assertEqual({h1: ('forwarding', 1000, 'Forwarding')}, self.history())
+        # the payment info is only read again once the payment is marked dirty
+        self.lnworker.payment_info[h1] = PaymentInfo(h1, 1, RECEIVED, PR_PAID)
+        self.assertEqual('forwarding', self.history()[h1][0])
+        self.lnworker._mark_payment_dirty(h1)
+        self.assertEqual({h1: ('received', 1000, '')}, self.history())
+        # labels are not cached
+        self.lnworker.wallet.labels[h1.hex()] = 'coffee'
+        self.assertEqual({h1: ('received', 1000, 'coffee')}, self.history())
+
+
+class MockWatchtowerChannel:
+
+    def __init__(self, ctn: int, sweep_ctns):
+        self.funding_outpoint = mock.Mock(to_str=lambda: 'aa' * 32 + ':0')
+        self.ctn = ctn
+        # ctns that have a sweep tx
+        self.sweep_ctns = sweep_ctns
+
+    def get_funding_address(self):
+        return 'addr'
+
+    def get_oldest_unrevoked_ctn(self, subject):
+        assert subject == REMOTE
+        return self.ctn
+
+    def create_sweeptxs(self, ctn):
+        if ctn not in self.sweep_ctns:
+            return []
+        tx = mock.Mock()
+        tx.inputs.return_value = [mock.Mock(prevout=mock.Mock(to_str=lambda: f'{ctn:064x}:0'))]
+        tx.serialize.return_value = f'tx{ctn}'
+        return [tx]
+
+
+class LegacyWatchtower:
+    """A watchtower without bulk upload."""
+
+    def __init__(self):
+        self.sweep_txs = []
+
+    async def get_ctn(self, outpoint, addr):
+        return -1
+
+    async def add_sweep_txs(self, *args):
+        raise JsonRPCMethodNotFound()
+
+    async def add_sweep_tx(self, outpoint, ctn, prevout, raw_tx):
+        self.sweep_txs.append((ctn, raw_tx))
+
+
+class TestWatchtowerSync(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def test_legacy_watchtower_with_empty_batch(self):
+        mock_lnworker = mock.Mock(logger=get_logger(__name__))
+        watchtower = LegacyWatchtower()
+        # the first batch has no sweep tx
+        chan = MockWatchtowerChannel(ctn=7, sweep_ctns={4, 5})
+        with mock.patch.object(lnworker, 'WATCHTOWER_SYNC_BATCH_SIZE', 3):
+            self.loop.run_until_complete(
+                LNWallet.sync_channel_with_watchtower(mock_lnworker, chan, watchtower))
+        self.assertEqual([(4, 'tx4'), (5, 'tx5')], watchtower.sweep_txs)
@@ -0,0 +1,96 @@
+import asyncio
+
+from aiorpcx import connect_rs
+from aiorpcx.jsonrpc import RPCError
+
+from electrum import bitcoin, constants
+from electrum.benchmarks.mock_server import MockChain, MockServer, merkle_root_and_branches
+from electrum.benchmarks.wallet import make_raw_tx
+from electrum.blockchain import hash_raw_header
+from electrum.crypto import sha256
+from electrum.synchronizer import history_status
+from electrum.transaction import Transaction
+from electrum.util import bh2u
+from electrum.verifier import SPV
+
+from . import ElectrumTestCase
+
+
+class TestMockServer(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        self.addr = bitcoin.hash160_to_p2pkh(bytes(20))
+        self.txs = [Transaction(make_raw_tx([(bh2u(sha256(bytes([i]))), 0)], [(self.addr, 1000 + i)]))
+                    for i in range(5)]
+        self.chain = MockChain()
+        self.chain.add_blocks(2)
+        self.chain.add_block(self.txs[:3])
+        self.chain.add_block(self.txs[3:])
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def test_merkle_root_and_branches(self):
+        txids = [tx.txid() for tx in self.txs]
+        self.assertEqual((txids[0], [[]]), merkle_root_and_branches(txids[:1]))
+        for num_txs in range(2, len(txids) + 1):
+            root, branches = merkle_root_and_branches(txids[:num_txs])
+            for pos, (txid, branch) in enumerate(zip(txids, branches)):
+                self.assertEqual(root, SPV.hash_merkle_root(branch, txid, pos))
+
+    def test_chain(self):
+        self.assertEqual(4, self.chain.height())
+        for height in range(1, 5):
+            self.assertEqual(hash_raw_header(bh2u(self.chain.headers[height - 1])),
+                             self.chain.get_header(height)['prev_block_hash'])
+        for tx in self.txs:
+            merkle = self.chain.get_merkle(tx.txid())
+            self.assertEqual(self.chain.get_header(merkle['block_height'])['merkle_root'],
+                             SPV.hash_merkle_root(merkle['merkle'], tx.txid(), merkle['pos']))
+        sh = bitcoin.address_to_scripthash(self.addr)
+        history = [(tx.txid(), 3 if i < 3 else 4) for i, tx in enumerate(self.txs)]
+        self.assertEqual(history, self.chain.get_history(sh))
+        self.assertEqual(history_status(history), self.chain.get_status(sh))
+        self.assertIsNone(self.chain.get_status(bh2u(bytes(32))))
+
+    def test_server(self):
+        server = MockServer(self.chain, error_rate=1, inject_methods={'blockchain.transaction.get'})
+        sh = bitcoin.address_to_scripthash(self.addr)
+
+        async def f():
+            await server.start()
+            addr = server.server_addr
+            try:
+                async with connect_rs(addr.host, addr.port) as session:
+                    tip = await session.send_request('blockchain.headers.subscribe', [])
+                    self.assertEqual({'hex': bh2u(self.chain.headers[4]), 'height': 4}, tip)
+                    res = await session.send_request('blockchain.block.headers', [0, 2016])
+                    self.assertEqual(5, res['count'])
+                    status = await session.send_request('blockchain.scripthash.subscribe', [sh])
+                    self.assertEqual(self.chain.get_status(sh), status)
+                    history = await session.send_request('blockchain.scripthash.get_history', [sh])
+                    self.assertEqual(5, len(history))
+                    with self.assertRaises(RPCError):
+                        await session.send_request('blockchain.transaction.get', [self.txs[0].txid()])
+                    # mining a block notifies the subscribed session
+                    await server.add_block()
+                    self.assertEqual(5, server.chain.height())
+            finally:
+                await server.stop()
+
+        self.loop.run_until_complete(f())
+        self.assertEqual(1, server.num_injected_failures)
+        self.assertEqual(1, server.requests['blockchain.transaction.get'])
@@ -1,11 +1,16 @@
 import asyncio
 import tempfile
+import threading
 import unittest
+from collections import defaultdict, deque
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface, ServerAddr
+from electrum.interface import Interface, ServerAddr, RequestCorrupted
+from electrum.logging import Logger
+from electrum.network import Network, ServerScore, ServerScorecard
+from electrum.network_stats import NetworkStats, to_prometheus_text
 from electrum.crypto import sha256
 from electrum.util import bh2u
 
@@ -117,6 +122,196 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class TestServerScorecard(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.servers = [ServerAddr.from_str(f'server{i}.example.com:50002:s') for i in range(4)]
+
+    def test_score(self):
+        score = ServerScore()
+        self.assertEqual(ServerScore.DEFAULT_LATENCY, score.score())
+        score.add_response(0.1)
+        self.assertAlmostEqual(0.1, score.latency)
+        score.add_response(0.6)
+        self.assertAlmostEqual(0.2, score.latency)
+        score.add_timeout()
+        self.assertEqual(3, score.num_requests)
+        self.assertEqual(1, score.num_timeouts)
+        self.assertGreater(score.score(), ServerScore.DEFAULT_LATENCY)
+        # the timeout is forgotten over time
+        for i in range(50):
+            score.add_response(0.2)
+        self.assertAlmostEqual(0.2, score.score(), places=3)
+        score.tip_lag = 1
+        self.assertAlmostEqual(0.2 + ServerScore.TIP_LAG_PENALTY, score.score(), places=3)
+
+    def test_sort_servers(self):
+        scores = ServerScorecard(self.config)
+        s0, s1, s2, s3 = self.servers
+        scores.add_response(s0, 2.0)
+        scores.add_response(s1, 0.1)
+        scores.add_timeout(s2)
+        # unknown servers are tried before slow and failing ones
+        self.assertEqual([s1, s3, s0, s2], scores.sort_servers([s0, s1, s2, s3]))
+        scores.set_tip_lag(s1, 5)
+        self.assertEqual([s3, s0, s2, s1], scores.sort_servers([s0, s1, s2, s3]))
+        # e.g. after a disconnection
+        scores.clear_tip_lag(s1)
+        scores.clear_tip_lag(s3)
+        self.assertEqual([s1, s3, s0, s2], scores.sort_servers([s0, s1, s2, s3]))
+        self.assertIsNone(scores.get(s3))
+
+    def test_persistence(self):
+        scores = ServerScorecard(self.config)
+        scores.add_response(self.servers[0], 0.5)
+        scores.add_timeout(self.servers[1])
+        scores.save()
+        scores2 = ServerScorecard(self.config)
+        for server in self.servers[:2]:
+            self.assertEqual(scores.get(server).to_json(), scores2.get(server).to_json())
+        self.assertIsNone(scores2.get(self.servers[2]))
+
+
+class MockHedgeInterface(Logger):
+    def __init__(self, name, *, delay, result=None, exc=None):
+        Logger.__init__(self)
+        self.server = ServerAddr.from_str(f'{name}.example.com:50002:s')
+        self.ready = asyncio.Future()
+        self.ready.set_result(1)
+        self.blockchain = None
+        self.delay = delay
+        self.result = result
+        self.exc = exc
+        self.num_requests = 0
+
+    async def request(self):
+        self.num_requests += 1
+        await asyncio.sleep(self.delay)
+        if self.exc:
+            raise self.exc
+        return self.result
+
+
+class MockHedgingNetwork(Logger):
+    def __init__(self, config, main_iface, other_ifaces):
+        Logger.__init__(self)
+        self.config = config
+        self.interface = main_iface
+        self.interfaces = {iface.server: iface for iface in [main_iface] + other_ifaces}
+        self.interfaces_lock = threading.Lock()
+        self.server_scores = ServerScorecard(config)
+        self._hedge_latencies = defaultdict(deque)
+
+    _get_hedge_delay = Network._get_hedge_delay
+    _get_interface_to_hedge_on = Network._get_interface_to_hedge_on
+    _maybe_hedge = Network._maybe_hedge
+
+
+class TestHedgedRequests(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.config.set_key('network_hedged_requests', True)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def run_hedged(self, main_iface, other_ifaces):
+        async def f():
+            network = MockHedgingNetwork(self.config, main_iface, other_ifaces)
+            network._hedge_latencies['method'].extend([0.01] * 100)
+            return await network._maybe_hedge('method', lambda iface: iface.request())
+        return self.loop.run_until_complete(f())
+
+    def test_fast_main_interface_is_not_hedged(self):
+        main = MockHedgeInterface('main', delay=0, result='main')
+        other = MockHedgeInterface('other', delay=0, result='other')
+        self.assertEqual('main', self.run_hedged(main, [other]))
+        self.assertEqual(0, other.num_requests)
+
+    def test_hedging_disabled(self):
+        self.config.set_key('network_hedged_requests', False)
+        main = MockHedgeInterface('main', delay=0.1, result='main')
+        other = MockHedgeInterface('other', delay=0, result='other')
+        self.assertEqual('main', self.run_hedged(main, [other]))
+        self.assertEqual(0, other.num_requests)
+
+    def test_slow_main_interface_is_hedged(self):
+        main = MockHedgeInterface('main', delay=1, result='main')
+        other = MockHedgeInterface('other', delay=0, result='other')
+        self.assertEqual('other', self.run_hedged(main, [other]))
+        self.assertEqual(1, other.num_requests)
+
+    def test_invalid_hedged_answer_is_ignored(self):
+        main = MockHedgeInterface('main', delay=0.1, result='main')
+        other = MockHedgeInterface('other', delay=0, exc=RequestCorrupted('bad txid'))
+        self.assertEqual('main', self.run_hedged(main, [other]))
+        self.assertEqual(1, other.num_requests)
+
+    def test_exception_of_main_interface_is_raised(self):
+        main = MockHedgeInterface('main', delay=0.1, exc=RequestCorrupted('main'))
+        other = MockHedgeInterface('other', delay=0, exc=RequestCorrupted('other'))
+        with self.assertRaises(RequestCorrupted) as ctx:
+            self.run_hedged(main, [other])
+        self.assertEqual('main', str(ctx.exception))
+
+
+class TestNetworkStats(ElectrumTestCase):
+
+    def test_request_stats(self):
+        stats = NetworkStats()
+        for server in ('a:1:s', 'b:1:s'):
+            stats.request_started(server, 'server.ping')
+        stats.request_finished('a:1:s', 'server.ping', 0.03)
+        stats.request_finished('b:1:s', 'server.ping', None, timed_out=True)
+        stats.request_started('a:1:s', 'blockchain.transaction.get')
+        stats.request_started('a:1:s', 'blockchain.transaction.get')
+        stats.request_finished('a:1:s', 'blockchain.transaction.get', 2, error=True)
+        d = stats.to_json()
+        ping = d['methods']['server.ping']
+        self.assertEqual(0, ping['in_flight'])
+        self.assertEqual(1, ping['timeouts'])
+        self.assertEqual(1, ping['latency']['count'])
+        self.assertEqual(0, ping['latency']['buckets']['0.025'])
+        self.assertEqual(1, ping['latency']['buckets']['0.05'])
+        self.assertEqual(1, ping['latency']['buckets']['+Inf'])
+        server_a = d['servers']['a:1:s']
+        self.assertEqual(1, server_a['in_flight'])
+        self.assertEqual(1, server_a['errors'])
+        self.assertEqual(2, server_a['latency']['count'])
+        self.assertAlmostEqual(2.03, server_a['latency']['sum'])
+
+    def test_connection_stats(self):
+        stats = NetworkStats()
+        stats.connection_attempt('a:1:s')
+        stats.session_closed('a:1:s', was_connected=False, bytes_sent=10, bytes_received=0)
+        stats.connection_attempt('a:1:s')
+        stats.connected('a:1:s')
+        stats.session_closed('a:1:s', was_connected=True, bytes_sent=100, bytes_received=1000)
+        self.assertEqual({'connection_attempts': 2, 'connects': 1, 'disconnects': 1,
+                          'bytes_sent': 110, 'bytes_received': 1000},
+                         stats.to_json()['connections']['a:1:s'])
+
+    def test_prometheus_text(self):
+        stats = NetworkStats()
+        stats.request_started('a:1:s', 'server.ping')
+        stats.request_finished('a:1:s', 'server.ping', 0.2)
+        stats.connected('a:1:s')
+        d = stats.to_json()
+        d['num_connected_servers'] = 1
+        lines = to_prometheus_text(d).splitlines()
+        self.assertIn('electrum_method_request_duration_seconds_bucket{method="server.ping",le="0.25"} 1', lines)
+        self.assertIn('electrum_server_request_duration_seconds_count{server="a:1:s"} 1', lines)
+        self.assertIn('electrum_method_requests_in_flight{method="server.ping"} 0', lines)
+        self.assertIn('electrum_server_connects_total{server="a:1:s"} 1', lines)
+        self.assertIn('electrum_connected_servers 1', lines)
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
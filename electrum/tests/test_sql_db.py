@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from electrum.sql_db import SqlDB, sql
+from electrum.util import create_and_start_event_loop
+
+from . import ElectrumTestCase
+
+
+class ValuesDB(SqlDB):
+
+    def create_database(self):
+        self.conn.execute("CREATE TABLE IF NOT EXISTS vals (v INTEGER)")
+        self.conn.commit()
+
+    @sql
+    def add_values(self, values, *, fail_after=None):
+        for i, v in enumerate(values):
+            if i == fail_after:
+                raise Exception('failed halfway')
+            self.conn.execute("INSERT INTO vals (v) VALUES (?)", (v,))
+
+    @sql
+    def get_values(self):
+        return [row[0] for row in self.conn.execute("SELECT v FROM vals ORDER BY v")]
+
+
+class TestSqlDB(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        self.db.sql_thread.join(timeout=1)
+        super().tearDown()
+
+    def _test_failing_request_is_rolled_back(self, commit_interval):
+        self.db = ValuesDB(self.asyncio_loop, os.path.join(self.electrum_path, 'db'), commit_interval=commit_interval)
+
+        async def f():
+            # queued together, so that they likely run in one batch
+            futures = [self.db.add_values([1, 2]),
+                       self.db.add_values([3, 4], fail_after=1),
+                       self.db.add_values([5])]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            self.assertEqual([None, None], [results[0], results[2]])
+            self.assertEqual('failed halfway', str(results[1]))
+            return await self.db.get_values()
+
+        values = asyncio.run_coroutine_threadsafe(f(), self.asyncio_loop).result(timeout=10)
+        self.assertEqual([1, 2, 5], values)
+
+    def test_failing_request_is_rolled_back(self):
+        self._test_failing_request_is_rolled_back(None)
+
+    def test_failing_request_is_rolled_back_with_commit_interval(self):
+        self._test_failing_request_is_rolled_back(100)
@@ -10,7 +10,8 @@ from io import StringIO
 from electrum.storage import WalletStorage
 from electrum.wallet_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
-                             restore_wallet_from_text, Imported_Wallet, Wallet)
+                             restore_wallet_from_text, Imported_Wallet, Wallet,
+                             AddressChainUsage)
 from electrum.exchange_rate import ExchangeBase, FxThread
 from electrum.util import TxMinedInfo, InvalidPassword
 from electrum.bitcoin import COIN
@@ -235,6 +236,72 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
 
+class TestAddressChainUsage(ElectrumTestCase):
+
+    def test_gaps(self):
+        usage = AddressChainUsage()
+        self.assertEqual(-1, usage.last_used())
+        self.assertEqual(-1, usage.last_old())
+        self.assertEqual(0, usage.max_gap_of_non_old())
+        usage.mark_used(3)
+        self.assertEqual(3, usage.last_used())
+        self.assertEqual({3}, usage.pending)
+        self.assertEqual(4, usage.max_gap_of_non_old())
+        usage.mark_old(3)
+        self.assertEqual(set(), usage.pending)
+        self.assertEqual(3, usage.max_gap_of_non_old())
+        usage.mark_used(10)
+        usage.mark_old(10)
+        self.assertEqual(6, usage.max_gap_of_non_old())
+        # out-of-order promotion splits the largest gap
+        usage.mark_used(6)
+        usage.mark_old(6)
+        self.assertEqual([3, 6, 10], usage.old)
+        self.assertEqual(3, usage.max_gap_of_non_old())
+        usage.mark_unused(6)
+        self.assertEqual([3, 10], usage.used)
+        self.assertEqual(6, usage.max_gap_of_non_old())
+
+
+class TestDeterministicWalletGapLimit(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.set_key('skipmerklecheck', True)
+        text = 'xpub661MyMwAqRbcFWohJWt7PHsFEJfZAvw9ZxwQoDa4SoMgsDDM1T7WK3u9E4edkC4ugRnZ8E4xDZRpk8Rnts3Nbt97dPwT52CwBdDWroaZf8U'
+        d = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=5, config=self.config)
+        self.wallet = d['wallet']  # type: Standard_Wallet
+        self.wallet.db.put('stored_height', 100)
+
+    def test_gap_limit_extends_only_for_old_addresses(self):
+        wallet = self.wallet
+        self.assertEqual(5, len(wallet.get_receiving_addresses()))
+        addr = wallet.get_receiving_addresses()[3]
+        # unconfirmed history does not extend the gap
+        wallet.receive_history_callback(addr, [('00' * 32, 0)], {})
+        wallet.synchronize()
+        self.assertEqual(5, len(wallet.get_receiving_addresses()))
+        self.assertEqual(5, wallet.min_acceptable_gap())
+        # deeply confirmed history does
+        wallet.receive_history_callback(addr, [('00' * 32, 90)], {})
+        wallet.synchronize()
+        self.assertEqual(9, len(wallet.get_receiving_addresses()))
+        self.assertEqual(4, wallet.min_acceptable_gap())
+        self.assertEqual(set(), wallet.get_all_known_addresses_beyond_gap_limit())
+
+    def test_addresses_beyond_gap_limit(self):
+        wallet = self.wallet
+        for i in range(8):
+            wallet.create_new_address(False)
+        addrs = wallet.get_receiving_addresses()
+        wallet.receive_history_callback(addrs[12], [('00' * 32, 90)], {})
+        self.assertEqual(set(addrs[5:12]), wallet.get_all_known_addresses_beyond_gap_limit())
+        # reloading rebuilds the same state from the db
+        wallet.load_address_usage()
+        self.assertEqual(set(addrs[5:12]), wallet.get_all_known_addresses_beyond_gap_limit())
+        self.assertEqual(13, wallet.min_acceptable_gap())
+
+
 class TestWalletPassword(WalletTestCase):
 
     def test_update_password_of_imported_wallet(self):
@@ -0,0 +1,113 @@
+import asyncio
+import os
+from unittest import mock
+
+from electrum import webhooks
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop
+from electrum.webhooks import WebhookDispatcher, WebhookReceiver
+
+from . import ElectrumTestCase
+
+
+class TestWebhooks(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    def run_coroutine(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop).result(timeout=10)
+
+    async def wait_until(self, condition):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    def make_dispatcher(self, **options):
+        async def make():
+            return WebhookDispatcher(SimpleConfig(dict(electrum_path=self.electrum_path, **options)))
+        dispatcher = self.run_coroutine(make())
+        asyncio.run_coroutine_threadsafe(dispatcher.run(), self.asyncio_loop)
+        return dispatcher
+
+    def test_delivery_in_order(self):
+        receiver = WebhookReceiver(error_rate=0.5, seed=0)
+        self.run_coroutine(receiver.start())
+        dispatcher = self.make_dispatcher()
+        events = [{'address': 'a', 'status': str(i)} for i in range(10)]
+
+        async def f():
+            for event in events:
+                dispatcher.post(receiver.url + 'a', event)
+                dispatcher.post(receiver.url + 'b', event)
+            await self.wait_until(lambda: len(receiver.received) == 20)
+        with mock.patch.object(webhooks, 'WEBHOOK_RETRY_DELAY', 0.01):
+            self.run_coroutine(f())
+        for path in ('/a', '/b'):
+            self.assertEqual(events, [body for p, body in receiver.received if p == path])
+        stats = dispatcher.get_stats()
+        self.assertEqual(20, stats['events_delivered'])
+        self.assertEqual(0, stats['events_queued'])
+        self.assertEqual(receiver.num_errors, stats['requests_failed'])
+        self.assertEqual(receiver.num_requests, stats['requests_sent'])
+        self.run_coroutine(dispatcher.stop())
+        self.run_coroutine(receiver.stop())
+
+    def test_batches(self):
+        receiver = WebhookReceiver()
+        self.run_coroutine(receiver.start())
+        dispatcher = self.make_dispatcher(webhook_batch_size=4)
+        events = [{'address': 'a', 'status': str(i)} for i in range(10)]
+
+        async def f():
+            for event in events:
+                dispatcher.post(receiver.url, event)
+            await self.wait_until(lambda: dispatcher.get_stats()['events_delivered'] == 10)
+        self.run_coroutine(f())
+        self.assertEqual(events, [event for path, body in receiver.received for event in body])
+        self.assertTrue(all(len(body) <= 4 for path, body in receiver.received))
+        self.run_coroutine(dispatcher.stop())
+        self.run_coroutine(receiver.stop())
+
+    def test_queue_is_persisted(self):
+        receiver = WebhookReceiver(error_rate=1)
+        self.run_coroutine(receiver.start())
+        dispatcher = self.make_dispatcher(webhook_max_queue=3)
+        for i in range(5):
+            dispatcher.post(receiver.url, {'status': i})
+        self.run_coroutine(self.wait_until(lambda: receiver.num_errors))
+        self.run_coroutine(dispatcher.stop())
+        self.assertEqual(2, dispatcher.get_stats()['events_dropped'])
+        # a new dispatcher delivers the events that were still queued
+        receiver.error_rate = 0
+        dispatcher = self.make_dispatcher()
+        self.run_coroutine(self.wait_until(lambda: len(receiver.received) == 3))
+        self.assertEqual([{'status': i} for i in range(2, 5)], [body for path, body in receiver.received])
+        self.run_coroutine(dispatcher.stop())
+        self.run_coroutine(receiver.stop())
+
+    def test_max_attempts(self):
+        receiver = WebhookReceiver(error_rate=1)
+        self.run_coroutine(receiver.start())
+        dispatcher = self.make_dispatcher(webhook_max_attempts=3)
+        for i in range(2):
+            dispatcher.post(receiver.url, {'status': i})
+        with mock.patch.object(webhooks, 'WEBHOOK_RETRY_DELAY', 0.01):
+            self.run_coroutine(self.wait_until(lambda: dispatcher.get_stats()['events_dropped'] == 2))
+        self.assertEqual(3, receiver.num_requests)
+        self.assertEqual(0, dispatcher.get_stats()['events_queued'])
+        # later events are delivered again
+        receiver.error_rate = 0
+        dispatcher.post(receiver.url, {'status': 2})
+        self.run_coroutine(self.wait_until(lambda: receiver.received))
+        self.assertEqual([{'status': 2}], [body for path, body in receiver.received])
+        # the log is compacted once it is mostly made of delivered events
+        with mock.patch.object(webhooks, 'WEBHOOK_LOG_COMPACTION_THRESHOLD', 0):
+            self.run_coroutine(dispatcher.stop())
+        self.assertEqual(0, os.path.getsize(dispatcher.path))
+        self.run_coroutine(receiver.stop())
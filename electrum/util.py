@@ -45,6 +45,7 @@ import ipaddress
 from ipaddress import IPv4Address, IPv6Address
 import random
 import secrets
+import zlib
 
 import attr
 import aiohttp
@@ -56,6 +57,7 @@ import dns.resolver
 
 from .i18n import _
 from .logging import get_logger, Logger
+from . import instrumentation
 
 if TYPE_CHECKING:
     from .network import Network
@@ -396,6 +398,7 @@ def constant_time_compare(val1, val2):
 
 
 # decorator that prints execution time
+# note: it also records a span, see instrumentation.py
 _profiler_logger = _logger.getChild('profiler')
 def profiler(func):
     def do_profile(args, kw_args):
@@ -404,6 +407,7 @@ def profiler(func):
         o = func(*args, **kw_args)
         t = time.time() - t0
         _profiler_logger.debug(f"{name} {t:,.4f}")
+        instrumentation.record_span(name, t)
         return o
     return lambda *args, **kw_args: do_profile(args, kw_args)
 
@@ -1445,8 +1449,19 @@ class MySocksProxy(aiorpcx.SOCKSProxy):
         return ret
 
 
+# JSON-RPC 2.0 error code for calls to a method the server does not have
+JSONRPC_METHOD_NOT_FOUND = -32601
+
+
+class JsonRPCMethodNotFound(Exception):
+    pass
+
+
 class JsonRPCClient:
 
+    # request bodies larger than this are sent deflate-compressed
+    COMPRESS_MIN_SIZE = 1024
+
     def __init__(self, session: aiohttp.ClientSession, url: str):
         self.session = session
         self.url = url
@@ -1456,17 +1471,26 @@ class JsonRPCClient:
         self._id += 1
         data = ('{"jsonrpc": "2.0", "id":"%d", "method": "%s", "params": %s }'
                 % (self._id, endpoint, json.dumps(args)))
-        async with self.session.post(self.url, data=data) as resp:
+        headers = {}
+        if len(data) > self.COMPRESS_MIN_SIZE:
+            data = zlib.compress(data.encode('utf8'))
+            headers['Content-Encoding'] = 'deflate'
+        async with self.session.post(self.url, data=data, headers=headers) as resp:
             if resp.status == 200:
                 r = await resp.json()
                 result = r.get('result')
                 error = r.get('error')
+                if isinstance(error, dict) and error.get('code') == JSONRPC_METHOD_NOT_FOUND:
+                    raise JsonRPCMethodNotFound(endpoint)
                 if error:
                     return 'Error: ' + str(error)
                 else:
                     return result
             else:
                 text = await resp.text()
+                if resp.status == 500 and text == 'Invalid Request':
+                    # older Electrum servers answer this to calls of unknown methods
+                    raise JsonRPCMethodNotFound(endpoint)
                 return 'Error: ' + str(text)
 
     def add_method(self, endpoint):
@@ -43,6 +43,7 @@ from decimal import Decimal
 from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Sequence, Dict, Any, Set
 from abc import ABC, abstractmethod
 import itertools
+import bisect
 
 from aiorpcx import TaskGroup
 
@@ -66,6 +67,7 @@ from .util import multisig_type
 from .storage import StorageEncryptionVersion, WalletStorage
 from .wallet_db import WalletDB
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
+from . import instrumentation
 from .transaction import (Transaction, TxInput, UnknownTxinType, TxOutput,
                           PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint)
 from .plugin import run_hook
@@ -1644,6 +1646,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             except UnknownTxinType:
                 pass
 
+    @instrumentation.traced('wallet.sign_transaction')
     def sign_transaction(self, tx: Transaction, password) -> Optional[PartialTransaction]:
         if self.is_watching_only():
             return
@@ -2028,6 +2031,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         encrypt_keystore = self.can_have_keystore_encryption()
         self.db.set_keystore_encryption(bool(new_pw) and encrypt_keystore)
         self.save_db()
+        if self.lnworker:
+            self.lnworker.reencrypt_htlc_archives()
 
     @abstractmethod
     def _update_password_for_keystore(self, old_pw: Optional[str], new_pw: Optional[str]) -> None:
@@ -2413,12 +2418,81 @@ class Imported_Wallet(Simple_Wallet):
         return self.keystore.decrypt_message(pubkey, message, password)
 
 
+class AddressChainUsage:
+    """Usage bookkeeping for one derivation chain (receiving or change)
+    of a deterministic wallet, maintained incrementally as histories arrive.
+
+    An address is "used" if it has history, and "old" if that history is
+    deeply confirmed (see Abstract_Wallet.address_is_old).
+    Once old, an address is assumed to stay old.
+    """
+
+    def __init__(self):
+        self.used = []  # type: List[int]  # sorted derivation indices
+        self.old = []  # type: List[int]  # sorted derivation indices
+        self.pending = set()  # type: Set[int]  # used but not yet old
+        # longest run of non-old indices before the last old one
+        self._max_gap_before_last_old = 0
+
+    def last_used(self) -> int:
+        return self.used[-1] if self.used else -1
+
+    def last_old(self) -> int:
+        return self.old[-1] if self.old else -1
+
+    def is_used(self, idx: int) -> bool:
+        i = bisect.bisect_left(self.used, idx)
+        return i < len(self.used) and self.used[i] == idx
+
+    def mark_used(self, idx: int) -> None:
+        if self.is_used(idx):
+            return
+        bisect.insort(self.used, idx)
+        self.pending.add(idx)
+
+    def mark_unused(self, idx: int) -> None:
+        if not self.is_used(idx):
+            return
+        self.used.remove(idx)
+        self.pending.discard(idx)
+        if idx in self.old:
+            self.old.remove(idx)
+            self._recalc_max_gap()
+
+    def mark_old(self, idx: int) -> None:
+        self.pending.discard(idx)
+        last_old = self.last_old()
+        if idx > last_old:
+            # common case: addresses get old in derivation order
+            self._max_gap_before_last_old = max(self._max_gap_before_last_old, idx - last_old - 1)
+            self.old.append(idx)
+        elif idx not in self.old:
+            bisect.insort(self.old, idx)
+            self._recalc_max_gap()
+
+    def _recalc_max_gap(self) -> None:
+        max_gap = 0
+        prev = -1
+        for idx in self.old:
+            max_gap = max(max_gap, idx - prev - 1)
+            prev = idx
+        self._max_gap_before_last_old = max_gap
+
+    def max_gap_of_non_old(self) -> int:
+        """Longest run of non-old addresses, not counting trailing unused ones."""
+        tail = max(0, self.last_used() - self.last_old())
+        return max(self._max_gap_before_last_old, tail)
+
+
 class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, db, storage, *, config):
         self._ephemeral_addr_to_addr_index = {}  # type: Dict[str, Sequence[int]]
+        self._address_usage = (AddressChainUsage(), AddressChainUsage())  # receiving, change
+        self._address_usage_checked_height = None  # type: Optional[int]
         Abstract_Wallet.__init__(self, db, storage, config=config)
         self.gap_limit = db.get('gap_limit', 20)
+        self.load_address_usage()
         # generate addresses now. note that without libsecp this might block
         # for a few seconds!
         self.synchronize()
@@ -2487,17 +2561,61 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def min_acceptable_gap(self) -> int:
         # fixme: this assumes wallet is synchronized
-        n = 0
-        nmax = 0
-        addresses = self.get_receiving_addresses()
-        k = self.num_unused_trailing_addresses(addresses)
-        for addr in addresses[0:-k]:
-            if self.address_is_old(addr):
-                n = 0
-            else:
-                n += 1
-                nmax = max(nmax, n)
-        return nmax + 1
+        with self.lock:
+            self._update_old_addresses()
+            return self._address_usage[0].max_gap_of_non_old() + 1
+
+    @profiler
+    def load_address_usage(self):
+        with self.lock:
+            self._address_usage = (AddressChainUsage(), AddressChainUsage())
+            self._address_usage_checked_height = None
+            for addr in self.db.get_history():
+                self._update_address_usage(addr)
+
+    def _update_address_usage(self, addr: str) -> None:
+        addr_index = self.db.get_address_index(addr)
+        if addr_index is None:
+            return
+        for_change, n = addr_index
+        usage = self._address_usage[int(for_change)]
+        if self.db.get_addr_history(addr):
+            usage.mark_used(n)
+            # new history might already be deeply confirmed
+            self._address_usage_checked_height = None
+        else:
+            usage.mark_unused(n)
+
+    def _update_old_addresses(self) -> None:
+        """Promotes used addresses to old. Only the pending (used but not old)
+        ones are checked, and only if something that affects their age changed.
+        """
+        local_height = self.get_local_height()
+        if self._address_usage_checked_height == local_height:
+            return
+        self._address_usage_checked_height = local_height
+        for for_change, usage in enumerate(self._address_usage):
+            for n in list(usage.pending):
+                if for_change:
+                    address = self.get_change_addresses(slice_start=n, slice_stop=n+1)[0]
+                else:
+                    address = self.get_receiving_addresses(slice_start=n, slice_stop=n+1)[0]
+                if self.address_is_old(address):
+                    usage.mark_old(n)
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        super().receive_history_callback(addr, hist, tx_fees)
+        with self.lock:
+            self._update_address_usage(addr)
+
+    def add_verified_tx(self, tx_hash, info):
+        super().add_verified_tx(tx_hash, info)
+        with self.lock:
+            self._address_usage_checked_height = None
+
+    def clear_history(self):
+        super().clear_history()
+        self.load_address_usage()
 
     @abstractmethod
     def derive_pubkeys(self, c: int, i: int) -> Sequence[str]:
@@ -2542,6 +2660,8 @@ class Deterministic_Wallet(Abstract_Wallet):
             address = self.derive_address(int(for_change), n)
             self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
             self.add_address(address)
+            if self.db.get_addr_history(address):
+                self._update_address_usage(address)
             if for_change:
                 # note: if it's actually "old", it will get filtered later
                 self._not_old_change_addresses.append(address)
@@ -2549,16 +2669,11 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
+        usage = self._address_usage[int(for_change)]
         while True:
             num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            if num_addr < limit:
-                self.create_new_address(for_change)
-                continue
-            if for_change:
-                last_few_addresses = self.get_change_addresses(slice_start=-limit)
-            else:
-                last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.address_is_old, last_few_addresses)):
+            # extend if there is an old address among the last `limit` ones
+            if num_addr < limit or usage.last_old() >= num_addr - limit:
                 self.create_new_address(for_change)
             else:
                 break
@@ -2566,6 +2681,7 @@ class Deterministic_Wallet(Abstract_Wallet):
     @AddressSynchronizer.with_local_height_cached
     def synchronize(self):
         with self.lock:
+            self._update_old_addresses()
             self.synchronize_sequence(False)
             self.synchronize_sequence(True)
 
@@ -2573,18 +2689,19 @@ class Deterministic_Wallet(Abstract_Wallet):
         # note that we don't stop at first large gap
         found = set()
 
-        def process_addresses(addrs, gap_limit):
-            rolling_num_unused = 0
-            for addr in addrs:
-                if self.db.get_addr_history(addr):
-                    rolling_num_unused = 0
-                else:
-                    if rolling_num_unused >= gap_limit:
-                        found.add(addr)
-                    rolling_num_unused += 1
+        def process_addresses(for_change, gap_limit):
+            get_addresses = self.get_change_addresses if for_change else self.get_receiving_addresses
+            num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+            prev_used = -1
+            for n in itertools.chain(self._address_usage[for_change].used, [num_addr]):
+                start = prev_used + 1 + gap_limit
+                if start < n:
+                    found.update(get_addresses(slice_start=start, slice_stop=n))
+                prev_used = n
 
-        process_addresses(self.get_receiving_addresses(), self.gap_limit)
-        process_addresses(self.get_change_addresses(), self.gap_limit_for_change)
+        with self.lock:
+            process_addresses(0, self.gap_limit)
+            process_addresses(1, self.gap_limit_for_change)
         return found
 
     def get_address_index(self, address) -> Optional[Sequence[int]]:
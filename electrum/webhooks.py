@@ -0,0 +1,289 @@
+# Copyright (C) 2020 The Electrum developers
+# Distributed under the MIT software license, see the accompanying
+# file LICENCE or http://www.opensource.org/licenses/mit-license.php
+"""
+webhooks.py delivers webhooks: HTTP POSTs of JSON events, such as the
+address status changes of the Notifier.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict, deque
+from itertools import islice
+from typing import Dict, Deque, List, Optional, Set, TYPE_CHECKING
+
+from aiohttp import web
+from aiorpcx import TaskGroup
+
+from . import instrumentation
+from .logging import Logger
+from .network_stats import LatencyHistogram
+from .util import make_aiohttp_session, log_exceptions, ignore_exceptions
+
+if TYPE_CHECKING:
+    from .simple_config import SimpleConfig
+
+
+# number of deliveries running at a time ('webhook_concurrency'), each to a different URL
+WEBHOOK_CONCURRENCY = 4
+# maximum number of events sent in one POST ('webhook_batch_size').
+# If larger than 1, the body of each POST is a list of events.
+WEBHOOK_BATCH_SIZE = 1
+# events queued per URL, beyond which the oldest ones are dropped ('webhook_max_queue')
+WEBHOOK_MAX_QUEUE = 10_000
+# seconds before giving up on a POST ('webhook_timeout')
+WEBHOOK_TIMEOUT = 10
+# delay before the first retry of a failed delivery, doubled after each failure
+WEBHOOK_RETRY_DELAY = 1
+WEBHOOK_MAX_RETRY_DELAY = 600
+# consecutive failed deliveries to a URL, after which its queued events
+# are dropped ('webhook_max_attempts')
+WEBHOOK_MAX_ATTEMPTS = 20
+# seconds between two writes of the log of queued events, when it changed
+WEBHOOK_SAVE_INTERVAL = 1
+# the log is rewritten with the queued events only, when it has this many
+# records more than twice the number of queued events
+WEBHOOK_LOG_COMPACTION_THRESHOLD = 10_000
+
+
+class WebhookDispatcher(Logger):
+    """Delivers events to URLs. Events are queued per URL, and saved to disk,
+    so that they survive restarts. Events to the same URL are delivered in
+    order; a failed delivery is retried with exponential backoff, until
+    max_attempts consecutive failures.
+
+    The queues are saved as an append-only log of JSON records, one per line:
+    ["post", url, event] queues an event, ["pop", url, n] removes the first n
+    events of the queue of url.
+    """
+
+    def __init__(self, config: 'SimpleConfig', *, proxy: Optional[dict] = None):
+        Logger.__init__(self)
+        self.proxy = proxy
+        self.path = os.path.join(config.path, 'webhooks')
+        self.concurrency = config.get('webhook_concurrency', WEBHOOK_CONCURRENCY)
+        self.batch_size = config.get('webhook_batch_size', WEBHOOK_BATCH_SIZE)
+        self.max_queue_size = config.get('webhook_max_queue', WEBHOOK_MAX_QUEUE)
+        self.timeout = config.get('webhook_timeout', WEBHOOK_TIMEOUT)
+        self.max_attempts = config.get('webhook_max_attempts', WEBHOOK_MAX_ATTEMPTS)
+        self.queues = defaultdict(deque)  # type: Dict[str, Deque[dict]]
+        # URLs in the ready queue, being delivered, or waiting for a retry
+        self._scheduled = set()  # type: Set[str]
+        self._ready = asyncio.Queue()  # type: asyncio.Queue[str]
+        self._failures = defaultdict(int)  # type: Dict[str, int]
+        self._pending_records = []  # type: List[str]  # not written to the log yet
+        self._num_records = 0  # in the log, including the pending ones
+        self.taskgroup = None  # type: Optional[TaskGroup]
+        self.latency = LatencyHistogram()
+        self.stats = {
+            'events_delivered': 0,
+            'events_dropped': 0,
+            'requests_sent': 0,
+            'requests_failed': 0,
+        }
+        self._load()
+
+    def _load(self) -> None:
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        op, url, arg = json.loads(line)
+                        if op == 'post':
+                            self.queues[url].append(arg)
+                        elif op == 'pop':
+                            for i in range(min(arg, len(self.queues[url]))):
+                                self.queues[url].popleft()
+            except (OSError, ValueError) as e:
+                # e.g. the last record was being written when we stopped
+                self.logger.warning(f'cannot read queued webhooks: {e!r}')
+        for url, events in list(self.queues.items()):
+            if events:
+                self._schedule(url)
+            else:
+                del self.queues[url]
+        self._compact()
+
+    def _append(self, op: str, url: str, arg) -> None:
+        self._pending_records.append(json.dumps([op, url, arg]) + '\n')
+        self._num_records += 1
+
+    def _save(self) -> None:
+        if self._num_records > 2 * self._num_queued() + WEBHOOK_LOG_COMPACTION_THRESHOLD:
+            self._compact()
+        elif self._pending_records:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(self._pending_records)
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending_records = []
+
+    def _compact(self) -> None:
+        """Rewrites the log with the queued events only."""
+        self._pending_records = []
+        self._num_records = 0
+        for url, events in self.queues.items():
+            for event in events:
+                self._append('post', url, event)
+        temp_path = '%s.tmp.%s' % (self.path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.writelines(self._pending_records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._pending_records = []
+
+    def _num_queued(self) -> int:
+        return sum(len(events) for events in self.queues.values())
+
+    def _schedule(self, url: str) -> None:
+        if url in self._scheduled:
+            return
+        self._scheduled.add(url)
+        self._ready.put_nowait(url)
+
+    def post(self, url: str, event: dict) -> None:
+        """Queues event for delivery to url."""
+        queue = self.queues[url]
+        queue.append(event)
+        self._append('post', url, event)
+        if len(queue) > self.max_queue_size:
+            queue.popleft()
+            self._append('pop', url, 1)
+            self.stats['events_dropped'] += 1
+            instrumentation.count('webhooks.events_dropped')
+        self._schedule(url)
+
+    def get_stats(self) -> dict:
+        return dict(
+            self.stats,
+            events_queued=self._num_queued(),
+            urls_failing=sum(1 for n in self._failures.values() if n),
+            latency=self.latency.to_json(),
+        )
+
+    @ignore_exceptions
+    @log_exceptions
+    async def run(self):
+        headers = {'content-type': 'application/json'}
+        async with make_aiohttp_session(proxy=self.proxy, headers=headers, timeout=self.timeout) as session:
+            self.taskgroup = TaskGroup()
+            try:
+                async with self.taskgroup as group:
+                    for i in range(self.concurrency):
+                        await group.spawn(self._deliver_forever(session))
+                    await group.spawn(self._save_periodically())
+            finally:
+                self._save()
+
+    async def stop(self):
+        if self.taskgroup:
+            await self.taskgroup.cancel_remaining()
+        self._save()
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(WEBHOOK_SAVE_INTERVAL)
+            self._save()
+
+    async def _deliver_forever(self, session):
+        while True:
+            url = await self._ready.get()
+            events = list(islice(self.queues[url], self.batch_size))
+            if not events:
+                self._scheduled.discard(url)
+                del self.queues[url]
+                continue
+            if await self._deliver(session, url, events):
+                self._failures.pop(url, None)
+                num_delivered = 0
+                for event in events:
+                    # the queue may have been trimmed meanwhile
+                    if self.queues[url] and self.queues[url][0] is event:
+                        self.queues[url].popleft()
+                        num_delivered += 1
+                if num_delivered:
+                    self._append('pop', url, num_delivered)
+                self._ready.put_nowait(url)
+            elif self._failures[url] + 1 >= self.max_attempts:
+                self._failures.pop(url, None)
+                num_dropped = len(self.queues[url])
+                self.logger.warning(f'giving up on {url} after {self.max_attempts} attempts, '
+                                    f'dropping {num_dropped} events')
+                self.queues[url].clear()
+                self._append('pop', url, num_dropped)
+                self.stats['events_dropped'] += num_dropped
+                instrumentation.count('webhooks.events_dropped', num_dropped)
+                # removes the empty queue
+                self._ready.put_nowait(url)
+            else:
+                self._failures[url] += 1
+                delay = min(WEBHOOK_RETRY_DELAY * 2 ** (self._failures[url] - 1), WEBHOOK_MAX_RETRY_DELAY)
+                asyncio.get_event_loop().call_later(delay, self._ready.put_nowait, url)
+
+    async def _deliver(self, session, url: str, events) -> bool:
+        data = events if self.batch_size > 1 else events[0]
+        self.stats['requests_sent'] += 1
+        start_time = time.monotonic()
+        try:
+            async with session.post(url, json=data) as resp:
+                await resp.text()
+                if resp.status >= 300:
+                    raise Exception(f'HTTP status {resp.status}')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats['requests_failed'] += 1
+            instrumentation.count('webhooks.requests_failed')
+            self.logger.info(f'failed to deliver {len(events)} events to {url}: {e!r}')
+            return False
+        self.latency.add(time.monotonic() - start_time)
+        self.stats['events_delivered'] += len(events)
+        instrumentation.count('webhooks.events_delivered', len(events))
+        return True
+
+
+class WebhookReceiver(Logger):
+    """Local HTTP server recording the webhooks it receives, to test deliveries.
+    A fraction error_rate of the requests get an HTTP 500 error.
+    """
+
+    def __init__(self, *, error_rate: float = 0.0, seed=None):
+        Logger.__init__(self)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.received = []  # type: list  # (path, body) of the requests answered with success
+        self.num_requests = 0
+        self.num_errors = 0
+        self.runner = None  # type: Optional[web.AppRunner]
+        self.port = None  # type: Optional[int]
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/'
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post('/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.logger.info(f'listening on {self.url}')
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def handle(self, request):
+        self.num_requests += 1
+        body = await request.json()
+        if self.random.random() < self.error_rate:
+            self.num_errors += 1
+            return web.Response(text='injected error', status=500)
+        self.received.append((request.path, body))
+        self.logger.info(f'received {request.path} {body}')
+        return web.Response(text='ok')